@@ -0,0 +1,267 @@
+"""
+
+BandwidthSchedule - Time of day bandwidth limits
+
+Windows defined in the config file via defineBandwidthWindow() map weekdays and a time
+range to a max rate, or to pausing the downloader altogether. The BandwidthScheduler
+checks them every minute, and applies the rate of the window currently in effect
+(Hellanzb.MAX_RATE outside of any window)
+
+Changes are only made when a window begins or ends: a maxrate/pause/continue made via
+XML-RPC during a window stays in effect until the next window change
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import time, Hellanzb
+from twisted.internet import reactor
+from Hellanzb.Log import *
+from Hellanzb.Util import FatalError
+
+__id__ = '$Id$'
+
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+DAY_ALIASES = {'daily': DAYS, 'all': DAYS, '*': DAYS,
+               'weekdays': DAYS[:5], 'weekends': DAYS[5:]}
+
+# The rate of windows that pause the downloader
+PAUSED = 'paused'
+
+def dayIndex(name):
+    """ Return the weekday number (0 == Monday) of the specified day name """
+    try:
+        return DAYS.index(name.strip()[:3])
+    except ValueError:
+        raise ValueError('invalid day: %s' % name)
+
+def parseDays(days):
+    """ Parse the days of a window into a list of weekday numbers (0 == Monday). Accepts
+    day names, ranges of them (which may wrap around the week) and DAY_ALIASES, separated
+    by commas, or a list of those: 'mon-fri', 'sat,sun', 'fri-mon', 'daily' """
+    if isinstance(days, basestring):
+        days = days.split(',')
+
+    weekdays = []
+    for day in days:
+        day = day.strip().lower()
+        if day in DAY_ALIASES:
+            names = DAY_ALIASES[day]
+        elif '-' in day:
+            first, last = [dayIndex(name) for name in day.split('-', 1)]
+            names = [DAYS[(first + i) % 7] for i in range((last - first) % 7 + 1)]
+        else:
+            names = [day[:3]]
+
+        for name in names:
+            weekday = dayIndex(name)
+            if weekday not in weekdays:
+                weekdays.append(weekday)
+
+    if not len(weekdays):
+        raise ValueError('no days specified')
+    weekdays.sort()
+    return weekdays
+
+def parseTime(hourMinute):
+    """ Parse a 'HH:MM' time of day (24 hour clock) into minutes since midnight. '24:00'
+    denotes the end of the day """
+    hour, minute = [int(part) for part in hourMinute.split(':')]
+    if hour < 0 or minute < 0 or minute > 59 or hour * 60 + minute > 24 * 60:
+        raise ValueError('invalid time: %s' % hourMinute)
+    return hour * 60 + minute
+
+def parseRate(rate):
+    """ Parse the rate of a window into KB/s (0 for unlimited), or PAUSED """
+    if rate is None or str(rate).lower() == 'unlimited':
+        return 0
+    if str(rate).lower() == PAUSED:
+        return PAUSED
+
+    rate = int(rate)
+    if rate < 0:
+        raise ValueError('invalid rate: %i' % rate)
+    elif rate == 0:
+        # A zero rate window stops downloading altogether
+        return PAUSED
+    return rate
+
+def formatTime(minutes):
+    """ Format minutes since midnight as 'HH:MM' """
+    return '%02i:%02i' % (minutes / 60, minutes % 60)
+
+class BandwidthWindow:
+    """ A time range on the specified weekdays, with its own max rate """
+    def __init__(self, days, start, end, rate):
+        self.days = parseDays(days)
+        self.start = parseTime(start)
+        self.end = parseTime(end)
+        self.rate = parseRate(rate)
+
+    def contains(self, weekday, minute):
+        """ Whether or not the specified minute (since midnight) of the weekday falls within
+        this window """
+        if self.start < self.end:
+            return weekday in self.days and self.start <= minute < self.end
+
+        # Windows ending on or before their start time run past midnight, into the
+        # following day
+        return (weekday in self.days and minute >= self.start) or \
+            ((weekday - 1) % 7 in self.days and minute < self.end)
+
+    def rateString(self):
+        if self.rate == PAUSED:
+            return PAUSED
+        elif self.rate == 0:
+            return 'unlimited'
+        return '%iKB/s' % self.rate
+
+    def __str__(self):
+        return '%s %s-%s: %s' % (','.join([DAYS[day] for day in self.days]),
+                                 formatTime(self.start), formatTime(self.end),
+                                 self.rateString())
+
+def defineBandwidthWindow(days, start, end, rate):
+    """ Define a window of the bandwidth schedule (called from the config file) """
+    try:
+        window = BandwidthWindow(days, start, end, rate)
+    except (ValueError, AttributeError), e:
+        error('Problem in config file with defineBandwidthWindow(%s, %s, %s, %s): %s' % \
+              (repr(days), repr(start), repr(end), repr(rate), str(e)))
+        raise FatalError('Invalid bandwidth window')
+    Hellanzb.BANDWIDTH_SCHEDULE.append(window)
+
+class BandwidthScheduler:
+    """ Applies the rate of the bandwidth window in effect, checking the schedule every
+    minute """
+    CHECK_INTERVAL = 60
+
+    def __init__(self, windows):
+        self.windows = windows
+        self.started = False
+        # The window in effect as of the last check (None when outside all windows)
+        self.current = None
+        # Whether or not the current window paused the downloader
+        self.pausedDownload = False
+        self.checkID = None
+
+    def start(self):
+        """ Apply the current window, and begin checking the schedule """
+        info('Bandwidth schedule: %i window(s) defined' % len(self.windows))
+        self.check()
+
+    def stop(self):
+        if self.checkID is not None and self.checkID.active():
+            self.checkID.cancel()
+        self.checkID = None
+
+    def windowAt(self, when):
+        """ Return the window in effect at the specified time, None if no window is. The
+        first defined of overlapping windows wins """
+        localTime = time.localtime(when)
+        minute = localTime.tm_hour * 60 + localTime.tm_min
+        for window in self.windows:
+            if window.contains(localTime.tm_wday, minute):
+                return window
+        return None
+
+    def nextChange(self, now = None):
+        """ Return a tuple of the time the window in effect next changes, and the window
+        taking effect then (None when returning to the default rate). Returns None when the
+        schedule never changes """
+        if now is None:
+            now = time.time()
+        current = self.windowAt(now)
+
+        localTime = time.localtime(now)
+        changes = []
+        # A week and a day covers windows running past midnight
+        for day in range(8):
+            for window in self.windows:
+                for minute in (window.start, window.end):
+                    changes.append(time.mktime((localTime.tm_year, localTime.tm_mon,
+                                                localTime.tm_mday + day, minute / 60,
+                                                minute % 60, 0, 0, 0, -1)))
+        changes.sort()
+
+        for change in changes:
+            if change <= now:
+                continue
+            window = self.windowAt(change)
+            if window is not current:
+                return change, window
+        return None
+
+    def check(self):
+        """ Apply the window in effect should it have changed, then schedule the next
+        check (at the beginning of the next minute) """
+        now = time.time()
+        window = self.windowAt(now)
+        if not self.started or window is not self.current:
+            self.started = True
+            self.current = window
+            self.apply(window)
+
+        self.checkID = reactor.callLater(self.CHECK_INTERVAL - now % self.CHECK_INTERVAL + 0.1,
+                                         self.check)
+
+    def apply(self, window):
+        """ Apply the rate of the specified window (the default rate when None) """
+        from Hellanzb.Daemon import continueCurrent, pauseCurrent
+        if window is None:
+            rate = Hellanzb.MAX_RATE
+            info('Bandwidth schedule: outside of all windows, max rate: %s' % \
+                 (rate and '%iKB/s' % rate or 'unlimited'))
+        else:
+            rate = window.rate
+            info('Bandwidth schedule: entering window: %s' % window)
+
+        if rate == PAUSED:
+            if not Hellanzb.downloadPaused:
+                pauseCurrent()
+                self.pausedDownload = True
+            return
+
+        if self.pausedDownload:
+            # Only continue downloads this scheduler paused
+            self.pausedDownload = False
+            if Hellanzb.downloadPaused:
+                continueCurrent()
+        Hellanzb.ht.setReadLimit(rate * 1024)
+
+    def windowStatus(self, window):
+        """ Return a dict describing the specified window, for the XML-RPC status call """
+        if window is None:
+            return {'window': 'default', 'paused': False, 'rate': Hellanzb.MAX_RATE}
+        return {'window': str(window), 'paused': window.rate == PAUSED,
+                'rate': window.rate != PAUSED and window.rate or 0}
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
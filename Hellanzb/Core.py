@@ -20,10 +20,12 @@ from shutil import rmtree
 from socket import gethostname
 from threading import Lock
 from twisted.internet import reactor
+from Hellanzb.BandwidthSchedule import defineBandwidthWindow
 from Hellanzb.Daemon import initDaemon, postProcess
 from Hellanzb.HellaXMLRPC import hellaRemote, initXMLRPCClient
 from Hellanzb.Log import *
 from Hellanzb.Logging import initLogging, stdinEchoOn
+from Hellanzb.NZBQueue import flushStateXML
 from Hellanzb.PostProcessorUtil import defineMusicType
 from Hellanzb.Util import *
 
@@ -146,6 +148,37 @@ def loadConfig(fileName):
             Hellanzb.DISABLE_ANSI = False
 
         Hellanzb.CACHE_LIMIT = unPrettyBytes(getattr(Hellanzb, 'CACHE_LIMIT', 0))
+        Hellanzb.SPILL_LIMIT = unPrettyBytes(getattr(Hellanzb, 'SPILL_LIMIT', 0))
+        Hellanzb.SPILL_MIN_FREE = unPrettyBytes(getattr(Hellanzb, 'SPILL_MIN_FREE', '64MB'))
+
+        if not hasattr(Hellanzb, 'DECODE_THREADS') or Hellanzb.DECODE_THREADS < 1:
+            Hellanzb.DECODE_THREADS = 1
+
+        if not hasattr(Hellanzb, 'DECODE_BACKLOG_LIMIT') or Hellanzb.DECODE_BACKLOG_LIMIT < 0:
+            Hellanzb.DECODE_BACKLOG_LIMIT = 200
+
+        if not hasattr(Hellanzb, 'DIRECT_PLACEMENT'):
+            Hellanzb.DIRECT_PLACEMENT = False
+
+        if not hasattr(Hellanzb, 'ENDGAME_HEDGING'):
+            Hellanzb.ENDGAME_HEDGING = True
+
+        if not hasattr(Hellanzb, 'NZB_CACHE'):
+            Hellanzb.NZB_CACHE = True
+
+        if not hasattr(Hellanzb, 'STREAM_NZB_PARSE'):
+            Hellanzb.STREAM_NZB_PARSE = False
+
+        if not hasattr(Hellanzb, 'SEGMENT_JOURNAL'):
+            Hellanzb.SEGMENT_JOURNAL = True
+
+        if not hasattr(Hellanzb, 'STATE_XML_WRITE_DELAY'):
+            Hellanzb.STATE_XML_WRITE_DELAY = 1
+
+        if not hasattr(Hellanzb, 'DOWNLOAD_WORKERS') or Hellanzb.DOWNLOAD_WORKERS < 1 or \
+                isWindows():
+            # Download worker processes talk to the daemon over a UNIX socket
+            Hellanzb.DOWNLOAD_WORKERS = 0
 
         if not hasattr(Hellanzb, 'OTHER_NZB_FILE_TYPES'):
             # By default, just match .nzb files in the queue dir
@@ -257,6 +290,9 @@ def init(options = {}):
     # defineServer's from the config file
     Hellanzb.SERVERS = {}
 
+    # defineBandwidthWindow's from the config file
+    Hellanzb.BANDWIDTH_SCHEDULE = []
+
     # we can compare the current thread's ident to our MAIN_THREAD's to determine whether
     # or not we may need to route things through twisted's callFromThread
     Hellanzb.MAIN_THREAD_IDENT = thread.get_ident()
@@ -432,6 +468,9 @@ def finishShutdown():
     # Just in case we left it off
     stdinEchoOn()
 
+    # Don't lose any state changes still waiting to be written
+    flushStateXML()
+
     if hasattr(Hellanzb, 'DOWNLOAD_TEMP_DIR'):
         # Remove the temporary files with the encoded data. Any errors causing hellanzb to
         # shut down prematurely (like can't bind to specific port -- maybe another
@@ -525,6 +564,10 @@ def parseArgs():
                       help='specify the rpc server password (overwrites Hellanzb.XMLRPC_PASSWORD config file setting)')
     parser.add_option('-t', '--rpc-port', type='int', dest='rpcPort',
                       help='specify the rpc server port (overwrites Hellanzb.XMLRPC_PORT config file setting)')
+    if not isWindows():
+        # Internal: run as one of the daemon's download worker processes
+        parser.add_option('--download-worker', type='string', dest='downloadWorker',
+                          help=optparse.SUPPRESS_HELP)
     if optcomplete:
         optcomplete.autocomplete(parser)
     return parser.parse_args()
@@ -532,7 +575,12 @@ def parseArgs():
 def processArgs(options, args):
     """ By default (no args) run the daemon. Otherwise we could be making an XML RPC call, or
     calling a PostProcessor on the specified dir then exiting """
-    if not len(args) and not options.postProcessDir:
+    if getattr(options, 'downloadWorker', None):
+        # Spawned by the daemon (Hellanzb.DOWNLOAD_WORKERS)
+        from Hellanzb.NZBLeecher.Sharding import runShardWorker
+        runShardWorker(options.downloadWorker)
+
+    elif not len(args) and not options.postProcessDir:
         Hellanzb.IS_DOWNLOADER = True
         
         if getattr(options, 'daemonize', False):
@@ -13,7 +13,7 @@ from Hellanzb.HellaXMLRPC import initXMLRPCServer, HellaXMLRPCServer
 from Hellanzb.Log import *
 from Hellanzb.Logging import prettyException, LogOutputStream
 from Hellanzb.NZBQueue import dequeueNZBs, recoverStateFromDisk, parseNZB, \
-    scanQueueDir, writeStateXML
+    scanQueueDir, writeStateXML, StateXMLWriter
 from Hellanzb.Util import archiveName, daemonize, ensureDirs, getMsgId, hellaRename, \
     isWindows, prettyElapsed, prettySize, touch, validNZB, IDPool
 
@@ -32,6 +32,11 @@ def ensureDaemonDirs():
             
     ensureDirs(dirNames)
 
+    if Hellanzb.NZB_CACHE:
+        # Not cleaned on startup: the cache persists across restarts
+        Hellanzb.NZB_CACHE_DIR = os.path.join(Hellanzb.TEMP_DIR, 'nzb-cache')
+        ensureDirs({'NZB_CACHE_DIR': Hellanzb.NZB_CACHE_DIR})
+
     if hasattr(Hellanzb, 'QUEUE_LIST'):
         if not hasattr(Hellanzb, 'STATE_XML_FILE'):
             Hellanzb.STATE_XML_FILE = Hellanzb.QUEUE_LIST
@@ -87,6 +92,9 @@ def initDaemon():
         from Hellanzb.Core import shutdownAndExit
         shutdownAndExit(1)
 
+    Hellanzb.stateXMLWriter = StateXMLWriter(Hellanzb.STATE_XML_FILE,
+                                             Hellanzb.STATE_XML_WRITE_DELAY)
+
     reactor.callLater(0, info, 'hellanzb - Now monitoring queue...')
     reactor.callLater(0, notify, 'Queue', 'hellanzb', 'Now monitoring queue..', False)
     # Twisted does not guarantee callLater(0, first); callLater(0, second) will run in
@@ -109,6 +117,11 @@ def initDaemon():
     if hasattr(Hellanzb, 'HELLAHELLA_CONFIG'):
         initHellaHella(Hellanzb.HELLAHELLA_CONFIG)
     
+    if len(Hellanzb.BANDWIDTH_SCHEDULE):
+        from Hellanzb.BandwidthSchedule import BandwidthScheduler
+        Hellanzb.bandwidthScheduler = BandwidthScheduler(Hellanzb.BANDWIDTH_SCHEDULE)
+        reactor.callLater(0, Hellanzb.bandwidthScheduler.start)
+
     from Hellanzb.NZBLeecher import initNZBLeecher, startNZBLeecher
     initNZBLeecher()
     startNZBLeecher()
@@ -274,13 +287,26 @@ def beginDownload(nzb=None):
 
     Hellanzb.downloading = True
 
+def downloadIdle():
+    """ All of the factories ran out of segments to download: the download is finished,
+    unless an NZB is still being streamed into the queue. Its parser queues more segments
+    (waking the factories), or ends the download once it's done (see
+    NZBSegmentQueue._streamedNZB) """
+    for nzb in Hellanzb.queue.currentNZBs():
+        if nzb.parsing:
+            return
+    endDownload()
+
 def endDownload():
     """ Finished downloading """
     Hellanzb.ht.rate = 0
+    Hellanzb.ht.endDownload()
     sessionStartTime = None
     sessionReadBytes = 0
+    sessionWireBytes = 0
     for nsf in Hellanzb.nsfs:
         sessionReadBytes += nsf.sessionReadBytes
+        sessionWireBytes += nsf.sessionWireBytes
         if nsf.fillServerPriority == 0:
             sessionStartTime = nsf.sessionStartTime
         nsf.endDownload()
@@ -305,6 +331,8 @@ def endDownload():
     info('Transferred %s in %s at %.1fKB/s (%s)' % \
          (prettySize(sessionReadBytes), prettyElapsed(downloadTime), speed,
           currentNZB.archiveName))
+    if sessionWireBytes < sessionReadBytes:
+        info('(compressed to %s over the wire)' % prettySize(sessionWireBytes))
     if not currentNZB.isParRecovery:
         currentNZB.downloadTime = downloadTime
     else:
@@ -320,17 +348,7 @@ def disconnectUnAntiIdleFactories():
     for nsf in Hellanzb.nsfs:
         debug('Empty NZB queue: disconnecting %s (antiIdle is 0)' % nsf.serverPoolName)
         if nsf.antiIdleTimeout == 0:
-            for client in nsf.clients:
-                client.transport.loseConnection()
-
-                # NOTE: WEIRD: after pool-coop branch, I have to force this to prevent
-                # fetchNextNZBSegment from re-calling the fetch loop (it gets called
-                # twice. the parseNZB->beginDownload->fetchNext call is made before
-                # the client gets to call connectionLost). or has this problem always
-                # existed??? See r403
-                client.isLoggedIn = False
-
-                client.deactivate()
+            nsf.disconnectClients()
 
 def handleNZBDone(nzb):
     """ Hand-off from the downloader -- make a dir for the NZB with its contents, then post
@@ -344,6 +362,10 @@ def handleNZBDone(nzb):
         else:
             nzb.downloadAndDecodeTime += downloadAndDecodeTime
     
+    # Nothing left to resume
+    from Hellanzb.NZBLeecher.SegmentJournal import removeJournal
+    removeJournal(nzb)
+
     # Make our new directory, minus the .nzb
     processingDir = os.path.join(Hellanzb.PROCESSING_DIR, nzb.archiveName)
     
@@ -351,6 +373,7 @@ def handleNZBDone(nzb):
     hellaRename(processingDir)
         
     move(Hellanzb.WORKING_DIR, processingDir)
+    Hellanzb.workingDirIndex.invalidate()
     nzb.destDir = processingDir
     nzb.archiveDir = processingDir
 
@@ -417,11 +440,13 @@ def cancelCurrent():
     if not isActive():
         return True
     
+    from Hellanzb.NZBLeecher.SegmentJournal import removeJournal
     canceled = False
     for nzb in Hellanzb.queue.currentNZBs():
         # FIXME: should GC here
         canceled = True
         nzb.cancel()
+        removeJournal(nzb)
         os.remove(nzb.nzbFileName)
         info('Canceling download: ' + nzb.archiveName)
     Hellanzb.queue.cancel()
@@ -429,6 +454,7 @@ def cancelCurrent():
         hellaRename(os.path.join(Hellanzb.TEMP_DIR, 'canceled_WORKING_DIR'))
         move(Hellanzb.WORKING_DIR, os.path.join(Hellanzb.TEMP_DIR, 'canceled_WORKING_DIR'))
         os.mkdir(Hellanzb.WORKING_DIR)
+        Hellanzb.workingDirIndex.invalidate()
         rmtree(os.path.join(Hellanzb.TEMP_DIR, 'canceled_WORKING_DIR'))
     except Exception, e:
         error('Problem while canceling WORKING_DIR', e)
@@ -437,17 +463,7 @@ def cancelCurrent():
         debug('ERROR: isActive was True but canceled nothing (no active nzbs!??)')
 
     for nsf in Hellanzb.nsfs:
-        clients = nsf.activeClients.copy()
-        for client in clients:
-            client.transport.loseConnection()
-            
-            # NOTE: WEIRD: after pool-coop branch, I have to force this to prevent
-            # fetchNextNZBSegment from re-calling the fetch loop (it gets called
-            # twice. the parseNZB->beginDownload->fetchNext call is made before the client
-            # gets to call connectionLost). or has this problem always existed??? See r403
-            client.isLoggedIn = False
-            
-            client.deactivate()
+        nsf.disconnectClients(justActive = True)
             
     writeStateXML()
     reactor.callLater(0, scanQueueDir)
@@ -459,8 +475,7 @@ def pauseCurrent():
     Hellanzb.downloadPaused = True
 
     for nsf in Hellanzb.nsfs:
-        for client in nsf.clients:
-            client.transport.stopReading()
+        nsf.pauseDownload()
 
     info('Pausing downloader')
     return True
@@ -472,53 +487,7 @@ def continueCurrent():
 
     resetConnections = 0
     for nsf in Hellanzb.nsfs:
-        connectionCount = nsf.connectionCount
-        # XXX:
-        debug('%s: connectionCount: %i' % (nsf.serverPoolName, connectionCount))
-        for client in nsf.clients:
-
-            # When we pause a download, we simply stop reading from the socket. That
-            # causes the connection to become lost fairly quickly. When that happens a new
-            # client is created with the flag pauseReconnected=True. This new client acts
-            # normally (anti idles the connection, etc) except it does not enter the
-            # fetchNextNZBSegment loop. Thus when we encounter these clients we simply
-            # tell them to begin downloading
-            if client.pauseReconnected:
-                debug(str(client) + ' pauseReconnect')
-                client.pauseReconnected = False
-                reactor.callLater(0, client.fetchNextNZBSegment)
-            else:
-                # Otherwise this was a short pause, the connection hasn't been lost, and
-                # we can simply continue reading from the socket
-                debug(str(client) + ' startReading')
-                client.transport.startReading()
-                connectionCount -= 1
-
-        if nsf.clients:        
-            resetConnections += connectionCount
-        # XXX:
-        debug('resetConnections(%s): %i: added %i' % (nsf.serverPoolName, resetConnections,
-                                                      connectionCount))
-
-        # Reconnect (antiIdleTimeout == 0) NZBLeechers
-        if nsf.antiIdleTimeout == 0:
-            reconnecting = []
-            for connector in nsf.leecherConnectors:
-                # Reconnect if it's the main (fillserver==0) factory, or the
-                # client explicitly idled out during the connection
-                # (pauseIdledOut)
-                if nsf.fillServerPriority == 0 or getattr(connector, 'pauseIdledOut',
-                                                          False):
-                    debug(str(connector) + ' pauseIdledOut')
-                    connector.pauseIdledOut = False
-                    connector.connect()
-                    reconnecting.append(connector)
-            for connector in reconnecting:
-                nsf.leecherConnectors.remove(connector)
-            resetConnections += len(reconnecting)
-            # XXX:
-            debug('>resetConnections(%s): %i: added %i' % (nsf.serverPoolName, resetConnections,
-                                                           len(reconnecting)))
+        resetConnections += nsf.continueDownload()
 
     Hellanzb.downloadPaused = False
     if resetConnections:
@@ -565,29 +534,34 @@ def maxRate(rate):
         
     info('Resetting MAX_RATE to: ' + str(rate) + 'KB/s')
     
-    rate = rate * 1024
-        
-    restartCheckRead = False
-    if rate == 0:
-        if Hellanzb.ht.unthrottleReadsID is not None and \
-                not Hellanzb.ht.unthrottleReadsID.cancelled and \
-                not Hellanzb.ht.unthrottleReadsID.called:
-            Hellanzb.ht.unthrottleReadsID.cancel()
-
-        if Hellanzb.ht.checkReadBandwidthID is not None and \
-            not Hellanzb.ht.checkReadBandwidthID.cancelled:
-            Hellanzb.ht.checkReadBandwidthID.cancel()
-        Hellanzb.ht.unthrottleReads()
-    elif Hellanzb.ht.readLimit == 0 and rate > 0:
-        restartCheckRead = True
-        
-    Hellanzb.ht.readLimit = rate
-
-    if restartCheckRead:
-        Hellanzb.ht.readThisSecond = 0 # nobody's been resetting this value
-        reactor.callLater(1, Hellanzb.ht.checkReadBandwidth)
+    Hellanzb.ht.setReadLimit(rate * 1024)
     return getRate()
 
+def nzbMaxRate(nzbId, rate = None):
+    """ Change the maxRate of the currently downloading NZB with the specified ID. Return the
+    new value (-1 when the NZB isn't downloading) """
+    try:
+        nzbId = int(nzbId)
+    except:
+        debug('Invalid ID: ' + str(nzbId))
+        return -1
+
+    if rate == 'None':
+        rate = 0
+    elif rate is not None:
+        try:
+            rate = max(0, int(rate))
+        except:
+            rate = None
+
+    for nzb in Hellanzb.queue.currentNZBs():
+        if nzb.id == nzbId:
+            if rate is not None:
+                info('Resetting ' + nzb.archiveName + ' maxRate to: ' + str(rate) + 'KB/s')
+                nzb.maxRate = rate * 1024
+            return nzb.maxRate / 1024
+    return -1
+
 def setRarPassword(nzbId, rarPassword):
     """ Set the rarPassword on the specified NZB or NZB archive """
     try:
@@ -1,7 +1,8 @@
 """
 
-HellaReactor - Custom reactor (extends the default SelectReactor). Ties into the twisted
-reactor system so it can catch signals, and shutdown hellanzb cleanly
+HellaReactor - Custom reactor (extends the default SelectReactor, or the EPollReactor on
+Linux). Ties into the twisted reactor system so it can catch signals, and shutdown hellanzb
+cleanly
 
 (c) Copyright 2005 Philip Jenvey
 [See end of file]
@@ -18,7 +19,13 @@ else:
     from twisted.internet.default import _NO_FILENO
     from twisted.internet.default import _NO_FILEDESC
 
-from twisted.internet.main import installReactor
+try:
+    from twisted.internet.epollreactor import EPollReactor
+except ImportError:
+    # Not Linux, or twisted is too old (or lacks its _epoll extension)
+    EPollReactor = None
+
+from twisted.internet.main import CONNECTION_LOST, installReactor
 from twisted.python import log, failure
 from Hellanzb.Log import *
 
@@ -43,8 +50,8 @@ __id__ = '$Id$'
 #You can return a Deferred from your shutdown function and Twisted will
 #wait until it's got a result before shutting down.
 
-class HellaReactor(SelectReactor):
-    """ Handle taking care of PostProcessors during a SIGINT """
+class HellaReactorMixin:
+    """ Signal handling and IOError handling common to the HellaReactors """
 
     def sigInt(self, *args):
         """ Core's signal handler will shut the app down appropriately (including the reactor) """
@@ -61,6 +68,32 @@ class HellaReactor(SelectReactor):
         reactor.callLater(0, shutdown, **dict(killPostProcessors = True,
                                               message = 'Caught SIGTERM, exiting..'))
 
+    def handleIOError(self, selectable, ioe):
+        """ Handle OutOfDiskSpace IOErrors raised while reading from an NZBLeecher. Returns
+        True if the NZBLeecher has been disconnected (and the IOError was dealt with) """
+        # NOTE: Importing this in the module causes TimeoutMixin to not work. ???
+        from twisted.protocols.policies import ThrottlingProtocol
+            
+        # Handle OutOfDiskSpace exceptions. Piggybacking this check into the reactor
+        # here uses less CPU than try: excepting in NZBLeecher.dataReceived
+        if isinstance(getattr(selectable, 'protocol', None), ThrottlingProtocol):
+            from Hellanzb.Util import OutOfDiskSpace
+            from Hellanzb.NZBLeecher.ArticleDecoder import handleIOError
+            try:
+                handleIOError(ioe)
+            except OutOfDiskSpace:
+                # handleIOError would have just paused the downloader for us
+                selectable.protocol.wrappedProtocol.transport.loseConnection()
+                selectable.protocol.wrappedProtocol.isLoggedIn = False
+                selectable.protocol.wrappedProtocol.deactivate()
+                return True
+            except:
+                pass
+        return False
+
+class HellaReactor(HellaReactorMixin, SelectReactor):
+    """ Handle taking care of PostProcessors during a SIGINT """
+
     def _doReadOrWrite(self, selectable, method, dict, faildict={
         error.ConnectionDone: failure.Failure(error.ConnectionDone()),
         error.ConnectionLost: failure.Failure(error.ConnectionLost())
@@ -74,24 +107,8 @@ class HellaReactor(SelectReactor):
             elif handfn() == -1:
                 why = _NO_FILEDESC
         except IOError, ioe:
-            # NOTE: Importing this in the module causes TimeoutMixin to not work. ???
-            from twisted.protocols.policies import ThrottlingProtocol
-            
-            # Handle OutOfDiskSpace exceptions. Piggybacking this check into the reactor
-            # here uses less CPU than try: excepting in NZBLeecher.dataReceived
-            if selectable.protocol.__class__ is ThrottlingProtocol:
-                from Hellanzb.Util import OutOfDiskSpace
-                from Hellanzb.NZBLeecher.ArticleDecoder import handleIOError
-                try:
-                    handleIOError(ioe)
-                except OutOfDiskSpace:
-                    # handleIOError would have just paused the downloader for us
-                    selectable.protocol.wrappedProtocol.transport.loseConnection()
-                    selectable.protocol.wrappedProtocol.isLoggedIn = False
-                    selectable.protocol.wrappedProtocol.deactivate()
-                    return
-                except:
-                    pass
+            if self.handleIOError(selectable, ioe):
+                return
             why = sys.exc_info()[1]
             log.err()
         except:
@@ -107,13 +124,64 @@ class HellaReactor(SelectReactor):
                 selectable.connectionLost(failure.Failure(why))
 
     def install(klass):
-        """ Install custom reactor """
+        """ Install custom reactor. The epoll based HellaEPollReactor is preferred on Linux:
+        its cost scales with the number of active connections, not the number of
+        connections (and it has no FD_SETSIZE limit) """
         if sys.modules.has_key('twisted.internet.reactor'):
             del sys.modules['twisted.internet.reactor']
-        Hellanzb.reactor = HellaReactor()
+
+        Hellanzb.reactor = None
+        if HellaEPollReactor is not None and sys.platform.startswith('linux'):
+            try:
+                Hellanzb.reactor = HellaEPollReactor()
+            except (IOError, OSError):
+                # epoll unsupported by the running kernel
+                pass
+        if Hellanzb.reactor is None:
+            Hellanzb.reactor = HellaReactor()
         installReactor(Hellanzb.reactor)
     install = classmethod(install)
 
+# epoll event masks (from sys/epoll.h)
+EPOLLIN = 0x001
+EPOLLOUT = 0x004
+EPOLLERR = 0x008
+EPOLLHUP = 0x010
+
+if EPollReactor is None:
+    HellaEPollReactor = None
+else:
+    class HellaEPollReactor(HellaReactorMixin, EPollReactor):
+        """ HellaReactor backed by epoll """
+
+        def _doReadOrWrite(self, selectable, fd, event):
+            """ Handle IOErrors/out of disk space """
+            why = None
+            inRead = False
+            if event & (EPOLLHUP | EPOLLERR) and not event & EPOLLIN:
+                why = CONNECTION_LOST
+            else:
+                try:
+                    if event & EPOLLIN:
+                        why = selectable.doRead()
+                        inRead = True
+                    if not why and event & EPOLLOUT:
+                        why = selectable.doWrite()
+                        inRead = False
+                    if selectable.fileno() != fd:
+                        why = error.ConnectionFdescWentAway('Filedescriptor went away')
+                        inRead = False
+                except IOError, ioe:
+                    if self.handleIOError(selectable, ioe):
+                        return
+                    why = sys.exc_info()[1]
+                    log.err()
+                except:
+                    why = sys.exc_info()[1]
+                    log.err()
+            if why:
+                self._disconnectSelectable(selectable, why, inRead)
+
 """
 Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
 All rights reserved.
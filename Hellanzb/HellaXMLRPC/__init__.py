@@ -86,6 +86,40 @@ class HellaXMLRPCServer(XMLRPC):
     xmlrpc_clear.signature = [ ['struct'],
                                ['struct', 'boolean'] ]
 
+    def xmlrpc_connections(self):
+        """ Return the number of connections open to each server, and the recent decisions of
+        the servers' connection scalers """
+        servers = []
+        for nsf in Hellanzb.nsfs:
+            serverStatus = {'server': nsf.serverPoolName,
+                            'host': '%s:%i' % (nsf.host, nsf.port),
+                            'open': len(nsf.clients),
+                            'active': len(nsf.activeClients),
+                            'parked': len(nsf.parkedConnectors),
+                            'autoscale': nsf.scaler is not None,
+                            'cost': nsf.cost,
+                            'maxrate': nsf.maxRate / 1024}
+            scaler = nsf.scaler
+            if scaler is not None:
+                serverStatus['connections'] = scaler.connections
+                serverStatus['min_connections'] = scaler.minConnections
+                serverStatus['max_connections'] = scaler.maxConnections
+                serverStatus['rate'] = int(scaler.rate / 1024)
+                serverStatus['client_rates'] = [int(scaler.clientRates[client] / 1024) \
+                                                for client in nsf.clients \
+                                                if client in scaler.clientRates]
+                serverStatus['decisions'] = [{'time': DateTime(decisionTime),
+                                              'action': action,
+                                              'connections': connections,
+                                              'rate': int(rate / 1024),
+                                              'reason': reason} \
+                                             for decisionTime, action, connections, rate, \
+                                                 reason in scaler.decisions]
+            servers.append(serverStatus)
+        return servers
+
+    xmlrpc_connections.signature = [ ['list'] ]
+
     def xmlrpc_continue(self):
         """ Continue downloading after being paused """
         from Hellanzb.Daemon import continueCurrent
@@ -222,6 +256,18 @@ class HellaXMLRPCServer(XMLRPC):
     xmlrpc_move.signature = [ ['list', 'string', 'string'],
                               ['list', 'int', 'int'] ]
     
+    def xmlrpc_nzbmaxrate(self, nzbId, rate = None):
+        """ Return the maximum download rate of the currently downloading NZB with the specified
+        ID. Specify a third argument to change the value -- a value of zero denotes no
+        maximum rate. Returns -1 when the NZB isn't currently downloading """
+        from Hellanzb.Daemon import nzbMaxRate
+        return nzbMaxRate(nzbId, rate)
+
+    xmlrpc_nzbmaxrate.signature = [ ['int', 'int'],
+                                    ['int', 'string'],
+                                    ['int', 'int', 'int'],
+                                    ['int', 'string', 'string'] ]
+
     def xmlrpc_next(self, nzbId):
         """ Move the NZB with the specified ID to the beginning of the queue """
         from Hellanzb.NZBQueue import listQueue, nextNZBId
@@ -315,11 +361,24 @@ class HellaXMLRPCServer(XMLRPC):
             s['maxrate'] = 0
         else:
             s['maxrate'] = Hellanzb.ht.readLimit / 1024
+
+        scheduler = getattr(Hellanzb, 'bandwidthScheduler', None)
+        if scheduler is not None:
+            s['bandwidth_window'] = scheduler.windowStatus(scheduler.current)
+            nextChange = scheduler.nextChange()
+            if nextChange is not None:
+                changeTime, window = nextChange
+                s['next_bandwidth_window'] = scheduler.windowStatus(window)
+                s['next_bandwidth_window']['begins'] = DateTime(changeTime)
+
+        s['article_cache'] = Hellanzb.articleCache.status()
+        s['decoder'] = Hellanzb.decodeBacklog.status()
             
         s['total_dl_nzbs'] = Hellanzb.totalArchivesDownloaded
         s['total_dl_files'] = Hellanzb.totalFilesDownloaded
         s['total_dl_segments'] = Hellanzb.totalSegmentsDownloaded
         s['total_dl_mb'] = Hellanzb.totalBytesDownloaded / 1024 / 1024
+        s['total_dl_wire_mb'] = Hellanzb.totalWireBytesDownloaded / 1024 / 1024
         s['config_file'] = Hellanzb.CONFIG_FILENAME
         s['hostname'] = Hellanzb.HOSTNAME
         s['version'] = Hellanzb.version
@@ -376,6 +435,26 @@ def printQueueListAndExit(remoteCall, result):
         return printResultAndExit(remoteCall, result)
     reactor.stop()
 
+def printConnectionsAndExit(remoteCall, result):
+    """ Print the result of the connections call """
+    for serverStatus in result:
+        line = '(%s) %s: %i open, %i active' % \
+            (serverStatus['server'], serverStatus['host'], serverStatus['open'],
+             serverStatus['active'])
+        if serverStatus['autoscale']:
+            line += ', %i parked -- scaling %i-%i, currently %i at %i KB/s' % \
+                (serverStatus['parked'], serverStatus['min_connections'],
+                 serverStatus['max_connections'], serverStatus['connections'],
+                 serverStatus['rate'])
+        noLogFile(line)
+
+        for decision in serverStatus.get('decisions', []):
+            t = decision['time'].value
+            noLogFile('  %s:%s:%s %s to %i connections at %i KB/s: %s' % \
+                      (t[9:11], t[12:14], t[15:17], decision['action'],
+                       decision['connections'], decision['rate'], decision['reason']))
+    reactor.stop()
+
 def resultMadeItBoolAndExit(remoteCall, result):
     """ generic xml rpc call back for a boolean result """
     if isinstance(result, bool):
@@ -617,6 +696,7 @@ def initXMLRPCClient():
     r = RemoteCall('asciiart', printResultAndExit, published = False)
     r = RemoteCall('cancel', statusString)
     r = RemoteCall('clear', statusString)
+    r = RemoteCall('connections', printConnectionsAndExit)
     r = RemoteCall('continue', statusString)
     r = RemoteCall('dequeue', printQueueListAndExit)
     r.addRequiredArg('nzbid')
@@ -642,6 +722,9 @@ def initXMLRPCClient():
     r.addRequiredArg('index')
     r = RemoteCall('next', printQueueListAndExit)
     r.addRequiredArg('nzbid')
+    r = RemoteCall('nzbmaxrate', printResultAndExit)
+    r.addRequiredArg('nzbid')
+    r.addOptionalArg('newrate')
     r = RemoteCall('pause', statusString)
     r = RemoteCall('process', statusString)
     r.addRequiredArg('archivedir')
@@ -397,6 +397,13 @@ class NZBLeecherTicker:
         paused = ''
         if Hellanzb.downloadPaused:
             paused = '%s [Paused]%s' % (ACODE.F_DCYAN, ACODE.RESET)
+        elif Hellanzb.decodeBacklog.depth() > Hellanzb.DECODE_THREADS:
+            # Segments are queueing up for the decoders
+            color = ACODE.F_DMAGENTA
+            if Hellanzb.decodeBacklog.backedUp:
+                color = ACODE.F_LRED
+            paused = '%s [Decoding: %i]%s' % (color, Hellanzb.decodeBacklog.depth(),
+                                              ACODE.RESET)
 
         totalSpeed = Hellanzb.getCurrentRate()
 
@@ -0,0 +1,312 @@
+"""
+
+ArticleCache - Accounting of downloaded article data waiting to be decoded
+
+Downloaded articles are held in memory (NZBSegment.encodedDataList) until a decode thread
+writes them out. The ArticleCache keeps all of them within one global budget
+(Hellanzb.CACHE_LIMIT): once the decoders fall far enough behind the downloader to fill it,
+articles are spilled to _ENC files in the DOWNLOAD_TEMP_DIR instead. Should the spilled
+articles then grow past Hellanzb.SPILL_LIMIT, or the DOWNLOAD_TEMP_DIR's free space fall
+under Hellanzb.SPILL_MIN_FREE, reads are paused until the decoders catch up
+
+The DecodeBacklog tracks the segments queued for the decode threads. Past
+Hellanzb.DECODE_BACKLOG_LIMIT of them, NZBLeechers stop pulling segments from the queue until
+the decoders catch up
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import os, time, Hellanzb
+from threading import Lock
+from twisted.internet import reactor
+from Hellanzb.Log import *
+from Hellanzb.Util import prettySize
+
+__id__ = '$Id$'
+
+class ArticleCache:
+    """ Decides where downloaded article data is cached (memory or disk), tallying the bytes
+    of both until they're decoded. Also tracks their high-water marks """
+    # How often (in seconds) paused reads are reconsidered, and the free space is checked
+    CHECK_INTERVAL = 1
+
+    def __init__(self, limit, spillLimit = 0, spillMinFree = 0):
+        # Max bytes of article data cached to memory (-1 for no limit, 0 to always cache
+        # to disk)
+        self.limit = limit
+        # Max bytes of article data cached to disk (0 for no limit), and the minimum free
+        # space of the DOWNLOAD_TEMP_DIR to leave
+        self.spillLimit = spillLimit
+        self.spillMinFree = spillMinFree
+
+        # Decode threads release bytes concurrently
+        self.lock = Lock()
+        self.memoryBytes = 0
+        self.spilledBytes = 0
+        self.memoryHighWater = 0
+        self.spilledHighWater = 0
+
+        # Whether or not reads are paused until the decoders catch up (see HellaThrottler),
+        # and why
+        self.readsPaused = False
+        self.pausedReason = None
+        self.checkID = None
+
+    def start(self):
+        """ Begin checking the free space and paused reads """
+        self.check()
+
+    def stop(self):
+        if self.checkID is not None and self.checkID.active():
+            self.checkID.cancel()
+        self.checkID = None
+
+    def cacheToMemory(self):
+        """ Whether or not the next downloaded article data should be cached to memory (as
+        opposed to disk) """
+        return self.limit < 0 or self.memoryBytes < self.limit
+
+    def store(self, segment):
+        """ Tally the article data of the specified segment, just downloaded (via the twisted
+        main thread) """
+        self.lock.acquire()
+        try:
+            self._release(segment)
+            segment.cachedArticleDataBytes = segment.readBytes
+            if segment.cachedToDisk:
+                self.spilledBytes += segment.readBytes
+                self.spilledHighWater = max(self.spilledHighWater, self.spilledBytes)
+            else:
+                self.memoryBytes += segment.readBytes
+                self.memoryHighWater = max(self.memoryHighWater, self.memoryBytes)
+        finally:
+            self.lock.release()
+
+        if not self.readsPaused and self.spillLimit > 0 and \
+                self.spilledBytes >= self.spillLimit:
+            self.pauseReads('%s of article data waiting on the decoders' % \
+                                prettySize(self.spilledBytes))
+
+    def release(self, segment):
+        """ The specified segment's article data was decoded (or discarded): untally it """
+        self.lock.acquire()
+        try:
+            self._release(segment)
+        finally:
+            self.lock.release()
+
+    def _release(self, segment):
+        if segment.cachedToDisk:
+            self.spilledBytes -= segment.cachedArticleDataBytes
+        else:
+            self.memoryBytes -= segment.cachedArticleDataBytes
+        segment.cachedArticleDataBytes = 0
+
+    def check(self):
+        """ Pause reads should the DOWNLOAD_TEMP_DIR run low on space, resume them once there's
+        room to cache article data again """
+        reason = None
+        if self.spillLimit > 0 and self.spilledBytes >= self.spillLimit:
+            reason = '%s of article data waiting on the decoders' % \
+                prettySize(self.spilledBytes)
+        elif self.spillMinFree > 0 and hasattr(os, 'statvfs'):
+            try:
+                stat = os.statvfs(Hellanzb.DOWNLOAD_TEMP_DIR)
+                free = stat.f_bavail * stat.f_frsize
+                if free < self.spillMinFree:
+                    reason = 'only %s free in the DOWNLOAD_TEMP_DIR' % prettySize(free)
+            except OSError:
+                pass
+
+        if reason is not None:
+            if not self.readsPaused:
+                self.pauseReads(reason)
+        elif self.readsPaused:
+            self.resumeReads()
+
+        self.checkID = reactor.callLater(self.CHECK_INTERVAL, self.check)
+
+    def pauseReads(self, reason):
+        self.readsPaused = True
+        self.pausedReason = reason
+        info('Pausing reads: %s' % reason)
+
+    def resumeReads(self):
+        self.readsPaused = False
+        self.pausedReason = None
+        info('Resuming reads')
+        Hellanzb.ht.unthrottleReads()
+
+    def status(self):
+        """ Return a dict describing the cache, for the XML-RPC status call """
+        return {'cached_mb': self.memoryBytes / 1024 / 1024,
+                'cached_high_water_mb': self.memoryHighWater / 1024 / 1024,
+                'spilled_mb': self.spilledBytes / 1024 / 1024,
+                'spilled_high_water_mb': self.spilledHighWater / 1024 / 1024,
+                'reads_paused': self.readsPaused}
+
+class DecodeBacklog:
+    """ Runs segments through the decodePool, tracking the ones waiting on (or being
+    decoded by) it, and the decode rate. Once more than limit are waiting, the backlog is
+    backedUp: the downloaders wait() on it, until it drains to RESUME_RATIO of the limit """
+    # How often (in seconds) the decode rate is updated
+    CHECK_INTERVAL = 1
+    RESUME_RATIO = 0.75
+
+    def __init__(self, limit = 0):
+        # Max number of segments waiting on the decoders (0 for no limit)
+        self.limit = limit
+
+        # Decode threads finish segments concurrently
+        self.lock = Lock()
+        # Times the pending segments were queued at, by job number
+        self.pending = {}
+        self.nextJob = 0
+
+        # Segments/bytes decoded since the last check, and the resulting rates
+        self.decodedSegments = 0
+        self.decodedBytes = 0
+        self.segmentRate = 0.0
+        self.rate = 0
+        self.lastCheck = time.time()
+
+        self.backedUp = False
+        # Functions to call (to continue downloading) once the backlog drains
+        self.waiting = []
+        self.checkID = None
+
+    def start(self):
+        """ Begin updating the decode rate """
+        self.lastCheck = time.time()
+        self.check()
+
+    def stop(self):
+        if self.checkID is not None and self.checkID.active():
+            self.checkID.cancel()
+        self.checkID = None
+
+    def depth(self):
+        """ Return the number of segments waiting on the decoders """
+        return len(self.pending)
+
+    def oldestAge(self):
+        """ Return how long (in seconds) the oldest pending segment has been waiting """
+        self.lock.acquire()
+        try:
+            if not len(self.pending):
+                return 0
+            return time.time() - self.pending[min(self.pending.keys())]
+        finally:
+            self.lock.release()
+
+    def defer(self, decodeFunc, segment):
+        """ Decode the segment via decodeFunc, in one of the decodePool's threads """
+        self.lock.acquire()
+        try:
+            job = self.nextJob
+            self.nextJob += 1
+            self.pending[job] = time.time()
+            depth = len(self.pending)
+        finally:
+            self.lock.release()
+
+        if self.limit > 0 and depth > self.limit and not self.backedUp:
+            self.backedUp = True
+            info('Decoder backlog: %i segments waiting, slowing the downloader' % depth)
+        Hellanzb.decodePool.callInThread(self.decode, job, decodeFunc, segment)
+
+    def decode(self, job, decodeFunc, segment):
+        """ Decode the segment (from one of the decodePool's threads) """
+        try:
+            decodeFunc(segment)
+        finally:
+            self.lock.acquire()
+            try:
+                del self.pending[job]
+                self.decodedSegments += 1
+                self.decodedBytes += segment.bytes
+                depth = len(self.pending)
+            finally:
+                self.lock.release()
+
+            if self.backedUp and depth <= self.limit * self.RESUME_RATIO:
+                reactor.callFromThread(self.drained)
+
+    def wait(self, resumeFunc):
+        """ Call resumeFunc once the backlog drains """
+        if resumeFunc not in self.waiting:
+            self.waiting.append(resumeFunc)
+
+    def drained(self):
+        """ Resume the downloaders waiting on the backlog """
+        if self.backedUp and self.depth() <= self.limit * self.RESUME_RATIO:
+            self.backedUp = False
+            info('Decoder backlog: caught up, resuming the downloader')
+        self.wake()
+
+    def wake(self):
+        if self.backedUp or Hellanzb.downloadPaused:
+            # continueCurrent doesn't know about the waiting downloaders, check() will
+            # resume them once the download is continued
+            return
+        waiting = self.waiting
+        self.waiting = []
+        for resumeFunc in waiting:
+            reactor.callLater(0, resumeFunc)
+
+    def check(self):
+        """ Update the decode rate """
+        now = time.time()
+        elapsed = max(now - self.lastCheck, 0.001)
+        self.lastCheck = now
+
+        self.lock.acquire()
+        try:
+            self.segmentRate = self.decodedSegments / elapsed
+            self.rate = int(self.decodedBytes / elapsed)
+            self.decodedSegments = self.decodedBytes = 0
+        finally:
+            self.lock.release()
+
+        if len(self.waiting):
+            self.wake()
+        self.checkID = reactor.callLater(self.CHECK_INTERVAL, self.check)
+
+    def status(self):
+        """ Return a dict describing the backlog, for the XML-RPC status call """
+        return {'queued_segments': self.depth(),
+                'oldest_age': int(self.oldestAge()),
+                'rate': self.rate / 1024,
+                'segment_rate': round(self.segmentRate, 1),
+                'backed_up': self.backedUp}
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
@@ -6,7 +6,7 @@ ArticleDecoder - Decode and assemble files from usenet articles (nzbSegments)
 [See end of file]
 """
 import binascii, os, re, shutil, string, time, Hellanzb
-from threading import Lock
+from threading import Lock, RLock
 from twisted.internet import reactor
 from zlib import crc32
 from Hellanzb.Daemon import beginDownload, endDownload, handleNZBDone, pauseCurrent
@@ -15,6 +15,9 @@ from Hellanzb.Logging import prettyException
 from Hellanzb.Util import BUF_SIZE, checkShutdown, isHellaTemp, nuke, touch, \
     OutOfDiskSpace, PoolsExhausted
 from Hellanzb.NZBLeecher.DupeHandler import handleDupeNZBFile, handleDupeNZBSegment
+from Hellanzb.NZBLeecher.SegmentPlacement import PARTIAL_SUFFIX, SEGMENT_MAP_SUFFIX, \
+    finishPlacement, getPlacementOffset, isPlaced, isPlacing, placeSegment, \
+    placeSegmentFile, recordSegmentFile, startPlacement
 if Hellanzb.HAVE_C_YENC: import _yenc
 
 __id__ = '$Id$'
@@ -22,6 +25,15 @@ __id__ = '$Id$'
 # Decode types enum
 UNKNOWN, YENCODE, UUENCODE, YENCODE_CRC_FAILED = range(4)
 
+# Segments are decoded by multiple threads (see Hellanzb.DECODE_THREADS). Decoding itself
+# runs concurrently, but writing segments to their destinations (which depend on the
+# NZBFile's filename, duplicate handling and temp file renaming) is serialized via
+# segmentWriteLock. postDecodeLock serializes the post-decode bookkeeping
+# (segmentDone/firstSegmentsDownloaded accounting and assembly), as if there were only
+# one decoder thread
+segmentWriteLock = RLock()
+postDecodeLock = RLock()
+
 def decode(segment):
     """ Decode the NZBSegment's articleData to it's destination. Toggle the NZBSegment
     instance as having been decoded, then assemble all the segments together if all their
@@ -29,18 +41,26 @@ def decode(segment):
     if Hellanzb.SHUTDOWN:
         return
 
+    if segment.crcFailedOf is not None:
+        decodeCRCFailedCopy(segment)
+        return
+
     encoding = UNKNOWN
     try:
-        segment.loadArticleData()
-        encoding, encodingMessage = decodeArticleData(segment)
+        if segment.yDecoder is not None and segment.yDecoder.isYEncoded():
+            # Already yDecoded as it was downloaded
+            encoding, encodingMessage = finishYDecodedSegment(segment)
+        else:
+            segment.yDecoder = None
+            segment.loadArticleData()
+            encoding, encodingMessage = decodeArticleData(segment)
         
     except OutOfDiskSpace:
         # Ran out of disk space and the download was paused! Easiest way out of this
         # sticky situation is to requeue the segment
         nuke(segment.getDestination())
         segment.nzbFile.totalReadBytes -= segment.readBytes
-        if not segment.cachedToDisk:
-            segment.nzbFile.nzb.cachedArticleDataBytes -= segment.readBytes
+        Hellanzb.articleCache.release(segment)
         segment.nzbFile.nzb.totalReadBytes -= segment.readBytes
         reactor.callFromThread(segment.fromQueue.put, (segment.priority, segment))
         return
@@ -48,15 +68,16 @@ def decode(segment):
         if handleCanceledSegment(segment):
             # Cancelled NZBs could potentially cause IOErrors during writes -- just handle
             # cleanup and return
+            Hellanzb.articleCache.release(segment)
             return
 
         error(segment.nzbFile.showFilename + ' segment: ' + str(segment.number) + \
               ' a problem occurred during decoding', e)
         del segment.articleData
         segment.articleData = ''
-        if not segment.cachedToDisk:
-            segment.nzbFile.nzb.cachedArticleDataBytes -= segment.readBytes
+        Hellanzb.articleCache.release(segment)
         touch(segment.getDestination())
+        Hellanzb.workingDirIndex.refresh(segment.getDestination())
 
     if Hellanzb.SMART_PAR and segment.isFirstSegment():
         # This will dequeue all of this segment's sibling segments that are still in the
@@ -85,22 +106,85 @@ def decode(segment):
     else:
         postDecode(segment)
 
-def postDecode(segment):
+def postDecode(segment, crcFailed = False):
     """ Handle post-decode operations (assembly, detect the NZB is finished downloading, etc)
     """
-    Hellanzb.queue.segmentDone(segment)
+    Hellanzb.workingDirIndex.refresh(segment.getDestination())
+    postDecodeLock.acquire()
+    try:
+        Hellanzb.queue.segmentDone(segment)
 
-    if handleCanceledSegment(segment):
-        return
+        if handleCanceledSegment(segment):
+            return
+
+        if segment.nzbFile.nzb.journal is not None:
+            segment.nzbFile.nzb.journal.segmentDone(segment, crcFailed)
+
+        if Hellanzb.SMART_PAR and segment.isFirstSegment() and \
+                not segment.nzbFile.nzb.parsing and \
+                segment.nzbFile.nzb.firstSegmentsDownloaded == \
+                len(segment.nzbFile.nzb.nzbFiles):
+            # Done downloading all first segments. Check for a few special situations
+            # that warrant requeueing of files
+            segment.nzbFile.nzb.smartRequeue()
+            segment.nzbFile.nzb.logSkippedPars()
+
+        tryAssemble(segment.nzbFile)
+    finally:
+        postDecodeLock.release()
+
+def decodeCRCFailedCopy(segment):
+    """ Write out the crcFailedCopy's download as its -hellafailed file (its segment was
+    already requeued by requeueCRCFailed) """
+    try:
+        finishYDecodedSegment(segment)
+    except Exception, e:
+        if not isinstance(e, OutOfDiskSpace) and not handleCanceledSegment(segment):
+            error(segment.nzbFile.showFilename + ' segment: ' + str(segment.number) + \
+                  ' a problem occurred writing out a failed download', e)
+        Hellanzb.articleCache.release(segment)
+    Hellanzb.workingDirIndex.refresh(segment.getDestination())
+
+    reactor.callFromThread(crcFailedCopyWritten, segment.crcFailedOf)
+
+def yDecodedCRCFailure(segment):
+    """ Validate the CRC of a segment yDecoded as it was downloaded, as soon as its article
+    has been received. Return the CRC mismatch message, or None if the CRC passed (or it's
+    left for the decode thread to validate) """
+    decoder = segment.yDecoder
+    if decoder is None or decoder.state != YDecoder.DONE or decoder.yend is None:
+        return None
 
-    if Hellanzb.SMART_PAR and segment.isFirstSegment() and \
-            segment.nzbFile.nzb.firstSegmentsDownloaded == len(segment.nzbFile.nzb.nzbFiles):
-        # Done downloading all first segments. Check for a few special situations that
-        # warrant requeueing of files
-        segment.nzbFile.nzb.smartRequeue()
-        segment.nzbFile.nzb.logSkippedPars()
+    yCrc = yEndCRC(decoder.yend)
+    crc = decoder.getCRC()
+    if yCrc is None or crc == yCrc:
+        return None
+    return segment.nzbFile.showFilename + ' segment ' + str(segment.number) + \
+        ': CRC mismatch ' + crc + ' != ' + yCrc
+
+def requeueCRCFailed(segment, encodingMessage):
+    """ Requeue a segment that failed the CRC verification (as soon as its article was
+    received) for download via the twisted main thread. Returns a crcFailedCopy of the
+    segment, to be written out by the decode thread instead """
+    failed = segment.crcFailedCopy()
+    try:
+        Hellanzb.queue.requeueMissing(segment.fromServer.factory, segment)
+    except PoolsExhausted:
+        # Handled by crcFailedExhausted once the failed downloads are all written out
+        segment.crcExhaustedMessage = encodingMessage
+    else:
+        debug('%s from server: %s. requeued to alternate server' % \
+              (encodingMessage, segment.fromServer.factory.serverPoolName))
+    return failed
 
-    tryAssemble(segment.nzbFile)
+def crcFailedCopyWritten(segment):
+    """ One of the segment's crcFailedCopies was written out (via the twisted main thread)
+    """
+    segment.crcFailedCopies -= 1
+    if not segment.crcFailedCopies and segment.crcExhaustedMessage is not None:
+        encodingMessage = segment.crcExhaustedMessage
+        segment.crcExhaustedMessage = None
+        crcFailedExhausted(segment, encodingMessage)
 
 def crcFailedRequeue(segment, encodingMessage):
     """ Requeue a segment that failed the CRC verification for download via the twisted main
@@ -124,39 +208,56 @@ def crcFailedRequeue(segment, encodingMessage):
                   ' stopping downloader')
             endDownload()
 
-        # All servers failed to get a good copy of this segment
-        error(encodingMessage)
-
-        # Acquire the assembly lock to avoid potential clashing with postpone() 
-        segment.nzbFile.nzb.assembleLock.acquire()
-
-        if len(segment.failedServerPools) > 1:
-            # Use the largest file (by size) downloaded from the servers, and delete the
-            # rest
-            failedFiles = []
-            for serverPoolName in segment.failedServerPools:
-                failedFile = segment.getDestination() + '-hellafailed_%s' % serverPoolName
-                if not os.path.exists(failedFile):
-                    # Failed files won't exist in the case the server reported
-                    # the article as missing
-                    continue
-                failedFiles.append((os.path.getsize(failedFile), failedFile))
-            failedFiles.sort()
+        crcFailedExhausted(segment, encodingMessage)
+    else:
+        debug('%s from server: %s. requeued to alternate server' % \
+              (encodingMessage, segment.fromServer.factory.serverPoolName))
+
+def crcFailedExhausted(segment, encodingMessage):
+    """ All servers failed to get a good copy of this segment: use the best of the failed
+    downloads """
+    error(encodingMessage)
+
+    # Acquire the assembly lock to avoid potential clashing with postpone() 
+    segment.nzbFile.nzb.assembleLock.acquire()
+
+    if len(segment.failedServerPools) > 1:
+        # Use the largest file (by size) downloaded from the servers, and delete the
+        # rest
+        failedFiles = []
+        for serverPoolName in segment.failedServerPools:
+            failedFile = segment.getDestination() + '-hellafailed_%s' % serverPoolName
+            if not os.path.exists(failedFile):
+                # Failed files won't exist in the case the server reported
+                # the article as missing
+                continue
+            failedFiles.append((os.path.getsize(failedFile), failedFile))
+        failedFiles.sort()
+        useFile = None
+        if len(failedFiles):
             useFile = failedFiles.pop()[1]
-            for failedFile in failedFiles:
-                nuke(failedFile[1])
-        else:
-            # FIXME: crcFailedRequeue should really never be triggered when there's only
-            # one server to fail on
-            useFile = segment.getDestination() + '-hellafailed_%s' % segment.failedServerPools[0]
+        for failedFile in failedFiles:
+            nuke(failedFile[1])
+    else:
+        # FIXME: crcFailedRequeue should really never be triggered when there's only
+        # one server to fail on
+        useFile = segment.getDestination() + '-hellafailed_%s' % segment.failedServerPools[0]
+
+    if useFile is not None and os.path.exists(useFile):
         os.rename(useFile, segment.getDestination())
+        Hellanzb.workingDirIndex.refresh(useFile)
+        segmentWriteLock.acquire()
+        try:
+            recordSegmentFile(segment)
+        finally:
+            segmentWriteLock.release()
+    else:
+        # The failed downloads couldn't be written out
+        touch(segment.getDestination())
 
-        segment.nzbFile.nzb.assembleLock.release()
+    segment.nzbFile.nzb.assembleLock.release()
 
-        postDecode(segment)
-    else:
-        debug('%s from server: %s. requeued to alternate server' % \
-              (encodingMessage, segment.fromServer.factory.serverPoolName))
+    postDecode(segment, crcFailed = True)
 
 def tryAssemble(nzbFile):
     """ Assemble the specified NZBFile if all its segments have been downloaded """
@@ -191,6 +292,7 @@ def nuke(f):
         os.remove(f)
     except Exception, e:
         pass
+    Hellanzb.workingDirIndex.refresh(f)
 
 def handleCanceledSegment(nzbSegment): 
     """ Return whether or not the specified NZBSegment has been canceled. If so, delete its
@@ -265,50 +367,26 @@ def parseArticleData(segment, justExtractFilename = False):
         # After stripping the articleData, we should find a yencode header, uuencode
         # header, or a uuencode part header (an empty line)
         if not withinData and line.startswith('=ybegin'):
-            # Parse the =ybegin line. Be explicit about the length of =ybegin fields we're
-            # splitting, incase badly named filenames destroy the regexp Example:
-            # =ybegin part=1 line=128 size=71492 name=--=GRUB=-- Puker_S1_D1.par2
-            splits = 3
-            if line.find(' part=') > -1:
-                splits += 1
-            if line.find(' total=') > -1:
-                splits += 1
-            ybegin = ySplit(line, splits)
-            
-            if not ('line' in ybegin and 'size' in ybegin and 'name' in ybegin):
+            ybegin = ySplitBegin(line)
+            if ybegin is None:
                 # FIXME: show filename information
                 raise FatalError('* Invalid =ybegin line in part %d!' % segment.number)
 
-            setRealFileName(segment.nzbFile, ybegin['name'],
-                            settingSegmentNumber = segment.number)
-            if segment.nzbFile.ySize is None:
-                    segment.nzbFile.ySize = yInt(ybegin['size'],
-                                                  '* Invalid =ybegin line in part %d!' % segment.number)
-                    
+            setYBegin(segment, ybegin)
             encodingType = YENCODE
 
         elif not withinData and line.startswith('=ypart'):
             # ybegin doesn't ensure a ypart on the next line
             withinData = True
 
-            ypart = ySplit(line)
-            if 'begin' in ypart:
-                segment.yBegin = yInt(ypart['begin'])
-            if 'end' in ypart:
-                segment.yEnd = yInt(ypart['end'])
+            setYPart(segment, ySplit(line))
 
             # Just incase a bad post doesn't include a begin header, ensure
             # the correct encodingType
             encodingType = YENCODE
 
         elif withinData and line.startswith('=yend'):
-            yend = ySplit(line)
-            if 'size' in yend:
-                segment.ySize = yInt(yend['size'])
-            if 'pcrc32' in yend:
-                segment.yCrc = '0' * (8 - len(yend['pcrc32'])) + yend['pcrc32'].upper()
-            elif 'crc32' in yend and yend.get('part', '1') == '1':
-                segment.yCrc = '0' * (8 - len(yend['crc32'])) + yend['crc32'].upper()
+            setYEnd(segment, ySplit(line))
 
         elif not withinData and line.startswith('begin '):
             filename = line.rstrip().split(' ', 2)[2]
@@ -356,8 +434,7 @@ def parseArticleData(segment, justExtractFilename = False):
     encodingType = decodeSegmentToFile(segment, encodingType)
     del segment.articleData
     segment.articleData = '' # We often check it for is None
-    if not segment.cachedToDisk:
-        segment.nzbFile.nzb.cachedArticleDataBytes -= segment.readBytes
+    Hellanzb.articleCache.release(segment)
     return encodingType
 decodeArticleData=parseArticleData
 
@@ -365,95 +442,110 @@ def setRealFileName(nzbFile, filename, forceChange = False, settingSegmentNumber
     """ Set the actual filename of the segment's parent nzbFile. If the filename wasn't
     already previously set, set the actual filename atomically and also atomically rename
     known temporary files belonging to that nzbFile to use the new real filename """
-    # FIXME: remove locking. actually, this function really needs to be locking when
-    # nzb.destDir is changing (when the archive dir is moved around)
-    switchedReal = False
-    if nzbFile.filename is not None and nzbFile.filename != filename and \
-            not isHellaTemp(nzbFile.filename):
-        # This NZBFile already had a real filename set, and now something has triggered it
-        # be changed
-        switchedReal = True
-
-        if forceChange:
-            # Force change -- this segment has been found to be a duplicate and needs to
-            # be renamed (but its parent NZBFile is currently being downloaded)
-            nzbFile.forcedChangedFilename = True
-        else:
-            # Not a force change. Either ignore the supposed new real filename (we already
-            # had one, we're just going to stick with it) and print an error about
-            # receiving bad header data. Or if this NZBFile filename mismatches because it
-            # was previously found to be a dupe (and its filename was renamed) just
-            # completely ignore the new filename
-            if not nzbFile.forcedChangedFilename:
-                segmentInfo = ''
-                if settingSegmentNumber is not None:
-                    segmentInfo = ' segment: %i' % settingSegmentNumber
+    # Renaming files on disk must not interleave with the decoder threads writing
+    # segments to their destinations
+    segmentWriteLock.acquire()
+    try:
+        # FIXME: remove locking. actually, this function really needs to be locking when
+        # nzb.destDir is changing (when the archive dir is moved around)
+        switchedReal = False
+        if nzbFile.filename is not None and nzbFile.filename != filename and \
+                not isHellaTemp(nzbFile.filename):
+            # This NZBFile already had a real filename set, and now something has triggered it
+            # be changed
+            switchedReal = True
+
+            if forceChange:
+                # Force change -- this segment has been found to be a duplicate and needs to
+                # be renamed (but its parent NZBFile is currently being downloaded)
+                nzbFile.forcedChangedFilename = True
+            else:
+                # Not a force change. Either ignore the supposed new real filename (we already
+                # had one, we're just going to stick with it) and print an error about
+                # receiving bad header data. Or if this NZBFile filename mismatches because it
+                # was previously found to be a dupe (and its filename was renamed) just
+                # completely ignore the new filename
+                if not nzbFile.forcedChangedFilename:
+                    segmentInfo = ''
+                    if settingSegmentNumber is not None:
+                        segmentInfo = ' segment: %i' % settingSegmentNumber
                     
-                error(nzbFile.showFilename + segmentInfo + \
-                      ' has incorrect filename header!: ' + filename + ' should be: ' + \
-                      nzbFile.showFilename)
+                    error(nzbFile.showFilename + segmentInfo + \
+                          ' has incorrect filename header!: ' + filename + ' should be: ' + \
+                          nzbFile.showFilename)
+                return
+        elif nzbFile.filename == filename:
             return
-    elif nzbFile.filename == filename:
-        return
      
-    # We might have been using a tempFileName previously, and just succesfully found
-    # the real filename in the articleData. Immediately rename any files that were
-    # using the temp name
-    nzbFile.tempFileNameLock.acquire()
-    renameFilenames = {}
-
-    if switchedReal:
-        notOnDisk = nzbFile.todoNzbSegments.union(nzbFile.dequeuedSegments)
-        # Get the original segment filenames via getDestination() (before we change it)
-        renameSegments = [(nzbSegment, nzbSegment.getDestination()) for nzbSegment in
-                           nzbFile.nzbSegments if nzbSegment not in notOnDisk]
-
-    # Change the filename
-    nzbFile.filename = filename
-
-    if switchedReal:
-        # Now get the new filenames via getDestination()
-        for (renameSegment, oldName) in renameSegments:
-            renameFilenames[os.path.basename(oldName)] = \
-                os.path.basename(renameSegment.getDestination())
-
-    # We also need a mapping of temp filenames to the new filename, incase we just found
-    # the real file name (filename is None or filename was previously set to a temp name)
-    for nzbSegment in nzbFile.nzbSegments:
-        renameFilenames[nzbSegment.getTempFileName()] = \
-            os.path.basename(nzbSegment.getDestination())
+        # We might have been using a tempFileName previously, and just succesfully found
+        # the real filename in the articleData. Immediately rename any files that were
+        # using the temp name
+        nzbFile.tempFileNameLock.acquire()
+        renameFilenames = {}
+
+        if switchedReal:
+            notOnDisk = nzbFile.todoNzbSegments.union(nzbFile.dequeuedSegments)
+            # Get the original segment filenames via getDestination() (before we change it)
+            renameSegments = [(nzbSegment, nzbSegment.getDestination()) for nzbSegment in
+                               nzbFile.nzbSegments if nzbSegment not in notOnDisk]
+            oldName = os.path.basename(nzbFile.getDestination())
+
+        # Change the filename
+        nzbFile.filename = filename
+
+        if switchedReal:
+            # Now get the new filenames via getDestination()
+            for (renameSegment, oldSegmentName) in renameSegments:
+                renameFilenames[os.path.basename(oldSegmentName)] = \
+                    os.path.basename(renameSegment.getDestination())
+
+            # Along with the partial and segment map files of placed segments
+            newName = os.path.basename(nzbFile.getDestination())
+            for suffix in (PARTIAL_SUFFIX, SEGMENT_MAP_SUFFIX):
+                renameFilenames[oldName + suffix] = newName + suffix
+
+        # We also need a mapping of temp filenames to the new filename, incase we just found
+        # the real file name (filename is None or filename was previously set to a temp name)
+        for nzbSegment in nzbFile.nzbSegments:
+            renameFilenames[nzbSegment.getTempFileName()] = \
+                os.path.basename(nzbSegment.getDestination())
                           
-    # Rename all segments
-    for file in os.listdir(nzbFile.nzb.destDir):
-        if file in renameFilenames:
+        # Rename all segments (that were on disk before any of them are renamed)
+        renames = []
+        for file, newFile in renameFilenames.iteritems():
             orig = os.path.join(nzbFile.nzb.destDir, file)
-            new = os.path.join(nzbFile.nzb.destDir, renameFilenames.get(file))
-            shutil.move(orig, new)
-
-            # Keep the onDiskSegments map in sync
-            if Hellanzb.queue.onDiskSegments.has_key(orig):
-                Hellanzb.queue.onDiskSegments[new] = \
-                    Hellanzb.queue.onDiskSegments.pop(orig)
-
-    nzbFile.tempFileNameLock.release()
-
-def yDecodeCRCCheck(segment, decoded):
-    """ Validate the CRC of the segment with the yencode keyword """
+            if Hellanzb.workingDirIndex.isFile(orig):
+                renames.append((orig, os.path.join(nzbFile.nzb.destDir, newFile)))
+        for orig, new in renames:
+            if orig != new:
+                shutil.move(orig, new)
+                Hellanzb.workingDirIndex.refresh(orig, new)
+
+                # Keep the onDiskSegments map in sync
+                if Hellanzb.queue.onDiskSegments.has_key(orig):
+                    Hellanzb.queue.onDiskSegments[new] = \
+                        Hellanzb.queue.onDiskSegments.pop(orig)
+
+        if nzbFile.nzb.journal is not None:
+            nzbFile.nzb.journal.filenameFound(nzbFile)
+
+        nzbFile.tempFileNameLock.release()
+    finally:
+        segmentWriteLock.release()
+
+def yCRCCheck(segment, crc):
+    """ Validate the specified CRC (an 8 character, upper case hex string) of the segment's
+    decoded data with the yencode keyword """
     passedCRC = False
     message = None
     if segment.yCrc is None:
         message = segment.nzbFile.showFilename + ' segment: ' + str(segment.number) + \
             ' does not have a valid CRC/yend line!'
+    elif crc == segment.yCrc:
+        passedCRC = True
     else:
-        crc = '%08X' % (crc32(decoded) & 2**32L - 1)
-        
-        if crc == segment.yCrc:
-            passedCRC = True
-        else:
-            message = segment.nzbFile.showFilename + ' segment ' + str(segment.number) + \
-                ': CRC mismatch ' + crc + ' != ' + segment.yCrc
-            
-        del decoded
+        message = segment.nzbFile.showFilename + ' segment ' + str(segment.number) + \
+            ': CRC mismatch ' + crc + ' != ' + segment.yCrc
         
     return passedCRC, message
 
@@ -475,6 +567,122 @@ def handleIOError(ioe):
         debug('handleIOError: got: %s' % str(ioe))
         raise
     
+def writeData(dest, data):
+    """ Write the data out to the destination """
+    out = open(dest, 'wb')
+    try:
+        out.write(data)
+    except IOError, ioe:
+        out.close()
+        handleIOError(ioe) # will re-raise
+    out.close()
+
+def writeYDecodedSegment(segment, passedCRC, writeFunc):
+    """ Write the yDecoded segment to its destination (or its -hellafailed destination when it
+    failed the CRC check) via writeFunc(destination). Returns False if the segment's NZB
+    was canceled (and nothing was written) """
+    segmentWriteLock.acquire()
+    try:
+        # Handle dupes if they exist
+        handleDupeNZBSegment(segment)
+        if handleCanceledSegment(segment):
+            return False
+
+        filename = segment.getDestination()
+        if not passedCRC:
+            filename += '-hellafailed_%s' % segment.fromServer.factory.serverPoolName
+        writeFunc(filename)
+        recordSegmentFile(segment)
+        return True
+    finally:
+        segmentWriteLock.release()
+
+def finishYDecodedSegment(segment):
+    """ Validate a segment that was yDecoded (by a YDecoder) as it was downloaded, and move its
+    decoded data to the segment's destination """
+    decoder = segment.yDecoder
+    segment.yDecoder = None
+
+    setYBegin(segment, decoder.ybegin)
+    if decoder.ypart is not None:
+        setYPart(segment, decoder.ypart)
+    if decoder.yend is not None:
+        setYEnd(segment, decoder.yend)
+    if segment.crcFailedOf is not None:
+        # One of these failed downloads becomes the original segment's file should every
+        # server fail (crcFailedExhausted): its offset is needed to place it
+        segment.crcFailedOf.yBegin = segment.yBegin
+        segment.crcFailedOf.yEnd = segment.yEnd
+
+    passedCRC, message = yCRCCheck(segment, decoder.getCRC())
+
+    encFile = os.path.join(Hellanzb.DOWNLOAD_TEMP_DIR, segment.getTempFileName() + '_ENC')
+    try:
+        written = None
+        if passedCRC and Hellanzb.DIRECT_PLACEMENT:
+            written = placeYDecodedSegment(segment, decoder.decodedBytes, encFile)
+
+        if written is None:
+            if segment.cachedToDisk:
+                writeFunc = lambda filename: moveData(encFile, filename)
+            else:
+                writeFunc = lambda filename: writeData(filename,
+                                                       ''.join(segment.encodedDataList))
+            written = writeYDecodedSegment(segment, passedCRC, writeFunc)
+    finally:
+        if segment.cachedToDisk:
+            nuke(encFile)
+        segment.encodedDataList = None
+
+    segment.articleData = '' # We often check it for is None
+    Hellanzb.articleCache.release(segment)
+
+    if not written:
+        return YENCODE, None
+
+    if passedCRC:
+        yDecodeFileSizeCheck(segment, decoder.decodedBytes)
+    else:
+        return YENCODE_CRC_FAILED, message
+
+    return YENCODE, None
+
+def placeYDecodedSegment(segment, size, encFile):
+    """ Place the yDecoded segment directly into its NZBFile's partial file, at its yEnc
+    offset (Hellanzb.DIRECT_PLACEMENT). Returns None if the segment can't be placed (it
+    should be written to its own segment file instead), otherwise whether or not it was
+    placed (False if the segment's NZB was canceled) """
+    offset = getPlacementOffset(segment, size)
+    if offset is None:
+        return None
+
+    segmentWriteLock.acquire()
+    try:
+        if handleCanceledSegment(segment):
+            return False
+
+        try:
+            if not startPlacement(segment.nzbFile):
+                return None
+
+            if segment.cachedToDisk:
+                placeSegmentFile(segment, offset, encFile)
+            else:
+                placeSegment(segment, offset,
+                             lambda out: out.write(''.join(segment.encodedDataList)))
+        except IOError, ioe:
+            handleIOError(ioe) # will re-raise
+        return True
+    finally:
+        segmentWriteLock.release()
+
+def moveData(src, dest):
+    """ Move the src file to the destination """
+    try:
+        shutil.move(src, dest)
+    except IOError, ioe:
+        handleIOError(ioe) # will re-raise
+
 def writeLines(dest, lines):
     """ Write the lines out to the destination. Return the size of the file """
     size = 0
@@ -499,45 +707,20 @@ def decodeSegmentToFile(segment, encodingType = YENCODE):
 
     if encodingType == YENCODE:
         message = None
+        decoded, crc, cruft = yDecode(segment.articleData)
         if Hellanzb.HAVE_C_YENC:
-            decoded, crc, cruft = yDecode(segment.articleData)
-            
-            # CRC check. FIXME: use yDecodeCRCCheck for this!
-            if segment.yCrc is None:
-                passedCRC = False
-                message = segment.nzbFile.showFilename + ' segment: ' + str(segment.number) + \
-                    ' does not have a valid CRC/yend line!'
-            else:
-                crc = '%08X' % ((crc ^ -1) & 2**32L - 1)
-                passedCRC = crc == segment.yCrc
-                if not passedCRC:
-                    message = segment.nzbFile.showFilename + ' segment ' + str(segment.number) + \
-                        ': CRC mismatch ' + crc + ' != ' + segment.yCrc
-            
-        else:
-            decoded = yDecode(segment.articleData)
+            # _yenc's CRC has not been finalized
+            crc ^= -1
 
-            # CRC check
-            passedCRC, message = yDecodeCRCCheck(segment, decoded)
+        # CRC check
+        passedCRC, message = yCRCCheck(segment, '%08X' % (crc & 2**32L - 1))
 
         # Write the decoded segment to disk
         size = len(decoded)
 
-        # Handle dupes if they exist
-        handleDupeNZBSegment(segment)
-        if handleCanceledSegment(segment):
+        if not writeYDecodedSegment(segment, passedCRC,
+                                    lambda filename: writeData(filename, decoded)):
             return YENCODE, None
-
-        filename = segment.getDestination()
-        if not passedCRC:
-            filename += '-hellafailed_%s' % segment.fromServer.factory.serverPoolName
-        out = open(filename, 'wb')
-        try:
-            out.write(decoded)
-        except IOError, ioe:
-            out.close()
-            handleIOError(ioe) # will re-raise
-        out.close()
               
         if passedCRC:
             # File size check vs ydecode header. We only do the file size check if the CRC
@@ -557,12 +740,16 @@ def decodeSegmentToFile(segment, encodingType = YENCODE):
             error('UUDecode failed in file: %s (part number: %d) error: %s' % \
                   (segment.getDestination(), segment.number, msg))
 
-        handleDupeNZBSegment(segment)
-        if handleCanceledSegment(segment):
-            return UUENCODE, None
-        
-        # Write the decoded segment to disk
-        writeLines(segment.getDestination(), decodedLines)
+        segmentWriteLock.acquire()
+        try:
+            handleDupeNZBSegment(segment)
+            if handleCanceledSegment(segment):
+                return UUENCODE, None
+
+            # Write the decoded segment to disk
+            writeLines(segment.getDestination(), decodedLines)
+        finally:
+            segmentWriteLock.release()
 
         return UUENCODE, None
 
@@ -570,11 +757,15 @@ def decodeSegmentToFile(segment, encodingType = YENCODE):
         if Hellanzb.DEBUG_MODE_ENABLED:
             debug('NO articleData, touching file: ' + segment.getDestination())
 
-        handleDupeNZBSegment(segment)
-        if handleCanceledSegment(segment):
-            return UNKNOWN, None
+        segmentWriteLock.acquire()
+        try:
+            handleDupeNZBSegment(segment)
+            if handleCanceledSegment(segment):
+                return UNKNOWN, None
 
-        touch(segment.getDestination())
+            touch(segment.getDestination())
+        finally:
+            segmentWriteLock.release()
 
     else:
         # FIXME: should this be an info instead of debug? Should probably change the
@@ -584,17 +775,25 @@ def decodeSegmentToFile(segment, encodingType = YENCODE):
             debug('Mysterious data, did not YY/UDecode!! Touching file: ' + \
                   segment.getDestination())
 
-        handleDupeNZBSegment(segment)
-        if handleCanceledSegment(segment):
-            return UNKNOWN, None
+        segmentWriteLock.acquire()
+        try:
+            handleDupeNZBSegment(segment)
+            if handleCanceledSegment(segment):
+                return UNKNOWN, None
 
-        touch(segment.getDestination())
+            touch(segment.getDestination())
+        finally:
+            segmentWriteLock.release()
 
     return UNKNOWN, None
 
-# Build the yEnc decode table
+# Build the yEnc decode table, and the map of escaped characters to their unescaped (but
+# still encoded) values
 YDEC_TRANS = ''.join([chr((i + 256 - 42) % 256) for i in range(256)])
+YDEC_ESCAPES = dict([(chr(i), chr((i + 256 - 64) % 256)) for i in range(256)])
 def yDecode(dataList):
+    """ yDecode the list of lines, returning a tuple of the decoded data, its CRC and the
+    escape state (see yDecodeString) """
     buffer = []
     index = -1
     for line in dataList:
@@ -609,21 +808,47 @@ def yDecode(dataList):
 
     if Hellanzb.HAVE_C_YENC:
         return _yenc.decode_string(data)
+    return yDecodeString(data)
+
+def yDecodeString(data, crc = 0, escape = 0):
+    """ yDecode the string of data (with its CRLFs removed) in pure python. Mirrors
+    _yenc.decode_string: returns a tuple of the decoded data, its CRC (continuing the
+    specified crc, though unlike _yenc's, the CRC is zlib's already finalized value) and
+    whether or not the data ended with an escape character (to be passed along with the
+    next string) """
+    # The yencode standard dictates only the 'critical' characters (NUL, LF, CR, =, and
+    # TAB, ' ' and . in some positions) be escaped, but ydecoders should be able to handle
+    # ANY character being escaped (some yencoders escape the ESCAPE CHAR, for instance).
+    # Splitting on the escape character unescapes all of them in one pass over the data,
+    # leaving only one slice per escape in python, before the single translate of the
+    # whole thing
+    if escape:
+        data = '=' + data
+    escape = 0
+    if '=' in data:
+        parts = data.split('=')
+        buffer = [parts[0]]
+        append = buffer.append
+        escapes = YDEC_ESCAPES
+        i, count = 1, len(parts)
+        while i < count:
+            part = parts[i]
+            if part:
+                append(escapes[part[0]])
+                append(part[1:])
+            elif i + 1 < count:
+                # '==': an escaped escape character
+                append(escapes['='])
+                append(parts[i + 1])
+                i += 1
+            else:
+                # Ended with an escape character
+                escape = 1
+            i += 1
+        data = ''.join(buffer)
 
-    # unescape NUL, TAB, LF, CR, 'ESC', ' ', ., =
-    # NOTE: The yencode standard dictates these characters as 'critical' and are required
-    # to be escaped, EXCEPT for the ESCAPE CHAR. It is included here because it has been
-    # seen to be escaped by some yencoders. The standard also says that ydecoders should
-    # be able to handle decoding ANY character being escaped. I have noticed some
-    # yencoders take it upon themselves to escape the ESCAPE CHAR, so we handle it. FIXME:
-    # We obviously aren't 'correct' in we only handle unescaping characters we know about
-    # (this is faster). This will be as good as it gets for the python yDecoder, the next
-    # step in fixing this & optimizing the ydecoder is switching to a C implementation
-    # -pjenvey
-    for i in (0, 9, 10, 13, 27, 32, 46, 61):
-        j = '=%c' % (i + 64)
-        data = data.replace(j, chr(i))
-    return data.translate(YDEC_TRANS)
+    decoded = data.translate(YDEC_TRANS)
+    return decoded, crc32(decoded, crc), escape
                
 YSPLIT_RE = re.compile(r'([a-zA-Z0-9]+)=')
 def ySplit(line, strictFieldLen = None):
@@ -644,6 +869,169 @@ def ySplit(line, strictFieldLen = None):
     
     return fields
 
+def ySplitBegin(line):
+    """ Split a =ybegin line into its key/value pairs. Returns None if the line is missing
+    required keywords """
+    # Be explicit about the length of =ybegin fields we're splitting, incase badly named
+    # filenames destroy the regexp Example:
+    # =ybegin part=1 line=128 size=71492 name=--=GRUB=-- Puker_S1_D1.par2
+    splits = 3
+    if line.find(' part=') > -1:
+        splits += 1
+    if line.find(' total=') > -1:
+        splits += 1
+    ybegin = ySplit(line, splits)
+
+    if not ('line' in ybegin and 'size' in ybegin and 'name' in ybegin):
+        return None
+    return ybegin
+
+def setYBegin(segment, ybegin):
+    """ Apply the =ybegin keywords to the segment (and its parent NZBFile) """
+    setRealFileName(segment.nzbFile, ybegin['name'], settingSegmentNumber = segment.number)
+    if segment.nzbFile.ySize is None:
+        segment.nzbFile.ySize = yInt(ybegin['size'],
+                                     '* Invalid =ybegin line in part %d!' % segment.number)
+
+def setYPart(segment, ypart):
+    """ Apply the =ypart keywords to the segment """
+    if 'begin' in ypart:
+        segment.yBegin = yInt(ypart['begin'])
+    if 'end' in ypart:
+        segment.yEnd = yInt(ypart['end'])
+
+def setYEnd(segment, yend):
+    """ Apply the =yend keywords to the segment """
+    if 'size' in yend:
+        segment.ySize = yInt(yend['size'])
+    yCrc = yEndCRC(yend)
+    if yCrc is not None:
+        segment.yCrc = yCrc
+
+def yEndCRC(yend):
+    """ Return the CRC of the segment's decoded data specified by the =yend keywords (upper
+    case and lpadded with 0s), None if there isn't one """
+    if 'pcrc32' in yend:
+        return '0' * (8 - len(yend['pcrc32'])) + yend['pcrc32'].upper()
+    elif 'crc32' in yend and yend.get('part', '1') == '1':
+        return '0' * (8 - len(yend['crc32'])) + yend['crc32'].upper()
+    return None
+
+class YDecoder:
+    """ Incrementally yDecodes an article's BODY as it's received, chunk by chunk (the chunks
+    are complete lines or not, CRLFs intact). Decoded data is passed straight to the sink
+    function, and a running CRC of it is maintained. The =ybegin, =ypart and =yend keywords
+    are kept for the ArticleDecoder to validate the segment with.
+
+    Articles that turn out not to be yEncoded (or whose =ybegin line is invalid) are
+    passed to the sink untouched, to be handled by the normal ArticleDecoder path """
+    UNDECIDED, DECODING, DONE, RAW = range(4)
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.state = YDecoder.UNDECIDED
+
+        # Raw data received while the encoding is still UNDECIDED, and the trailing
+        # partial line of the previous chunk
+        self.head = []
+        self.partial = ''
+
+        self.ybegin = None
+        self.ypart = None
+        self.yend = None
+
+        # Running CRC (and _yenc's escape state) of the decoded data
+        self.crc = None
+        self.escape = 0
+        self.decodedBytes = 0
+
+    def isYEncoded(self):
+        """ Whether or not the article was yDecoded (vs. passed to the sink untouched) """
+        return self.state == YDecoder.DECODING or self.state == YDecoder.DONE
+
+    def feed(self, data):
+        """ Process the next chunk of the article's data """
+        if self.state == YDecoder.RAW:
+            self.sink(data)
+            return
+        elif self.state == YDecoder.DONE:
+            return
+        elif self.state == YDecoder.UNDECIDED:
+            self.head.append(data)
+
+        lines = (self.partial + data).split('\r\n')
+        self.partial = lines.pop()
+
+        index = 0
+        if self.state == YDecoder.UNDECIDED:
+            # Skip any leading whitespace and MIME headers, we should find a =ybegin
+            for line in lines:
+                index += 1
+                if line == '' or MIME_HEADER_RE.match(line):
+                    continue
+
+                if line.startswith('=ybegin'):
+                    self.ybegin = ySplitBegin(line)
+                if self.ybegin is None:
+                    # Not yEncoded (or garbage): let the ArticleDecoder deal with it
+                    self.state = YDecoder.RAW
+                    self.sink(''.join(self.head))
+                    self.head = None
+                    return
+
+                self.state = YDecoder.DECODING
+                self.head = None
+                break
+            else:
+                return
+
+        buffer = []
+        for line in lines[index:]:
+            if line[:2] == '=y':
+                if line.startswith('=yend'):
+                    self.yend = ySplit(line)
+                    self.state = YDecoder.DONE
+                    break
+                elif line.startswith('=ypart') and self.ypart is None and \
+                        not self.decodedBytes and not len(buffer):
+                    self.ypart = ySplit(line)
+                    continue
+            elif line[:2] == '..':
+                # un-double-dot
+                line = line[1:]
+            elif line == '.':
+                # End of the article, without a =yend
+                self.state = YDecoder.DONE
+                break
+
+            buffer.append(line)
+
+        if len(buffer):
+            self.decode(''.join(buffer))
+
+    def decode(self, data):
+        """ yDecode the data (complete lines, CRLFs removed) to the sink """
+        if Hellanzb.HAVE_C_YENC:
+            if self.crc is None:
+                decoded, self.crc, self.escape = _yenc.decode_string(data)
+            else:
+                decoded, self.crc, self.escape = _yenc.decode_string(data, self.crc,
+                                                                     self.escape)
+        else:
+            decoded, self.crc, self.escape = yDecodeString(data, self.crc or 0, self.escape)
+
+        self.decodedBytes += len(decoded)
+        self.sink(decoded)
+
+    def getCRC(self):
+        """ Return the CRC of all the decoded data, as an 8 character upper case hex string """
+        if self.crc is None:
+            return '%08X' % (crc32('') & 2**32L - 1)
+        elif Hellanzb.HAVE_C_YENC:
+            # _yenc's running CRC has not been finalized
+            return '%08X' % ((self.crc ^ -1) & 2**32L - 1)
+        return '%08X' % (self.crc & 2**32L - 1)
+
 def UUDecode(dataList):
     """ UUDecode the specified list of data, returning results as a list """
     buffer = []
@@ -696,13 +1084,59 @@ def assembleNZBFile(nzbFile, autoFinish = True):
         return
 
     nzbFile.nzb.assembleLock.acquire()
-    file = open(nzbFile.getDestination(), 'wb')
-    write = file.write
 
     # Sort the segments incase they were out of order in the NZB file
     toAssembleSegments = nzbFile.nzbSegments[:]
     toAssembleSegments.sort(lambda x, y : cmp(x.number, y.number))
+
+    keptSegments = ()
+    if isPlacing(nzbFile):
+        keptSegments = assemblePlacedFile(nzbFile, toAssembleSegments)
+    else:
+        assembleSegmentFiles(nzbFile, toAssembleSegments)
+
+    # Journal the assembly before the segment files are gone
+    if nzbFile.nzb.journal is not None:
+        nzbFile.nzb.journal.fileAssembled(nzbFile)
+
+    # Finally, delete all the segment files when finished
+    for nzbSegment in toAssembleSegments:
+        if nzbSegment in keptSegments:
+            continue
+        try:
+            os.remove(nzbSegment.getDestination())
+        except OSError, ose:
+            # postponement might have moved the file we just wrote to:
+            # exceptions.OSError: [Errno 2] No such file or directory: 
+            if ose.errno != 2:
+                debug('Unexpected ERROR while removing segmentFile: ' +
+                      nzbSegment.getDestination())
+        Hellanzb.workingDirIndex.refresh(nzbSegment.getDestination())
+    Hellanzb.workingDirIndex.refresh(nzbFile.getDestination())
+
+    Hellanzb.queue.fileDone(nzbFile)
+    nzbFile.nzb.assembleLock.release()
+    reactor.callFromThread(fileDone)
+    
+    debug('Assembled file: ' + nzbFile.getDestination() + ' from segment files: ' + \
+          str([nzbSegment.getDestination() for nzbSegment in toAssembleSegments]))
+
+    # nudge gc
+    for nzbSegment in nzbFile.nzbSegments:
+        del nzbSegment.nzbFile
+        del nzbSegment
+    del nzbFile.nzbSegments
     
+    if autoFinish and not handleCanceledFile(nzbFile):
+        # After assembling a file, check the contents of the filesystem to determine if we're done 
+        tryFinishNZB(nzbFile.nzb)
+
+def assembleSegmentFiles(nzbFile, toAssembleSegments):
+    """ Assemble the final file by copying the NZBFile's decoded segment files into it, in
+    order. Called with the assembleLock held (it's released if an exception is raised) """
+    file = open(nzbFile.getDestination(), 'wb')
+    write = file.write
+
     for nzbSegment in toAssembleSegments:
         decodedSegmentFile = open(nzbSegment.getDestination(), 'rb')
         read = decodedSegmentFile.read
@@ -737,37 +1171,45 @@ def assembleNZBFile(nzbFile, autoFinish = True):
                 # exceptions.OSError: [Errno 2] No such file or directory: 
                 if ose.errno != 2:
                     debug('Unexpected ERROR while removing nzbFile: ' + nzbFile.getDestination())
+            Hellanzb.workingDirIndex.refresh(nzbFile.getDestination())
             nzbFile.nzb.assembleLock.release()
             raise
 
     file.close()
-    # Finally, delete all the segment files when finished
-    for nzbSegment in toAssembleSegments:
-        try:
-            os.remove(nzbSegment.getDestination())
-        except OSError, ose:
-            # postponement might have moved the file we just wrote to:
-            # exceptions.OSError: [Errno 2] No such file or directory: 
-            if ose.errno != 2:
-                debug('Unexpected ERROR while removing segmentFile: ' +
-                      nzbSegment.getDestination())
-
-    Hellanzb.queue.fileDone(nzbFile)
-    nzbFile.nzb.assembleLock.release()
-    reactor.callFromThread(fileDone)
-    
-    debug('Assembled file: ' + nzbFile.getDestination() + ' from segment files: ' + \
-          str([nzbSegment.getDestination() for nzbSegment in toAssembleSegments]))
 
-    # nudge gc
-    for nzbSegment in nzbFile.nzbSegments:
-        del nzbSegment.nzbFile
-        del nzbSegment
-    del nzbFile.nzbSegments
-    
-    if autoFinish and not handleCanceledFile(nzbFile):
-        # After assembling a file, check the contents of the filesystem to determine if we're done 
-        tryFinishNZB(nzbFile.nzb)
+def assemblePlacedFile(nzbFile, toAssembleSegments):
+    """ Finish the NZBFile whose segments were placed directly into its partial file: place
+    any segments that were written to their own segment files instead (e.g. those that
+    failed the CRC check on every server), then move the partial file to its final
+    destination. Segment files that couldn't be placed are left on disk, and returned.
+    Called with the assembleLock held (it's released if an exception is raised) """
+    keptSegments = set()
+    try:
+        for nzbSegment in toAssembleSegments:
+            segmentFileName = nzbSegment.getDestination()
+            if isPlaced(nzbSegment) or not os.path.isfile(segmentFileName):
+                continue
+
+            size = os.path.getsize(segmentFileName)
+            if not size:
+                # Missing article. Leave its hole in the file for par2 to repair
+                continue
+
+            offset = getPlacementOffset(nzbSegment, size)
+            if offset is None:
+                # Leave it for par2 to repair the hole, keeping its data
+                error(nzbFile.showFilename + ' segment: ' + str(nzbSegment.number) + \
+                      ' unable to determine its offset, leaving its segment file: ' + \
+                      os.path.basename(segmentFileName))
+                keptSegments.add(nzbSegment)
+                continue
+            placeSegmentFile(nzbSegment, offset, segmentFileName)
+
+        finishPlacement(nzbFile)
+    except IOError, ioe:
+        nzbFile.nzb.assembleLock.release()
+        handleIOError(ioe) # will re-raise
+    return keptSegments
 
 def fileDone():
     Hellanzb.totalFilesDownloaded += 1
@@ -78,6 +78,7 @@ def handleDupeNZBSegment(nzbSegment):
                   'beingDownloadedNZBSegment!?): %s renaming to: %s' % \
                   (os.path.basename(dest), os.path.basename(dupeNZBFileName)))
             os.rename(dest, dupeNZBFileName + segmentNumStr)
+            Hellanzb.workingDirIndex.refresh(dest, dupeNZBFileName + segmentNumStr)
 
 def handleDupeNZBFile(nzbFile):
     """ Handle a duplicate NZBFile file on disk (prior to writing a new one), if one exists
@@ -99,6 +100,7 @@ def handleDupeNZBFile(nzbFile):
                                                         os.path.basename(dupeNZBFileName)))
 
         os.rename(dest, dupeNZBFileName)
+        Hellanzb.workingDirIndex.refresh(dest, dupeNZBFileName)
 
 def handleDupeOnDisk(filename, workingDirDupeMap):
     """ Determine if the specified filename on disk (in the WORKING_DIR) is a duplicate
@@ -0,0 +1,266 @@
+"""
+
+NZBCache - On disk cache of parsed NZB files
+
+NZB files are parsed more than once during their lifetime: for their total bytes when
+queued, then again when downloading begins, after every restart, unpostpone and par
+recovery download. The first parse of an NZB is recorded to the Hellanzb.NZB_CACHE_DIR
+(as marshalled tuples: its files, their groups and segments), keyed by the md5 of the NZB
+file's contents. Later parses replay the recording to the parser instead of parsing the XML
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import marshal, os, tempfile, time, Hellanzb
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+from xml.sax import make_parser
+from xml.sax.handler import feature_external_ges, feature_namespaces, ContentHandler
+from xml.sax.xmlreader import AttributesImpl
+from Hellanzb.Log import *
+from Hellanzb.Util import BUF_SIZE
+
+__id__ = '$Id$'
+
+# Bumped whenever the format of the cache files changes
+CACHE_VERSION = 1
+
+# Cached NZBs not used for this long (in seconds) are removed
+MAX_AGE = 14 * 24 * 60 * 60
+
+def nzbDigest(fileName):
+    """ Return the hex md5 digest of the specified NZB file's contents """
+    digest = md5()
+    nzbFile = open(fileName, 'rb')
+    try:
+        while True:
+            data = nzbFile.read(BUF_SIZE * 4)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        nzbFile.close()
+    return digest.hexdigest()
+
+def cacheEnabled():
+    return Hellanzb.NZB_CACHE and getattr(Hellanzb, 'NZB_CACHE_DIR', None) is not None
+
+def cacheFileName(digest):
+    return os.path.join(Hellanzb.NZB_CACHE_DIR, digest + '.nzbc')
+
+def loadNZBCache(digest, headerOnly = False):
+    """ Load the cached NZB with the specified digest. Returns a tuple of its total bytes and
+    its files (None when headerOnly), or None if it isn't cached """
+    fileName = cacheFileName(digest)
+    try:
+        cacheFile = open(fileName, 'rb')
+    except IOError:
+        return None
+
+    try:
+        try:
+            version, totalBytes = marshal.load(cacheFile)
+            if version != CACHE_VERSION:
+                return None
+            files = None
+            if not headerOnly:
+                files = marshal.load(cacheFile)
+        except (EOFError, ValueError, TypeError):
+            debug('loadNZBCache: Ignoring invalid cache file: %s' % fileName)
+            return None
+    finally:
+        cacheFile.close()
+
+    try:
+        # Keep it from being pruned
+        os.utime(fileName, None)
+    except OSError:
+        pass
+    return totalBytes, files
+
+def saveNZBCache(digest, totalBytes, files):
+    """ Write the specified parsed NZB to the cache """
+    fileName = cacheFileName(digest)
+    tempFileName = None
+    try:
+        # The same NZB may be cached by multiple threads at once (e.g. the
+        # NZBTotalBytesParser and the download's parse): each writes its own temp file
+        fd, tempFileName = tempfile.mkstemp('.tmp', digest + '.nzbc.',
+                                            Hellanzb.NZB_CACHE_DIR)
+        cacheFile = os.fdopen(fd, 'wb')
+        try:
+            marshal.dump((CACHE_VERSION, totalBytes), cacheFile)
+            marshal.dump(files, cacheFile)
+        finally:
+            cacheFile.close()
+        os.rename(tempFileName, fileName)
+    except (IOError, OSError), e:
+        debug('saveNZBCache: Unable to write cache file: %s' % fileName, e)
+        if tempFileName is not None and os.path.exists(tempFileName):
+            try:
+                os.remove(tempFileName)
+            except OSError:
+                pass
+        return
+    pruneNZBCache()
+
+def pruneNZBCache():
+    """ Remove the cached NZBs that haven't been used in MAX_AGE """
+    oldest = time.time() - MAX_AGE
+    for file in os.listdir(Hellanzb.NZB_CACHE_DIR):
+        fileName = os.path.join(Hellanzb.NZB_CACHE_DIR, file)
+        try:
+            if os.path.getmtime(fileName) < oldest:
+                os.remove(fileName)
+        except OSError:
+            pass
+
+def compactAttr(value):
+    """ Store numeric attributes as ints (the NZBParser int()s them anyway) """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+def replayAttr(value):
+    if isinstance(value, int):
+        return str(value)
+    return value
+
+def attributes(**attrs):
+    """ Return SAX Attributes of the specified keyword arguments (that aren't None) """
+    for name, value in attrs.items():
+        if value is None:
+            del attrs[name]
+    return AttributesImpl(attrs)
+
+class NZBRecorder(ContentHandler):
+    """ Passes the SAX events of an NZB file through to the handler, recording its files
+    for the cache """
+    def __init__(self, handler):
+        self.handler = handler
+
+        # Lists of (subject, poster, date, groups, segments) tuples. Segments are (bytes,
+        # number, messageId) tuples
+        self.files = []
+        self.totalBytes = 0
+
+        self.file = None
+        self.segmentAttrs = None
+        self.chars = None
+
+    def startElement(self, name, attrs):
+        if name == 'file':
+            self.file = (attrs.get('subject'), attrs.get('poster'), attrs.get('date'), [], [])
+            self.files.append(self.file)
+        elif name == 'group' and self.file is not None:
+            self.chars = []
+        elif name == 'segment' and self.file is not None:
+            self.segmentAttrs = (compactAttr(attrs.get('bytes')),
+                                 compactAttr(attrs.get('number')))
+            self.chars = []
+        self.handler.startElement(name, attrs)
+
+    def characters(self, content):
+        if self.chars is not None:
+            self.chars.append(content)
+        self.handler.characters(content)
+
+    def endElement(self, name):
+        if name == 'group' and self.chars is not None:
+            self.file[3].append(''.join(self.chars))
+            self.chars = None
+        elif name == 'segment' and self.chars is not None:
+            self.file[4].append(self.segmentAttrs + (''.join(self.chars),))
+            if isinstance(self.segmentAttrs[0], int):
+                self.totalBytes += self.segmentAttrs[0]
+            self.chars = None
+        elif name == 'file':
+            self.file = None
+        self.handler.endElement(name)
+
+def replayNZB(files, handler):
+    """ Replay the SAX events of the specified cached NZB files to the handler """
+    for subject, poster, date, groups, segments in files:
+        handler.startElement('file', attributes(subject = subject, poster = poster,
+                                                date = date))
+        for group in groups:
+            handler.startElement('group', attributes())
+            handler.characters(group)
+            handler.endElement('group')
+
+        for bytes, number, messageId in segments:
+            handler.startElement('segment', attributes(bytes = replayAttr(bytes),
+                                                       number = replayAttr(number)))
+            handler.characters(messageId)
+            handler.endElement('segment')
+        handler.endElement('file')
+
+def parseNZBFile(fileName, handler):
+    """ Feed the specified NZB file to the handler (a ContentHandler): from the cache when
+    it's been parsed before, otherwise by parsing it (and caching the result). Raises
+    SAXParseException for invalid NZB files """
+    digest = None
+    if cacheEnabled():
+        digest = nzbDigest(fileName)
+        cached = loadNZBCache(digest)
+        if cached is not None:
+            replayNZB(cached[1], handler)
+            return
+
+    parser = make_parser()
+    # No XML namespaces here
+    parser.setFeature(feature_namespaces, 0)
+    parser.setFeature(feature_external_ges, 0)
+
+    if digest is None:
+        parser.setContentHandler(handler)
+        parser.parse(fileName)
+        return
+
+    recorder = NZBRecorder(handler)
+    parser.setContentHandler(recorder)
+    parser.parse(fileName)
+    saveNZBCache(digest, recorder.totalBytes, recorder.files)
+
+def cachedTotalBytes(fileName):
+    """ Return the total bytes of the specified NZB file, if it's cached (otherwise None) """
+    if not cacheEnabled():
+        return None
+    cached = loadNZBCache(nzbDigest(fileName), headerOnly = True)
+    if cached is not None:
+        return cached[0]
+    return None
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
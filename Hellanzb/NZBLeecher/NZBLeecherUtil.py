@@ -4,49 +4,139 @@ NZBLeecherUtil - Misc. code for NZBLeecher and its related modules
 (c) Copyright 2005 Philip Jenvey
 [See end of file]
 """
-import os, stat, sys, Hellanzb
+import os, stat, sys, time, Hellanzb
 from twisted.internet import reactor
 from twisted.python import log
-from twisted.protocols.policies import ThrottlingProtocol, WrappingFactory
+from twisted.protocols.policies import ProtocolWrapper, ThrottlingProtocol, \
+    WrappingFactory
+from Hellanzb.Log import *
 
 __id__ = '$Id$'
 
+class TokenBucket:
+    """ A token bucket: tokens (bytes) accumulate at rate per second, up to burst tokens.
+    Reads spend them, possibly going into debt -- readers then wait for the debt to be
+    repaid """
+    # Size of the bucket, in seconds worth of tokens
+    BURST_SECONDS = 0.25
+    MIN_BURST = 16 * 1024
+
+    def __init__(self, rate):
+        self.setRate(rate)
+
+    def setRate(self, rate):
+        """ Change the rate (bytes/sec) """
+        self.rate = rate
+        self.burst = max(self.MIN_BURST, int(rate * self.BURST_SECONDS))
+        self.tokens = self.burst
+        self.lastTime = time.time()
+
+    def spend(self, length, now):
+        """ Spend the specified number of tokens. Returns the number of seconds to wait before
+        reading again (0 when the bucket isn't in debt) """
+        self.tokens = min(self.burst, self.tokens + (now - self.lastTime) * self.rate)
+        self.lastTime = now
+
+        self.tokens -= length
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / float(self.rate)
+
 class HellaThrottler:
-    """ This is twisted.protocols.policies.ThrottlingFactory abstracted away from
-    Factory. Multiple factories all share the same HellaThrottler singlteton -- thus this
-    provides global bandwidth throttling for all twisted HellaThrottlingFactories """
-    def __init__(self, readLimit=None, writeLimit=None):
+    """ Limits the download rate of all HellaThrottlingFactories. Each read is paid for with
+    tokens from the global TokenBucket (Hellanzb.MAX_RATE), the server's bucket (the
+    server's maxRate) and the NZB's bucket (its maxRate) -- the protocol that read pauses
+    until all of its buckets are out of debt. This paces every connection smoothly,
+    instead of bursting to line rate then stopping all reads until the next second
+
+    Also maintains the download rate statistics (updated every second) """
+    def __init__(self, readLimit = 0):
         self.connectionCount = 0
-        self.readLimit = readLimit # max bytes we should read per second
-        self.writeLimit = writeLimit # max bytes we should write per second
-        self.readThisSecond = 0
-        self.writtenThisSecond = 0
-        self.unthrottleReadsID = None
-        self.checkReadBandwidthID = None
-        self.unthrottleWritesID = None
-        self.checkWriteBandwidthID = None
-        
         self.factories = [] # All throttling factories
 
+        # max bytes we should read per second, and its TokenBucket
+        self.readLimit = 0
+        self.readBucket = None
+        self.setReadLimit(readLimit)
+
+        # TokenBuckets of NZBs with a maxRate
+        self.nzbBuckets = {}
+
+        self.readThisSecond = 0
+        self.updateRatesID = None
+
         # The current download rate
         self.rate = 0
 
+    def setReadLimit(self, readLimit):
+        """ Change the global read limit (bytes/sec, 0 for no limit) """
+        self.readLimit = readLimit
+        if not readLimit:
+            self.readBucket = None
+            self.unthrottleReads()
+        elif self.readBucket is None:
+            self.readBucket = TokenBucket(readLimit)
+        else:
+            self.readBucket.setRate(readLimit)
+
+    def getNZBBucket(self, nzb):
+        """ Return the specified NZB's TokenBucket, None if it has no maxRate """
+        if not nzb.maxRate:
+            if nzb in self.nzbBuckets:
+                del self.nzbBuckets[nzb]
+            return None
+
+        bucket = self.nzbBuckets.get(nzb)
+        if bucket is None:
+            bucket = self.nzbBuckets[nzb] = TokenBucket(nzb.maxRate)
+        elif bucket.rate != nzb.maxRate:
+            bucket.setRate(nzb.maxRate)
+        return bucket
+
+    def nzbDone(self, nzb):
+        """ Forget the TokenBucket of the specified finished (or canceled) NZB """
+        # (Called from the decoder threads: pop is atomic)
+        self.nzbBuckets.pop(nzb, None)
+
+    def endDownload(self):
+        """ Forget all NZB TokenBuckets """
+        self.nzbBuckets.clear()
+
     def registerWritten(self, length):
         """Called by protocol to tell us more bytes were written."""
-        self.writtenThisSecond += length
+        # Writes aren't limited
+        pass
         
-    def registerRead(self, length):
-        """Called by protocol to tell us more bytes were read."""
+    def registerRead(self, length, protocol):
+        """ Called by protocol to tell us more bytes were read. Pause its reads if it's
+        exceeding any of its limits """
         self.readThisSecond += length
 
-    def checkReadBandwidth(self):
-        """Checks if we've passed bandwidth limits."""
-        if self.readLimit and self.readThisSecond > self.readLimit:
-            self.throttleReads()
-            throttleTime = (float(self.readThisSecond) / self.readLimit) - 1.0
-            self.unthrottleReadsID = reactor.callLater(throttleTime,
-                                                       self.unthrottleReads)
+        now = time.time()
+        wait = 0
+        if self.readBucket is not None:
+            wait = self.readBucket.spend(length, now)
 
+        serverBucket = protocol.factory.readBucket
+        if serverBucket is not None:
+            wait = max(wait, serverBucket.spend(length, now))
+
+        segment = protocol.wrappedProtocol.currentSegment
+        if segment is not None:
+            nzbBucket = self.getNZBBucket(segment.nzbFile.nzb)
+            if nzbBucket is not None:
+                wait = max(wait, nzbBucket.spend(length, now))
+
+        if Hellanzb.articleCache.readsPaused:
+            # No room left to cache article data: wait on the decoders (the ArticleCache
+            # unthrottles reads once there is)
+            wait = max(wait, Hellanzb.articleCache.CHECK_INTERVAL)
+
+        if wait > 0:
+            protocol.throttleReadsFor(wait)
+
+    def updateRates(self):
+        """ Update the download rate statistics (and the UI) """
         nzbFiles = []
         if Hellanzb.downloading:
             # Update the total download rate and each NZBFiles rate and d/l percentage
@@ -71,66 +161,66 @@ class HellaThrottler:
         for nzbFile in nzbFiles:
             nzbFile.readThisSecond = 0
 
-        self.checkReadBandwidthID = reactor.callLater(1, self.checkReadBandwidth)
-
-    def checkWriteBandwidth(self):
-        if self.writeLimit and self.writtenThisSecond > self.writeLimit:
-            self.throttleWrites()
-            throttleTime = (float(self.writtenThisSecond) / self.writeLimit) - 1.0
-            self.unthrottleWritesID = reactor.callLater(throttleTime,
-                                                        self.unthrottleWrites)
-        # reset for next round    
-        self.writtenThisSecond = 0
-        self.checkWriteBandwidthID = reactor.callLater(1, self.checkWriteBandwidth)
-
-    def throttleReads(self):
-        """Throttle reads on all protocols."""
-        for f in self.factories:
-            log.msg("Throttling reads on %s" % f)
-            for p in f.protocols.keys():
-                p.throttleReads()
+        self.updateRatesID = reactor.callLater(1, self.updateRates)
 
     def unthrottleReads(self):
-        """Stop throttling reads on all protocols."""
+        """ Resume reading on all protocols paused by their limits """
         # unthrottling reads just means the protocls startReading() again. Obviously we
         # don't want to ever begin reading when the download is currently paused
         if Hellanzb.downloadPaused:
             return
-        
-        self.unthrottleReadsID = None
-        for f in self.factories:
-            log.msg("Stopped throttling reads on %s" % f)
-            for p in f.protocols.keys():
-                p.unthrottleReads()
 
-    def throttleWrites(self):
-        """Throttle writes on all protocols."""
         for f in self.factories:
-            log.msg("Throttling writes on %s" % f)
             for p in f.protocols.keys():
-                p.throttleWrites()
+                if p.unthrottleReadsID is not None:
+                    p.cancelUnthrottleReads()
+                    p.unthrottleReads()
+
+class HellaThrottlingProtocol(ThrottlingProtocol):
+    """ Pauses reading for as long as the HellaThrottler says """
+    unthrottleReadsID = None
+
+    def dataReceived(self, data):
+        self.factory.registerRead(len(data), self)
+        ProtocolWrapper.dataReceived(self, data)
+
+    def throttleReadsFor(self, seconds):
+        """ Stop reading, for the specified number of seconds """
+        if self.unthrottleReadsID is not None:
+            # Already paused
+            return
+        self.throttleReads()
+        self.unthrottleReadsID = reactor.callLater(seconds, self.unthrottleReads)
 
-    def unthrottleWrites(self):
-        """Stop throttling writes on all protocols."""
-        self.unthrottleWritesID = None
-        for f in self.factories:
-            log.msg("Stopped throttling writes on %s" % f)
-            for p in f.protocols.keys():
-                p.unthrottleWrites()
+    def unthrottleReads(self):
+        self.unthrottleReadsID = None
+        if Hellanzb.downloadPaused:
+            # pauseCurrent stopped reading, continueCurrent will resume
+            return
+        ThrottlingProtocol.unthrottleReads(self)
 
-class HellaThrottlingFactory(WrappingFactory):
-    """Throttles bandwidth and number of connections via the parent HellaThrottler
+    def cancelUnthrottleReads(self):
+        """ Cancel the scheduled unthrottleReads """
+        if self.unthrottleReadsID is not None and self.unthrottleReadsID.active():
+            self.unthrottleReadsID.cancel()
+        self.unthrottleReadsID = None
+
+    def connectionLost(self, reason):
+        self.cancelUnthrottleReads()
+        ThrottlingProtocol.connectionLost(self, reason)
 
-    Write bandwidth will only be throttled if there is a producer
-    registered.
-    """
+class HellaThrottlingFactory(WrappingFactory):
+    """ Throttles bandwidth via the parent HellaThrottler, and optionally limits the number of
+    connections. readBucket is the TokenBucket of the server's own limit (shared by all of
+    the server's factories), if any """
 
-    protocol = ThrottlingProtocol
+    protocol = HellaThrottlingProtocol
 
-    def __init__(self, wrappedFactory, maxConnectionCount=sys.maxint):
+    def __init__(self, wrappedFactory, maxConnectionCount=sys.maxint, readBucket=None):
         WrappingFactory.__init__(self, wrappedFactory)
         self.connectionCount = 0
         self.maxConnectionCount = maxConnectionCount
+        self.readBucket = readBucket
 
         self.ht = Hellanzb.ht
         self.ht.factories.append(self)
@@ -139,22 +229,13 @@ class HellaThrottlingFactory(WrappingFactory):
         """Called by protocol to tell us more bytes were written."""
         self.ht.registerWritten(length)
 
-    def registerRead(self, length):
+    def registerRead(self, length, protocol):
         """Called by protocol to tell us more bytes were read."""
-        self.ht.registerRead(length)
-
-    def checkReadBandwidth(self):
-        self.ht.checkReadBandwidth()
-
-    def checkWriteBandwidth(self):
-        self.ht.checkWriteBandwidth()
+        self.ht.registerRead(length, protocol)
 
     def buildProtocol(self, addr):
         if self.ht.connectionCount == 0:
-            if self.ht.readLimit is not None:
-                self.ht.checkReadBandwidth()
-            if self.ht.writeLimit is not None:
-                self.ht.checkWriteBandwidth()
+            self.ht.updateRates()
 
         if self.connectionCount < self.maxConnectionCount:
             self.connectionCount += 1
@@ -175,9 +256,223 @@ class HellaThrottlingFactory(WrappingFactory):
         self.ht.connectionCount -= 1
         
         if self.ht.connectionCount == 0:
-            for name in ('unthrottleReadsID', 'checkReadBandwidthID',
-                         'unthrottleWritesID', 'checkWriteBandwidthID'):
-                self.cancelScheduled(getattr(self.ht, name))
+            self.cancelScheduled(self.ht.updateRatesID)
+
+class ConnectionScaler:
+    """ Scales the number of connections a NZBLeecherFactory keeps open (between
+    minConnections and maxConnections) according to their measured throughput
+
+    Servers throttling per connection benefit from more connections, servers throttling
+    per account do not. The scaler periodically probes by adding or dropping a
+    connection, keeping the change only when it was worth it: an added connection must
+    raise the factory's aggregate rate, and a dropped connection (the slowest one) must
+    not lower it. Dropped connections are parked -- their connectors are kept in the
+    factory's parkedConnectors for reconnecting when the scaler grows again """
+    GROW, SHRINK = 'grow', 'shrink'
+
+    # Seconds between throughput samples
+    SAMPLE_INTERVAL = 10
+    # Relative change of the aggregate rate that's considered significant
+    THRESHOLD = 0.05
+    # Number of samples to hold the connection count steady for between probes. Doubled
+    # after each consecutive reverted probe, up to MAX_PROBE_SAMPLES
+    PROBE_SAMPLES = 6
+    MAX_PROBE_SAMPLES = 48
+    # Number of recent decisions kept for reporting
+    MAX_DECISIONS = 20
+
+    def __init__(self, factory, minConnections, maxConnections):
+        self.factory = factory
+        self.minConnections = max(1, minConnections)
+        self.maxConnections = max(self.minConnections, maxConnections)
+        # The number of connections we currently want open
+        self.connections = self.maxConnections
+
+        # The aggregate and per client rates (bytes/sec) measured by the last sample
+        self.rate = 0
+        self.clientRates = {}
+
+        # The probe awaiting evaluation: (GROW or SHRINK, aggregate rate before it)
+        self.probe = None
+        self.probeDirection = self.SHRINK
+        self.holdSamples = self.PROBE_SAMPLES
+        self.probeSamples = self.PROBE_SAMPLES
+        # The sample following a change is skipped, connections need time to settle
+        self.settling = False
+
+        # Recent decisions: (time, action, connections, rate, reason)
+        self.decisions = []
+
+        self.sampleID = None
+        self.lastSampleTime = None
+
+    def start(self):
+        """ Begin sampling """
+        if self.sampleID is not None:
+            return
+        self.reset()
+        self.sampleID = reactor.callLater(self.SAMPLE_INTERVAL, self.sample)
+
+    def stop(self):
+        """ Stop sampling """
+        if self.sampleID is not None and self.sampleID.active():
+            self.sampleID.cancel()
+        self.sampleID = None
+        self.reset()
+
+    def reset(self):
+        """ Discard the current measurements (they're meaningless after pausing, etc) """
+        self.lastSampleTime = time.time()
+        self.factory.sampleReadBytes = 0
+        for client in self.factory.clients:
+            client.sampleReadBytes = 0
+        self.probe = None
+        self.settling = False
+        self.holdSamples = self.PROBE_SAMPLES
+
+    def sample(self):
+        """ Measure the aggregate and per client rates, and adjust the connection count
+        accordingly """
+        self.sampleID = None
+        factory = self.factory
+
+        now = time.time()
+        elapsed = max(0.001, now - self.lastSampleTime)
+        self.lastSampleTime = now
+
+        self.rate = factory.sampleReadBytes / elapsed
+        factory.sampleReadBytes = 0
+        self.clientRates = {}
+        for client in factory.clients:
+            self.clientRates[client] = client.sampleReadBytes / elapsed
+            client.sampleReadBytes = 0
+
+        if not factory.activated or Hellanzb.downloadPaused:
+            self.reset()
+        elif self.isSaturated():
+            self.adjust()
+
+        self.sampleID = reactor.callLater(self.SAMPLE_INTERVAL, self.sample)
+
+    def isSaturated(self):
+        """ Whether or not all of the wanted connections are busy downloading. The rates
+        aren't comparable otherwise (e.g. the queue is running dry) """
+        busy = [client for client in self.factory.clients \
+                if client.activated and not client.parking]
+        return len(busy) >= self.connections
+
+    def adjust(self):
+        """ Evaluate the last probe, or begin a new one """
+        if self.settling:
+            self.settling = False
+            return
+
+        if self.probe is not None:
+            action, previousRate = self.probe
+            self.probe = None
+            if action == self.GROW and \
+                    self.rate < previousRate * (1 + self.THRESHOLD):
+                self.shrink('added connection did not raise the rate (%s -> %s KB/s)' % \
+                            (toKB(previousRate), toKB(self.rate)))
+                self.probeDirection = self.SHRINK
+            elif action == self.SHRINK and \
+                    self.rate < previousRate * (1 - self.THRESHOLD):
+                self.grow('dropped connection lowered the rate (%s -> %s KB/s)' % \
+                          (toKB(previousRate), toKB(self.rate)))
+                self.probeDirection = self.GROW
+            else:
+                # Worth it, keep going in the same direction
+                self.record('keep', '%s KB/s (was %s KB/s)' % \
+                            (toKB(self.rate), toKB(previousRate)))
+                self.holdSamples = 1
+                self.probeSamples = self.PROBE_SAMPLES
+                return
+            # Reverted: hold steady for a while, longer each time
+            self.holdSamples = self.probeSamples
+            self.probeSamples = min(self.MAX_PROBE_SAMPLES, self.probeSamples * 2)
+            return
+
+        self.holdSamples -= 1
+        if self.holdSamples > 0:
+            return
+
+        if self.probeDirection == self.GROW and self.connections >= self.maxConnections:
+            self.probeDirection = self.SHRINK
+        elif self.probeDirection == self.SHRINK and \
+                self.connections <= self.minConnections:
+            self.probeDirection = self.GROW
+
+        previousRate = self.rate
+        if self.probeDirection == self.GROW:
+            probed = self.grow('probing with an additional connection')
+        else:
+            probed = self.shrink('probing without the slowest connection')
+
+        if probed:
+            self.probe = (self.probeDirection, previousRate)
+        else:
+            self.holdSamples = self.PROBE_SAMPLES
+
+    def grow(self, reason):
+        """ Open another connection: unpark a connection still winding down, otherwise
+        reconnect a parked connector """
+        if self.connections >= self.maxConnections:
+            return False
+
+        factory = self.factory
+        for client in factory.clients:
+            if client.parking:
+                client.parking = False
+                break
+        else:
+            if not len(factory.parkedConnectors):
+                return False
+            factory.parkedConnectors.pop(0).connect()
+
+        self.connections += 1
+        self.settling = True
+        self.record(self.GROW, reason)
+        return True
+
+    def shrink(self, reason):
+        """ Park the slowest connection. It's disconnected as soon as it finishes its current
+        segment """
+        if self.connections <= self.minConnections:
+            return False
+
+        client = None
+        for candidate in self.factory.clients:
+            if not candidate.isLoggedIn or candidate.parking:
+                continue
+            if client is None or \
+                    self.clientRates.get(candidate, 0) < self.clientRates.get(client, 0):
+                client = candidate
+        if client is None:
+            return False
+        clientRate = self.clientRates.get(client, 0)
+
+        client.parking = True
+        if client.currentSegment is None:
+            client.park()
+
+        self.connections -= 1
+        self.settling = True
+        self.record(self.SHRINK, '%s (parked %s at %s KB/s)' % \
+                    (reason, str(client), toKB(clientRate)))
+        return True
+
+    def record(self, action, reason):
+        """ Note a decision """
+        self.decisions.append((time.time(), action, self.connections, self.rate, reason))
+        if len(self.decisions) > self.MAX_DECISIONS:
+            self.decisions.pop(0)
+        if action != 'keep':
+            debug('ConnectionScaler (%s:%i): %s to %i connections: %s' % \
+                  (self.factory.host, self.factory.port, action, self.connections, reason))
+
+def toKB(rate):
+    """ Return the specified bytes/sec rate as a KB/s string """
+    return str(int(rate / 1024))
 
 def validWorkingFile(file, overwriteZeroByteFiles = False):
     """ Determine if the specified file path is a valid, existing file in the WORKING_DIR """
@@ -5,7 +5,7 @@ NZBModel - Representations of the NZB file format in memory
 (c) Copyright 2005 Philip Jenvey
 [See end of file]
 """
-import os, re, Hellanzb
+import copy, os, re, Hellanzb
 try:
     set
 except NameError:
@@ -18,7 +18,10 @@ from Hellanzb.Util import IDPool, UnicodeList, archiveName, getFileExtension, ge
     hellaRename, isHellaTemp, nuke, toUnicode
 from Hellanzb.NZBLeecher.ArticleDecoder import parseArticleData, setRealFileName, tryAssemble
 from Hellanzb.NZBLeecher.DupeHandler import handleDupeNZBFileNeedsDownload
-from Hellanzb.NZBLeecher.NZBLeecherUtil import validWorkingFile
+from Hellanzb.NZBLeecher.SegmentJournal import removeJournal
+from Hellanzb.NZBLeecher.SegmentPlacement import isPlacedNumber, loadSegmentMaps, \
+    resumePlacement, subjectKey
+from Hellanzb.NZBLeecher.WorkingDirIndex import SubjectMatcher
 from Hellanzb.PostProcessorUtil import Archive, getParEnum, getParName
 from Hellanzb.SmartPar import identifyPar, logSkippedPars, smartDequeue, smartRequeue
 
@@ -43,6 +46,9 @@ class NZB(Archive):
         self.skippedParFiles = []
         self.category = category
 
+        ## Maximum download rate (bytes/sec) of this NZB, 0 for no limit
+        self.maxRate = 0
+
         ## Where the nzb files will be downloaded
         self.destDir = Hellanzb.WORKING_DIR
 
@@ -60,13 +66,14 @@ class NZB(Archive):
 
         ## Whether the total byte count of this NZB is still being calculated
         self.calculatingBytes = True
+        ## Whether the NZB file is still being parsed while its download is underway (see
+        ## NZBSegmentQueue.streamNZB). It isn't done until the parse is
+        self.parsing = False
         
         ## How many bytes were skipped for downloading
         self.totalSkippedBytes = 0
         ## How many bytes have been downloaded for this NZB
         self.totalReadBytes = 0
-        ## How many bytes of encoded article data is currently cached to memory
-        self.cachedArticleDataBytes = 0
         ## Time this NZB began downloading
         self.downloadStartTime = None
         ## Amount of time taken to download the NZB
@@ -78,6 +85,9 @@ class NZB(Archive):
         ## are 0 bytes in size
         self.overwriteZeroByteFiles = True
 
+        ## The SegmentJournal of the download's progress (while downloading)
+        self.journal = None
+
         # All segment0001s are downloaded first. Every time we successfully decode a
         # segment0001, we add to this number
         self.firstSegmentsDownloaded = 0
@@ -124,6 +134,8 @@ class NZB(Archive):
         try:
             self.destDir = postponed
 
+            # The postponed dir is rescanned when it's resumed
+            removeJournal(self)
             move(self.nzbFileName, os.path.join(Hellanzb.QUEUE_DIR,
                                                 os.path.basename(self.nzbFileName)))
             self.nzbFileName = os.path.join(Hellanzb.QUEUE_DIR,
@@ -134,6 +146,7 @@ class NZB(Archive):
             # Move the postponed files to the new postponed dir
             for file in os.listdir(Hellanzb.WORKING_DIR):
                 move(os.path.join(Hellanzb.WORKING_DIR, file), os.path.join(postponed, file))
+            Hellanzb.workingDirIndex.invalidate()
         finally:
             self.assembleLock.release()
             
@@ -178,7 +191,6 @@ class NZB(Archive):
         self.totalBytes = 0
         self.totalSkippedBytes = 0
         self.totalReadBytes = 0
-        self.cachedArticleDataBytes = 0
         self.firstSegmentsDownloaded = 0
         ##self.neededBlocks = 0 # ?
         self.queuedBlocks = 0
@@ -410,6 +422,12 @@ class NZBFile:
         self.filename = None
         # The filename used temporarily until the real filename is determined
         self.tempFilename = None
+        # Bitmap of the segments placed directly into the partial file (see
+        # SegmentPlacement), when Hellanzb.DIRECT_PLACEMENT is enabled
+        self.segmentMap = None
+        # yEnc (begin, end) offsets of the segments decoded to their own segment files
+        # while placing, keyed by segment number
+        self.segmentOffsets = {}
         
         ## Optimizations
         # LAME: maintain a cached file name displayed in the scrolling UI, and whether or
@@ -501,13 +519,11 @@ class NZBFile:
         self.tempFilename = self.getTempFileName()
         return self.tempFilename
 
-    def needsDownload(self, workingDirListing, workingDirDupeMap):
-        """ Whether or not this NZBFile needs to be downloaded (isn't on the file system). You may
-        specify the optional workingDirListing so this function does not need to prune
-        this directory listing every time it is called (i.e. prune directory
-        names). workingDirListing should be a list of only filenames (basename, not
+    def needsDownload(self, workingDirMatcher, workingDirDupeMap):
+        """ Whether or not this NZBFile needs to be downloaded (isn't on the file system).
+        workingDirMatcher should be a SubjectMatcher of only filenames (basename, not
         including dirname) of files lying in Hellanzb.WORKING_DIR """
-        if os.path.isfile(self.getDestination()):
+        if Hellanzb.workingDirIndex.isFile(self.getDestination()):
             # This block only handles matching temporary file names
             self.nzb.firstSegmentsDownloaded += 1
             return False
@@ -526,24 +542,23 @@ class NZBFile:
                 return dupeNeedsDl
 
             # We only know about the temp filename. In that case, fall back to matching
-            # filenames in our subject line
-            for file in workingDirListing:
-                # Whole file match
-                if self.subject.find(file) > -1:
-                    # No need for setRealFileName(self, file)'s extra work here
-                    self.filename = file
-                    
-                    # Prevent matching of this file multiple times
-                    workingDirListing.remove(file)
-
-                    if Hellanzb.SMART_PAR:
-                        identifyPar(self)
-                        if self.isPar:
-                            debug('needsDownload: Found par on disk: %s isExtraPar: %s' % \
-                                  (file, str(self.isExtraPar)))
-                        
-                    self.nzb.firstSegmentsDownloaded += 1
-                    return False
+            # filenames in our subject line (whole file match)
+            file = workingDirMatcher.match(self.subject)
+            if file is not None:
+                # No need for setRealFileName(self, file)'s extra work here
+                self.filename = file
+
+                # Prevent matching of this file multiple times
+                workingDirMatcher.remove(file)
+
+                if Hellanzb.SMART_PAR:
+                    identifyPar(self)
+                    if self.isPar:
+                        debug('needsDownload: Found par on disk: %s isExtraPar: %s' % \
+                              (file, str(self.isExtraPar)))
+
+                self.nzb.firstSegmentsDownloaded += 1
+                return False
     
         return True
 
@@ -575,8 +590,16 @@ class NZBFile:
     #           self.subject
     #    return msg
 
-class NZBSegment:
+class NZBSegment(object):
     """ <file><segment/></file> """
+    # Large NZBs have hundreds of thousands of segments: they're kept compact (no per
+    # instance __dict__)
+    __slots__ = ('bytes', 'number', 'messageId', 'nzbFile', 'encodedDataList',
+                 'encodedDataFile', 'cachedToDisk', 'yDecoder', 'articleData', 'readBytes',
+                 'cachedArticleDataBytes', 'yCrc', 'yBegin', 'yEnd', 'ySize', 'priority',
+                 'failedServerPools', 'dontRequeue', 'fromQueue', 'fromServer',
+                 'hedgeClients', 'hedgeOf', 'hedgeLost', 'fetchTime', 'crcFailedOf',
+                 'crcFailedCopies', 'crcExhaustedMessage')
     
     def __init__(self, bytes, number, messageId, nzbFile):
         ## XML attributes
@@ -603,16 +626,22 @@ class NZBSegment:
         # Whether or not decoded data for this segment is written to disk, or
         # kept in memory
         self.cachedToDisk = False
+
+        ## The YDecoder the article data is fed to as it's downloaded. When the article is
+        ## yEncoded, encodedDataList/encodedDataFile hold its already decoded data
+        self.yDecoder = None
         
         ## Downloaded article data stored as an array of lines whose CRLFs are stripped
         ## NOTE: encodedDataList and encodedDataFile are splitlines() into this list for
-        ## use by the ArticleDecoder. In the future we should avoid this translation,
-        ## somehow. Also note that NZBFile.getFilename relies on this variable being None
+        ## use by the ArticleDecoder, unless the article was yDecoded as it was
+        ## downloaded (see yDecoder). Also note that NZBFile.getFilename relies on this variable being None
         ## until the entire segment has been downloaded and put here.
         self.articleData = None
 
         ## Number of bytes downloaded
         self.readBytes = 0
+        # Number of those bytes tallied by the ArticleCache (until decoded)
+        self.cachedArticleDataBytes = 0
 
         ## yEncoder header keywords used for validation. Optional, obviously not used for
         ## UUDecoded segments
@@ -624,8 +653,9 @@ class NZBSegment:
         ## A copy of the priority level of this segment, as set in the NZBQueue
         self.priority = None
 
-        ## Any server pools that failed to download this file
-        self.failedServerPools = []
+        ## Any server pools that failed to download this file. A tuple, shared by all
+        ## segments until one fails (see failedOn)
+        self.failedServerPools = ()
 
         # This flag is set when we want to trash the NZB and prevent the leechers from
         # trying to requeue it
@@ -637,6 +667,77 @@ class NZBSegment:
         # The NZBLeecherFactory this segment was last downloaded from
         self.fromServer = None
 
+        ## Endgame hedging (see NZBLeecher.startHedge). When the segment is hedged, multiple
+        ## NZBLeechers download it at once: the NZBLeecher of the original download, and
+        ## others downloading copies of it (hedgeCopy). hedgeClients lists them all
+        self.hedgeClients = None
+        # The segment this is a hedgeCopy of
+        self.hedgeOf = None
+        # Whether or not this download lost to another (its data is to be discarded)
+        self.hedgeLost = False
+        # When its BODY began arriving
+        self.fetchTime = None
+
+        ## CRC failures are detected as soon as the article is received (see
+        ## ArticleDecoder.requeueCRCFailed). The failed download is handed to the decode
+        ## threads as a crcFailedCopy, while the segment itself is requeued. The segment
+        ## this is a crcFailedCopy of
+        self.crcFailedOf = None
+        # Number of crcFailedCopies of this segment yet to be written out
+        self.crcFailedCopies = 0
+        # The CRC failure message, when all servers failed to get a good copy of the
+        # segment (handled once all its crcFailedCopies are written out)
+        self.crcExhaustedMessage = None
+
+    def failedOn(self, serverPoolName):
+        """ Mark the specified server pool as having failed to download this segment """
+        self.failedServerPools += (serverPoolName,)
+
+    def hedgeCopy(self):
+        """ Return a copy of this segment, for downloading it a second time """
+        hedge = copy.copy(self)
+        hedge.hedgeOf = self
+        hedge.hedgeClients = None
+        hedge.encodedDataList = None
+        hedge.encodedDataFile = None
+        hedge.cachedToDisk = False
+        hedge.yDecoder = None
+        hedge.articleData = None
+        hedge.readBytes = 0
+        hedge.cachedArticleDataBytes = 0
+        hedge.fetchTime = None
+        return hedge
+
+    def crcFailedCopy(self):
+        """ Return a copy of this segment taking on its download (which failed the CRC
+        check), resetting this segment for downloading it again """
+        failed = copy.copy(self)
+        failed.crcFailedOf = self
+        self.crcFailedCopies += 1
+
+        self.encodedDataList = None
+        self.encodedDataFile = None
+        self.cachedToDisk = False
+        self.yDecoder = None
+        self.readBytes = 0
+        self.cachedArticleDataBytes = 0
+        self.fetchTime = None
+        return failed
+
+    def adoptDownload(self, hedge):
+        """ Take on the downloaded data of the specified hedgeCopy, in place of our own. Only
+        the original download's bytes are tallied by the NZBFile/NZB statistics, account
+        for the difference """
+        difference = hedge.readBytes - self.readBytes
+        self.nzbFile.totalReadBytes += difference
+        self.nzbFile.nzb.totalReadBytes += difference
+
+        self.encodedDataList = hedge.encodedDataList
+        self.encodedDataFile = hedge.encodedDataFile
+        self.cachedToDisk = hedge.cachedToDisk
+        self.yDecoder = hedge.yDecoder
+        self.readBytes = hedge.readBytes
+
     def getDestination(self):
         """ Where this decoded segment will reside on the fs """
         return self.nzbFile.getDestination() + '.segment' + str(self.number).zfill(4)
@@ -690,7 +791,43 @@ class NZBSegment:
     #           str(self.number) + ' subject: ' + self.nzbFile.subject
 
 segmentEndRe = re.compile(r'^segment\d{4}$')
-def segmentsNeedDownload(segmentList, overwriteZeroByteSegments = False):
+def scanWorkingSegments(overwriteZeroByteSegments = False):
+    """ Scan the WORKING_DIR (via the workingDirIndex) for segments, for
+    segmentsNeedDownload. Returns a tuple of the on disk segment filenames (a map of sets
+    keyed by segment number), a SubjectMatcher of those filenames, and the segment maps """
+    onDiskSegmentsByNumber = {}
+    segmentFileMatcher = SubjectMatcher()
+
+    workingDirIndex = Hellanzb.workingDirIndex
+    files = workingDirIndex.listing()
+
+    # Segments placed directly into their file's partial file are listed in segment maps,
+    # keyed by their NZBFile's subject
+    segmentMaps = loadSegmentMaps(Hellanzb.WORKING_DIR, files)
+
+    # Cache all WORKING_DIR segment filenames in a map of sets
+    for file in files:
+        ext = getFileExtension(file)
+        if ext is None or not segmentEndRe.match(ext) or \
+                not workingDirIndex.isValid(file, overwriteZeroByteSegments):
+            continue
+
+        segmentNumber = int(ext[-4:])
+        if onDiskSegmentsByNumber.has_key(segmentNumber):
+            segmentFileNames = onDiskSegmentsByNumber[segmentNumber]
+        else:
+            segmentFileNames = set()
+            onDiskSegmentsByNumber[segmentNumber] = segmentFileNames
+
+        # cut off .segmentXXXX
+        fileNoExt = file[:-12]
+        segmentFileNames.add(fileNoExt)
+        segmentFileMatcher.add(fileNoExt)
+
+    return onDiskSegmentsByNumber, segmentFileMatcher, segmentMaps
+
+def segmentsNeedDownload(segmentList, overwriteZeroByteSegments = False,
+                         workingSegments = None):
     """ Faster version of needsDownload for multiple segments that do not have their real file
     name (for use by the Queue).
 
@@ -701,58 +838,68 @@ def segmentsNeedDownload(segmentList, overwriteZeroByteSegments = False):
     This function is the second pass. It takes all of those NZBFiles that need to be
     downloaded's child NZBSegments and scans the disk, detecting which segments are
     already on disk and can be skipped
-    """
-    # Arrange all WORKING_DIR segment's filenames in a list. Key this list by segment
-    # number in a map. Loop through the specified segmentList, doing a subject.find for
-    # each segment filename with a matching segment number
 
-    onDiskSegmentsByNumber = {}
+    A previous scanWorkingSegments can be passed as workingSegments, to check multiple
+    segmentLists against one scan of the disk (matched segments are removed from it)
+    """
+    # Arrange all WORKING_DIR segment's filenames in sets. Key these sets by segment
+    # number in a map. Each NZBFile's subject is matched against all of the segment
+    # filenames once, then its segments are looked up by their number in that map
+    if workingSegments is None:
+        workingSegments = scanWorkingSegments(overwriteZeroByteSegments)
+    onDiskSegmentsByNumber, segmentFileMatcher, segmentMaps = workingSegments
     
     needDlFiles = set() # for speed while iterating
     needDlSegments = []
     onDiskSegments = []
 
-    # Cache all WORKING_DIR segment filenames in a map of lists
-    for file in os.listdir(Hellanzb.WORKING_DIR):
-        if not validWorkingFile(os.path.join(Hellanzb.WORKING_DIR, file),
-                                overwriteZeroByteSegments):
-            continue
-        
-        ext = getFileExtension(file)
-        if ext is not None and segmentEndRe.match(ext):
-            segmentNumber = int(ext[-4:])
-            
-            if onDiskSegmentsByNumber.has_key(segmentNumber):
-                segmentFileNames = onDiskSegmentsByNumber[segmentNumber]
-            else:
-                segmentFileNames = []
-                onDiskSegmentsByNumber[segmentNumber] = segmentFileNames
-
-            # cut off .segmentXXXX
-            fileNoExt = file[:-12]
-            segmentFileNames.append(fileNoExt)
+    # The segment filenames found in each NZBFile's subject
+    subjectMatches = {}
 
     # Determine if each segment needs to be downloaded
     for segment in segmentList:
 
-        if not onDiskSegmentsByNumber.has_key(segment.number):
+        foundFileName = None
+        if len(segmentMaps):
+            placedFileName, segmentMap = \
+                segmentMaps.get(subjectKey(segment.nzbFile.subject), (None, None))
+            if placedFileName is not None:
+                resumePlacement(segment.nzbFile, segmentMap)
+                if isPlacedNumber(segment.nzbFile.segmentMap, segment.number):
+                    foundFileName = placedFileName
+
+                if not segment.isFirstSegment() and segment.nzbFile.filename is None:
+                    # The partial file is named after the real filename. The first
+                    # segment's real filename HACK (below) isn't needed here
+                    segment.nzbFile.filename = placedFileName
+        placed = foundFileName is not None
+
+        if not placed and not onDiskSegmentsByNumber.has_key(segment.number):
             # No matching segment numbers, obviously needs to be downloaded
             needDlSegments.append(segment)
             needDlFiles.add(segment.nzbFile)
             continue
 
-        segmentFileNames = onDiskSegmentsByNumber[segment.number]
-        
-        foundFileName = None
-        for segmentFileName in segmentFileNames:
+        if not placed:
+            segmentFileNames = onDiskSegmentsByNumber[segment.number]
+            matches = subjectMatches.get(segment.nzbFile)
+            if matches is None:
+                matches = segmentFileMatcher.matches(segment.nzbFile.subject)
+                subjectMatches[segment.nzbFile] = matches
+
             # We've matched to our on disk segment if we:
-            # a) find that on disk segment's file name in our potential segment's subject
-            # b) match that on disk segment's file name to our potential segment's temp
-            # file name (w/ .segmentXXXX cutoff)
-            if segment.nzbFile.subject.find(segmentFileName) > -1 or \
-                    segment.getTempFileName()[:-12] == segmentFileName:
-                foundFileName = segmentFileName
-                break
+            # a) find that on disk segment's file name in our potential segment's
+            # subject
+            # b) match that on disk segment's file name to our potential segment's
+            # temp file name (w/ .segmentXXXX cutoff)
+            for segmentFileName in matches:
+                if segmentFileName in segmentFileNames:
+                    foundFileName = segmentFileName
+                    break
+            else:
+                tempFileName = segment.getTempFileName()[:-12]
+                if tempFileName in segmentFileNames:
+                    foundFileName = tempFileName
 
         if not foundFileName:
             needDlSegments.append(segment)
@@ -789,7 +936,8 @@ def segmentsNeedDownload(segmentList, overwriteZeroByteSegments = False):
 
             # This segment was matched. Remove it from the list to avoid matching it again
             # later (dupes)
-            segmentFileNames.remove(foundFileName)
+            if not placed:
+                segmentFileNames.remove(foundFileName)
 
         #else:
         #    debug('SKIPPING SEGMENT: ' + segment.getTempFileName() + ' subject: ' + \
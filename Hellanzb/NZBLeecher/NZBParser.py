@@ -5,19 +5,20 @@ NZBParser - Parses NZB XML into NZBModels
 (c) Copyright 2005 Philip Jenvey
 [See end of file]
 """
-import os, re, Hellanzb
+import os, re, time, Hellanzb
 try:
     set
 except NameError:
     from sets import Set as set
 from sets import Set
-from xml.sax import make_parser, SAXParseException
-from xml.sax.handler import feature_external_ges, feature_namespaces, ContentHandler
+from xml.sax import SAXParseException
+from xml.sax.handler import ContentHandler
 from Hellanzb.Log import *
 from Hellanzb.Util import DUPE_SUFFIX
 from Hellanzb.NZBLeecher.DupeHandler import handleDupeOnDisk
-from Hellanzb.NZBLeecher.NZBLeecherUtil import validWorkingFile
+from Hellanzb.NZBLeecher.NZBCache import cachedTotalBytes, parseNZBFile
 from Hellanzb.NZBLeecher.NZBModel import NZBFile, NZBSegment
+from Hellanzb.NZBLeecher.WorkingDirIndex import SubjectMatcher
 
 __id__ = '$Id$'
 
@@ -26,7 +27,8 @@ FAILED_ALT_SERVER_SEGMENT_RE = re.compile('.*-hellafailed_.*$')
 class NZBParser(ContentHandler):
     """ Parse an NZB 1.0 file into an NZBSegmentQueue
     http://www.newzbin.com/DTD/nzb/nzb-1.0.dtd """
-    def __init__(self, nzb, needWorkFiles, needWorkSegments):
+    def __init__(self, nzb, needWorkFiles, needWorkSegments, fileParsedFunc = None,
+                 journal = None):
         # nzb file to parse
         self.nzb = nzb
 
@@ -35,6 +37,13 @@ class NZBParser(ContentHandler):
         self.needWorkFiles = needWorkFiles
         self.needWorkSegments = needWorkSegments
 
+        # Called with each of the needWorkFiles as soon as all of its segments are parsed
+        self.fileParsedFunc = fileParsedFunc
+
+        # The NZB's SegmentJournal. When replaying, files on disk are determined from it
+        # instead of the WORKING_DIR. Otherwise the files found on disk are recorded to it
+        self.journal = journal
+
         # parsing variables
         self.file = None
         self.bytes = None
@@ -49,8 +58,8 @@ class NZBParser(ContentHandler):
         # All encountered segment numbers for the current NZBFile
         self.segmentNumbers = set()
         
-        # Current listing of existing files in the WORKING_DIR
-        self.workingDirListing = []
+        # Existing files in the WORKING_DIR, to match against the NZBFile's subjects
+        self.workingDirMatcher = SubjectMatcher()
         
         # Map of duplicate filenames -- @see DupeHandler.handleDupeOnDisk
         self.workingDirDupeMap = {}
@@ -58,28 +67,30 @@ class NZBParser(ContentHandler):
         # heapq priority
         from Hellanzb.NZBLeecher.NZBSegmentQueue import NZBSegmentQueue
         self.nzbContentPriority = NZBSegmentQueue.NZB_CONTENT_P
+
+        if journal is not None and journal.replaying:
+            return
         
-        files = os.listdir(Hellanzb.WORKING_DIR)
-        files.sort()
-        for file in files:
+        workingDirIndex = Hellanzb.workingDirIndex
+        for file in workingDirIndex.listing():
 
             # Anonymous duplicate file segments lying around are too painful to keep track
             # of. As are segments that previously failed on different servers
             if DUPE_SEGMENT_RE.match(file) or FAILED_ALT_SERVER_SEGMENT_RE.match(file):
                 os.remove(os.path.join(Hellanzb.WORKING_DIR, file))
+                workingDirIndex.refresh(os.path.join(Hellanzb.WORKING_DIR, file))
                 continue
 
             # Add an entry to the self.workingDirDupeMap if this file looks like a
-            # duplicate, and also skip adding it to self.workingDirListing (dupes are
+            # duplicate, and also skip adding it to self.workingDirMatcher (dupes are
             # handled specially so we don't care for them there)
             if handleDupeOnDisk(file, self.workingDirDupeMap):
                 continue
             
-            if not validWorkingFile(os.path.join(Hellanzb.WORKING_DIR, file),
-                                    self.nzb.overwriteZeroByteFiles):
+            if not workingDirIndex.isValid(file, self.nzb.overwriteZeroByteFiles):
                 continue
 
-            self.workingDirListing.append(file)
+            self.workingDirMatcher.add(file)
             
     def startElement(self, name, attrs):
         if name == 'file':
@@ -89,9 +100,7 @@ class NZBParser(ContentHandler):
             self.file = NZBFile(subject, attrs.get('date'), poster, self.nzb)
             self.segmentNumbers.clear()
 
-            self.fileNeedsDownload = \
-                self.file.needsDownload(workingDirListing = self.workingDirListing,
-                                        workingDirDupeMap = self.workingDirDupeMap)
+            self.fileNeedsDownload = self.needsDownload(self.file)
 
             # Special handling for par recovery downloads
             extraMsg = ''
@@ -139,6 +148,8 @@ class NZBParser(ContentHandler):
         if name == 'file':
             if self.fileNeedsDownload:
                 self.needWorkFiles.append(self.file)
+                if self.fileParsedFunc is not None:
+                    self.fileParsedFunc(self.file)
             else:
                 # done adding all child segments to this NZBFile. make note that none of
                 # them need to be downloaded
@@ -181,6 +192,17 @@ class NZBParser(ContentHandler):
             self.number = None
             self.bytes = None    
 
+    def needsDownload(self, nzbFile):
+        """ Whether or not the nzbFile needs to be downloaded (isn't on disk) """
+        if self.journal is not None and self.journal.replaying:
+            return self.journal.fileNeedsDownload(nzbFile)
+
+        needsDownload = nzbFile.needsDownload(workingDirMatcher = self.workingDirMatcher,
+                                              workingDirDupeMap = self.workingDirDupeMap)
+        if not needsDownload and self.journal is not None:
+            self.journal.fileAssembled(nzbFile)
+        return needsDownload
+
     def parseUnicode(self, unicodeOrStr):
         if isinstance(unicodeOrStr, unicode):
             unicodeOrStr = unicodeOrStr.encode('latin-1')
@@ -203,20 +225,14 @@ class NZBTotalBytesParser(ContentHandler):
     def getBytes(nzb):
         """ Return the number of bytes the specified NZB represents """
         s = time.time()
-        # Create a parser
-        parser = make_parser()
-
-        # No XML namespaces here
-        parser.setFeature(feature_namespaces, 0)
-        parser.setFeature(feature_external_ges, 0)
-
-        # Tell the parser to use it
         p = NZBTotalBytesParser()
-        parser.setContentHandler(p)
+        p.bytes = cachedTotalBytes(nzb.nzbFileName)
 
-        # Parse the input
+        # Parse the input (caching it for the NZBParser)
         try:
-            parser.parse(nzb.nzbFileName)
+            if p.bytes is None:
+                p.bytes = 0
+                parseNZBFile(nzb.nzbFileName, p)
         except SAXParseException, saxpe:
             debug('Unable to parse invalid NZB file: %s: %s: exception: %s' % \
                   (os.path.basename(nzb.nzbFileName), saxpe.getMessage(),
@@ -13,226 +13,239 @@ except NameError:
     from sets import Set as set
 from threading import Lock
 from twisted.internet import reactor
-from xml.sax import make_parser, SAXParseException
-from xml.sax.handler import feature_external_ges, feature_namespaces
+from twisted.internet.threads import deferToThread
+from xml.sax import SAXParseException
 from Hellanzb.Log import *
 from Hellanzb.Util import EmptyForThisPool, PoolsExhausted, PriorityQueue, OutOfDiskSpace, \
     archiveName, isHellaTemp, prettySize
 from Hellanzb.PostProcessorUtil import getParRecoveryName
 from Hellanzb.SmartPar import getParSize, logSkippedPars, smartRequeue
-from Hellanzb.NZBLeecher.ArticleDecoder import assembleNZBFile
-from Hellanzb.NZBLeecher.NZBModel import segmentsNeedDownload, NZBFile
+from Hellanzb.NZBLeecher.ArticleDecoder import assembleNZBFile, decode, postDecodeLock
+from Hellanzb.NZBLeecher.NZBCache import parseNZBFile
+from Hellanzb.NZBLeecher.NZBModel import scanWorkingSegments, segmentsNeedDownload, NZBFile
 from Hellanzb.NZBLeecher.NZBParser import NZBParser
+from Hellanzb.NZBLeecher.SegmentJournal import openJournal
+from Hellanzb.NZBLeecher.SegmentRouter import SegmentRouter
+from heapq import heapify, heappop, heappush
 from Queue import Empty
 
 __id__ = '$Id$'
 
 class RetryQueue:
-    """ Maintains various PriorityQueues for requeued segments. Each PriorityQueue maintained
-    is keyed by a string describing what serverPools previously failed to download that
-    queue's segments """
+    """ Maintains the requeued segments, each excluded from the serverPools that previously
+    failed to download it (or passed on it). Every serverPool is assigned a bit: a segment's
+    mask holds the bits of the serverPools it's excluded from
+
+    Each serverPool has its own heap of the segments it may retry, so get() is O(log n)
+    regardless of the number of serverPools. Segments are pushed onto the heap of every
+    serverPool not in their mask. Once one serverPool gets (or dequeueSegments removes) a
+    segment, the entries left on the other heaps are dead, and are skipped when they reach
+    the top """
+    # Rebuild the heaps when they hold this many times more entries than there are live
+    # ones
+    COMPACT_RATIO = 4
+    
     def __init__(self):
         # all the known pool names
         self.serverPoolNames = []
-        
-        # dict to lookup the priority by name -- the name describes which serverPools
-        # should NOT look into that particular queue. Example: 'not1not2not4'
-        self.poolQueues = {}
-
-        # map of serverPoolNames to their list of valid retry queue names
-        self.nameIndex = {}
-
-        # A list of all queue names
-        self.allNotNames = []
+        # map of serverPoolNames to their bits, and all of those bits
+        self.poolBits = {}
+        self.allPoolsMask = 0
+        self.nextBit = 1
+
+        # map of serverPoolNames to the heap of entries they may retry. Entries are lists
+        # of: [priority, sequence number, segment, mask, live]
+        self.poolHeaps = {}
+        # map of segments to their live entry
+        self.entries = {}
+        self.sequence = 0
+
+        # Whether or not createQueues was called
+        self.created = False
+        self.lock = Lock()
 
     def clear(self):
         """ Clear all the queues """
-        for queue in self.poolQueues.itervalues():
-            queue.clear()
+        self.lock.acquire()
+        try:
+            for heap in self.poolHeaps.itervalues():
+                del heap[:]
+            self.entries.clear()
+        finally:
+            self.lock.release()
 
     def addServerPool(self, serverPoolName):
-        """ Add an additional serverPool. This does not create any associated PriorityQueues, that
-        work is done by createQueues """
-        self.serverPoolNames.append(serverPoolName)
+        """ Add an additional serverPool. It may retry all of the currently queued segments
+        """
+        self.lock.acquire()
+        try:
+            self.serverPoolNames.append(serverPoolName)
+            self.poolBits[serverPoolName] = self.nextBit
+            self.allPoolsMask |= self.nextBit
+            self.nextBit <<= 1
+
+            heap = self.poolHeaps[serverPoolName] = self.entries.values()
+            heapify(heap)
+        finally:
+            self.lock.release()
 
     def removeServerPool(self, serverPoolName):
-        """ Remove a serverPool. FIXME: probably never needed, so not implemented """
-        raise NotImplementedError()
+        """ Remove a serverPool. Returns the queued segments no remaining serverPool is left to
+        retry (they're dequeued) """
+        self.lock.acquire()
+        try:
+            self.serverPoolNames.remove(serverPoolName)
+            self.allPoolsMask &= ~self.poolBits.pop(serverPoolName)
+            del self.poolHeaps[serverPoolName]
+
+            exhausted = []
+            for segment, entry in self.entries.items():
+                if entry[3] & self.allPoolsMask != self.allPoolsMask:
+                    continue
+
+                failedMask = self.getMask(segment.failedServerPools)
+                if failedMask & self.allPoolsMask == self.allPoolsMask:
+                    self._kill(segment)
+                    exhausted.append(segment)
+                else:
+                    # The remaining serverPools only passed on it: they may retry it
+                    entry[3] = failedMask
+                    for poolName, heap in self.poolHeaps.iteritems():
+                        if not failedMask & self.poolBits[poolName]:
+                            heappush(heap, entry)
+            self._maybeCompact()
+            return exhausted
+        finally:
+            self.lock.release()
 
     def needRetryQueue(self):
         """ Determine whether or not the RetryQueue is needed (should be
         enabled). len(serverPoolNames) > 1 """
         return len(self.serverPoolNames) > 1
 
-    def requeue(self, serverPoolName, segment):
+    def getMask(self, poolNames):
+        """ Return the mask of the specified serverPools (unknown ones are ignored) """
+        mask = 0
+        for poolName in poolNames:
+            mask |= self.poolBits.get(poolName, 0)
+        return mask
+
+    def requeue(self, serverPoolName, segment, passed = False):
         """ Requeue the segment (which failed to download on the specified serverPool) for later
         retry by another serverPool
 
-        The segment is requeued by adding it to the correct PriorityQueue -- dictated by
-        which serverPools have previously failed to download the specified segment. A
-        PoolsExhausted exception is thrown when all serverPools have failed to download
-        the segment """
+        The segment is requeued onto the heaps of the serverPools that haven't previously
+        failed to download it. A PoolsExhausted exception is thrown when all serverPools
+        have failed to download the segment
+
+        When passed is True the specified serverPool didn't fail, it passed on the segment
+        (see SegmentRouter). It's excluded from the segment's queue just the same, but
+        isn't marked as failed """
+        mask = self.getMask(segment.failedServerPools)
         # All serverPools we know about failed to download this segment
-        if len(segment.failedServerPools) == len(self.serverPoolNames):
+        if mask & self.allPoolsMask == self.allPoolsMask:
             raise PoolsExhausted()
 
-        # Figure out the correct queue by looking at the previously failed serverPool
-        # names
-        notName = ''
-        i = 0
-        for poolName in self.serverPoolNames:
-            i += 1
-            if poolName in segment.failedServerPools:
-                notName += 'not' + str(i)
+        if passed:
+            passedMask = mask | self.poolBits.get(serverPoolName, 0)
+            if passedMask & self.allPoolsMask != self.allPoolsMask:
+                mask = passedMask
+            # Otherwise there's no one else to pass it to
 
-        # Requeued for later
-        self.poolQueues[notName].put((segment.priority, segment))
+        self.lock.acquire()
+        try:
+            if segment in self.entries:
+                # Already queued (shouldn't happen): replace it
+                self._kill(segment)
+
+            entry = [segment.priority, self.sequence, segment, mask, True]
+            self.sequence += 1
+            self.entries[segment] = entry
+            for poolName, heap in self.poolHeaps.iteritems():
+                if not mask & self.poolBits[poolName]:
+                    heappush(heap, entry)
+            self._maybeCompact()
+        finally:
+            self.lock.release()
 
     def dequeueSegments(self, segments):
         """ Dequeue the specified nzb segments """
-        dequeued = []
-        for queue in self.poolQueues.itervalues():
-            poolDequeued = queue.dequeueItems([(segment.priority, segment) for segment \
-                                               in segments])
-            dequeued.extend([segment for priority, segment in poolDequeued])
-        return dequeued
-    
+        self.lock.acquire()
+        try:
+            dequeued = []
+            for segment in segments:
+                if segment in self.entries:
+                    self._kill(segment)
+                    dequeued.append(segment)
+            self._maybeCompact()
+            return dequeued
+        finally:
+            self.lock.release()
+
     def get(self, serverPoolName):
         """ Return the next segment for the specified serverPool that is queued to be retried """
-        # Loop through all the valid priority queues for the specified serverPool
-        valids = self.nameIndex[serverPoolName]
-        for queueName in valids:
-            queue = self.poolQueues[queueName]
+        self.lock.acquire()
+        try:
+            heap = self.poolHeaps[serverPoolName]
+            while len(heap):
+                entry = heappop(heap)
+                if not entry[4]:
+                    # Already taken by another serverPool
+                    continue
 
-            # Found a segment waiting to be retried
-            if len(queue):
-                return queue.get_nowait()
+                segment = entry[2]
+                self._kill(segment)
+                return entry[0], segment
+        finally:
+            self.lock.release()
 
         raise Empty()
 
-    def __len__(self):
-        length = 0
-        for queue in self.poolQueues.itervalues():
-            length += len(queue)
-        return length
-
-    def createQueues(self):
-        """ Create the retry PriorityQueues for all known serverPools
-
-        This is a hairy way to do this. It's not likely to scale for more than probably
-        4-5 serverPools. However it is functionally ideal for a reasonable number of
-        serverPools
-
-        The idea is you want your downloaders to always be busy. Without the RetryQueue,
-        they would simply always pull the next available segment out of the main
-        NZBSegmentQueue. Once the NZBSegmentQueue was empty, all downloaders knew they
-        were done
-
-        Now that we desire the ability to requeue a segment that failed on a particular
-        serverPool, the downloaders need to exclude the segments they've previously failed
-        to download, when pulling segments out of the NZBSegmentQueue
-
-        If we continue keeping all queued (and now requeued) segments in the same queue,
-        the potentially many downloaders could easily end up going through the entire
-        queue seeking a segment they haven't already tried. This is unacceptable when our
-        queues commonly hold over 60K items
-
-        The best way I can currently see to support the downloaders being able to quickly
-        lookup the 'actual' next segment they want to download is to have multiple queues,
-        indexed by what serverPool(s) have previously failed on those segments
-
-        If we have 3 serverPools (1, 2, and 3) we end up with a dict looking like:
-
-        not1     -> q
-        not2     -> q
-        not3     -> q
-        not1not2 -> q
-        not1not3 -> q
-        not2not3 -> q
-
-        I didn't quite figure out the exact equation to gather the number of Queues in
-        regard to the number of serverPools, but (if my math is right) it seems to grow
-        pretty quickly (is quadratic)
-
-        Every serverPool avoids certain queues. In the previous example, serverPool 1 only
-        needs to look at all the Queues that are not tagged as having already failed on 1
-        (not2, not3, and not2not3) -- only half of the queues
-
-        The numbers:
-
-        serverPools    totalQueues    onlyQueues
-
-        2              2              1
-        3              6              3
-        4              14             7
-        5              30             15
-        6              62             31
-        7              126            63
-
-        The RetryQueue.get() algorithim simply checks all queues for emptyness until it
-        finds one with items in it. The > 5 is worrysome. That means for 6 serverPools,
-        the worst case scenario (which could be very common in normal use) would be to
-        make 31 array len() calls. With a segment size of 340KB, downloading at 1360KB/s,
-        (and multiple connections) we could be doing those 31 len() calls on average of 4
-        times a second. And with multiple connections, this could easily spurt to near
-        your max connection count, per second (4, 10, even 30 connections?)
-
-        Luckily len() calls are as quick as can be and who the hell uses 6 different
-        usenet providers anyway? =]
-        """
-        # Go through all the serverPools and create the initial 'not1' 'not2'
-        # queues
-        # FIXME: could probably let the recursive function take care of this
-        for i in range(len(self.serverPoolNames)):
-            notName = 'not' + str(i + 1)
-            self.poolQueues[notName] = PriorityQueue()
-
-            self._recurseCreateQueues([i], i, len(self.serverPoolNames))
-
-        # Finished creating all the pools. Now index every pool's list of valid retry
-        # queues they need to check.  (using the above docstring, serverPool 1 would have
-        # a list of 'not2', 'not3', and 'not2not3' in its nameIndex
-        i = 0
-        for name in self.serverPoolNames:
-            i += 1
-            
-            valids = []
-            for notName in self.poolQueues.keys():
-                if notName.find('not' + str(i)) > -1:
-                    continue
-                valids.append(notName)
-            self.nameIndex[name] = valids
-
-    def _recurseCreateQueues(self, currentList, currentIndex, totalCount):
-        """ Recurse through, creating the matrix of 'not1not2not3not4not5' etc and all its
-        variants. Avoid creating duplicates """
-        # Build the original notName
-        notName = ''
-        for i in currentList:
-            notName += 'not' + str(i + 1)
-
-        if len(currentList) >= totalCount - 1:
-            # We've reached the end
+    def _kill(self, segment):
+        """ Remove the segment's entry (left on the heaps as a dead entry) """
+        self.entries.pop(segment)[4] = False
+
+    def _maybeCompact(self):
+        """ Drop the dead entries from all the heaps, when there are too many of them """
+        heapEntries = 0
+        for heap in self.poolHeaps.itervalues():
+            heapEntries += len(heap)
+        if heapEntries <= self.COMPACT_RATIO * (len(self.entries) + 64) * \
+                max(1, len(self.poolHeaps)):
             return
 
-        for x in range(totalCount):
-            if x == currentIndex or x in currentList:
-                # We've already not'd x, skip it
-                continue
-
-            newList = currentList[:]
-            newList.append(x)
-            newList.sort()
-
-            if newList in self.allNotNames:
-                # this notName == an already generated notName, skip it
-                continue
+        for heap in self.poolHeaps.itervalues():
+            heap[:] = [entry for entry in heap if entry[4]]
+            heapify(heap)
 
-            self.allNotNames.append(newList)
+    def __len__(self):
+        return len(self.entries)
 
-            newNotName = notName + 'not' + str(x + 1)
-            self.poolQueues[newNotName] = PriorityQueue()
-            self._recurseCreateQueues(newList, x, totalCount)
+    def createQueues(self):
+        """ Enable the RetryQueue for all known serverPools. Their heaps are maintained as
+        serverPools are added or removed, so there's nothing left to create """
+        self.created = True
+
+class StreamStopped(Exception):
+    """ The NZB was canceled or postponed while it was being streamed into the queue """
+    pass
+
+class NZBStream:
+    """ An NZB being streamed into the queue (see NZBSegmentQueue.streamNZB) """
+    def __init__(self, nzb, verbose = True):
+        self.nzb = nzb
+        self.verbose = verbose
+
+        # Whether or not the NZB's download has begun
+        self.begun = False
+        # The NZB's SegmentJournal (None when disabled)
+        self.journal = None
+        # The scanWorkingSegments shared by all of the NZB's files
+        self.workingSegments = None
+        # The NZBFiles with segments that need to be downloaded
+        self.needDlFiles = set()
+        self.onDiskSegmentsCount = 0
+        self.onDiskSegmentBytes = 0
 
 class NZBSegmentQueue(PriorityQueue):
     """ priority fifo queue of segments to download. lower numbered segments are downloaded
@@ -240,6 +253,8 @@ class NZBSegmentQueue(PriorityQueue):
     NZB_CONTENT_P = 100000 # normal nzb downloads
     # FIXME: EXTRA_PAR2_P isn't actually used
     EXTRA_PAR2_P = 0 # par2 after-the-fact downloads are more important
+    # Max segments getSmart passes on (see SegmentRouter) per call
+    MAX_PASSES = 64
 
     def __init__(self, fileName = None, parent = None):
         PriorityQueue.__init__(self)
@@ -260,6 +275,9 @@ class NZBSegmentQueue(PriorityQueue):
 
         self.nzbs = []
         self.nzbsLock = Lock()
+        # Serializes streamed NZB files being queued (from the parsing thread) with
+        # cancel/postpone
+        self.streamLock = Lock()
 
         self.totalQueuedBytes = 0
 
@@ -267,6 +285,8 @@ class NZBSegmentQueue(PriorityQueue):
 
         self.retryQueueEnabled = False
         self.rQueue = RetryQueue()
+        # Steers segments to the best suited serverPools, when there are multiple
+        self.router = SegmentRouter()
 
         if fileName is not None:
             self.parseNZB(fileName)
@@ -280,25 +300,31 @@ class NZBSegmentQueue(PriorityQueue):
             self.rQueue.clear()
         PriorityQueue.clear(self)
 
+        for nzb in self.nzbs:
+            Hellanzb.ht.nzbDone(nzb)
         self.nzbs = []
         
         self.parent.onDiskSegments.clear()
 
     def postpone(self, cancel = False):
         """ Postpone the current download """
-        self.clear()
+        self.streamLock.acquire()
+        try:
+            self.clear()
 
-        self.nzbsLock.acquire()
-        self.nzbFilesLock.acquire()
+            self.nzbsLock.acquire()
+            self.nzbFilesLock.acquire()
 
-        if not cancel:
-            self.postponedNzbFiles.update(self.nzbFiles)
-        self.nzbFiles.clear()
-        
-        self.nzbFilesLock.release()
-        self.nzbsLock.release()
+            if not cancel:
+                self.postponedNzbFiles.update(self.nzbFiles)
+            self.nzbFiles.clear()
 
-        self.totalQueuedBytes = 0
+            self.nzbFilesLock.release()
+            self.nzbsLock.release()
+
+            self.totalQueuedBytes = 0
+        finally:
+            self.streamLock.release()
 
     def unpostpone(self, nzb):
         """ Recall a postponed NZB """
@@ -330,6 +356,23 @@ class NZBSegmentQueue(PriorityQueue):
                 self.nzbFiles.add(item.nzbFile)
             PriorityQueue._put(self, (priority, item))
 
+    def _putItems(self, items):
+        """ Add all the segments (and NZBFiles) to the queue """
+        segmentItems = []
+        for priority, item in items:
+            if isinstance(item, NZBFile):
+                offset = 0
+                for nzbSegment in item.nzbSegments:
+                    segmentItems.append((priority + offset, nzbSegment))
+                    offset += 1
+            else:
+                segmentItems.append((priority, item))
+
+        for priority, nzbSegment in segmentItems:
+            if nzbSegment.nzbFile not in self.nzbFiles:
+                self.nzbFiles.add(nzbSegment.nzbFile)
+        PriorityQueue._putItems(self, segmentItems)
+
     def calculateTotalQueuedBytes(self):
         """ Calculate how many bytes are queued to be downloaded in this queue """
         # NOTE: we don't maintain this calculation all the time, too much CPU work for
@@ -389,9 +432,14 @@ class NZBSegmentQueue(PriorityQueue):
             # NZB might have been canceled
             pass
         self.nzbsLock.release()
+        Hellanzb.ht.nzbDone(nzb)
 
     def isNZBDone(self, nzb, postponed = None):
         """ Determine whether or not all of the specified NZB as been thoroughly downloaded """
+        if nzb.parsing:
+            # More of it has yet to be queued
+            return False
+
         if postponed is None:
             if nzb not in Hellanzb.queue.currentNZBs():
                 postponed = True
@@ -416,16 +464,27 @@ class NZBSegmentQueue(PriorityQueue):
     def serverAdd(self, serverFactory):
         """ Add the specified server pool, for use by the RetryQueue """
         self.rQueue.addServerPool(serverFactory.serverPoolName)
+        self.router.addServerPool(serverFactory.serverPoolName, serverFactory.cost)
+        self.retryQueueEnabled = self.rQueue.needRetryQueue()
 
     def initRetryQueue(self):
         """ Initialize and enable use of the RetryQueue """
+        self.rQueue.createQueues()
         self.retryQueueEnabled = self.rQueue.needRetryQueue()
-        if self.retryQueueEnabled:
-            self.rQueue.createQueues()
 
     def serverRemove(self, serverFactory):
-        """ Remove the specified server pool """
-        self.rQueue.removeServerPool(serverFactory.serverPoolName)
+        """ Remove the specified server pool. Returns the segments that were queued for retry
+        that no remaining server pool is left to retry """
+        exhausted = self.rQueue.removeServerPool(serverFactory.serverPoolName)
+        self.router.removeServerPool(serverFactory.serverPoolName)
+        self.retryQueueEnabled = self.rQueue.needRetryQueue()
+
+        if not self.retryQueueEnabled and len(self.rQueue):
+            # The remaining server pool retries from the main queue (getSmart no longer
+            # checks the RetryQueue)
+            for segment in self.rQueue.dequeueSegments(self.rQueue.entries.keys()):
+                self.put((segment.priority, segment))
+        return exhausted
             
     def getSmart(self, serverFactory):
         """ Get the next available segment in the queue. The 'smart'ness first checks for segments
@@ -441,17 +500,45 @@ class NZBSegmentQueue(PriorityQueue):
                 # All retry queues for this serverPool are empty. fall through
                 pass
 
-            if not len(self) and len(self.rQueue):
-                # Catch the special case where both the main NZBSegmentQueue is empty, all
-                # the retry queues for the serverPool are empty, but there is still more
-                # left to download in the retry queue (scheduled for retry by other
-                # serverPools)
-                raise EmptyForThisPool()
+            available = None
+            passed = None
+            try:
+                for i in xrange(self.MAX_PASSES):
+                    self.checkEmptyForThisPool()
+
+                    priority, segment = PriorityQueue.get_nowait(self)
+                    segment.fromQueue = self
+                    if available is None:
+                        available = self.router.availablePools()
+                    if not self.router.shouldPass(serverFactory.serverPoolName, segment,
+                                                  available):
+                        return priority, segment
+
+                    # Leave it to the other serverPools (they'll find it in the retry
+                    # queue)
+                    self.rQueue.requeue(serverFactory.serverPoolName, segment,
+                                        passed = True)
+                    passed = segment
+            finally:
+                if passed is not None:
+                    # Wake the other serverPools once, for all of the passed segments
+                    self.nudgeIdleNZBLeechers(passed)
+
+            # Passed on enough for one call: take the next segment regardless
+            self.checkEmptyForThisPool()
             
         priority, segment = PriorityQueue.get_nowait(self)
         segment.fromQueue = self
         return priority, segment
     
+    def checkEmptyForThisPool(self):
+        """ Catch the special case where both the main NZBSegmentQueue is empty, all the
+        retry queues for the serverPool are empty, but there is still more left to download
+        in the retry queue (scheduled for retry by other serverPools): raise
+        EmptyForThisPool """
+        if not len(self) and len(self.rQueue):
+            raise EmptyForThisPool()
+
     def requeue(self, serverFactory, segment):
         """ Requeue the segment for download. This differs from requeueMissing as it's for
         downloads that failed for reasons other than the file or group missing from the
@@ -474,7 +561,8 @@ class NZBSegmentQueue(PriorityQueue):
         where other serverPools will find it and reattempt the download """
         # This serverPool has just failed the download
         assert(serverFactory.serverPoolName not in segment.failedServerPools)
-        segment.failedServerPools.append(serverFactory.serverPoolName)
+        segment.failedOn(serverFactory.serverPoolName)
+        self.router.segmentMissing(serverFactory.serverPoolName, segment)
 
         if self.retryQueueEnabled:
             self.rQueue.requeue(serverFactory.serverPoolName, segment)
@@ -485,6 +573,10 @@ class NZBSegmentQueue(PriorityQueue):
         else:
             raise PoolsExhausted()
 
+    def segmentFound(self, serverFactory, segment):
+        """ Notify the queue the specified server pool successfully downloaded the segment """
+        self.router.segmentFound(serverFactory.serverPoolName, segment)
+
     def nudgeIdleNZBLeechers(self, requeuedSegment):
         """ Activate any idle NZBLeechers that might need to download the specified requeued
         segment """
@@ -574,27 +666,20 @@ class NZBSegmentQueue(PriorityQueue):
 
     def parseNZB(self, nzb, verbose = True):
         """ Initialize the queue from the specified nzb file """
-        # Create a parser
-        parser = make_parser()
-        
-        # No XML namespaces here
-        parser.setFeature(feature_namespaces, 0)
-        parser.setFeature(feature_external_ges, 0)
-
         # Create the handler
         fileName = nzb.nzbFileName
         self.nzbAdd(nzb)
         needWorkFiles = []
         needWorkSegments = []
-        nzbp = NZBParser(nzb, needWorkFiles, needWorkSegments)
+        journal = None
+        if Hellanzb.SEGMENT_JOURNAL:
+            journal = openJournal(nzb)
+        nzbp = NZBParser(nzb, needWorkFiles, needWorkSegments, journal = journal)
         
-        # Tell the parser to use it
-        parser.setContentHandler(nzbp)
-
         nzb.calculatingBytes = True
-        # Parse the input
+        # Parse the input (or replay it from the NZBCache)
         try:
-            parser.parse(fileName)
+            parseNZBFile(fileName, nzbp)
         except SAXParseException, saxpe:
             nzb.calculatingBytes = False
             self.nzbDone(nzb)
@@ -619,9 +704,19 @@ class NZBSegmentQueue(PriorityQueue):
         # The parser will add all the segments of all the NZBFiles that have not already
         # been downloaded. After the parsing, we'll check if each of those segments have
         # already been downloaded. it's faster to check all segments at one time
-        needDlFiles, needDlSegments, onDiskSegments = segmentsNeedDownload(needWorkSegments,
-                                                                           overwriteZeroByteSegments = \
-                                                                           nzb.overwriteZeroByteFiles)
+        if journal is not None and journal.replaying:
+            # The journal already knows, no need to scan the WORKING_DIR
+            needDlFiles, needDlSegments, onDiskSegments = \
+                journal.segmentsNeedDownload(needWorkSegments,
+                                             overwriteZeroByteSegments = \
+                                             nzb.overwriteZeroByteFiles)
+        else:
+            needDlFiles, needDlSegments, onDiskSegments = \
+                segmentsNeedDownload(needWorkSegments,
+                                     overwriteZeroByteSegments = nzb.overwriteZeroByteFiles)
+            if journal is not None:
+                journal.recordScanned(nzb.nzbFiles, onDiskSegments)
+                journal.commit()
         e = time.time() - s
 
         # firstSegmentsDownloaded needs to be tweaked if isSkippedPar and no segments were
@@ -692,15 +787,18 @@ class NZBSegmentQueue(PriorityQueue):
                     error('Cannot assemble ' + nzbFile.getFilename() + ': No space left on device! Exiting..')
                     Hellanzb.Core.shutdown(True)
 
+        queueSegments = []
         for nzbSegment in needDlSegments:
             # smartDequeue called from segmentsNeedDownload would have set
             # isSkippedParFile for us
             if not nzbSegment.nzbFile.isSkippedPar:
-                self.put((nzbSegment.priority, nzbSegment))
+                queueSegments.append((nzbSegment.priority, nzbSegment))
             else:
                 # This would need to be downloaded if we didn't skip the segment, they are
                 # officially dequeued, and can be requeued later
                 nzbSegment.nzbFile.dequeuedSegments.add(nzbSegment)
+        # Load them all at once (large NZBs have 100k+ segments)
+        self.putItems(queueSegments)
                 
         # Requeue files in certain situations
         if nzb.firstSegmentsDownloaded == len(nzb.nzbFiles):
@@ -723,10 +821,12 @@ class NZBSegmentQueue(PriorityQueue):
                 msg = '%s (%i par files)' % (msg, skippedPars)
             if verbose:
                 warn(msg)
+            queueSegments = []
             for nzbSegment in needDlSegments:
                 if nzbSegment.nzbFile.isSkippedPar:
-                    self.put((nzbSegment.priority, nzbSegment))
+                    queueSegments.append((nzbSegment.priority, nzbSegment))
                     nzbSegment.nzbFile.todoNzbSegments.add(nzbSegment)
+            self.putItems(queueSegments)
 
             # Only reset the isSkippedPar flag after queueing
             for nzbSegment in needDlSegments:
@@ -756,6 +856,191 @@ class NZBSegmentQueue(PriorityQueue):
         # Archive not complete
         return False
 
+    def streamNZB(self, nzb, verbose = True):
+        """ Parse the specified nzb file in a separate thread, queueing the segments of each of
+        its <file>s as soon as the file is parsed (and checked for segments already on
+        disk). The download begins (via Daemon.beginDownload) with the first queued file,
+        rather than after the entire nzb file is parsed. Returns a Deferred fired once the
+        parse is finished """
+        self.nzbAdd(nzb)
+        nzb.calculatingBytes = True
+        nzb.parsing = True
+        stream = NZBStream(nzb, verbose)
+
+        d = deferToThread(self._streamNZB, stream)
+        d.addCallbacks(self._streamedNZB, self._streamNZBFailed, callbackArgs = (stream,),
+                       errbackArgs = (stream,))
+        return d
+
+    def _streamNZB(self, stream):
+        """ Parse the stream's nzb file (from a separate thread) """
+        nzb = stream.nzb
+        if Hellanzb.SEGMENT_JOURNAL:
+            stream.journal = openJournal(nzb)
+        nzbp = NZBParser(nzb, [], [],
+                         lambda nzbFile: self._queueStreamedFile(stream, nzbFile),
+                         journal = stream.journal)
+        if stream.journal is None or not stream.journal.replaying:
+            # The NZBParser cleans out the WORKING_DIR: scan it afterwards
+            stream.workingSegments = scanWorkingSegments(nzb.overwriteZeroByteFiles)
+
+        try:
+            parseNZBFile(nzb.nzbFileName, nzbp)
+        except SAXParseException, saxpe:
+            raise FatalError('Unable to parse invalid NZB file: %s: %s' % \
+                             (os.path.basename(nzb.nzbFileName), saxpe.getException()))
+        return nzbp
+
+    def _queueStreamedFile(self, stream, nzbFile):
+        """ Queue the segments of the just parsed nzbFile that aren't already on disk, or
+        assemble it if they all are (from the parsing thread) """
+        nzb = stream.nzb
+        if nzb.canceled or nzb not in self.currentNZBs():
+            raise StreamStopped()
+
+        # See parseNZB
+        if nzbFile.firstSegment is None and len(nzbFile.nzbSegments):
+            sortedSegments = [(nzbSegment.number, nzbSegment) for nzbSegment in \
+                              nzbFile.nzbSegments]
+            sortedSegments.sort()
+            nzbFile.firstSegment = sortedSegments[0][1]
+            nzbFile.firstSegment.priority = NZBSegmentQueue.NZB_CONTENT_P
+
+        journal = stream.journal
+        if journal is not None and journal.replaying:
+            needDlFiles, needDlSegments, onDiskSegments = \
+                journal.segmentsNeedDownload(nzbFile.nzbSegments,
+                                             overwriteZeroByteSegments = \
+                                             nzb.overwriteZeroByteFiles)
+        else:
+            needDlFiles, needDlSegments, onDiskSegments = \
+                segmentsNeedDownload(nzbFile.nzbSegments,
+                                     overwriteZeroByteSegments = nzb.overwriteZeroByteFiles,
+                                     workingSegments = stream.workingSegments)
+            if journal is not None:
+                journal.recordScanned([nzbFile], onDiskSegments)
+
+        onDiskBytes = 0
+        for nzbSegment in onDiskSegments:
+            onDiskBytes += nzbSegment.bytes
+        nzbFile.totalSkippedBytes += onDiskBytes
+        nzb.totalSkippedBytes += onDiskBytes
+        stream.onDiskSegmentsCount += len(onDiskSegments)
+        stream.onDiskSegmentBytes += onDiskBytes
+
+        if not len(needDlSegments):
+            if stream.verbose:
+                info(nzbFile.getFilename() + ': Assembling -- all segments were on disk')
+            try:
+                assembleNZBFile(nzbFile, autoFinish = False)
+            except OutOfDiskSpace:
+                error('Cannot assemble ' + nzbFile.getFilename() + \
+                      ': No space left on device! Exiting..')
+                reactor.callFromThread(Hellanzb.Core.shutdown, True)
+                raise StreamStopped()
+            return
+
+        stream.needDlFiles.add(nzbFile)
+        if nzbFile.isSkippedPar:
+            # Skipped by smartDequeue (via segmentsNeedDownload): officially dequeued, to
+            # be requeued later if necessary
+            for nzbSegment in needDlSegments:
+                nzbFile.dequeuedSegments.add(nzbSegment)
+            return
+
+        # segmentsNeedDownload's segmentDone calls subtracted the onDiskSegments from the
+        # totalQueuedBytes, which never included them
+        queuedBytes = onDiskBytes
+        for nzbSegment in needDlSegments:
+            queuedBytes += nzbSegment.bytes
+
+        # A cancel/postpone (from the twisted main thread) clears the queue: don't let
+        # these segments slip in after it did
+        self.streamLock.acquire()
+        try:
+            if nzb.canceled or nzb not in self.currentNZBs():
+                raise StreamStopped()
+            self.addQueuedBytes(queuedBytes)
+            self.putItems([(nzbSegment.priority, nzbSegment) \
+                               for nzbSegment in needDlSegments])
+        finally:
+            self.streamLock.release()
+
+        reactor.callFromThread(self._streamedFileQueued, stream, needDlSegments[0])
+
+    def _streamedFileQueued(self, stream, nzbSegment):
+        """ Start (or continue) the download of the stream's just queued segments """
+        if stream.nzb not in self.currentNZBs():
+            return
+        
+        if not stream.begun:
+            stream.begun = True
+            Hellanzb.Daemon.beginDownload(stream.nzb)
+        elif not Hellanzb.downloading:
+            # The downloaders caught up with the parser, and stopped
+            Hellanzb.Daemon.beginDownload()
+        else:
+            self._nudgeIdleNZBLeechers(nzbSegment)
+
+    def _streamedNZB(self, nzbp, stream):
+        """ The stream's nzb file was parsed: finish up what parseNZB would have """
+        nzb = stream.nzb
+        # Synchronize with any decoders finishing the NZB's segments (tryFinishNZB)
+        postDecodeLock.acquire()
+        try:
+            nzb.calculatingBytes = False
+            nzb.parsing = False
+            if nzb not in self.currentNZBs():
+                return
+
+            if stream.journal is not None:
+                # Every file's scan results are recorded
+                stream.journal.commit()
+
+            if Hellanzb.SMART_PAR and nzb.firstSegmentsDownloaded == len(nzb.nzbFiles):
+                smartRequeue(nzb)
+                logSkippedPars(nzb)
+
+            onDiskBytes = stream.onDiskSegmentBytes
+            for nzbFile in nzb.nzbFiles:
+                if nzbFile not in stream.needDlFiles:
+                    onDiskBytes += nzbFile.totalBytes
+            onDiskFilesCount = nzbp.fileCount - len(nzbp.needWorkFiles)
+            info('Parsed: %i files (%i posts), %s' % (nzbp.fileCount, nzbp.segmentCount,
+                                                      prettySize(nzb.totalBytes)))
+            if onDiskFilesCount or stream.onDiskSegmentsCount:
+                info('Skipped (on disk): %i files and %i segments, %s' % \
+                     (onDiskFilesCount, stream.onDiskSegmentsCount, prettySize(onDiskBytes)))
+
+            if Hellanzb.downloading and \
+                    not len([nsf for nsf in Hellanzb.nsfs if nsf.activated]):
+                # The factories ran out of segments before the parsing did (see
+                # Daemon.downloadIdle)
+                Hellanzb.Daemon.endDownload()
+
+            if self.isNZBDone(nzb):
+                self.nzbDone(nzb)
+                if not stream.begun and stream.verbose:
+                    info(nzb.archiveName + ': Assembled archive!')
+                reactor.callLater(0, Hellanzb.Daemon.handleNZBDone, nzb)
+            else:
+                info('Queued: %s' % prettySize(self.totalQueuedBytes))
+        finally:
+            postDecodeLock.release()
+
+    def _streamNZBFailed(self, failure, stream):
+        """ The stream was stopped, or its nzb file couldn't be parsed """
+        nzb = stream.nzb
+        nzb.calculatingBytes = False
+        nzb.parsing = False
+        if failure.check(StreamStopped):
+            return
+        
+        if not stream.begun:
+            self.nzbDone(nzb)
+        return failure
+
+
 class FillServerQueue(object):
     def __init__(self, fileName = None):
         # NZBSegmentQueues indexed by their fill server priority
@@ -791,6 +1076,10 @@ class FillServerQueue(object):
         """ Add a segment to the queue """
         self.queues[0].put(item)
 
+    def putItems(self, items):
+        """ Add all the segments to the queue at once """
+        self.queues[0].putItems(items)
+
     def dequeueSegments(self, nzbSegments):
         """ Explicitly dequeue the specified nzb segments """
         dequeuedSegments = []
@@ -848,10 +1137,25 @@ class FillServerQueue(object):
         self.queues[serverFactory.fillServerPriority].serverAdd(serverFactory)
 
     def serverRemove(self, serverFactory):
-        """ Unregister the specified NZBLeecherFactory """
-        assert(serverFactory.fillServerPriority in queues)
-        self.queues[serverFactory.fillServerPriority].serverRemove(serverFactory)
+        """ Unregister the specified NZBLeecherFactory. Segments queued for retry that were
+        only left for it to retry are requeued on the next fillServerPriority, or are
+        missing when there is none """
+        assert(serverFactory.fillServerPriority in self.queues)
         # FIXME: delete the queue if contains no more servers
+        queue = self.queues[serverFactory.fillServerPriority]
+        for segment in queue.serverRemove(serverFactory):
+            try:
+                self.requeueNextPriority(serverFactory.fillServerPriority, segment)
+            except PoolsExhausted:
+                info(segment.nzbFile.showFilename + ' segment: ' + str(segment.number) + \
+                     ' Article is missing!')
+                # Decode the (empty) article, as if the last server pool failed to
+                # download it
+                segment.fromQueue = queue
+                segment.yDecoder = None
+                segment.cachedToDisk = False
+                segment.encodedDataList = []
+                Hellanzb.decodeBacklog.defer(decode, segment)
 
     def getSmart(self, serverFactory):
         """ Get the next available segment in the queue according to the specified serverFactory's
@@ -873,22 +1177,33 @@ class FillServerQueue(object):
         try:
             queue.requeueMissing(serverFactory, segment)
         except PoolsExhausted:
-            nextPriority = serverFactory.fillServerPriority + 1
-            if len(self.queues) <= nextPriority:
-                # Totally exhausted all queues/fill servers
-                raise
-            nextQueue = self.queues[nextPriority]
-            nextQueue.put((segment.priority, segment))
-
-            # Note: the old queue still contains the segment's nzbFile in its nzbFiles Set
-            # -- but we call fileDone on all NZBSegmentQueues, ensuring its removal
-            nextQueue.nzbFilesLock.acquire()
-            nextQueue.nzbFiles.add(segment.nzbFile)
-            nextQueue.nzbFilesLock.release()
-
-            queue.totalQueuedBytes -= segment.bytes
-            nextQueue.totalQueuedBytes += segment.bytes
-            nextQueue.nudgeIdleNZBLeechers(segment)
+            self.requeueNextPriority(serverFactory.fillServerPriority, segment)
+
+    def requeueNextPriority(self, fillServerPriority, segment):
+        """ Requeue a segment all servers under the specified fillServerPriority failed to
+        download on the next fillServerPriority. Raises PoolsExhausted when there is none
+        """
+        nextPriority = fillServerPriority + 1
+        if len(self.queues) <= nextPriority:
+            # Totally exhausted all queues/fill servers
+            raise PoolsExhausted()
+        queue = self.queues[fillServerPriority]
+        nextQueue = self.queues[nextPriority]
+        nextQueue.put((segment.priority, segment))
+
+        # Note: the old queue still contains the segment's nzbFile in its nzbFiles Set
+        # -- but we call fileDone on all NZBSegmentQueues, ensuring its removal
+        nextQueue.nzbFilesLock.acquire()
+        nextQueue.nzbFiles.add(segment.nzbFile)
+        nextQueue.nzbFilesLock.release()
+
+        queue.totalQueuedBytes -= segment.bytes
+        nextQueue.totalQueuedBytes += segment.bytes
+        nextQueue.nudgeIdleNZBLeechers(segment)
+
+    def segmentFound(self, serverFactory, segment):
+        """ Notify the queue the specified server pool successfully downloaded the segment """
+        self.queues[serverFactory.fillServerPriority].segmentFound(serverFactory, segment)
 
     def nudgeIdleNZBLeechers(self, requeuedSegment):
         self.queues[0].nudgeIdleNZBLeechers(requeuedSegment)
@@ -914,6 +1229,10 @@ class FillServerQueue(object):
         """ Initialize the queue from the specified nzb file """
         return self.queues[0].parseNZB(nzb, verbose)
 
+    def streamNZB(self, nzb, verbose = True):
+        """ Stream the specified nzb file into the queue """
+        return self.queues[0].streamNZB(nzb, verbose)
+
 """
 Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
 All rights reserved.
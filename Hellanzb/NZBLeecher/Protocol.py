@@ -5,7 +5,7 @@ Protocol - The NZBLeecher twisted factory and protocol
 (c) Copyright 2005-2007 Philip Jenvey
 [See end of file]
 """
-import os, time, Hellanzb
+import copy, os, time, zlib, Hellanzb
 try:
     set
 except NameError:
@@ -15,11 +15,12 @@ from twisted.internet.error import ConnectionDone, ConnectionLost, ConnectionRef
     DNSLookupError
 from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.protocols.policies import TimeoutMixin
-from Hellanzb.Daemon import cancelCurrent, endDownload
+from Hellanzb.Daemon import cancelCurrent, downloadIdle
 from Hellanzb.Log import *
 from Hellanzb.Util import EmptyForThisPool, PoolsExhausted
 from Hellanzb.NZBLeecher.nntp import NNTPClient, extractCode
-from Hellanzb.NZBLeecher.ArticleDecoder import decode
+from Hellanzb.NZBLeecher.ArticleDecoder import decode, requeueCRCFailed, yDecodedCRCFailure, \
+    YDecoder
 from Queue import Empty
 
 __id__ = '$Id$'
@@ -28,7 +29,8 @@ PHI = 1.6180339887498948 # (1 + math.sqrt(5)) / 2
 class NZBLeecherFactory(ReconnectingClientFactory):
 
     def __init__(self, username, password, activeTimeout, antiIdleTimeout, hostname,
-                 serverPoolName, skipGroupCmd, fillServerPriority = 0, color = None):
+                 serverPoolName, skipGroupCmd, fillServerPriority = 0, color = None,
+                 pipelineDepth = 1, compress = False, cost = 0, maxRate = 0):
         self.username = username
         self.password = password
         self.antiIdleTimeout = antiIdleTimeout
@@ -42,10 +44,16 @@ class NZBLeecherFactory(ReconnectingClientFactory):
 
         # statistics for the current session (sessions end when downloading stops on all
         # clients). sessionReadBytes and sessionStartime are used to calculate the average
-        # rate of the download session when a download is finished
+        # rate of the download session when a download is finished. sessionWireBytes is
+        # the number of bytes actually received from the server (which differs from
+        # sessionReadBytes when the connection is compressed)
         self.sessionReadBytes = 0
+        self.sessionWireBytes = 0
         self.sessionStartTime = None
 
+        # bytes read since the ConnectionScaler's last sample
+        self.sampleReadBytes = 0
+
         # all of this factory's clients 
         self.clients = []
         # The factory maintains the NZBLeecher id, and recycles them when building new
@@ -64,6 +72,14 @@ class NZBLeecherFactory(ReconnectingClientFactory):
         self.idledOut = False
         self.leecherConnectors = []
 
+        # Optional ConnectionScaler, adjusting the number of open connections according to
+        # their throughput. Connectors of the connections it has parked (disconnected)
+        # are kept in parkedConnectors, parkingLost counts parked clients whose
+        # clientConnectionLost is pending
+        self.scaler = None
+        self.parkedConnectors = []
+        self.parkingLost = 0
+
         # server reconnecting drop off factor, by default e. PHI (golden ratio) is a lower
         # factor than e
         self.factor = PHI # (Phi is acceptable for use as a factor if e is too large for
@@ -72,6 +88,21 @@ class NZBLeecherFactory(ReconnectingClientFactory):
         # Whether or not we should skip sending GROUP cmds to this nntp server
         self.skipGroupCmd = skipGroupCmd
 
+        # Maximum number of BODY commands each client keeps in flight at once. Pipelining
+        # hides the round trip between articles on high latency servers
+        self.pipelineDepth = max(1, pipelineDepth)
+
+        # Whether or not clients should attempt to enable compression (COMPRESS DEFLATE)
+        self.compress = compress
+
+        # The relative cost of downloading from this server (e.g. per GB), 0 for
+        # unlimited. Segments are steered away from costlier servers (see SegmentRouter)
+        self.cost = cost
+
+        # Maximum download rate (bytes/sec) of this server, 0 for no limit. Enforced by the
+        # HellaThrottlingFactory
+        self.maxRate = maxRate
+
         if color is not None:
             self.color = color
         else:
@@ -84,7 +115,7 @@ class NZBLeecherFactory(ReconnectingClientFactory):
         # connections, info('Unable to connect!: + str(error)')
 
     def buildProtocol(self, addr):
-        p = NZBLeecher(self.username, self.password)
+        p = self.protocol(self.username, self.password)
         p.factory = self
         p.id = self.clientIds[0]
         self.clientIds.remove(p.id)
@@ -121,6 +152,12 @@ class NZBLeecherFactory(ReconnectingClientFactory):
 
     def clientConnectionLost(self, connector, reason):
         """ Handle lost connections """
+        if self.parkingLost:
+            # Parked by the ConnectionScaler: don't reconnect until it asks for it
+            self.parkingLost -= 1
+            self.parkedConnectors.append(connector)
+            return
+
         # Connectors are stored in leecherConnectors for later, explicit reconnection
         # because we are NOT queueing a reconnect at this point in time (antiIdle == 0:
         # disconnect when idle). We still need to requeue an ASAP reconnection when the
@@ -160,10 +197,88 @@ class NZBLeecherFactory(ReconnectingClientFactory):
         self.leecherConnectors = []
         self.idledOut = False
 
+    def pauseDownload(self):
+        """ Pause the download: stop reading from all clients """
+        for client in self.clients:
+            client.transport.stopReading()
+
+    def continueDownload(self):
+        """ Continue a paused download. Returns the number of connections that were reset
+        """
+        resetConnections = 0
+        connectionCount = self.connectionCount
+        # XXX:
+        debug('%s: connectionCount: %i' % (self.serverPoolName, connectionCount))
+        for client in self.clients:
+
+            # When we pause a download, we simply stop reading from the socket. That
+            # causes the connection to become lost fairly quickly. When that happens a new
+            # client is created with the flag pauseReconnected=True. This new client acts
+            # normally (anti idles the connection, etc) except it does not enter the
+            # fetchNextNZBSegment loop. Thus when we encounter these clients we simply
+            # tell them to begin downloading
+            if client.pauseReconnected:
+                debug(str(client) + ' pauseReconnect')
+                client.pauseReconnected = False
+                reactor.callLater(0, client.fetchNextNZBSegment)
+            else:
+                # Otherwise this was a short pause, the connection hasn't been lost, and
+                # we can simply continue reading from the socket
+                debug(str(client) + ' startReading')
+                client.transport.startReading()
+                connectionCount -= 1
+
+        if self.clients:
+            resetConnections += connectionCount
+        # XXX:
+        debug('resetConnections(%s): %i: added %i' % (self.serverPoolName, resetConnections,
+                                                      connectionCount))
+
+        # Reconnect (antiIdleTimeout == 0) NZBLeechers
+        if self.antiIdleTimeout == 0:
+            reconnecting = []
+            for connector in self.leecherConnectors:
+                # Reconnect if it's the main (fillserver==0) factory, or the client
+                # explicitly idled out during the connection (pauseIdledOut)
+                if self.fillServerPriority == 0 or getattr(connector, 'pauseIdledOut',
+                                                           False):
+                    debug(str(connector) + ' pauseIdledOut')
+                    connector.pauseIdledOut = False
+                    connector.connect()
+                    reconnecting.append(connector)
+            for connector in reconnecting:
+                self.leecherConnectors.remove(connector)
+            resetConnections += len(reconnecting)
+            # XXX:
+            debug('>resetConnections(%s): %i: added %i' % (self.serverPoolName,
+                                                           resetConnections,
+                                                           len(reconnecting)))
+        return resetConnections
+
+    def disconnectClients(self, justActive = False):
+        """ Disconnect and deactivate all clients (or just the active ones) """
+        if justActive:
+            clients = self.activeClients.copy()
+        else:
+            clients = self.clients[:]
+        for client in clients:
+            client.transport.loseConnection()
+
+            # NOTE: WEIRD: after pool-coop branch, I have to force this to prevent
+            # fetchNextNZBSegment from re-calling the fetch loop (it gets called
+            # twice. the parseNZB->beginDownload->fetchNext call is made before the client
+            # gets to call connectionLost). or has this problem always existed??? See r403
+            client.isLoggedIn = False
+
+            client.deactivate()
+
     def beginDownload(self):
         """ Start the download """
         self.sessionReadBytes = 0
+        self.sessionWireBytes = 0
         self.sessionStartTime = time.time()
+        if self.scaler is not None:
+            self.scaler.start()
         if self.fillServerPriority == 0:
             self.activated = True
             self.fetchNextNZBSegment()
@@ -171,6 +286,8 @@ class NZBLeecherFactory(ReconnectingClientFactory):
     def endDownload(self):
         """ End the download """
         self.activated = False
+        if self.scaler is not None:
+            self.scaler.stop()
 
     def setConnectionCount(self, connectionCount):
         """ Set the number of total connections for this factory """
@@ -208,7 +325,7 @@ class NZBLeecherFactory(ReconnectingClientFactory):
                 return
 
         # No more active factories, finished downloading
-        endDownload()
+        downloadIdle()
 
     def getCurrentRate():
         """ Return the current download rate in KB/s """
@@ -252,11 +369,22 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
 
         # current article (<segment>) we're dealing with
         self.currentSegment = None
+        # segments whose BODY commands have already been sent (pipelined) after the
+        # currentSegment's, in the order the server will respond to them
+        self.pipelinedSegments = []
+        # segment pulled from the queue by fillPipeline that needs a GROUP command first.
+        # It's the next segment fetched once the pipeline drains
+        self.heldSegment = None
         # function to write to the current segment
         self.write = None
 
         self.isLoggedIn = False
         self.setReaderAfterLogin = False
+
+        # Compressors for the connection, when COMPRESS DEFLATE is active
+        self.triedCompress = False
+        self.inflater = None
+        self.deflater = None
             
         self.activeTimeout = None
         # Idle time -- after being idle this long send anti idle requests
@@ -265,8 +393,17 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
         # whether or not this NZBLeecher is the in the fetchNextNZBSegment download loop
         self.activated = False
 
+        # whether or not the factory's ConnectionScaler has parked this NZBLeecher (it
+        # will disconnect once its current segment is finished)
+        self.parking = False
+        # bytes read since the ConnectionScaler's last sample
+        self.sampleReadBytes = 0
+
         # the connection is idle when it receives Empty()
         self.idle = False
+        # whether or not this client is waiting on the decoder backlog to drain (it may or
+        # may not be activated)
+        self.waitingOnBacklog = False
 
         # Whether or not this client was created when hellanzb downloading was paused
         self.pauseReconnected = False
@@ -316,11 +453,7 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
         if self.setReaderAfterLogin:
             self.setReader()
         else:
-            if Hellanzb.downloadPaused:
-                self.pauseReconnected = True
-                return
-            else:
-                reactor.callLater(0, self.fetchNextNZBSegment)
+            self.beginFetching()
 
     def authInfoFailed(self, err):
         "Override for notification when authInfoFailed() action fails"
@@ -360,8 +493,18 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
             self.factory.continueTrying = False
             self.factory.idledOut = True
 
+        if self.parking and not Hellanzb.SHUTDOWN:
+            self.factory.parkingLost += 1
+
         NNTPClient.connectionLost(self) # calls self.factory.clientConnectionLost(self, reason)
 
+        if not Hellanzb.SHUTDOWN and self.currentSegment != None:
+            if self.currentSegment.hedgeLost or self.leaveHedge():
+                # Another NZBLeecher has (or is still downloading) the segment
+                self.dropSegment()
+            else:
+                self.takeOverHedge()
+
         if not Hellanzb.SHUTDOWN and self.currentSegment != None:
             if (self.currentSegment.priority, self.currentSegment, self.factory.color) in \
                     Hellanzb.scroller.segments:
@@ -379,6 +522,9 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
                 debug(str(self) + ' DID NOT requeue existing segment: ' + \
                           self.currentSegment.getDestination())
             self.resetCurrentSegment(removeEncFile = True)
+
+        if not Hellanzb.SHUTDOWN:
+            self.resetPipelinedSegments()
         
         # Continue being quiet about things if we're shutting down. Don't bother plaguing
         # the log with typical disconnection reasons
@@ -418,12 +564,7 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
             # (username & pass == None). This would have already been set to True by
             # authInfoSuccess otherwise
             self.isLoggedIn = True
-            
-            if Hellanzb.downloadPaused:
-                self.pauseReconnected = True
-                return
-            else:
-                reactor.callLater(0, self.fetchNextNZBSegment)
+            self.beginFetching()
         else:
             self.authInfo()
         
@@ -440,6 +581,49 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
         else:
             debug(str(self) + 'MODE READER failed, err: ' + str(err))
 
+    def beginFetching(self):
+        """ Logged in and ready: enable compression if configured to, then begin fetching
+        segments (unless the download is paused) """
+        if self.factory.compress and not self.triedCompress:
+            self.triedCompress = True
+            self.compressDeflate()
+            return
+
+        if Hellanzb.downloadPaused:
+            self.pauseReconnected = True
+            return
+        reactor.callLater(0, self.fetchNextNZBSegment)
+
+    def compressDeflate(self):
+        """ Ask the server to compress the connection (RFC 8054) """
+        self.sendLine('COMPRESS DEFLATE')
+        self._newState(None, self.compressDeflateFailed, self.compressDeflateResponse)
+
+    def compressDeflateResponse(self, (code, message)):
+        if code == 206:
+            debug(str(self) + ' COMPRESS DEFLATE successful')
+            # Everything following the response, in both directions, is raw deflate data
+            self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                             -zlib.MAX_WBITS)
+            self._endState()
+            self.beginFetching()
+        else:
+            self._endState()
+            self.compressDeflateFailed('%d %s' % (code, message))
+
+    def compressDeflateFailed(self, err):
+        """ The server doesn't support compression, continue on without it """
+        debug(str(self) + ' COMPRESS DEFLATE failed: ' + str(err))
+        self.beginFetching()
+
+    def sendLine(self, line):
+        """ Send the line to the server, compressed when COMPRESS DEFLATE is active """
+        if self.deflater is None:
+            return NNTPClient.sendLine(self, line)
+        self.transport.write(self.deflater.compress(line + self.delimiter) + \
+                                 self.deflater.flush(zlib.Z_SYNC_FLUSH))
+
     def activate(self):
         """ Mark this client as being active -- that is, it is in the fetchNextNZBSegment download
         loop """
@@ -471,23 +655,32 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
     def fetchNextNZBSegment(self):
         """ Pop nzb article from the queue, and attempt to retrieve it if it hasn't already been
         retrieved"""
+        if self.parking and self.currentSegment is None:
+            self.park()
+            return
+
+        if self.currentSegment is not None and len(self._state) and \
+                self._state[0] == self._stateBody:
+            # The currentSegment's BODY was pipelined and is already on its way. Just keep
+            # the pipeline full
+            self.fillPipeline()
+            return
+
+        if self.currentSegment is not None and self.currentSegment.hedgeLost:
+            # Lost the hedge before its BODY was even requested
+            self.dropSegment()
+
         if self.currentSegment is None:
+            if Hellanzb.decodeBacklog.backedUp:
+                # Let the decoders catch up
+                self.waitingOnBacklog = True
+                Hellanzb.decodeBacklog.wait(self.resumeFetching)
+                return
 
             try:
-                priority, self.currentSegment = \
-                    Hellanzb.queue.getSmart(self.factory)
-                cachedArticleDataBytes = self.currentSegment.nzbFile.nzb.cachedArticleDataBytes
-                if Hellanzb.CACHE_LIMIT < 0 or cachedArticleDataBytes < Hellanzb.CACHE_LIMIT:
-                    self.currentSegment.cachedToDisk = False
-                    self.currentSegment.encodedDataList = []
-                    self.write = self.currentSegment.encodedDataList.append
-                else:
-                    self.currentSegment.cachedToDisk = True
-                    self.currentSegment.encodedDataFile = \
-                        open(os.path.join(Hellanzb.DOWNLOAD_TEMP_DIR,
-                                          self.currentSegment.getTempFileName() + \
-                                              '_ENC'), 'wb')
-                    self.write = self.currentSegment.encodedDataFile.write
+                priority, self.currentSegment = self.getNextSegment()
+                self.prepareSegment(self.currentSegment)
+                self.write = self.getSegmentWriter(self.currentSegment)
 
                 if Hellanzb.DEBUG_MODE_ENABLED:
                     debug(str(self) + ' PULLED FROM QUEUE: ' + \
@@ -496,24 +689,19 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
                 # got a segment - set ourselves as active unless we're already set as so
                 self.activate()
 
-                # Determine the filename to show in the UI
-                if self.currentSegment.nzbFile.showFilename == None:
-                    if self.currentSegment.nzbFile.filename == None:
-                        self.currentSegment.nzbFile.showFilenameIsTemp = True
-                        
-                    self.currentSegment.nzbFile.showFilename = self.currentSegment.nzbFile.getFilename()
-
             except EmptyForThisPool:
-                debug(str(self) + ' EMPTY QUEUE (for just this pool)')
-                # done for this download pool
-                self.deactivate(justThisDownloadPool = True)
-                return
+                if not self.startHedge():
+                    debug(str(self) + ' EMPTY QUEUE (for just this pool)')
+                    # done for this download pool
+                    self.deactivate(justThisDownloadPool = True)
+                    return
             
             except Empty:
-                debug(str(self) + ' EMPTY QUEUE')
-                # all done
-                self.deactivate()
-                return
+                if not self.startHedge():
+                    debug(str(self) + ' EMPTY QUEUE')
+                    # all done
+                    self.deactivate()
+                    return
 
         if not self.factory.skipGroupCmd:
             # Change group
@@ -554,7 +742,7 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
 
                         # cancelCurrent will deactivate, kill the connections (and
                         # connectionLost will take care of closing file handles etc)
-                        cancelCurrent()
+                        self.cancelCurrentNZB()
 
                     return
             
@@ -562,6 +750,248 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
         # before it even happens!
         #reactor.callLater(0, self.fetchBody, str(self.currentSegment.messageId))
         self.fetchBody(str(self.currentSegment.messageId))
+        self.fillPipeline()
+
+    def getNextSegment(self):
+        """ Return the segment held by fillPipeline (unless its NZB was since canceled or
+        postponed), otherwise the next segment from the queue """
+        segment = self.heldSegment
+        if segment is not None:
+            self.heldSegment = None
+            if segment.nzbFile.nzb in Hellanzb.queue.currentNZBs() and \
+                    not segment.dontRequeue:
+                return segment.priority, segment
+        return Hellanzb.queue.getSmart(self.factory)
+
+    def cancelCurrentNZB(self):
+        """ Cancel the download of the current NZB """
+        cancelCurrent()
+
+    def startHedge(self):
+        """ Endgame: the queue is empty. Speculatively download (hedge) the in-flight segment
+        another NZBLeecher has been downloading the longest, the first to finish wins. Returns
+        whether or not a hedge was started """
+        if not Hellanzb.ENDGAME_HEDGING or self.parking:
+            return False
+
+        currentNZBs = Hellanzb.queue.currentNZBs()
+        oldest = None
+        for nsf in Hellanzb.nsfs:
+            if nsf.fillServerPriority != self.factory.fillServerPriority or \
+                    nsf.cost > self.factory.cost:
+                # Another fill server tier, or not worth paying for
+                continue
+            for client in nsf.clients:
+                segment = client.currentSegment
+                if client is self or segment is None or segment.hedgeLost or \
+                        segment.fetchTime is None:
+                    continue
+                original = segment.hedgeOf or segment
+                if original.hedgeClients is not None or original.dontRequeue or \
+                        self.factory.serverPoolName in original.failedServerPools or \
+                        original.nzbFile.nzb not in currentNZBs:
+                    # Already hedged, or not ours to download
+                    continue
+                if oldest is None or segment.fetchTime < oldest[0].fetchTime:
+                    oldest = (segment, client)
+
+        if oldest is None:
+            return False
+
+        original, client = oldest
+        original.hedgeClients = [client, self]
+        self.currentSegment = original.hedgeCopy()
+        self.prepareSegment(self.currentSegment)
+        self.write = self.getSegmentWriter(self.currentSegment)
+        debug(str(self) + ' HEDGING ' + str(client) + ': ' + original.getDestination())
+        self.activate()
+        return True
+
+    def winHedge(self):
+        """ The currentSegment finished downloading: if it was hedged, the other downloads of
+        it lost """
+        segment = self.currentSegment
+        original = segment.hedgeOf or segment
+        if original.hedgeClients is not None:
+            for client in original.hedgeClients:
+                if client is not self:
+                    client.loseHedge(original)
+        self.takeOverHedge()
+
+    def loseHedge(self, original):
+        """ Another NZBLeecher finished downloading the specified hedged segment first. Discard
+        the rest of our download of it """
+        segment = self.currentSegment
+        self.removeScrollerClient(segment)
+        if segment is original:
+            # The original is about to be decoded. Drain the rest of the response into a
+            # detached copy
+            segment = self.currentSegment = copy.copy(original)
+        segment.hedgeLost = True
+        self.write = self.discardData
+
+    def leaveHedge(self):
+        """ The currentSegment's download failed. When hedged, leave it to the other
+        NZBLeecher(s) downloading it. Returns whether or not we left it """
+        segment = self.currentSegment
+        original = segment.hedgeOf or segment
+        if original.hedgeClients is None or self not in original.hedgeClients or \
+                len(original.hedgeClients) == 1:
+            return False
+
+        original.hedgeClients.remove(self)
+        return True
+
+    def takeOverHedge(self):
+        """ The currentSegment is no longer hedged: make its original segment the
+        currentSegment, taking on our downloaded data """
+        segment = self.currentSegment
+        original = segment.hedgeOf or segment
+        original.hedgeClients = None
+        if original is segment:
+            return
+
+        scrolling = self.removeScrollerClient(segment)
+        original.adoptDownload(segment)
+        self.currentSegment = original
+        if scrolling:
+            Hellanzb.scroller.addClient(original, self.factory.color)
+
+    def dropSegment(self):
+        """ Abandon the currentSegment, discarding its downloaded data """
+        self.removeScrollerClient(self.currentSegment)
+        self.resetCurrentSegment(removeEncFile = True)
+
+    def removeScrollerClient(self, segment):
+        """ Remove the specified segment from the scroller, if it's there. Returns whether or
+        not it was """
+        if (segment.priority, segment, self.factory.color) in Hellanzb.scroller.segments:
+            Hellanzb.scroller.removeClient(segment, self.factory.color)
+            return True
+        return False
+
+    def discardData(self, data):
+        """ Writer for the article data of lost hedges """
+        pass
+
+    def park(self):
+        """ Disconnect. The factory's ConnectionScaler parked this connection, it's reconnected
+        when the scaler wants more connections """
+        debug(str(self) + ' PARKING')
+        self.transport.loseConnection()
+
+    def prepareSegment(self, segment):
+        """ Prepare the specified segment (just pulled from the queue) for downloading: choose
+        where its article data will be cached to (memory or disk), and yDecode it as it's
+        received """
+        # Hedges are always cached to memory: the _ENC file is the original download's.
+        # Likewise for segments whose crcFailedCopies are still being written out
+        if Hellanzb.articleCache.cacheToMemory() or segment.hedgeOf is not None or \
+                segment.crcFailedCopies:
+            segment.cachedToDisk = False
+            segment.encodedDataList = []
+            sink = segment.encodedDataList.append
+        else:
+            segment.cachedToDisk = True
+            segment.encodedDataFile = \
+                open(os.path.join(Hellanzb.DOWNLOAD_TEMP_DIR,
+                                  segment.getTempFileName() + '_ENC'), 'wb')
+            sink = segment.encodedDataFile.write
+        segment.yDecoder = YDecoder(sink)
+        segment.fetchTime = None
+
+        # Determine the filename to show in the UI
+        if segment.nzbFile.showFilename == None:
+            if segment.nzbFile.filename == None:
+                segment.nzbFile.showFilenameIsTemp = True
+
+            segment.nzbFile.showFilename = segment.nzbFile.getFilename()
+
+    def getSegmentWriter(self, segment):
+        """ Return the function that writes received article data for the specified segment
+        """
+        return segment.yDecoder.feed
+
+    def canPipeline(self, segment):
+        """ Whether or not the BODY of the specified segment can be requested before the
+        outstanding BODY commands have completed. Segments needing a GROUP command (or that
+        failed all of their GROUPs) take the normal, unpipelined route """
+        if self.factory.skipGroupCmd:
+            return True
+
+        groups = segment.nzbFile.groups
+        for group in groups:
+            if group not in self.activeGroups and group not in self.failedGroups:
+                return False
+        return not self.allGroupsFailed(groups)
+
+    def fillPipeline(self):
+        """ Pipeline BODY commands for additional segments, up to the factory's pipelineDepth
+        """
+        while self.currentSegment is not None and self.heldSegment is None and \
+                not self.parking and not Hellanzb.decodeBacklog.backedUp and \
+                len(self.pipelinedSegments) + 1 < self.factory.pipelineDepth:
+            try:
+                priority, segment = Hellanzb.queue.getSmart(self.factory)
+            except Empty:
+                # Includes EmptyForThisPool. Deactivation is left to the normal
+                # fetchNextNZBSegment loop once the pipeline has drained
+                return
+
+            if not self.canPipeline(segment):
+                # Hold on to it, rather than requeueing it (which would nudge idle
+                # NZBLeechers and churn the RetryQueue). It's the next segment fetched
+                # once the pipeline drains
+                self.heldSegment = segment
+                return
+
+            self.prepareSegment(segment)
+            self.pipelinedSegments.append(segment)
+
+            if Hellanzb.DEBUG_MODE_ENABLED:
+                debug(str(self) + ' getting BODY (pipelined): <' + segment.messageId + \
+                          '> ' + segment.getDestination())
+            NNTPClient.fetchBody(self, '<' + str(segment.messageId) + '>')
+
+    def nextPipelinedSegment(self):
+        """ The currentSegment's response has been handled: make the next pipelined segment
+        (whose response is now arriving) the currentSegment """
+        if self.currentSegment is not None or not len(self.pipelinedSegments):
+            return
+
+        self.currentSegment = self.pipelinedSegments.pop(0)
+        self.currentSegment.fetchTime = time.time()
+        self.write = self.getSegmentWriter(self.currentSegment)
+        Hellanzb.scroller.addClient(self.currentSegment, self.factory.color)
+
+    def resetPipelinedSegments(self):
+        """ Requeue all pipelined segments (their responses will never arrive), closing and
+        removing their encodedDataFiles. The heldSegment is requeued too """
+        currentNZBs = Hellanzb.queue.currentNZBs()
+        segment = self.heldSegment
+        self.heldSegment = None
+        if segment is not None and segment.nzbFile.nzb in currentNZBs and \
+                not segment.dontRequeue:
+            debug(str(self) + ' requeueing held segment: ' + segment.getDestination())
+            Hellanzb.queue.requeue(self.factory, segment)
+
+        for segment in self.pipelinedSegments:
+            if segment.nzbFile.nzb in currentNZBs and not segment.dontRequeue:
+                debug(str(self) + ' requeueing pipelined segment: ' + \
+                          segment.getDestination())
+                Hellanzb.queue.requeue(self.factory, segment)
+
+            if segment.encodedDataFile != None:
+                try:
+                    segment.encodedDataFile.close()
+                except Exception, e:
+                    pass
+                try:
+                    os.remove(os.path.join(Hellanzb.DOWNLOAD_TEMP_DIR,
+                                           segment.getTempFileName() + '_ENC'))
+                except Exception, e:
+                    pass
+        self.pipelinedSegments = []
 
     def fetchGroup(self, group):
         self.gettingGroup = group
@@ -572,6 +1002,7 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
             debug(str(self) + ' getting BODY: <' + self.currentSegment.messageId + \
                       '> ' + self.currentSegment.getDestination())
 
+        self.currentSegment.fetchTime = time.time()
         Hellanzb.scroller.addClient(self.currentSegment, self.factory.color)
         NNTPClient.fetchBody(self, '<' + index + '>')
 
@@ -581,9 +1012,14 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
             debug(str(self) + ' got BODY: ' + ' <' + self.currentSegment.messageId + \
                       '> ' + self.currentSegment.getDestination())
 
-        if not self.currentSegment.cachedToDisk:
-            self.currentSegment.nzbFile.nzb.cachedArticleDataBytes += \
-                self.currentSegment.readBytes
+        if self.currentSegment.hedgeLost:
+            self.dropSegment()
+            reactor.callLater(0, self.fetchNextNZBSegment)
+            return
+        self.winHedge()
+
+        Hellanzb.articleCache.store(self.currentSegment)
+        Hellanzb.queue.segmentFound(self.factory, self.currentSegment)
         self.finishedSegmentDownload()
 
     def getBodyFailed(self, err):
@@ -596,6 +1032,14 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
                       str(self.currentSegment.bytes))
         self.gotResponseCode = False # for dataReceivedToFile
         self.lastChunk = ''
+
+        if self.currentSegment.hedgeLost or self.leaveHedge():
+            # Another NZBLeecher has (or is still downloading) the segment
+            self.dropSegment()
+            if not self.handle400Message(err):
+                reactor.callLater(0, self.fetchNextNZBSegment)
+            return
+        self.takeOverHedge()
         
         code = extractCode(err)
         if code is not None:
@@ -654,9 +1098,28 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
         reactor.callLater(0, self.fetchNextNZBSegment)
         
     def deferSegmentDecode(self, segment):
-        """ Decode the specified segment in a separate thread """
+        """ Decode the specified segment in one of the decodePool's threads """
         segment.fromServer = self
-        reactor.callInThread(decode, segment)
+
+        # The YDecoder already knows whether or not the CRC matched. Don't wait on the
+        # decode threads to requeue a bad download to another server
+        encodingMessage = yDecodedCRCFailure(segment)
+        if encodingMessage is not None:
+            segment = requeueCRCFailed(segment, encodingMessage)
+
+        Hellanzb.decodeBacklog.defer(decode, segment)
+
+    def resumeFetching(self):
+        """ Continue fetching segments, after waiting on the decoder backlog """
+        if not self.waitingOnBacklog:
+            return
+        if Hellanzb.downloadPaused:
+            # Paused since: wait to be woken again once the download is continued
+            Hellanzb.decodeBacklog.wait(self.resumeFetching)
+            return
+        self.waitingOnBacklog = False
+        if self.isLoggedIn and self.currentSegment is None:
+            self.fetchNextNZBSegment()
 
     def gotGroup(self, group):
         group = self.gettingGroup
@@ -731,8 +1194,13 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
     def updateByteCount(self, lineLen):
         Hellanzb.totalBytesDownloaded += lineLen
         self.factory.sessionReadBytes += lineLen
+        self.factory.sampleReadBytes += lineLen
+        self.sampleReadBytes += lineLen
         if self.currentSegment is not None:
             self.currentSegment.readBytes += lineLen
+            if self.currentSegment.hedgeOf is not None or self.currentSegment.hedgeLost:
+                # Only the original download is tallied (see NZBSegment.adoptDownload)
+                return
             nzbFile = self.currentSegment.nzbFile
             nzbFile.readThisSecond += lineLen
             nzbFile.totalReadBytes += lineLen
@@ -764,18 +1232,39 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
 
     def dataReceived(self, data):
         """ Receive data from the usenet server """
-        # Update statistics
-        self.updateByteCount(len(data))
-
         # got data -- reset the anti idle timeout
         self.resetTimeout()
 
-        stateLen = len(self._state)
-        if stateLen and self._state[stateLen - 1] == self._stateBody:
-            # Write the data to disk as it's received
+        # Bytes off the wire. The payload (decompressed) bytes are counted by
+        # updateByteCount
+        Hellanzb.totalWireBytesDownloaded += len(data)
+        self.factory.sessionWireBytes += len(data)
+
+        if self.inflater is not None:
+            try:
+                data = self.inflater.decompress(data)
+            except zlib.error, ze:
+                debug(str(self) + ' error inflating received data: ' + str(ze))
+                self.transport.loseConnection()
+                return
+            if not data:
+                return
+
+        return self.dispatchData(data)
+
+    def dispatchData(self, data):
+        """ Hand the received data off to the handler for the response currently being
+        received """
+        if len(self._state) and self._state[0] == self._stateBody:
+            # Write the data to disk as it's received. dataReceivedToFile updates the
+            # statistics itself, as the data might contain the responses of multiple
+            # (pipelined) BODY commands
             return self.dataReceivedToFile(data)
 
         else:
+            # Update statistics
+            self.updateByteCount(len(data))
+
             # return an array of the received data's lines to the callback function
             return self.dataReceivedToLines(data)
 
@@ -825,14 +1314,16 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
         (dataReceivedToLines) -- it simply dumps the data to file, and looks for the EOF
         string for usenet messages: "\r\n.\r\n".
 
-        It manually rstrip()s every chunk of data received, then matches both the
-        rstripped data and rstripped-off data with their associated usenet EOF pieces (to
-        safely detect the EOF across potentially two data chunks)
+        The EOF is searched for in every chunk of data received, along with the previous
+        chunk's final few bytes (to safely detect the EOF across potentially two data
+        chunks). Any data following the EOF belongs to the next pipelined response, and is
+        dispatched once the currentSegment is finished
 
         It is smarter about parsing the usenet response code (lineReceived does this for
         dataReceivedToLines and is lazier about it)
         
         Ultimately, significantly less work than dataReceivedToLines """
+        receivedLen = len(data)
         if not self.gotResponseCode:
             # find the nntp response in the header of the message (the BODY command)
             if self.lastChunk == '':
@@ -843,6 +1334,7 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
             off = data.find(self.delimiter)
             if off == -1:
                 # Haven't received the entire first line yet
+                self.updateByteCount(receivedLen)
                 self.lastChunk = data
                 return
             
@@ -850,6 +1342,8 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
 
             code = extractCode(line)
             if code is None or (not (200 <= code[0] < 400) and code[0] != 100): # An error!
+                remaining = data[off + len(self.delimiter):]
+                self.updateByteCount(receivedLen - len(remaining))
                 try:
                     # getBodyFailed or finishedSegmentDownload will close it
                     ##self.currentSegment.encodedDataFile.close()
@@ -861,27 +1355,54 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
                     debug(str(self) + ' lineReceived GOT TYPE ERROR!: ' + str(te) + ' state name: ' + \
                           self._state[0].__name__ + ' code: ' + str(code) + ' line: ' + line)
                 self._endState()
-                return
+                self.lastChunk = ''
+                return self.finishedResponse(remaining)
             else:
                 self._setResponseCode(code)
                 self.gotResponseCode = True
                 data = data[off:]
                 self.lastChunk = ''
 
-        # write data to disk
-        self.write(data)
+        # Find the EOF, first checking if it straddles the previous chunk
+        eofEnd = -1
+        lastChunkLen = len(self.lastChunk)
+        if lastChunkLen:
+            eofEnd = (self.lastChunk + data[:EOFLen - 1]).find(EOF)
+            if eofEnd > -1:
+                eofEnd += EOFLen - lastChunkLen
+        if eofEnd == -1:
+            eofEnd = data.find(EOF)
+            if eofEnd > -1:
+                eofEnd += EOFLen
+
+        if eofEnd == -1:
+            # write data to disk
+            self.write(data)
+            self.updateByteCount(receivedLen)
+
+            # save last (EOFLen - 1) bytes of current article in lastChunk
+            dataLen = len(data)
+            if dataLen >= EOFLen - 1:
+                self.lastChunk = data[-(EOFLen - 1):]
+            else:
+                self.lastChunk = self.lastChunk[-(EOFLen - 1 - dataLen):] + data
+            return
 
-        # save last EOFLen of current article in lastChunk
-        dataLen = len(data)
-        if dataLen >= EOFLen:
-            self.lastChunk = data[-EOFLen:]
-        else:
-            self.lastChunk = self.lastChunk[-(EOFLen - dataLen):] + data
+        remaining = data[eofEnd:]
+        self.write(data[:eofEnd])
+        self.updateByteCount(receivedLen - len(remaining))
 
-        if self.lastChunk == EOF:
-            self.gotResponseCode = False
-            self.lastChunk = ''
-            self.gotBody(self._endState())
+        self.gotResponseCode = False
+        self.lastChunk = ''
+        self.gotBody(self._endState())
+        return self.finishedResponse(remaining)
+
+    def finishedResponse(self, remaining):
+        """ The currentSegment's BODY response has been handled. Continue on to the next
+        pipelined segment, handing it any of its response data already received """
+        self.nextPipelinedSegment()
+        if remaining and self.transport and not self.transport.disconnecting:
+            return self.dispatchData(remaining)
 
     def timeoutConnection(self):
         """ Called when the connection times out -- i.e. when we've been idle longer than the
@@ -927,6 +1448,8 @@ class NZBLeecher(NNTPClient, TimeoutMixin):
     def __str__(self):
         """ Return the name of this NZBLeecher instance """
         return self.factory.serverPoolName + '[' + str(self.id) + ']'
+
+NZBLeecherFactory.protocol = NZBLeecher
     
 """
 Copyright (c) 2005-2007 Philip Jenvey <pjenvey@groovie.org>
@@ -0,0 +1,418 @@
+"""
+
+SegmentJournal - Append-only journal of an NZB's download progress
+
+As the NZB downloads, the segments decoded (and whether they passed the CRC check), the
+real filenames discovered, the files whose segments are being placed (see
+SegmentPlacement) and the files assembled are recorded to a journal in the CURRENT_DIR,
+alongside the NZB file. Records are written out as they happen, and fsynced in batches
+
+Resuming the download replays the journal to determine what's already on disk, instead of
+rediscovering it by scanning the WORKING_DIR. The replayed files are only checked against
+the WorkingDirIndex's listing: those since deleted are downloaded again. A missing,
+corrupt or stale journal (one that doesn't belong to the NZB file's contents, or to the
+current WORKING_DIR) falls back to the scan, and the journal is rebuilt from its
+results. A rebuilt journal is written under a temporary name until the scan's results are
+recorded
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import os, struct, time, Hellanzb
+from threading import Lock
+from zlib import crc32
+from Hellanzb.Log import *
+from Hellanzb.Util import isHellaTemp
+from Hellanzb.NZBLeecher.NZBCache import nzbDigest
+from Hellanzb.NZBLeecher.SegmentPlacement import isPlaced, isPlacedNumber, loadSegmentMap
+from Hellanzb.SmartPar import identifyPar
+
+__id__ = '$Id$'
+
+JOURNAL_SUFFIX = '.hellajournal'
+
+# Bumped whenever the format of the journal changes
+JOURNAL_MAGIC = 'HELLAJNL'
+JOURNAL_VERSION = 1
+# magic, version, the md5 of the NZB file, the (device, inode) of the WORKING_DIR
+HEADER_FORMAT = '>8sB32sQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# type, file number, segment number (or status), length of the data following. Records
+# end with the crc32 of the record
+RECORD_FORMAT = '>BIIH'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+CRC_FORMAT = '>I'
+CRC_SIZE = struct.calcsize(CRC_FORMAT)
+
+# Record types enum
+SEGMENT_DONE, FILENAME, PLACING, ASSEMBLED = range(1, 5)
+
+# Segment status enum
+SEGMENT_OK, SEGMENT_CRC_FAILED, SEGMENT_EMPTY, SEGMENT_PLACED = range(4)
+
+# fsync the journal after this many records, or this many seconds since the last fsync
+SYNC_RECORDS = 512
+SYNC_INTERVAL = 1
+
+class CorruptJournal(Exception):
+    pass
+
+def journalFileName(nzb):
+    return os.path.join(Hellanzb.CURRENT_DIR,
+                        os.path.basename(nzb.nzbFileName) + JOURNAL_SUFFIX)
+
+def workingDirId():
+    """ Identifies the current WORKING_DIR (it's replaced when moved off for processing,
+    canceled, etc) """
+    dirStat = os.stat(Hellanzb.WORKING_DIR)
+    return dirStat.st_dev, dirStat.st_ino
+
+def openJournal(nzb):
+    """ Open the specified NZB's journal, replaying it if possible (otherwise beginning a
+    new one). Returns the SegmentJournal, also set as nzb.journal """
+    if nzb.journal is not None:
+        nzb.journal.close()
+    journal = SegmentJournal(nzb)
+    journal.open()
+    nzb.journal = journal
+    return journal
+
+def removeJournal(nzb):
+    """ Remove the specified NZB's journal (it's no longer being downloaded) """
+    journal = nzb.journal
+    nzb.journal = None
+    if journal is None:
+        journal = SegmentJournal(nzb)
+    journal.remove()
+
+class SegmentJournal:
+    """ The journal of an NZB's download progress """
+    def __init__(self, nzb):
+        self.nzb = nzb
+        self.fileName = journalFileName(nzb)
+        self.tempFileName = self.fileName + '.tmp'
+        # Whether or not the journal is written under its real fileName (see commit)
+        self.committed = False
+
+        # Decode threads record concurrently
+        self.lock = Lock()
+        self.journalFile = None
+        self.unsynced = 0
+        self.lastSync = time.time()
+
+        # Whether or not the journal was replayed, and what it recorded: segment statuses
+        # keyed by (file number, segment number), filenames keyed by file number, and the
+        # numbers of files being placed and assembled
+        self.replaying = False
+        self.segments = {}
+        self.filenames = {}
+        self.placingFiles = set()
+        self.assembledFiles = set()
+
+    def open(self):
+        """ Replay the journal, then continue appending to it. A new journal is begun if it
+        can't be replayed """
+        digest = nzbDigest(self.nzb.nzbFileName)
+        dirDevice, dirInode = workingDirId()
+        
+        validLength = None
+        if os.path.isfile(self.fileName):
+            try:
+                validLength = self.load(digest, dirDevice, dirInode)
+            except CorruptJournal, cj:
+                info('Unable to resume from the journal (%s), scanning the WORKING_DIR' % \
+                     str(cj))
+            except (IOError, OSError, struct.error), e:
+                debug('SegmentJournal: unable to load: %s' % self.fileName, e)
+
+        try:
+            if validLength is not None:
+                self.replaying = True
+                self.committed = True
+                self.journalFile = open(self.fileName, 'r+b')
+                # Cut off any partially written record
+                self.journalFile.truncate(validLength)
+                self.journalFile.seek(validLength)
+            else:
+                self.clear()
+                self.journalFile = open(self.tempFileName, 'wb')
+                self.journalFile.write(struct.pack(HEADER_FORMAT, JOURNAL_MAGIC,
+                                                   JOURNAL_VERSION, digest, dirDevice,
+                                                   dirInode))
+                self.sync()
+        except (IOError, OSError), e:
+            error('Unable to write the segment journal: %s' % self.fileName, e)
+            self.abandon()
+
+    def load(self, digest, dirDevice, dirInode):
+        """ Replay the journal. Returns the length of its valid records, None if it doesn't
+        belong to the NZB or WORKING_DIR """
+        journalFile = open(self.fileName, 'rb')
+        try:
+            data = journalFile.read()
+        finally:
+            journalFile.close()
+
+        if len(data) < HEADER_SIZE:
+            raise CorruptJournal('truncated header')
+        magic, version, journalDigest, journalDevice, journalInode = \
+            struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+        if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+            raise CorruptJournal('unknown format')
+        if journalDigest != digest or (journalDevice, journalInode) != (dirDevice, dirInode):
+            debug('SegmentJournal: stale journal: %s' % self.fileName)
+            return None
+
+        offset = HEADER_SIZE
+        while offset < len(data):
+            end = offset + RECORD_SIZE
+            if end + CRC_SIZE > len(data):
+                # Partially written (only the last record can be)
+                break
+            type, fileNumber, number, length = struct.unpack(RECORD_FORMAT, data[offset:end])
+            if end + length + CRC_SIZE > len(data):
+                break
+
+            crc, = struct.unpack(CRC_FORMAT, data[end + length:end + length + CRC_SIZE])
+            if crc != crc32(data[offset:end + length]) & 0xffffffff:
+                if end + length + CRC_SIZE == len(data):
+                    break
+                raise CorruptJournal('bad record at offset %i' % offset)
+
+            if type == SEGMENT_DONE:
+                self.segments[(fileNumber, number >> 2)] = number & 3
+            elif type == FILENAME:
+                self.filenames[fileNumber] = data[end:end + length]
+            elif type == PLACING:
+                self.placingFiles.add(fileNumber)
+            elif type == ASSEMBLED:
+                self.assembledFiles.add(fileNumber)
+            else:
+                raise CorruptJournal('unknown record type at offset %i' % offset)
+            offset = end + length + CRC_SIZE
+
+        return offset
+
+    def clear(self):
+        self.replaying = False
+        self.segments.clear()
+        self.filenames.clear()
+        self.placingFiles.clear()
+        self.assembledFiles.clear()
+
+    def record(self, type, fileNumber, number = 0, data = ''):
+        """ Append a record to the journal """
+        record = struct.pack(RECORD_FORMAT, type, fileNumber, number, len(data)) + data
+        record += struct.pack(CRC_FORMAT, crc32(record) & 0xffffffff)
+
+        self.lock.acquire()
+        try:
+            if self.journalFile is None:
+                return
+            try:
+                self.journalFile.write(record)
+                # Survive the process dying, if not the machine
+                self.journalFile.flush()
+                self.unsynced += 1
+                if self.unsynced >= SYNC_RECORDS or \
+                        time.time() - self.lastSync >= SYNC_INTERVAL:
+                    self.sync()
+            except (IOError, OSError), e:
+                error('Unable to write the segment journal: %s' % self.fileName, e)
+                self.abandon()
+        finally:
+            self.lock.release()
+
+    def sync(self):
+        os.fsync(self.journalFile.fileno())
+        self.unsynced = 0
+        self.lastSync = time.time()
+
+    def commit(self):
+        """ The results of scanning the WORKING_DIR have been recorded: the rebuilt journal
+        can be replayed from now on """
+        self.lock.acquire()
+        try:
+            if self.committed or self.journalFile is None:
+                return
+            try:
+                self.journalFile.flush()
+                self.sync()
+                os.rename(self.tempFileName, self.fileName)
+                self.committed = True
+            except (IOError, OSError), e:
+                error('Unable to write the segment journal: %s' % self.fileName, e)
+                self.abandon()
+        finally:
+            self.lock.release()
+
+    def abandon(self):
+        """ Stop journaling, removing the incomplete journal (the next resume scans the
+        WORKING_DIR instead) """
+        if self.journalFile is not None:
+            try:
+                self.journalFile.close()
+            except IOError:
+                pass
+            self.journalFile = None
+        self.removeFiles()
+
+    def removeFiles(self):
+        for fileName in (self.fileName, self.tempFileName):
+            if os.path.isfile(fileName):
+                os.remove(fileName)
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.journalFile is not None:
+                try:
+                    self.journalFile.flush()
+                    self.sync()
+                    self.journalFile.close()
+                except (IOError, OSError), e:
+                    debug('SegmentJournal: unable to close: %s' % self.fileName, e)
+                self.journalFile = None
+        finally:
+            self.lock.release()
+
+    def remove(self):
+        self.close()
+        self.removeFiles()
+
+    def segmentDone(self, segment, crcFailed = False):
+        """ Record the segment as decoded """
+        if isPlaced(segment):
+            status = SEGMENT_PLACED
+        elif not Hellanzb.workingDirIndex.size(segment.getDestination()):
+            status = SEGMENT_EMPTY
+        elif crcFailed:
+            status = SEGMENT_CRC_FAILED
+        else:
+            status = SEGMENT_OK
+        self.record(SEGMENT_DONE, segment.nzbFile.number, segment.number << 2 | status)
+
+    def filenameFound(self, nzbFile):
+        """ Record the NZBFile's real filename """
+        filename = nzbFile.filename
+        if filename is None or isHellaTemp(filename) or \
+                self.filenames.get(nzbFile.number) == filename:
+            return
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+        self.filenames[nzbFile.number] = filename
+        self.record(FILENAME, nzbFile.number, data = filename)
+
+    def placing(self, nzbFile):
+        """ Record the NZBFile's segments as being placed into its partial file """
+        self.record(PLACING, nzbFile.number)
+
+    def fileAssembled(self, nzbFile):
+        """ Record the NZBFile as assembled """
+        self.filenameFound(nzbFile)
+        self.record(ASSEMBLED, nzbFile.number)
+
+    def recordScanned(self, nzbFiles, onDiskSegments):
+        """ Record what a scan of the WORKING_DIR found (the journal couldn't be replayed):
+        the real filenames of the nzbFiles, and the onDiskSegments """
+        for nzbFile in nzbFiles:
+            self.filenameFound(nzbFile)
+
+        placingFiles = set()
+        for segment in onDiskSegments:
+            nzbFile = segment.nzbFile
+            self.filenameFound(nzbFile)
+            if nzbFile.segmentMap is not None and nzbFile not in placingFiles:
+                placingFiles.add(nzbFile)
+                self.placing(nzbFile)
+            self.segmentDone(segment)
+
+    def fileNeedsDownload(self, nzbFile):
+        """ Replayed version of NZBFile.needsDownload """
+        filename = self.filenames.get(nzbFile.number)
+        if filename is not None:
+            nzbFile.filename = filename
+
+        if nzbFile.number not in self.assembledFiles:
+            return True
+        if not Hellanzb.workingDirIndex.isFile(nzbFile.getDestination()):
+            # Deleted or moved since it was assembled
+            debug('SegmentJournal: assembled file missing: %s' % nzbFile.getDestination())
+            self.assembledFiles.discard(nzbFile.number)
+            return True
+
+        if Hellanzb.SMART_PAR and filename is not None:
+            identifyPar(nzbFile)
+        self.nzb.firstSegmentsDownloaded += 1
+        return False
+
+    def segmentsNeedDownload(self, segmentList, overwriteZeroByteSegments = False):
+        """ Replayed version of NZBModel.segmentsNeedDownload """
+        needDlFiles = set()
+        needDlSegments = []
+        onDiskSegments = []
+
+        for segment in segmentList:
+            nzbFile = segment.nzbFile
+            status = self.segments.get((nzbFile.number, segment.number))
+            if status == SEGMENT_PLACED:
+                if nzbFile.segmentMap is None and nzbFile.number in self.placingFiles:
+                    # Only placed segments need the partial file's map
+                    self.placingFiles.remove(nzbFile.number)
+                    nzbFile.segmentMap = loadSegmentMap(nzbFile)
+                if nzbFile.segmentMap is None or \
+                        not isPlacedNumber(nzbFile.segmentMap, segment.number):
+                    status = None
+            elif status == SEGMENT_EMPTY and overwriteZeroByteSegments:
+                status = None
+            elif status is not None and \
+                    not Hellanzb.workingDirIndex.isFile(segment.getDestination()):
+                # Deleted or moved since it was decoded
+                debug('SegmentJournal: segment file missing: %s' % segment.getDestination())
+                status = None
+
+            if status is None:
+                needDlSegments.append(segment)
+                needDlFiles.add(nzbFile)
+                continue
+
+            if Hellanzb.SMART_PAR and segment.isFirstSegment() and \
+                    nzbFile.filename is not None and not isHellaTemp(nzbFile.filename):
+                # See segmentsNeedDownload
+                segment.smartDequeue(readOnlyQueue = True)
+
+            onDiskSegments.append(segment)
+            Hellanzb.queue.segmentDone(segment)
+
+        return needDlFiles, needDlSegments, onDiskSegments
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
@@ -0,0 +1,352 @@
+"""
+
+SegmentPlacement - Write decoded segments directly into their NZBFile's final file, at
+their yEnc offset (Hellanzb.DIRECT_PLACEMENT)
+
+The final file is written to under a partial filename until all its segments have been
+placed. Which segments have been placed is tracked by a bitmap of segment numbers, kept in
+a map file alongside the partial file (in place of the usual .segmentXXXX files), for
+resuming the download later
+
+Segments that can't be placed as they're decoded (e.g. those that failed the CRC check on
+every server) are written to their own segment files, and placed during assembly. Their
+yEnc offsets, and the final file's size, are kept in the map file too: they're only known
+from the yEnc headers of the decoded articles
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import os, tempfile, Hellanzb
+from array import array
+from Hellanzb.Log import *
+from Hellanzb.Util import BUF_SIZE, isHellaTemp
+
+__id__ = '$Id$'
+
+PARTIAL_SUFFIX = '.hellapartial'
+SEGMENT_MAP_SUFFIX = '.hellamap'
+
+def getPartialFileName(nzbFile):
+    """ The partial file the NZBFile's segments are placed into """
+    return nzbFile.getDestination() + PARTIAL_SUFFIX
+
+def getSegmentMapFileName(nzbFile):
+    """ The map file of segments already placed into the NZBFile's partial file """
+    return nzbFile.getDestination() + SEGMENT_MAP_SUFFIX
+
+def subjectKey(subject):
+    """ Identifies the NZBFile a map file belongs to """
+    if isinstance(subject, unicode):
+        return subject.encode('utf-8')
+    return subject
+
+def getPlacementOffset(segment, size):
+    """ Return the offset into the final file the segment's decoded data (of the specified
+    size) belongs at, or None if it can't be determined """
+    nzbFile = segment.nzbFile
+    ySize = nzbFile.ySize
+    if ySize is None:
+        return None
+
+    yBegin, yEnd = segment.yBegin, segment.yEnd
+    if yBegin is None and segment.number in nzbFile.segmentOffsets:
+        # Decoded before a restart (recorded in the map)
+        yBegin, yEnd = nzbFile.segmentOffsets[segment.number]
+
+    if yBegin is not None:
+        # =ypart begin/end are 1-based and inclusive
+        offset = yBegin - 1
+        if yEnd is not None and yEnd - offset != size:
+            return None
+    elif len(nzbFile.nzbSegments) == 1:
+        # Single part yEnc
+        offset = 0
+    else:
+        return None
+
+    if offset < 0 or offset + size > ySize:
+        return None
+    return offset
+
+def isPlacing(nzbFile):
+    """ Whether or not segments of the NZBFile are being placed into its partial file """
+    return nzbFile.segmentMap is not None and os.path.isfile(getPartialFileName(nzbFile))
+
+def startPlacement(nzbFile):
+    """ Ensure the NZBFile's partial file exists (creating it, at its final size, if
+    necessary). Returns False if the NZBFile's segments can't be placed """
+    if nzbFile.segmentMap is not None:
+        return os.path.isfile(getPartialFileName(nzbFile))
+
+    if nzbFile.filename is None or isHellaTemp(nzbFile.filename) or nzbFile.ySize is None:
+        return False
+
+    partialFileName = getPartialFileName(nzbFile)
+    mapFileName = getSegmentMapFileName(nzbFile)
+    if os.path.exists(partialFileName):
+        try:
+            subject, segmentMap = readSegmentMap(mapFileName, partialFileName)
+        except (IOError, OSError, ValueError):
+            # Orphaned: its map was lost, so what was placed into it is unknown. Start
+            # over
+            debug('startPlacement: removing partial file without a map: ' + \
+                  partialFileName)
+            for fileName in (partialFileName, mapFileName):
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+            Hellanzb.workingDirIndex.refresh(partialFileName, mapFileName)
+        else:
+            if subject != subjectKey(nzbFile.subject):
+                # Belongs to a dupe
+                return False
+            # Ours (e.g. left behind by an interrupted download): adopt it
+            resumePlacement(nzbFile, segmentMap)
+            if nzbFile.nzb.journal is not None:
+                nzbFile.nzb.journal.placing(nzbFile)
+            return True
+
+    # Segments already decoded to their own segment files are placed during assembly:
+    # their offsets must be known, and recorded to the map to survive a restart
+    segmentOffsets = {}
+    for nzbSegment in nzbFile.nzbSegments:
+        if not Hellanzb.workingDirIndex.isFile(nzbSegment.getDestination()):
+            continue
+        if nzbSegment.yBegin is not None:
+            segmentOffsets[nzbSegment.number] = (nzbSegment.yBegin, nzbSegment.yEnd)
+        elif len(nzbFile.nzbSegments) > 1:
+            # Decoded before a restart: only assembling the segment files is safe
+            return False
+
+    partialFile = open(partialFileName, 'wb')
+    try:
+        partialFile.truncate(nzbFile.ySize)
+    finally:
+        partialFile.close()
+
+    maxNumber = 0
+    for nzbSegment in nzbFile.nzbSegments:
+        maxNumber = max(maxNumber, nzbSegment.number)
+    nzbFile.segmentMap = array('B', '\0' * ((maxNumber + 7) / 8))
+    nzbFile.segmentOffsets = segmentOffsets
+    writeSegmentMap(nzbFile)
+    Hellanzb.workingDirIndex.refresh(partialFileName, mapFileName)
+    if nzbFile.nzb.journal is not None:
+        nzbFile.nzb.journal.placing(nzbFile)
+    return True
+
+def placeSegment(segment, offset, writeData):
+    """ Place the segment's decoded data into its NZBFile's partial file at the specified
+    offset, via writeData(fileObject). Then mark it as placed in the map """
+    partialFile = open(getPartialFileName(segment.nzbFile), 'r+b')
+    try:
+        partialFile.seek(offset)
+        writeData(partialFile)
+    finally:
+        partialFile.close()
+
+    index = segment.number - 1
+    segment.nzbFile.segmentMap[index / 8] |= 1 << (index % 8)
+    updateSegmentMap(segment.nzbFile, index / 8)
+
+def placeSegmentFile(segment, offset, segmentFileName):
+    """ Place the decoded segment file into its NZBFile's partial file """
+    def copyData(partialFile):
+        segmentFile = open(segmentFileName, 'rb')
+        try:
+            read = segmentFile.read
+            while True:
+                buf = read(BUF_SIZE)
+                if not buf:
+                    break
+                partialFile.write(buf)
+        finally:
+            segmentFile.close()
+    placeSegment(segment, offset, copyData)
+
+def recordSegmentFile(segment):
+    """ The segment was decoded to its own segment file. If its NZBFile's segments are being
+    placed, record the segment's offset to the map (it's placed during assembly) """
+    nzbFile = segment.nzbFile
+    if nzbFile.segmentMap is None or segment.yBegin is None:
+        return
+    nzbFile.segmentOffsets[segment.number] = (segment.yBegin, segment.yEnd)
+    writeSegmentMap(nzbFile)
+
+def isPlaced(segment):
+    """ Whether or not the segment has been placed into its NZBFile's partial file """
+    segmentMap = segment.nzbFile.segmentMap
+    if segmentMap is None:
+        return False
+    return isPlacedNumber(segmentMap, segment.number)
+
+def isPlacedNumber(segmentMap, number):
+    """ Whether or not the segment number is marked as placed in the segment map """
+    index = number - 1
+    return index / 8 < len(segmentMap) and segmentMap[index / 8] & (1 << (index % 8))
+
+def segmentMapHeader(nzbFile):
+    """ Return the header of the NZBFile's map file (preceding the bitmap): its subject,
+    ySize and segment offsets lines """
+    # The segment offsets line: number:yBegin:yEnd (0 when unknown) of each segment
+    # decoded to its own segment file
+    offsets = nzbFile.segmentOffsets.items()
+    offsets.sort()
+    offsetsLine = ','.join(['%i:%i:%i' % (number, yBegin, yEnd or 0) \
+                                for number, (yBegin, yEnd) in offsets])
+    return '%s\n%i\n%s\n' % (subjectKey(nzbFile.subject), nzbFile.ySize, offsetsLine)
+
+def writeSegmentMap(nzbFile):
+    """ Write the NZBFile's map of placed segments to disk. It's written to a temp file
+    first, then renamed over the previous map: a crash never leaves a partial map behind
+    """
+    mapFileName = getSegmentMapFileName(nzbFile)
+    fd, tempFileName = tempfile.mkstemp('.tmp', os.path.basename(mapFileName) + '.',
+                                        os.path.dirname(mapFileName))
+    try:
+        mapFile = os.fdopen(fd, 'wb')
+        try:
+            mapFile.write(segmentMapHeader(nzbFile))
+            mapFile.write(nzbFile.segmentMap.tostring())
+        finally:
+            mapFile.close()
+        if os.path.exists(mapFileName) and not hasattr(os, 'link'):
+            # Windows can't rename over an existing file
+            os.remove(mapFileName)
+        os.rename(tempFileName, mapFileName)
+    except:
+        if os.path.exists(tempFileName):
+            os.remove(tempFileName)
+        raise
+
+def updateSegmentMap(nzbFile, byteIndex):
+    """ Write the specified byte of the NZBFile's bitmap to its map file (in place: the
+    rest of the map is unchanged) """
+    mapFile = open(getSegmentMapFileName(nzbFile), 'r+b')
+    try:
+        mapFile.seek(len(segmentMapHeader(nzbFile)) + byteIndex)
+        mapFile.write(nzbFile.segmentMap[byteIndex:byteIndex + 1].tostring())
+    finally:
+        mapFile.close()
+
+def loadSegmentMaps(dirName, files = None):
+    """ Load the segment maps (whose partial files exist) in the specified dir (optionally
+    given its listing of files). Returns a dict of NZBFile subjects to (the real filename,
+    SegmentMap) """
+    if files is None:
+        files = os.listdir(dirName)
+
+    segmentMaps = {}
+    for file in files:
+        if not file.endswith(SEGMENT_MAP_SUFFIX):
+            continue
+
+        fileName = file[:-len(SEGMENT_MAP_SUFFIX)]
+        partialFileName = os.path.join(dirName, fileName + PARTIAL_SUFFIX)
+        if not os.path.isfile(partialFileName):
+            continue
+
+        try:
+            subject, segmentMap = readSegmentMap(os.path.join(dirName, file),
+                                                 partialFileName)
+        except (IOError, OSError, ValueError):
+            continue
+        segmentMaps[subject] = (fileName, segmentMap)
+    return segmentMaps
+
+def loadSegmentMap(nzbFile):
+    """ Load the NZBFile's segment map, resuming the placement of its segments (see
+    resumePlacement). Returns the bitmap, or None if the map (or its partial file) doesn't
+    exist """
+    partialFileName = getPartialFileName(nzbFile)
+    if not os.path.isfile(partialFileName):
+        return None
+    try:
+        subject, segmentMap = readSegmentMap(getSegmentMapFileName(nzbFile), partialFileName)
+    except (IOError, OSError, ValueError):
+        return None
+    if subject != subjectKey(nzbFile.subject):
+        return None
+    resumePlacement(nzbFile, segmentMap)
+    return nzbFile.segmentMap
+
+class SegmentMap:
+    """ The contents of a map file """
+    def __init__(self, bitmap, ySize, segmentOffsets):
+        self.bitmap = bitmap
+        self.ySize = ySize
+        self.segmentOffsets = segmentOffsets
+
+def readSegmentMap(mapFileName, partialFileName):
+    """ Return the subject and SegmentMap stored in the map file """
+    mapFile = open(mapFileName, 'rb')
+    try:
+        subject = mapFile.readline()[:-1]
+        ySize = int(mapFile.readline())
+        offsetsLine = mapFile.readline()[:-1]
+        bitmap = array('B', mapFile.read())
+    finally:
+        mapFile.close()
+
+    if ySize <= 0:
+        # The partial file was created at the final file's size
+        ySize = os.path.getsize(partialFileName)
+
+    segmentOffsets = {}
+    for offset in offsetsLine.split(','):
+        if offset:
+            number, yBegin, yEnd = [int(value) for value in offset.split(':')]
+            segmentOffsets[number] = (yBegin, yEnd or None)
+    return subject, SegmentMap(bitmap, ySize, segmentOffsets)
+
+def resumePlacement(nzbFile, segmentMap):
+    """ Continue placing the NZBFile's segments, as recorded in the loaded SegmentMap """
+    if nzbFile.segmentMap is not None:
+        return
+    nzbFile.segmentMap = segmentMap.bitmap
+    nzbFile.segmentOffsets = segmentMap.segmentOffsets
+    if nzbFile.ySize is None:
+        nzbFile.ySize = segmentMap.ySize
+
+def finishPlacement(nzbFile):
+    """ All of the NZBFile's segments have been placed: move its partial file to its final
+    destination """
+    os.rename(getPartialFileName(nzbFile), nzbFile.getDestination())
+    try:
+        os.remove(getSegmentMapFileName(nzbFile))
+    except OSError:
+        pass
+    Hellanzb.workingDirIndex.refresh(getPartialFileName(nzbFile), nzbFile.getDestination(),
+                                     getSegmentMapFileName(nzbFile))
+    nzbFile.segmentMap = None
+    nzbFile.segmentOffsets = {}
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
@@ -0,0 +1,277 @@
+"""
+
+SegmentRouter - Steers queued segments towards the cheapest serverPool likely to have
+them
+
+Every serverPool pulls segments from the same NZBSegmentQueue. Without routing, whichever
+pool asks first gets the next segment: expensive (e.g. per GB block account) pools take
+their share of the download, and pools with poor retention burn a 430 round trip on old
+articles before the RetryQueue hands them elsewhere
+
+The SegmentRouter keeps each serverPool's observed article miss rate (per newsgroup and
+article age), its throughput and its configured cost. A pool pulling a segment from the
+main queue passes on it when another available pool is cheaper and likely has the
+article, or when it's unlikely to have the article while another pool is far less likely
+to miss it. Passed segments are moved to the RetryQueue, excluding only the passing pool,
+so they're still retried there should the other pools miss them
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import time, Hellanzb
+try:
+    set
+except NameError:
+    from sets import Set as set
+from Hellanzb.Log import *
+
+__id__ = '$Id$'
+
+# Article age buckets, in days since posted
+AGE_BUCKETS = (1, 7, 30, 90, 365)
+
+def ageBucket(nzbFile, now = None):
+    """ Return the index of the specified NZBFile's age bucket (len(AGE_BUCKETS) for
+    articles older than all buckets). None when its posting date is unknown """
+    try:
+        posted = int(nzbFile.date)
+    except (TypeError, ValueError):
+        return None
+
+    if now is None:
+        now = time.time()
+    days = (now - posted) / 86400.0
+    i = 0
+    for limit in AGE_BUCKETS:
+        if days < limit:
+            return i
+        i += 1
+    return i
+
+def routeKey(nzbFile, now = None):
+    """ Return the (newsgroup, age bucket) key miss rates are tracked by for the specified
+    NZBFile """
+    group = None
+    if len(nzbFile.groups):
+        group = min(nzbFile.groups)
+    return (group, ageBucket(nzbFile, now))
+
+class PoolStats:
+    """ The routing related statistics of a serverPool """
+    # Past observations decay by this factor with every new observation (per key), so the
+    # miss rates follow changes in a server's retention
+    DECAY = 0.98
+    # Prior observations assumed of keys we don't know anything about yet: pools are
+    # assumed to have articles, until they're seen missing them
+    PRIOR_HITS = 2.0
+    PRIOR_MISSES = 0.1
+    # Minimum observations of a (newsgroup, age bucket) key before its miss rate is
+    # trusted over the rate of its age bucket (across all newsgroups)
+    MIN_OBSERVATIONS = 5
+    # Seconds between throughput calculations
+    RATE_INTERVAL = 10
+    # Seconds without finding any articles, while downloading, until the pool is
+    # considered stalled
+    STALL_TIME = 60
+
+    def __init__(self, serverPoolName, cost = 0):
+        self.serverPoolName = serverPoolName
+        self.cost = cost
+
+        # (newsgroup, age bucket) -> [hits, misses]
+        self.observations = {}
+
+        # Bytes/sec of articles found
+        self.rate = 0
+        self.rateBytes = 0
+        self.rateStartTime = time.time()
+        self.lastFoundTime = None
+
+        # Number of segments this pool passed on to other pools
+        self.passed = 0
+
+    def observe(self, key, found):
+        """ Record an article hit or miss """
+        group, bucket = key
+        keys = [key]
+        if group is not None:
+            # Also tally the age bucket across all newsgroups
+            keys.append((None, bucket))
+
+        for key in keys:
+            counts = self.observations.setdefault(key, [0.0, 0.0])
+            counts[0] *= self.DECAY
+            counts[1] *= self.DECAY
+            if found:
+                counts[0] += 1
+            else:
+                counts[1] += 1
+
+    def missRate(self, key):
+        """ Return the estimated likelihood of this pool missing an article of the specified
+        key """
+        counts = self.observations.get(key)
+        if (counts is None or sum(counts) < self.MIN_OBSERVATIONS) and key[0] is not None:
+            counts = self.observations.get((None, key[1]))
+        if counts is None:
+            counts = (0.0, 0.0)
+        hits, misses = counts
+        return (misses + self.PRIOR_MISSES) / \
+            (hits + misses + self.PRIOR_HITS + self.PRIOR_MISSES)
+
+    def found(self, bytes):
+        """ Record an article found, for calculating the throughput """
+        now = time.time()
+        self.lastFoundTime = now
+        self.rateBytes += bytes
+
+        elapsed = now - self.rateStartTime
+        if elapsed >= self.RATE_INTERVAL:
+            self.rate = (self.rate + self.rateBytes / elapsed) / 2
+            self.rateBytes = 0
+            self.rateStartTime = now
+
+    def isAvailable(self, loggedIn, active):
+        """ Whether or not this pool can take on segments: it has logged in connections (and
+        whether or not any are active), and hasn't stalled """
+        if not loggedIn:
+            return False
+
+        # Connected but not finding anything (e.g. it's hanging, or the account is out of
+        # its quota)
+        return not active or self.lastFoundTime is None or \
+            time.time() - self.lastFoundTime < self.STALL_TIME
+
+class SegmentRouter:
+    """ Decides which segments of the main queue a serverPool should pass on to other
+    serverPools """
+    # A pool is likely to have an article when its miss rate is below this
+    LIKELY_MISS_RATE = 0.25
+    # A pool passes on an article it's unlikely to have (miss rate of at least
+    # UNLIKELY_MISS_RATE) to a pool missing at least MISS_RATE_MARGIN less, even when
+    # that pool costs more
+    UNLIKELY_MISS_RATE = 0.5
+    MISS_RATE_MARGIN = 0.25
+
+    def __init__(self):
+        # serverPoolName -> PoolStats
+        self.pools = {}
+
+    def availablePools(self):
+        """ Return the names of the serverPools that can currently take on segments """
+        loggedIn = {}
+        active = {}
+        for nsf in Hellanzb.nsfs:
+            for client in nsf.clients:
+                if client.isLoggedIn:
+                    loggedIn[nsf.serverPoolName] = True
+                if client.activated:
+                    active[nsf.serverPoolName] = True
+
+        available = set()
+        for pool in self.pools.itervalues():
+            if pool.isAvailable(pool.serverPoolName in loggedIn,
+                                pool.serverPoolName in active):
+                available.add(pool.serverPoolName)
+        return available
+
+    def addServerPool(self, serverPoolName, cost = 0):
+        """ Add a serverPool to route to """
+        self.pools[serverPoolName] = PoolStats(serverPoolName, cost)
+
+    def removeServerPool(self, serverPoolName):
+        """ Stop routing to the specified serverPool """
+        self.pools.pop(serverPoolName, None)
+
+    def segmentFound(self, serverPoolName, segment):
+        """ The specified pool downloaded the segment """
+        pool = self.pools.get(serverPoolName)
+        if pool is not None:
+            pool.observe(routeKey(segment.nzbFile), True)
+            pool.found(segment.bytes)
+
+    def segmentMissing(self, serverPoolName, segment):
+        """ The specified pool doesn't have the segment """
+        pool = self.pools.get(serverPoolName)
+        if pool is not None:
+            pool.observe(routeKey(segment.nzbFile), False)
+
+    def shouldPass(self, serverPoolName, segment, available = None):
+        """ Whether or not the specified pool should pass on downloading the segment (to be
+        picked up by a better suited pool). available is the names of the available
+        serverPools (see availablePools) """
+        pool = self.pools.get(serverPoolName)
+        if pool is None or len(segment.failedServerPools):
+            # Only first attempts are routed, the RetryQueue takes care of the rest
+            return False
+
+        if available is None:
+            available = self.availablePools()
+
+        # The best suited pool: the cheapest pool likely to have the article. Otherwise
+        # the pool least likely to miss it. Faster pools win ties
+        key = routeKey(segment.nzbFile)
+        best = bestRank = None
+        for other in self.pools.itervalues():
+            if other is not pool and other.serverPoolName not in available:
+                continue
+
+            otherMissRate = other.missRate(key)
+            if otherMissRate < self.LIKELY_MISS_RATE:
+                rank = (0, other.cost, otherMissRate, -other.rate)
+            else:
+                rank = (1, otherMissRate, other.cost, -other.rate)
+            if best is None or rank < bestRank:
+                best, bestRank = other, rank
+
+        if best is pool:
+            return False
+
+        missRate = pool.missRate(key)
+        bestMissRate = best.missRate(key)
+        if best.cost < pool.cost:
+            passing = bestMissRate < self.LIKELY_MISS_RATE
+        else:
+            # Don't burn a round trip (and a 430) when we're unlikely to have it
+            passing = missRate >= self.UNLIKELY_MISS_RATE and \
+                missRate - bestMissRate >= self.MISS_RATE_MARGIN
+
+        if passing:
+            pool.passed += 1
+            if Hellanzb.DEBUG_MODE_ENABLED:
+                debug('SegmentRouter: %s passing segment: %s to %s (cost: %s/%s miss rate: '
+                      '%.2f/%.2f)' % (serverPoolName, segment.getDestination(),
+                                      best.serverPoolName, pool.cost, best.cost, missRate,
+                                      bestMissRate))
+        return passing
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
@@ -0,0 +1,1205 @@
+"""
+
+Sharding - Splits the downloading between multiple worker processes
+
+With Hellanzb.DOWNLOAD_WORKERS set, the daemon spawns that many download worker
+processes, each opening its share of every server's connections. The daemon keeps the
+one and only download queue: it hands out batches of segments to the workers over a
+local (UNIX socket) channel, and the workers report back the segments they finished
+(yDecoded to their _ENC files in the DOWNLOAD_TEMP_DIR), the segments missing from their
+servers, their byte counts and the state of their connections.
+
+Each of a worker's NZBLeecherFactories is represented in the daemon by a ShardFactory (in
+Hellanzb.nsfs), so the rest of the daemon -- the queue, decoding, the ticker and the
+XML-RPC calls -- works as it does without workers
+
+Messages are pickled tuples of the message name and its arguments, handled by the
+receiving end's msg_<name> method
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import cPickle, logging, os, signal, sys, tempfile, thread, time, Hellanzb
+try:
+    set
+except NameError:
+    from sets import Set as set
+from shutil import rmtree
+from twisted.internet import reactor
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ClientFactory, Factory, ProcessProtocol
+from twisted.protocols.basic import NetstringReceiver
+from Hellanzb.Log import *
+from Hellanzb.Logging import ScrollableHandler
+from Hellanzb.Util import EmptyForThisPool, PoolsExhausted, nuke, touch
+from Hellanzb.NZBLeecher import DEFAULT_ANTI_IDLE, DEFAULT_IDLE_TIMEOUT, connectServer, \
+    getServersByPriority, initNZBLeecher, setWithDefault
+from Hellanzb.NZBLeecher.ArticleDecoder import decode, YDecoder
+from Hellanzb.NZBLeecher.NZBLeecherUtil import HellaThrottler
+from Hellanzb.NZBLeecher.Protocol import NZBLeecher, NZBLeecherFactory
+from Queue import Empty
+
+__id__ = '$Id$'
+
+# Why a worker's queue ran dry (see ShardQueue.getSmart)
+EMPTY, EMPTY_FOR_THIS_POOL = 'empty', 'emptyForThisPool'
+
+def shareOf(count, workerIndex, workerCount):
+    """ Return the specified worker's share of the count (e.g. of connections) """
+    return count / workerCount + int(workerIndex < count % workerCount)
+
+def rateShareOf(rate, workerCount):
+    """ Return a worker's share of the specified rate limit (0 for no limit) """
+    if not rate:
+        return 0
+    return max(1, rate / workerCount)
+
+def shardServerDict(serverDict, workerIndex, workerCount):
+    """ Return a copy of the server information dict (from defineServer) with just the
+    specified worker's share of its connections (and its maxRate). None if the worker gets
+    none of its connections """
+    connections = int(serverDict['connections'])
+    shardConnections = shareOf(connections, workerIndex, workerCount)
+    if not shardConnections:
+        return None
+
+    shardDict = serverDict.copy()
+    shardDict['connections'] = shardConnections
+
+    minConnections = setWithDefault(serverDict, 'minConnections', None)
+    if minConnections is not None:
+        shardDict['minConnections'] = \
+            max(1, min(shardConnections,
+                       shareOf(int(minConnections), workerIndex, workerCount)))
+
+    maxRate = int(setWithDefault(serverDict, 'maxRate', 0))
+    if maxRate > 0:
+        shardDict['maxRate'] = max(1, maxRate * shardConnections / connections)
+    return shardDict
+
+def restoreYDecoder(decoderState):
+    """ Recreate the YDecoder (minus its sink) of a segment yDecoded by a worker """
+    decoder = YDecoder(None)
+    decoder.state, decoder.ybegin, decoder.ypart, decoder.yend, decoder.crc, \
+        decoder.decodedBytes = decoderState
+    return decoder
+
+class ShardChannel(NetstringReceiver):
+    """ The channel between the daemon and a worker """
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    # Handles the received messages
+    handler = None
+
+    def send(self, *message):
+        """ Send the message (its name followed by its arguments) """
+        self.sendString(cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL))
+
+    def stringReceived(self, string):
+        message = cPickle.loads(string)
+        handler = self.handler or self
+        getattr(handler, 'msg_' + message[0])(*message[1:])
+
+class ShardMasterChannel(ShardChannel):
+    """ The daemon's end of a channel. Handled by the ShardWorker of the worker process
+    that connected, once it has said hello """
+
+    def msg_hello(self, workerIndex):
+        self.handler = self.factory.master.workers[workerIndex]
+        self.handler.attach(self)
+
+    def connectionLost(self, reason):
+        if self.handler is not None:
+            self.handler.detach(self)
+
+class ShardMasterFactory(Factory):
+    protocol = ShardMasterChannel
+
+    def __init__(self, master):
+        self.master = master
+
+class ShardMaster:
+    """ Spawns the download workers, and keeps track of the segments handed out to them """
+    # Seconds between syncing the workers with the current NZBs
+    SYNC_INTERVAL = 1
+
+    def __init__(self, workerCount):
+        self.workers = [ShardWorker(self, workerIndex) for workerIndex in range(workerCount)]
+        self.socketDir = None
+        self.socketPath = None
+        self.syncID = None
+
+        # Identifies the segments handed out
+        self.lastKey = 0
+
+        # NZBs with segments handed out to the workers (by id()), and the maxRate they
+        # were handed out with
+        self.nzbs = {}
+        self.nzbRates = {}
+
+        # Ticker colors of the hosts
+        self.colors = {}
+
+    def addServer(self, serverId, serverDict):
+        """ Create the ShardFactories of the specified server (in the order its workers will
+        create their NZBLeecherFactories). Returns the number of connections that will be
+        made """
+        connectionCount = 0
+        added = False
+        for worker in self.workers:
+            shardDict = shardServerDict(serverDict, worker.index, len(self.workers))
+            if shardDict is None:
+                continue
+
+            for host in shardDict['hosts']:
+                nsf = ShardFactory(worker, len(worker.factories), serverId, shardDict, host)
+                worker.factories.append(nsf)
+                Hellanzb.nsfs.append(nsf)
+                connectionCount += nsf.connectionCount
+
+                if not added:
+                    # Let the queue know about this new serverPool
+                    Hellanzb.queue.serverAdd(nsf)
+                    added = True
+        return connectionCount
+
+    def start(self):
+        """ Listen for the workers, and spawn them """
+        self.socketDir = tempfile.mkdtemp(prefix = 'hellanzb-')
+        self.socketPath = os.path.join(self.socketDir, 'workers')
+        reactor.listenUNIX(self.socketPath, ShardMasterFactory(self))
+        reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+        info('Starting %i download workers' % len(self.workers))
+        for worker in self.workers:
+            worker.spawn()
+
+        self.sync()
+        # The worker's rates are tallied once a second
+        Hellanzb.ht.updateRates()
+
+    def stop(self):
+        """ Stop the workers """
+        if self.syncID is not None and self.syncID.active():
+            self.syncID.cancel()
+        for worker in self.workers:
+            worker.kill()
+        try:
+            rmtree(self.socketDir)
+        except OSError:
+            pass
+
+    def newKey(self):
+        self.lastKey += 1
+        return self.lastKey
+
+    def addNZB(self, nzb):
+        """ Note that segments of the specified NZB are being handed out """
+        nzbKey = id(nzb)
+        if nzbKey not in self.nzbs:
+            self.nzbs[nzbKey] = nzb
+            self.nzbRates[nzbKey] = nzb.maxRate
+        return nzbKey
+
+    def sync(self):
+        """ Sync the workers with the current NZBs """
+        self.forgetStale()
+
+        for nzbKey, nzb in self.nzbs.iteritems():
+            if self.nzbRates[nzbKey] != nzb.maxRate:
+                self.nzbRates[nzbKey] = nzb.maxRate
+                for worker in self.workers:
+                    worker.send('nzbMaxRate', nzbKey,
+                                rateShareOf(nzb.maxRate, len(self.workers)))
+
+        self.syncID = reactor.callLater(self.SYNC_INTERVAL, self.sync)
+
+    def forgetStale(self):
+        """ Make the workers forget about the segments of NZBs no longer being downloaded
+        (canceled or postponed) """
+        currentNZBs = Hellanzb.queue.currentNZBs()
+        staleKeys = [nzbKey for nzbKey, nzb in self.nzbs.iteritems() \
+                     if nzb not in currentNZBs]
+        if not len(staleKeys):
+            return
+
+        for nzbKey in staleKeys:
+            del self.nzbs[nzbKey]
+            del self.nzbRates[nzbKey]
+        for worker in self.workers:
+            worker.forget(staleKeys)
+
+class ShardWorker(ProcessProtocol):
+    """ A download worker process, as seen from the daemon """
+    # Seconds before respawning a worker that died
+    RESPAWN_DELAY = 5
+
+    def __init__(self, master, index):
+        self.master = master
+        self.index = index
+        # ShardFactories, in the order of the worker's Hellanzb.nsfs
+        self.factories = []
+
+        self.channel = None
+        self.respawnID = None
+
+        # The worker's current download rate, and total bytes downloaded
+        self.rate = 0
+        self.totalBytes = 0
+        self.totalWireBytes = 0
+
+        # Incomplete line of output
+        self.outBuffer = ''
+
+    def spawn(self):
+        """ Start the worker process. It connects back to the ShardMaster """
+        self.respawnID = None
+        self.outBuffer = ''
+
+        # The worker imports Hellanzb from wherever we did
+        env = os.environ.copy()
+        paths = [os.path.dirname(os.path.dirname(os.path.abspath(Hellanzb.__file__)))]
+        if env.get('PYTHONPATH'):
+            paths.append(env['PYTHONPATH'])
+        env['PYTHONPATH'] = os.pathsep.join(paths)
+
+        args = [sys.executable, '-c', 'from Hellanzb.Core import main; main()',
+                '-c', os.path.abspath(Hellanzb.CONFIG_FILENAME),
+                '--download-worker', '%i:%i:%s' % (self.index, len(self.master.workers),
+                                                   self.master.socketPath)]
+        reactor.spawnProcess(self, sys.executable, args, env = env)
+
+    def kill(self):
+        """ Stop the worker process (and don't respawn it) """
+        if self.respawnID is not None and self.respawnID.active():
+            self.respawnID.cancel()
+        self.respawnID = None
+        if self.transport is not None:
+            try:
+                self.transport.signalProcess('TERM')
+            except ProcessExitedAlready:
+                pass
+
+    def send(self, *message):
+        """ Send the message to the worker, if it's connected. Workers are caught up with the
+        current state of the download when they (re)connect """
+        if self.channel is not None:
+            self.channel.send(*message)
+
+    def attach(self, channel):
+        """ The worker connected: get it downloading """
+        debug('Download worker %i connected' % self.index)
+        self.channel = channel
+        self.totalBytes = 0
+        self.totalWireBytes = 0
+        self.send('setup', Hellanzb.DEBUG_MODE_ENABLED, Hellanzb.DOWNLOAD_TEMP_DIR,
+                  rateShareOf(Hellanzb.ht.readLimit, len(self.master.workers)),
+                  Hellanzb.downloadPaused)
+
+        if Hellanzb.downloading:
+            for nsf in self.factories:
+                if nsf.fillServerPriority == 0:
+                    nsf.beginDownload()
+
+    def detach(self, channel):
+        if self.channel is channel:
+            self.channel = None
+
+    def forget(self, nzbKeys):
+        """ Forget about the segments of the specified NZBs """
+        for nsf in self.factories:
+            nsf.forget(nzbKeys)
+        self.send('forget', nzbKeys)
+
+    def outReceived(self, data):
+        self.logOutput(data, debug)
+
+    def errReceived(self, data):
+        self.logOutput(data, error)
+
+    def logOutput(self, data, logFunction):
+        """ Log the worker's output (logging normally goes over the channel, this catches the
+        likes of tracebacks) """
+        lines = (self.outBuffer + data).split('\n')
+        self.outBuffer = lines.pop()
+        for line in lines:
+            logFunction('Download worker %i: %s' % (self.index, line.rstrip()))
+
+    def processEnded(self, reason):
+        self.channel = None
+        self.rate = 0
+        if Hellanzb.SHUTDOWN:
+            return
+
+        error('Download worker %i exited unexpectedly (%s), restarting it in %i seconds' % \
+              (self.index, reason.getErrorMessage(), self.RESPAWN_DELAY))
+        for nsf in self.factories:
+            nsf.reset()
+        self.respawnID = reactor.callLater(self.RESPAWN_DELAY, self.spawn)
+
+    def msg_log(self, levelno, message):
+        """ Log a message logged by the worker """
+        message = message.rstrip('\n')
+        if levelno == ScrollableHandler.LOGFILE:
+            logFile(message)
+        elif levelno == ScrollableHandler.NOLOGFILE:
+            noLogFile(message)
+        elif levelno >= logging.ERROR:
+            error(message)
+        elif levelno >= logging.WARNING:
+            warn(message)
+        elif levelno >= logging.INFO:
+            info(message)
+        else:
+            debug(message)
+
+    def msg_stats(self, rate, totalBytes, totalWireBytes, factoryStats):
+        """ The worker's periodic statistics """
+        self.rate = rate
+        Hellanzb.totalBytesDownloaded += totalBytes - self.totalBytes
+        Hellanzb.totalWireBytesDownloaded += totalWireBytes - self.totalWireBytes
+        self.totalBytes = totalBytes
+        self.totalWireBytes = totalWireBytes
+
+        for nsf, (sessionReadBytes, sessionWireBytes, clientStats) in \
+                zip(self.factories, factoryStats):
+            nsf.sessionReadBytes = sessionReadBytes
+            nsf.sessionWireBytes = sessionWireBytes
+            nsf.updateClients(clientStats)
+
+    def msg_want(self, factoryIndex):
+        self.factories[factoryIndex].fill()
+
+    def msg_idle(self, factoryIndex, justThisDownloadPool):
+        self.factories[factoryIndex].workerIdle(justThisDownloadPool)
+
+    def msg_done(self, factoryIndex, *args):
+        self.factories[factoryIndex].segmentDone(*args)
+
+    def msg_missing(self, factoryIndex, key):
+        self.factories[factoryIndex].segmentMissing(key)
+
+    def msg_cancel(self):
+        """ The worker was unable to download the current NZB """
+        from Hellanzb.Daemon import cancelCurrent
+        cancelCurrent()
+
+class ShardThrottler(HellaThrottler):
+    """ The daemon's HellaThrottler when downloading via workers: the workers do the
+    throttling (each with its share of the read limit), the daemon tallies their rates """
+
+    def __init__(self, readLimit, workers):
+        self.workers = workers
+        HellaThrottler.__init__(self, readLimit)
+
+    def setReadLimit(self, readLimit):
+        """ Change the global read limit (bytes/sec, 0 for no limit) """
+        self.readLimit = readLimit
+        self.readBucket = None
+        for worker in self.workers:
+            worker.send('maxRate', rateShareOf(readLimit, len(self.workers)))
+
+    def updateRates(self):
+        """ Update the download rate statistics (and the UI) """
+        self.readThisSecond = 0
+        for worker in self.workers:
+            self.readThisSecond += worker.rate
+        HellaThrottler.updateRates(self)
+
+class ShardTransport:
+    """ Stands in for the transport of a ShardClient """
+
+    def __init__(self, client):
+        self.client = client
+
+    def loseConnection(self):
+        client = self.client
+        client.factory.worker.send('disconnect', client.factory.index, client.id)
+
+class ShardClient:
+    """ Mirrors one of a worker's NZBLeechers (as of the worker's last stats) """
+
+    def __init__(self, factory, id):
+        self.factory = factory
+        self.id = id
+        self.transport = ShardTransport(self)
+
+        self.isLoggedIn = False
+        self.activated = False
+        self.currentSegment = None
+        self.pipelinedSegments = []
+
+    def setCurrentSegment(self, segment):
+        """ Change the currentSegment, updating the ticker """
+        if segment is self.currentSegment:
+            return
+
+        color = self.factory.color
+        if self.currentSegment is not None and \
+                (self.currentSegment.priority, self.currentSegment, color) in \
+                Hellanzb.scroller.segments:
+            Hellanzb.scroller.removeClient(self.currentSegment, color)
+        self.currentSegment = segment
+        if segment is not None:
+            Hellanzb.scroller.addClient(segment, color)
+
+    def deactivate(self, justThisDownloadPool = False):
+        """ Deactivation is up to the worker """
+        pass
+
+    def __str__(self):
+        return '%s[%i.%i]' % (self.factory.serverPoolName, self.factory.worker.index, self.id)
+
+class ShardFactory:
+    """ Represents one of a worker's NZBLeecherFactories: hands out segments from the queue
+    to it, and handles the segments it's done with """
+
+    def __init__(self, worker, index, serverName, serverDict, host):
+        self.worker = worker
+        # The index of the NZBLeecherFactory in the worker's Hellanzb.nsfs
+        self.index = index
+
+        self.serverPoolName = serverName
+        self.fillServerPriority = setWithDefault(serverDict, 'fillserver', 0)
+        self.cost = float(setWithDefault(serverDict, 'cost', 0))
+        self.maxRate = int(setWithDefault(serverDict, 'maxRate', 0)) * 1024
+        self.antiIdleTimeout = int(setWithDefault(serverDict, 'antiIdle', DEFAULT_ANTI_IDLE))
+        self.pipelineDepth = max(1, int(setWithDefault(serverDict, 'pipelining', 1)))
+        self.connectionCount = int(serverDict['connections'])
+
+        split = host.split(':')
+        self.host = split[0]
+        if len(split) == 2:
+            self.port = int(split[1])
+        else:
+            self.port = 119
+
+        self.sessionReadBytes = 0
+        self.sessionWireBytes = 0
+        self.sessionStartTime = None
+
+        self.activated = False
+
+        # Mirrors of the worker's NZBLeechers
+        self.clients = []
+        self.clientsById = {}
+        self.activeClients = set()
+
+        # The worker scales and reconnects its own connections
+        self.scaler = None
+        self.leecherConnectors = []
+        self.parkedConnectors = []
+
+        # Segments handed out to the worker (by key), and how many of their bytes have been
+        # tallied (as of the worker's last stats)
+        self.pending = {}
+        self.talliedBytes = {}
+
+        # How many segments the worker is kept supplied with: enough to keep its
+        # pipelines full, and then some
+        self.batchSize = self.connectionCount * (self.pipelineDepth + 2)
+
+        # Hosts are told apart by the color of their NZBLeechers in the ticker (the same
+        # color across workers)
+        colors = worker.master.colors
+        if host not in colors:
+            try:
+                colors[host] = Hellanzb.NZBLF_COLORS.pop(0)
+            except IndexError:
+                colors[host] = Hellanzb.ACODE.F_BROWN
+        self.color = colors[host]
+        Hellanzb.scroller.setConnectionCount(self.color, self.connectionCount)
+
+    def fill(self):
+        """ Hand out segments from the queue to the worker, up to the batchSize. Returns the
+        number of segments handed out """
+        if self.worker.channel is None:
+            return 0
+        if Hellanzb.decodeBacklog.backedUp:
+            # Hand out more once the decoders catch up
+            Hellanzb.decodeBacklog.wait(self.fill)
+            return 0
+
+        segments = []
+        empty = None
+        while len(self.pending) < self.batchSize:
+            try:
+                priority, segment = Hellanzb.queue.getSmart(self)
+            except EmptyForThisPool:
+                empty = EMPTY_FOR_THIS_POOL
+                break
+            except Empty:
+                empty = EMPTY
+                break
+            segments.append(self.describe(segment))
+
+        if len(segments):
+            self.activated = True
+        self.worker.send('segments', self.index, segments, empty)
+        return len(segments)
+
+    def describe(self, segment):
+        """ Return the description of the segment the worker downloads it by """
+        key = self.worker.master.newKey()
+        self.pending[key] = segment
+        self.talliedBytes[key] = 0
+
+        nzbFile = segment.nzbFile
+        nzb = nzbFile.nzb
+        # Determine the filename to show in the UI (see NZBLeecher.prepareSegment)
+        if nzbFile.showFilename == None:
+            if nzbFile.filename == None:
+                nzbFile.showFilenameIsTemp = True
+            nzbFile.showFilename = nzbFile.getFilename()
+
+        return {'key': key,
+                'messageId': segment.messageId,
+                'number': segment.number,
+                'bytes': segment.bytes,
+                'priority': segment.priority,
+                'tempFileName': segment.getTempFileName(),
+                'failedServerPools': list(segment.failedServerPools),
+                'nzbKey': self.worker.master.addNZB(nzb),
+                'archiveName': nzb.archiveName,
+                'nzbMaxRate': rateShareOf(nzb.maxRate, len(self.worker.master.workers)),
+                'fileNumber': nzbFile.number,
+                'subject': nzbFile.subject,
+                'groups': nzbFile.groups,
+                'showFilename': nzbFile.showFilename}
+
+    def tally(self, key, readBytes):
+        """ Tally the bytes read of the specified segment since its last tally """
+        segment = self.pending[key]
+        readBytes -= self.talliedBytes[key]
+        if readBytes <= 0:
+            return
+        self.talliedBytes[key] += readBytes
+
+        segment.readBytes += readBytes
+        nzbFile = segment.nzbFile
+        nzbFile.readThisSecond += readBytes
+        nzbFile.totalReadBytes += readBytes
+        nzbFile.nzb.totalReadBytes += readBytes
+
+    def release(self, key):
+        """ Remove the specified segment from the pending segments (and the clients
+        downloading it). Returns it, None if it isn't pending """
+        segment = self.pending.pop(key, None)
+        if segment is None:
+            return None
+        del self.talliedBytes[key]
+
+        for client in self.clients:
+            if client.currentSegment is segment:
+                client.setCurrentSegment(None)
+        return segment
+
+    def segmentDone(self, clientId, key, tempFileName, readBytes, failedServerPools, found,
+                    decoderState):
+        """ The worker finished downloading the segment: decode it """
+        segment = self.pending.get(key)
+        if segment is None or segment.dontRequeue:
+            # The NZB was canceled or postponed in the meantime
+            self.release(key)
+            nuke(os.path.join(Hellanzb.DOWNLOAD_TEMP_DIR, tempFileName + '_ENC'))
+            return
+
+        self.tally(key, readBytes)
+        self.release(key)
+
+        for serverPoolName in failedServerPools:
+            if serverPoolName not in segment.failedServerPools:
+                segment.failedOn(serverPoolName)
+
+        if found:
+            Hellanzb.queue.segmentFound(self, segment)
+        self.decodeSegment(clientId, segment, decoderState)
+
+    def segmentMissing(self, key):
+        """ The worker's serverPool is missing the segment: requeue it for the others """
+        segment = self.release(key)
+        if segment is None or segment.dontRequeue:
+            return
+
+        try:
+            Hellanzb.queue.requeueMissing(self, segment)
+        except PoolsExhausted:
+            info(segment.nzbFile.showFilename + ' segment: ' + str(segment.number) + \
+                 ' Article is missing!')
+            touch(os.path.join(Hellanzb.DOWNLOAD_TEMP_DIR,
+                               segment.getTempFileName() + '_ENC'))
+            self.decodeSegment(None, segment, None)
+
+    def decodeSegment(self, clientId, segment, decoderState):
+        """ Decode the downloaded segment in one of the decodePool's threads """
+        segment.cachedToDisk = True
+        segment.encodedDataFile = None
+        segment.encodedDataList = None
+        segment.yDecoder = None
+        if decoderState is not None:
+            segment.yDecoder = restoreYDecoder(decoderState)
+
+        segment.fromServer = self.clientsById.get(clientId)
+        if segment.fromServer is None:
+            segment.fromServer = ShardClient(self, clientId or 0)
+
+        Hellanzb.totalSegmentsDownloaded += 1
+        Hellanzb.decodeBacklog.defer(decode, segment)
+
+    def workerIdle(self, justThisDownloadPool):
+        """ All of the worker's NZBLeechers ran out of segments """
+        if self.fill() or Hellanzb.decodeBacklog.backedUp:
+            # More were available after all (or will be, once the decoders catch up)
+            return
+
+        self.activated = False
+        if justThisDownloadPool:
+            # This serverPool is finished but there are segments pending in the queue for
+            # other serverPools (not completely done)
+            return
+
+        # Completely finished downloading the NZB?
+        for nsf in Hellanzb.nsfs:
+            if nsf.activated:
+                # Not yet
+                return
+
+        # No more active factories, finished downloading
+        from Hellanzb.Daemon import downloadIdle
+        downloadIdle()
+
+    def updateClients(self, clientStats):
+        """ Update the mirrors of the worker's NZBLeechers """
+        clientIds = []
+        for clientId, isLoggedIn, activated, key, readBytes in clientStats:
+            clientIds.append(clientId)
+            client = self.clientsById.get(clientId)
+            if client is None:
+                client = self.clientsById[clientId] = ShardClient(self, clientId)
+                self.clients.append(client)
+                Hellanzb.scroller.size += 1
+
+            client.isLoggedIn = isLoggedIn
+            client.activated = activated
+            if activated:
+                self.activeClients.add(client)
+            elif client in self.activeClients:
+                self.activeClients.remove(client)
+
+            segment = None
+            if key in self.pending:
+                segment = self.pending[key]
+                self.tally(key, readBytes)
+            client.setCurrentSegment(segment)
+
+        for client in self.clients[:]:
+            if client.id not in clientIds:
+                self.removeClient(client)
+
+    def removeClient(self, client):
+        """ The worker's NZBLeecher is gone """
+        client.setCurrentSegment(None)
+        self.clients.remove(client)
+        del self.clientsById[client.id]
+        if client in self.activeClients:
+            self.activeClients.remove(client)
+        Hellanzb.scroller.size -= 1
+
+    def forget(self, nzbKeys):
+        """ Forget about the pending segments of the specified NZBs (the worker drops them) """
+        for key, segment in self.pending.items():
+            if id(segment.nzbFile.nzb) in nzbKeys:
+                self.release(key)
+
+    def reset(self):
+        """ The worker died: requeue the segments that were handed out to it """
+        currentNZBs = Hellanzb.queue.currentNZBs()
+        for key, segment in self.pending.items():
+            self.release(key)
+            if segment.nzbFile.nzb in currentNZBs and not segment.dontRequeue:
+                Hellanzb.queue.requeue(self, segment)
+
+        for client in self.clients[:]:
+            self.removeClient(client)
+        self.activated = False
+
+    def fetchNextNZBSegment(self):
+        """ Begin or continue downloading on the worker """
+        if Hellanzb.downloadPaused:
+            # 'continue' is responsible for re-triggerering all clients in this case
+            return
+
+        self.fill()
+        self.worker.send('fetch', self.index)
+
+    def beginDownload(self):
+        """ Start the download """
+        self.sessionReadBytes = 0
+        self.sessionWireBytes = 0
+        self.sessionStartTime = time.time()
+        if self.fillServerPriority == 0:
+            self.activated = True
+            # Segments first, so the worker has something to begin with
+            self.fill()
+        self.worker.send('begin', self.index)
+
+    def endDownload(self):
+        """ End the download """
+        self.activated = False
+        self.worker.send('end', self.index)
+
+    def pauseDownload(self):
+        """ Pause the download """
+        self.worker.send('pause', self.index)
+
+    def continueDownload(self):
+        """ Continue a paused download. The worker resets its connections as needed """
+        self.worker.send('continue', self.index)
+        return 0
+
+    def disconnectClients(self, justActive = False):
+        """ Disconnect and deactivate the worker's clients (or just the active ones) """
+        # Make sure the worker won't requeue segments of canceled NZBs
+        self.worker.master.forgetStale()
+        self.worker.send('disconnect', self.index, None, justActive)
+
+class ShardNZB:
+    """ Stands in for an NZB in a worker """
+
+    def __init__(self, nzbKey, archiveName, maxRate):
+        self.key = nzbKey
+        self.archiveName = archiveName
+        self.maxRate = maxRate
+        self.canceled = False
+        self.nzbFiles = []
+        self.totalReadBytes = 0
+
+class ShardNZBFile:
+    """ Stands in for an NZBFile in a worker """
+
+    def __init__(self, nzb, number, subject, groups, showFilename):
+        self.nzb = nzb
+        self.number = number
+        self.subject = subject
+        self.groups = groups
+        self.filename = self.showFilename = showFilename
+        self.showFilenameIsTemp = False
+        self.readThisSecond = 0
+        self.totalReadBytes = 0
+
+    def getFilename(self):
+        return self.showFilename
+
+class ShardSegment:
+    """ Stands in for an NZBSegment in a worker """
+
+    def __init__(self, nzbFile, description):
+        self.nzbFile = nzbFile
+        self.key = description['key']
+        self.messageId = description['messageId']
+        self.number = description['number']
+        self.bytes = description['bytes']
+        self.priority = description['priority']
+        self.tempFileName = description['tempFileName']
+        self.failedServerPools = description['failedServerPools']
+
+        self.dontRequeue = False
+        self.found = False
+        self.readBytes = 0
+        self.cachedArticleDataBytes = 0
+        self.fetchTime = None
+
+        self.cachedToDisk = True
+        self.encodedDataFile = None
+        self.encodedDataList = None
+        self.yDecoder = None
+
+        # Workers don't hedge
+        self.hedgeOf = None
+        self.hedgeClients = None
+        self.hedgeLost = False
+
+    def getDecoderState(self):
+        """ Return the state of the YDecoder, for the daemon's restoreYDecoder """
+        decoder = self.yDecoder
+        if decoder is None:
+            return None
+        return (decoder.state, decoder.ybegin, decoder.ypart, decoder.yend, decoder.crc,
+                decoder.decodedBytes)
+
+    def getTempFileName(self):
+        return self.tempFileName
+
+    def getDestination(self):
+        return self.tempFileName
+
+class ShardQueue:
+    """ Stands in for the download queue in a worker: a buffer of segments handed out by the
+    daemon for each NZBLeecherFactory """
+
+    def __init__(self, serverPoolNames):
+        self.serverPoolNames = serverPoolNames
+        self.nzbs = {}
+        self.nzbFiles = {}
+
+        # By NZBLeecherFactory shardIndex: the segments, whether or not more have been
+        # asked for, and why the daemon's queue ran dry for it (when it did)
+        self.buffers = []
+        self.wanting = []
+        self.empty = []
+
+    def addFactory(self, nsf):
+        """ Add a buffer for the specified NZBLeecherFactory """
+        nsf.shardIndex = len(self.buffers)
+        self.buffers.append([])
+        self.wanting.append(False)
+        self.empty.append(None)
+
+    def serverAdd(self, serverFactory):
+        pass
+
+    def initRetryQueue(self):
+        pass
+
+    def currentNZBs(self):
+        return self.nzbs.values()
+
+    def addSegments(self, index, descriptions, empty):
+        """ Add the segments handed out by the daemon to the specified buffer """
+        self.wanting[index] = False
+        self.empty[index] = empty
+
+        for description in descriptions:
+            nzb = self.nzbs.get(description['nzbKey'])
+            if nzb is None:
+                nzb = self.nzbs[description['nzbKey']] = \
+                    ShardNZB(description['nzbKey'], description['archiveName'],
+                             description['nzbMaxRate'])
+
+            nzbFileKey = (nzb.key, description['fileNumber'])
+            nzbFile = self.nzbFiles.get(nzbFileKey)
+            if nzbFile is None:
+                nzbFile = self.nzbFiles[nzbFileKey] = \
+                    ShardNZBFile(nzb, description['fileNumber'], description['subject'],
+                                 description['groups'], description['showFilename'])
+                nzb.nzbFiles.append(nzbFile)
+
+            self.buffers[index].append(ShardSegment(nzbFile, description))
+
+    def forget(self, nzbKeys):
+        """ Drop the segments of the specified NZBs """
+        for nzbKey in nzbKeys:
+            nzb = self.nzbs.pop(nzbKey, None)
+            if nzb is None:
+                continue
+            nzb.canceled = True
+            for nzbFile in nzb.nzbFiles:
+                del self.nzbFiles[(nzbKey, nzbFile.number)]
+
+        for index, buffer in enumerate(self.buffers):
+            self.buffers[index] = [segment for segment in buffer \
+                                   if not segment.nzbFile.nzb.canceled]
+
+    def want(self, serverFactory):
+        """ Ask the daemon for more segments for the specified factory """
+        index = serverFactory.shardIndex
+        if not self.wanting[index] and self.empty[index] is None:
+            self.wanting[index] = True
+            Hellanzb.shardDownloader.send('want', index)
+
+    def getSmart(self, serverFactory):
+        """ Get the next segment from the factory's buffer """
+        buffer = self.buffers[serverFactory.shardIndex]
+        if not len(buffer):
+            self.want(serverFactory)
+            if self.empty[serverFactory.shardIndex] == EMPTY_FOR_THIS_POOL:
+                raise EmptyForThisPool()
+            raise Empty()
+
+        segment = buffer.pop(0)
+        if len(buffer) < serverFactory.connectionCount:
+            self.want(serverFactory)
+        return segment.priority, segment
+
+    def requeue(self, serverFactory, segment):
+        """ Put the segment back at the front of the factory's buffer """
+        self.buffers[serverFactory.shardIndex].insert(0, segment)
+        if not Hellanzb.downloadPaused:
+            serverFactory.activated = True
+            reactor.callLater(0, serverFactory.fetchNextNZBSegment)
+
+    def requeueMissing(self, serverFactory, segment):
+        """ The segment is missing from the factory's serverPool: the daemon requeues it for
+        the others, unless they've all failed it """
+        segment.failedServerPools.append(serverFactory.serverPoolName)
+        if len(set(segment.failedServerPools)) >= len(self.serverPoolNames):
+            raise PoolsExhausted()
+        Hellanzb.shardDownloader.send('missing', serverFactory.shardIndex, segment.key)
+
+    def segmentFound(self, serverFactory, segment):
+        segment.found = True
+
+class ShardLeecher(NZBLeecher):
+    """ A worker's NZBLeecher. Its segments are decoded by the daemon """
+
+    def prepareSegment(self, segment):
+        """ Prepare the specified segment for downloading. Its article data is always cached
+        to disk (where the daemon picks it up from), yDecoded as it's received """
+        segment.cachedToDisk = True
+        segment.encodedDataFile = \
+            open(os.path.join(Hellanzb.DOWNLOAD_TEMP_DIR,
+                              segment.getTempFileName() + '_ENC'), 'wb')
+        segment.yDecoder = YDecoder(segment.encodedDataFile.write)
+        segment.fetchTime = None
+
+    def deferSegmentDecode(self, segment):
+        """ Hand the segment back to the daemon for decoding """
+        Hellanzb.shardDownloader.send('done', self.factory.shardIndex, self.id, segment.key,
+                                      segment.tempFileName, segment.readBytes,
+                                      segment.failedServerPools, segment.found,
+                                      segment.getDecoderState())
+        Hellanzb.articleCache.release(segment)
+
+    def cancelCurrentNZB(self):
+        """ Have the daemon cancel the download of the current NZB """
+        Hellanzb.shardDownloader.send('cancel')
+
+    def __str__(self):
+        return '%s[%i.%i]' % (self.factory.serverPoolName, Hellanzb.shardDownloader.index,
+                              self.id)
+
+class ShardLeecherFactory(NZBLeecherFactory):
+    """ A worker's NZBLeecherFactory """
+    protocol = ShardLeecher
+
+    def deactivateClient(self, client, justThisDownloadPool = False):
+        """ Deactive the specified client. The daemon decides whether or not downloading is
+        finished """
+        self.activeClients.remove(client)
+
+        if not len(self.activeClients):
+            self.activated = False
+            Hellanzb.shardDownloader.send('idle', self.shardIndex, justThisDownloadPool)
+
+class ShardLogHandler(logging.Handler):
+    """ Sends a worker's log messages to the daemon """
+
+    def __init__(self, downloader):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.downloader = downloader
+
+    def emit(self, record):
+        if record.levelno in (ScrollableHandler.SCROLL, ScrollableHandler.SHUTDOWN):
+            return
+
+        if thread.get_ident() == Hellanzb.MAIN_THREAD_IDENT:
+            self.downloader.send('log', record.levelno, record.getMessage())
+        else:
+            reactor.callFromThread(self.downloader.send, 'log', record.levelno,
+                                   record.getMessage())
+
+class ShardDownloaderChannel(ShardChannel):
+    """ A worker's end of the channel """
+
+    def connectionMade(self):
+        self.handler = self.factory.downloader
+        self.handler.attach(self)
+
+    def connectionLost(self, reason):
+        self.handler.detach()
+
+class ShardDownloaderFactory(ClientFactory):
+    protocol = ShardDownloaderChannel
+
+    def __init__(self, downloader):
+        self.downloader = downloader
+
+    def clientConnectionFailed(self, connector, reason):
+        self.downloader.detach()
+
+class ShardDownloader:
+    """ The worker's end: downloads the segments handed out by the daemon """
+    # Seconds between sending statistics to the daemon
+    STATS_INTERVAL = 1
+
+    def __init__(self, index, workerCount, socketPath):
+        self.index = index
+        self.workerCount = workerCount
+        self.socketPath = socketPath
+        self.channel = None
+
+        # The (serverId, serverDict) of the servers, in the daemon's order
+        self.servers = []
+
+        # Messages sent before the channel is connected
+        self.unsent = []
+
+    def connect(self):
+        reactor.connectUNIX(self.socketPath, ShardDownloaderFactory(self))
+
+    def attach(self, channel):
+        self.channel = channel
+        channel.send('hello', self.index)
+        for message in self.unsent:
+            channel.send(*message)
+        self.unsent = []
+
+    def detach(self):
+        """ Lost the daemon, we're done """
+        from Hellanzb.Core import shutdown
+        self.channel = None
+        shutdown()
+
+    def send(self, *message):
+        if self.channel is None:
+            self.unsent.append(message)
+        else:
+            self.channel.send(*message)
+
+    def sendStats(self):
+        """ Send the statistics of the downloading to the daemon """
+        factoryStats = []
+        for nsf in Hellanzb.nsfs:
+            clientStats = []
+            for client in nsf.clients:
+                key = readBytes = None
+                if client.currentSegment is not None:
+                    key = client.currentSegment.key
+                    readBytes = client.currentSegment.readBytes
+                clientStats.append((client.id, client.isLoggedIn, client.activated, key,
+                                    readBytes))
+            factoryStats.append((nsf.sessionReadBytes, nsf.sessionWireBytes, clientStats))
+
+        self.send('stats', Hellanzb.ht.rate, Hellanzb.totalBytesDownloaded,
+                  Hellanzb.totalWireBytesDownloaded, factoryStats)
+        reactor.callLater(self.STATS_INTERVAL, self.sendStats)
+
+    def msg_setup(self, debugModeEnabled, downloadTempDir, readLimit, downloadPaused):
+        """ Begin: connect to the servers """
+        Hellanzb.DEBUG_MODE_ENABLED = debugModeEnabled
+        Hellanzb.DOWNLOAD_TEMP_DIR = downloadTempDir
+        Hellanzb.ht.setReadLimit(readLimit)
+        Hellanzb.downloadPaused = downloadPaused
+        # Keeps the rates updating
+        Hellanzb.downloading = True
+
+        for serverId, serverDict in self.servers:
+            shardDict = shardServerDict(serverDict, self.index, self.workerCount)
+            if shardDict is not None:
+                connectServer(serverId, shardDict, DEFAULT_ANTI_IDLE, DEFAULT_IDLE_TIMEOUT,
+                              factoryClass = ShardLeecherFactory)
+        for nsf in Hellanzb.nsfs:
+            Hellanzb.queue.addFactory(nsf)
+
+        self.sendStats()
+
+    def msg_segments(self, index, descriptions, empty):
+        Hellanzb.queue.addSegments(index, descriptions, empty)
+        if len(descriptions):
+            nsf = Hellanzb.nsfs[index]
+            nsf.activated = True
+            nsf.fetchNextNZBSegment()
+
+    def msg_forget(self, nzbKeys):
+        Hellanzb.queue.forget(nzbKeys)
+
+    def msg_nzbMaxRate(self, nzbKey, maxRate):
+        nzb = Hellanzb.queue.nzbs.get(nzbKey)
+        if nzb is not None:
+            nzb.maxRate = maxRate
+
+    def msg_maxRate(self, readLimit):
+        Hellanzb.ht.setReadLimit(readLimit)
+
+    def msg_fetch(self, index):
+        nsf = Hellanzb.nsfs[index]
+        nsf.activated = True
+        nsf.fetchNextNZBSegment()
+
+    def msg_begin(self, index):
+        Hellanzb.nsfs[index].beginDownload()
+
+    def msg_end(self, index):
+        Hellanzb.nsfs[index].endDownload()
+
+    def msg_pause(self, index):
+        Hellanzb.downloadPaused = True
+        Hellanzb.nsfs[index].pauseDownload()
+
+    def msg_continue(self, index):
+        Hellanzb.downloadPaused = False
+        Hellanzb.nsfs[index].continueDownload()
+
+    def msg_disconnect(self, index, clientId, justActive = False):
+        """ Disconnect the specified client (all of the factory's clients when None, or
+        just the active ones) """
+        nsf = Hellanzb.nsfs[index]
+        if clientId is None:
+            nsf.disconnectClients(justActive)
+            return
+
+        for client in nsf.clients:
+            if client.id == clientId:
+                client.transport.loseConnection()
+                client.isLoggedIn = False
+                client.deactivate()
+                break
+
+def runShardWorker(workerSpec):
+    """ Run as a download worker process, as specified by the daemon: 'index:count:socket' """
+    index, workerCount, socketPath = workerSpec.split(':', 2)
+    downloader = Hellanzb.shardDownloader = ShardDownloader(int(index), int(workerCount),
+                                                            socketPath)
+
+    # Everything's logged by the daemon
+    for handler in Hellanzb.logger.handlers[:]:
+        Hellanzb.logger.removeHandler(handler)
+        handler.close()
+    Hellanzb.logger.addHandler(ShardLogHandler(downloader))
+
+    # We are a downloader, but one that leaves cleaning up the DOWNLOAD_TEMP_DIR (and the
+    # ticker, and hedging) to the daemon
+    Hellanzb.IS_DOWNLOADER = True
+    Hellanzb.DISABLE_SCROLLER = True
+    Hellanzb.ENDGAME_HEDGING = False
+    Hellanzb.DOWNLOAD_WORKERS = 0
+
+    initNZBLeecher()
+    downloader.servers = getServersByPriority()
+    Hellanzb.queue = ShardQueue([serverId for serverId, serverDict in downloader.servers])
+
+    # CTRL-C is the daemon's to handle, it'll stop us
+    reactor.callWhenRunning(signal.signal, signal.SIGINT, signal.SIG_IGN)
+    reactor.callWhenRunning(downloader.connect)
+    reactor.run()
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
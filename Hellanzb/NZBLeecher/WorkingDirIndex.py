@@ -0,0 +1,282 @@
+"""
+
+WorkingDirIndex - An in memory index of the files in the WORKING_DIR
+
+Parsing an NZB matches each of its files and segments against those already in the
+WORKING_DIR (resuming a previous download). Rather than listing and stat'ing the directory
+for every parse, the WorkingDirIndex scans it once, then is kept up to date as segments are
+written, renamed, assembled and removed. It rescans itself should the WORKING_DIR be
+replaced (moved off for post processing, canceled, loaded from the POSTPONED_DIR)
+
+A SubjectMatcher finds which of its filenames occur within an NZBFile's subject in a single
+pass over the subject (an Aho-Corasick automaton), instead of a subject.find() per filename
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import os, stat
+from threading import Lock
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+__id__ = '$Id$'
+
+class WorkingDirIndex:
+    """ The sizes of the regular files in a directory, keyed by filename """
+    def __init__(self, dirName):
+        self.dirName = os.path.normpath(dirName)
+
+        # Decode threads update the index concurrently
+        self.lock = Lock()
+        # None until scanned
+        self.files = None
+        # The (device, inode) of the directory when it was scanned
+        self.dirId = None
+
+    def scan(self):
+        """ Return the sizes of the directory's files, read from disk """
+        files = {}
+        if scandir is not None:
+            for entry in scandir(self.dirName):
+                try:
+                    if entry.is_file():
+                        files[entry.name] = entry.stat().st_size
+                except OSError:
+                    pass
+            return files
+
+        for file in os.listdir(self.dirName):
+            try:
+                fileStat = os.stat(os.path.join(self.dirName, file))
+            except OSError:
+                continue
+            if stat.S_ISREG(fileStat.st_mode):
+                files[file] = fileStat.st_size
+        return files
+
+    def sync(self):
+        """ Scan the directory if it hasn't been, or was replaced since it was. Called with
+        the lock held """
+        try:
+            dirStat = os.stat(self.dirName)
+        except OSError:
+            self.files = {}
+            self.dirId = None
+            return
+
+        dirId = (dirStat.st_dev, dirStat.st_ino)
+        if self.files is None or dirId != self.dirId:
+            self.files = self.scan()
+            self.dirId = dirId
+
+    def invalidate(self):
+        """ The directory was changed in bulk: rescan it when next needed """
+        self.lock.acquire()
+        try:
+            self.files = None
+        finally:
+            self.lock.release()
+
+    def listing(self):
+        """ Return a sorted list of the directory's filenames """
+        self.lock.acquire()
+        try:
+            self.sync()
+            files = self.files.keys()
+        finally:
+            self.lock.release()
+        files.sort()
+        return files
+
+    def isValid(self, file, overwriteZeroByteFiles = False):
+        """ Whether or not the filename (within the directory) exists, and isn't a 0 byte
+        file to be overwritten (see NZBLeecherUtil.validWorkingFile) """
+        self.lock.acquire()
+        try:
+            self.sync()
+            size = self.files.get(file)
+        finally:
+            self.lock.release()
+        return size is not None and (size != 0 or not overwriteZeroByteFiles)
+
+    def size(self, path):
+        """ Return the size of the specified file, None if it doesn't exist """
+        if not self.tracks(path):
+            try:
+                return os.path.getsize(path)
+            except OSError:
+                return None
+
+        self.lock.acquire()
+        try:
+            self.sync()
+            return self.files.get(os.path.basename(path))
+        finally:
+            self.lock.release()
+
+    def isFile(self, path):
+        """ os.path.isfile, looked up in the index for paths within the directory """
+        if not self.tracks(path):
+            return os.path.isfile(path)
+        return self.isValid(os.path.basename(path))
+
+    def tracks(self, path):
+        return os.path.normpath(os.path.dirname(path)) == self.dirName
+
+    def refresh(self, *paths):
+        """ Update the index with the current state of the specified (just written, renamed
+        or removed) paths. Paths outside of the directory are ignored """
+        for path in paths:
+            if not self.tracks(path):
+                continue
+
+            try:
+                fileStat = os.stat(path)
+            except OSError:
+                fileStat = None
+
+            self.lock.acquire()
+            try:
+                if self.files is None:
+                    # Not scanned yet
+                    return
+                file = os.path.basename(path)
+                if fileStat is not None and stat.S_ISREG(fileStat.st_mode):
+                    self.files[file] = fileStat.st_size
+                elif file in self.files:
+                    del self.files[file]
+            finally:
+                self.lock.release()
+
+class SubjectMatcher:
+    """ Finds which of its filenames occur within subjects. Matches are returned in the order
+    the filenames were added """
+    def __init__(self, names = ()):
+        # The order each filename was added in, by filename
+        self.ranks = {}
+        self.nextRank = 0
+
+        # The automaton's goto, fail and output functions. Built when needed. Removing
+        # filenames doesn't require a rebuild (they're filtered out of the output)
+        self.goto = None
+        self.fail = None
+        self.output = None
+
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.ranks)
+
+    def __contains__(self, name):
+        return name in self.ranks
+
+    def add(self, name):
+        if name and name not in self.ranks:
+            self.ranks[name] = self.nextRank
+            self.nextRank += 1
+            self.goto = None
+
+    def remove(self, name):
+        if name in self.ranks:
+            del self.ranks[name]
+
+    def build(self):
+        """ Build the automaton """
+        goto = [{}]
+        output = [()]
+        for name in self.ranks:
+            state = 0
+            for char in name:
+                nextState = goto[state].get(char)
+                if nextState is None:
+                    nextState = len(goto)
+                    goto[state][char] = nextState
+                    goto.append({})
+                    output.append(())
+                state = nextState
+            output[state] = (name,)
+
+        # Breadth first: each state's fail state is that of its longest proper suffix also
+        # in the automaton
+        fail = [0] * len(goto)
+        queue = goto[0].values()
+        while len(queue):
+            nextQueue = []
+            for state in queue:
+                for char, nextState in goto[state].iteritems():
+                    nextQueue.append(nextState)
+                    failState = fail[state]
+                    while failState and char not in goto[failState]:
+                        failState = fail[failState]
+                    failState = goto[failState].get(char, 0)
+                    fail[nextState] = failState
+                    if len(output[failState]):
+                        output[nextState] = output[nextState] + output[failState]
+            queue = nextQueue
+
+        self.goto = goto
+        self.fail = fail
+        self.output = output
+
+    def matches(self, subject):
+        """ Return a list of the filenames occurring within the subject """
+        if not len(self.ranks):
+            return []
+        if self.goto is None:
+            self.build()
+
+        goto, fail, output, ranks = self.goto, self.fail, self.output, self.ranks
+        found = {}
+        state = 0
+        for char in subject:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for name in output[state]:
+                if name in ranks:
+                    found[name] = ranks[name]
+
+        found = [(rank, name) for name, rank in found.iteritems()]
+        found.sort()
+        return [name for rank, name in found]
+
+    def match(self, subject):
+        """ Return the first added filename occurring within the subject, or None """
+        found = self.matches(subject)
+        if len(found):
+            return found[0]
+        return None
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
@@ -13,16 +13,23 @@ import logging, os, sys, Hellanzb
 from twisted.copyright import version as twistedVersion
 from twisted.internet import reactor
 from twisted.internet.tcp import Connector
+from twisted.python.threadpool import ThreadPool
 from Hellanzb.Core import shutdownAndExit, finishShutdown
 from Hellanzb.Log import *
 from Hellanzb.Logging import NZBLeecherTicker
 from Hellanzb.Util import isWindows
+from Hellanzb.NZBLeecher.ArticleCache import ArticleCache, DecodeBacklog
 from Hellanzb.NZBLeecher.NZBSegmentQueue import FillServerQueue, NZBSegmentQueue
-from Hellanzb.NZBLeecher.NZBLeecherUtil import HellaThrottler, HellaThrottlingFactory
+from Hellanzb.NZBLeecher.NZBLeecherUtil import ConnectionScaler, HellaThrottler, \
+    HellaThrottlingFactory, TokenBucket
 from Hellanzb.NZBLeecher.Protocol import NZBLeecherFactory
+from Hellanzb.NZBLeecher.WorkingDirIndex import WorkingDirIndex
 
 __id__ = '$Id$'
 
+DEFAULT_ANTI_IDLE = int(4.5 * 60) # 4.5 minutes
+DEFAULT_IDLE_TIMEOUT = 30
+
 def initNZBLeecher():
     """ Init """
     # Note what version of twisted/python/os being used
@@ -52,11 +59,24 @@ def initNZBLeecher():
     Hellanzb.totalFilesDownloaded = 0
     Hellanzb.totalSegmentsDownloaded = 0
     Hellanzb.totalBytesDownloaded = 0
+    Hellanzb.totalWireBytesDownloaded = 0
 
     # this class handles updating statistics via the SCROLL level (the UI)
     Hellanzb.scroller = NZBLeecherTicker()
 
-    Hellanzb.ht = HellaThrottler(Hellanzb.MAX_RATE * 1024)
+    Hellanzb.articleCache = ArticleCache(Hellanzb.CACHE_LIMIT, Hellanzb.SPILL_LIMIT,
+                                         Hellanzb.SPILL_MIN_FREE)
+    Hellanzb.decodeBacklog = DecodeBacklog(Hellanzb.DECODE_BACKLOG_LIMIT)
+    Hellanzb.workingDirIndex = WorkingDirIndex(Hellanzb.WORKING_DIR)
+
+    if Hellanzb.DOWNLOAD_WORKERS:
+        # Leave the downloading to worker processes
+        from Hellanzb.NZBLeecher.Sharding import ShardMaster, ShardThrottler
+        Hellanzb.shardMaster = ShardMaster(Hellanzb.DOWNLOAD_WORKERS)
+        Hellanzb.ht = ShardThrottler(Hellanzb.MAX_RATE * 1024, Hellanzb.shardMaster.workers)
+    else:
+        Hellanzb.shardMaster = None
+        Hellanzb.ht = HellaThrottler(Hellanzb.MAX_RATE * 1024)
     Hellanzb.getCurrentRate = NZBLeecherFactory.getCurrentRate
 
     # loop to scan the queue dir during download
@@ -114,7 +134,19 @@ def setWithDefault(dict, key, default):
     
     return default
 
-def connectServer(serverName, serverDict, defaultAntiIdle, defaultIdleTimeout):
+def getServersByPriority():
+    """ Return the (serverId, serverDict) of all enabled servers. Ordered by their fillserver
+    priority, if fillserver support is enabled (then by their id) """
+    serverDictsByPriority = [(serverId, serverDict) for serverId, serverDict in \
+                             Hellanzb.SERVERS.items() if not serverDict.get('enabled') is False]
+    serverDictsByPriority.sort(lambda x, y: cmp(x[0], y[0]))
+    if isinstance(Hellanzb.queue, FillServerQueue):
+        serverDictsByPriority.sort(lambda x, y: cmp(x[1].get('fillserver'),
+                                                    y[1].get('fillserver')))
+    return serverDictsByPriority
+
+def connectServer(serverName, serverDict, defaultAntiIdle, defaultIdleTimeout,
+                  factoryClass = NZBLeecherFactory):
     """ Establish connections to the specified server according to the server information dict
     (constructed from the config file). Returns the number of connections that were attempted
     to be made """
@@ -123,19 +155,33 @@ def connectServer(serverName, serverDict, defaultAntiIdle, defaultIdleTimeout):
     hosts = serverDict['hosts']
     connections = int(serverDict['connections'])
 
+    # The server's own rate limit is shared by all of its hosts
+    maxRate = int(setWithDefault(serverDict, 'maxRate', 0)) * 1024
+    readBucket = None
+    if maxRate > 0:
+        readBucket = TokenBucket(maxRate)
+
     for host in hosts:
         antiIdle = int(setWithDefault(serverDict, 'antiIdle', defaultAntiIdle))
         idleTimeout = int(setWithDefault(serverDict, 'idleTimeout', defaultIdleTimeout))
         skipGroupCmd = setWithDefault(serverDict, 'skipGroupCmd', False)
         fillServer = setWithDefault(serverDict, 'fillserver', 0)
         useSSL = setWithDefault(serverDict, 'ssl', False)
-
-        nsf = NZBLeecherFactory(serverDict['username'], serverDict['password'],
-                                idleTimeout, antiIdle, host, serverName, skipGroupCmd,
-                                fillServer)
+        pipelineDepth = int(setWithDefault(serverDict, 'pipelining', 1))
+        compress = setWithDefault(serverDict, 'compress', False)
+        minConnections = setWithDefault(serverDict, 'minConnections', None)
+        cost = float(setWithDefault(serverDict, 'cost', 0))
+
+        nsf = factoryClass(serverDict['username'], serverDict['password'],
+                           idleTimeout, antiIdle, host, serverName, skipGroupCmd,
+                           fillServer, pipelineDepth = pipelineDepth,
+                           compress = compress, cost = cost, maxRate = maxRate)
         color = nsf.color
         Hellanzb.nsfs.append(nsf)
 
+        if minConnections is not None and int(minConnections) < connections:
+            nsf.scaler = ConnectionScaler(nsf, int(minConnections), connections)
+
         split = host.split(':')
         host = split[0]
         if len(split) == 2:
@@ -145,7 +191,7 @@ def connectServer(serverName, serverDict, defaultAntiIdle, defaultIdleTimeout):
         nsf.host, nsf.port = host, port
 
         preWrappedNsf = nsf
-        nsf = HellaThrottlingFactory(nsf)
+        nsf = HellaThrottlingFactory(nsf, readBucket = readBucket)
 
         ctxf = None
         if useSSL:
@@ -231,19 +277,16 @@ def connectServer(serverName, serverDict, defaultAntiIdle, defaultIdleTimeout):
 
 def startNZBLeecher():
     """ gogogo """
-    defaultAntiIdle = int(4.5 * 60) # 4.5 minutes
-    defaultIdleTimeout = 30
-    
     totalCount = 0
     # Order the initialization of servers by the fillserver priority, if fillserver
     # support is enabled
-    serverDictsByPriority = Hellanzb.SERVERS.items()
-    if isinstance(Hellanzb.queue, FillServerQueue):
-        serverDictsByPriority.sort(lambda x, y: cmp(x[1].get('fillserver'),
-                                                    y[1].get('fillserver')))
-    for serverId, serverDict in serverDictsByPriority:
-        if not serverDict.get('enabled') is False:
-            totalCount += connectServer(serverId, serverDict, defaultAntiIdle, defaultIdleTimeout)
+    for serverId, serverDict in getServersByPriority():
+        if Hellanzb.shardMaster is not None:
+            # The worker processes make the connections
+            totalCount += Hellanzb.shardMaster.addServer(serverId, serverDict)
+        else:
+            totalCount += connectServer(serverId, serverDict, DEFAULT_ANTI_IDLE,
+                                        DEFAULT_IDLE_TIMEOUT)
 
     # How large the scroll ticker should be
     Hellanzb.scroller.maxCount = totalCount
@@ -253,8 +296,17 @@ def startNZBLeecher():
     # for queueing segments that failed to download on particular serverPools.
     Hellanzb.queue.initRetryQueue()
 
-    # Allocate only one thread, just for decoding
+    # Decoding is handled by its own pool of threads. The reactor's pool is left with only
+    # one thread, for the few other jobs deferred to it (e.g. redoAssembly)
     reactor.suggestThreadPoolSize(1)
+    Hellanzb.decodePool = ThreadPool(Hellanzb.DECODE_THREADS, Hellanzb.DECODE_THREADS)
+    reactor.callWhenRunning(Hellanzb.decodePool.start)
+    reactor.addSystemEventTrigger('during', 'shutdown', Hellanzb.decodePool.stop)
+    reactor.callWhenRunning(Hellanzb.articleCache.start)
+    reactor.callWhenRunning(Hellanzb.decodeBacklog.start)
+
+    if Hellanzb.shardMaster is not None:
+        reactor.callWhenRunning(Hellanzb.shardMaster.start)
 
     # Well, there's egg and bacon; egg sausage and bacon; egg and spam; egg bacon and
     # spam; egg bacon sausage and spam; spam bacon sausage and spam; spam egg spam spam
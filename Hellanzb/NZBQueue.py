@@ -10,7 +10,10 @@ Hellanzb.nzbQueue
 """
 import gc, gzip, os, re, shutil, time, zipfile, Hellanzb, Hellanzb.Daemon
 from shutil import copy, move, rmtree
+from StringIO import StringIO
+from threading import Lock
 from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
 from xml.sax import make_parser, SAXParseException
 from xml.sax.handler import ContentHandler, feature_external_ges, feature_namespaces
 from Hellanzb.external.elementtree.SimpleXMLWriter import XMLWriter
@@ -385,30 +388,148 @@ def _writeStateXML(outFile):
     Hellanzb.recoveredState = RecoveredState() 
 Hellanzb._writeStateXML = _writeStateXML
 
-def writeStateXML():
-    """ Write hellanzb's state to the STATE_XML_FILE atomically """
-    file = Hellanzb.STATE_XML_FILE
-    def backupThenWrite():
-        backedUp = False
-        if os.path.exists(file):
-            move(file, file + '.bak')
-            backedUp = True
-
-        outFile = open(file, 'wb')
+class StateXMLWriter:
+    """ Coalesces writes of the STATE_XML_FILE. Changes to the state only mark it dirty: it's
+    written once they stop coming for delay seconds (and at least every MAX_DELAY seconds
+    while they don't). The state is serialized in the twisted main thread, then written to
+    disk from another thread, atomically replacing the previous STATE_XML_FILE (which is
+    kept as a .bak) """
+    MAX_DELAY = 10
+
+    def __init__(self, fileName, delay = 1):
+        self.fileName = fileName
+        self.delay = delay
+
+        # Whether or not the state changed since it was last serialized, and since when
+        self.dirty = False
+        self.dirtySince = None
+        self.writeID = None
+        # Whether or not a serialized state is being written to disk
+        self.writing = False
+
+        # Serialized states are numbered, so an older one never overwrites a newer one
+        # (flush writes from the main thread, possibly while the writing thread does)
+        self.lock = Lock()
+        self.version = 0
+        self.writtenVersion = 0
+
+    def changed(self):
+        """ The state changed: schedule a write (must be called from the twisted main
+        thread) """
+        now = time.time()
+        if not self.dirty:
+            self.dirty = True
+            self.dirtySince = now
+        if self.writing:
+            # Written again once the current write is done
+            return
+
+        delay = max(0, min(self.delay, self.dirtySince + self.MAX_DELAY - now))
+        if self.writeID is not None and self.writeID.active():
+            self.writeID.reset(delay)
+        else:
+            self.writeID = reactor.callLater(delay, self.write)
+
+    def serialize(self):
+        """ Return the current state as XML, numbered by its version """
+        outFile = StringIO()
         _writeStateXML(outFile)
+        self.dirty = False
+        self.dirtySince = None
+        self.version += 1
+        return outFile.getvalue(), self.version
+
+    def write(self):
+        """ Serialize the state, and write it to disk in a separate thread """
+        self.writeID = None
+        if not self.dirty:
+            return
+        
+        self.writing = True
+        data, version = self.serialize()
+        d = deferToThread(self.writeFile, data, version)
+        d.addBoth(self.written)
+
+    def written(self, result):
+        self.writing = False
+        if self.dirty:
+            # Changed while writing
+            self.changed()
+
+    def flush(self):
+        """ Write out any pending changes now (from the twisted main thread, when shutting
+        down) """
+        if self.writeID is not None and self.writeID.active():
+            self.writeID.cancel()
+        self.writeID = None
+        if self.dirty:
+            self.writeFile(*self.serialize())
+
+    def writeFile(self, data, version):
+        """ Write the serialized state to disk """
+        self.lock.acquire()
         try:
-            outFile.close()
-        except IOError, ioe:
-            if ioe.errno == 28:
-                error('Unable to write STATE_XML_FILE: No space left on device')
-                if backedUp:
-                    move(file + '.bak', file)
-
-    if inMainThread():
-        backupThenWrite()
-    else:
-        reactor.callFromThread(backupThenWrite)
+            if version <= self.writtenVersion:
+                return
+
+            tempFileName = self.fileName + '.tmp'
+            backupFileName = self.fileName + '.bak'
+            try:
+                outFile = open(tempFileName, 'wb')
+                try:
+                    outFile.write(data)
+                    outFile.flush()
+                    os.fsync(outFile.fileno())
+                finally:
+                    outFile.close()
+
+                if os.path.exists(self.fileName):
+                    if os.path.exists(backupFileName):
+                        os.remove(backupFileName)
+                    if hasattr(os, 'link'):
+                        try:
+                            os.link(self.fileName, backupFileName)
+                        except OSError:
+                            # Filesystem without hard links
+                            copy(self.fileName, backupFileName)
+                    else:
+                        # Windows can't rename over an existing file
+                        os.rename(self.fileName, backupFileName)
+                os.rename(tempFileName, self.fileName)
+                self.writtenVersion = version
+            except (IOError, OSError), e:
+                if e.errno == 28:
+                    error('Unable to write STATE_XML_FILE: No space left on device')
+                else:
+                    error('Unable to write STATE_XML_FILE', e)
+                if os.path.exists(tempFileName):
+                    os.remove(tempFileName)
+                if not os.path.exists(self.fileName) and os.path.exists(backupFileName):
+                    os.rename(backupFileName, self.fileName)
+        finally:
+            self.lock.release()
+
+def writeStateXML():
+    """ Write hellanzb's state to the STATE_XML_FILE (soon, see StateXMLWriter) """
+    if not inMainThread():
+        reactor.callFromThread(writeStateXML)
+        return
+
+    stateXMLWriter = getattr(Hellanzb, 'stateXMLWriter', None)
+    if stateXMLWriter is None:
+        # Not running as a daemon: write it now
+        stateXMLWriter = StateXMLWriter(Hellanzb.STATE_XML_FILE)
+        stateXMLWriter.dirty = True
+        stateXMLWriter.flush()
+        return
+    stateXMLWriter.changed()
 Hellanzb.writeStateXML = writeStateXML
+
+def flushStateXML():
+    """ Write out the state immediately, should any changes be pending """
+    stateXMLWriter = getattr(Hellanzb, 'stateXMLWriter', None)
+    if stateXMLWriter is not None:
+        stateXMLWriter.flush()
     
 def parseNZB(nzb, notification = 'Downloading', quiet = False):
     """ Parse the NZB file into the Queue. Unless the NZB file is deemed already fully
@@ -424,7 +545,11 @@ def parseNZB(nzb, notification = 'Downloading', quiet = False):
         gc.collect()
         
         info('Parsing: ' + os.path.basename(nzb.nzbFileName) + '...')
-        if not Hellanzb.queue.parseNZB(nzb):
+        if Hellanzb.STREAM_NZB_PARSE and not nzb.isParRecovery:
+            # The download begins as soon as the first file is parsed
+            d = Hellanzb.queue.streamNZB(nzb)
+            d.addErrback(streamNZBFailed, nzb)
+        elif not Hellanzb.queue.parseNZB(nzb):
             Hellanzb.Daemon.beginDownload(nzb)
 
     except FatalError, fe:
@@ -432,6 +557,24 @@ def parseNZB(nzb, notification = 'Downloading', quiet = False):
         notify('Error', 'hellanzb', 'Problem while parsing the NZB: ' \
                   + prettyException(fe), True)
         error('Moving bad NZB out of queue into TEMP_DIR: ' + Hellanzb.TEMP_DIR)
+        from Hellanzb.NZBLeecher.SegmentJournal import removeJournal
+        removeJournal(nzb)
+        move(nzb.nzbFileName, Hellanzb.TEMP_DIR + os.sep)
+        reactor.callLater(5, scanQueueDir)
+
+def streamNZBFailed(failure, nzb):
+    """ Handle a problem while streaming the NZB file into the Queue (see parseNZB) """
+    error('Problem while parsing the NZB', failure.value)
+    notify('Error', 'hellanzb', 'Problem while parsing the NZB: ' \
+              + prettyException(failure.value), True)
+    error('Moving bad NZB out of queue into TEMP_DIR: ' + Hellanzb.TEMP_DIR)
+    if nzb in Hellanzb.queue.currentNZBs():
+        # Its download already began
+        copy(nzb.nzbFileName, Hellanzb.TEMP_DIR + os.sep)
+        Hellanzb.Daemon.cancelCurrent()
+    else:
+        from Hellanzb.NZBLeecher.SegmentJournal import removeJournal
+        removeJournal(nzb)
         move(nzb.nzbFileName, Hellanzb.TEMP_DIR + os.sep)
         reactor.callLater(5, scanQueueDir)
 
@@ -448,9 +591,11 @@ def ensureSafePostponedLoad(nzbFileName):
     cancelledClients = []
     for nsf in Hellanzb.nsfs:
         for nzbl in nsf.clients:
-            if nzbl.currentSegment != None and \
-                    os.path.basename(nzbl.currentSegment.nzbFile.nzb.nzbFileName) == \
-                    os.path.basename(nzbFileName):
+            segments = [segment for segment in [nzbl.currentSegment] + \
+                            nzbl.pipelinedSegments if segment is not None and \
+                            os.path.basename(segment.nzbFile.nzb.nzbFileName) == \
+                            os.path.basename(nzbFileName)]
+            if len(segments):
                 # the easiest way to prevent weird things from happening (such as the
                 # parser getting confused about what needs to be downloaded/skipped) is to
                 # just pull the trigger on those slow NZBLeechers connections --
@@ -458,7 +603,8 @@ def ensureSafePostponedLoad(nzbFileName):
                 # aren't requeued
                 debug('%s Aborting/Disconnecting to ensure safe postponed NZB load' % str(nzbl))
                 shouldCancel = True
-                nzbl.currentSegment.dontRequeue = True
+                for segment in segments:
+                    segment.dontRequeue = True
                 cancelledClients.append(nzbl)
 
                 # Can't recall the details of why we should manually loseConnection(), do
@@ -502,6 +648,7 @@ def findAndLoadPostponedDir(nzb):
                 move(Hellanzb.WORKING_DIR, name)
 
         move(d, Hellanzb.WORKING_DIR)
+        Hellanzb.workingDirIndex.invalidate()
         Hellanzb.queue.unpostpone(nzb)
         ensureSafePostponedLoad(nzb.nzbFileName)
         
@@ -213,7 +213,9 @@ def requeueSkippedPars(skippedParFiles):
         # Requeue only segments that were actually dequeued
         for nzbSegment in nzbFile.dequeuedSegments:
             nzbFile.todoNzbSegments.add(nzbSegment)
-            Hellanzb.queue.put((nzbSegment.priority, nzbSegment))
+        Hellanzb.queue.putItems([(nzbSegment.priority, nzbSegment) for nzbSegment in \
+                                 nzbFile.dequeuedSegments])
+        for nzbSegment in nzbFile.dequeuedSegments:
             Hellanzb.queue.addQueuedBytes(nzbSegment.bytes)
             nzbFile.nzb.totalSkippedBytes -= nzbSegment.bytes
 
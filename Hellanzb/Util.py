@@ -195,30 +195,40 @@ class Topen(protocol.ProcessProtocol):
             active.kill()
     killAll = staticmethod(killAll)
 
-# Future optimization: Faster way to init this from xml files would be to set the entire
-# list backing the queue in one operation (instead of putting 20k times)
-# can heapq.heapify(list) help?
 class PriorityQueue(Queue):
     """ Thread safe priority queue. This is the easiest way to do it (Queue.Queue
-    providing the thread safety and heapq providing priority). We may be able to get
-    better performance by using something other than heapq, but hellanzb use of pqueues is
-    limited -- so performance is not so important. Notes on performance:
+    providing the thread safety and heapq providing priority). Notes on performance:
     
     o An O(1) priority queue is always preferable, but I'm not sure that's even feasible
       w/ this collection type and/or python.
-    o From various google'd python hacker benchmarks it looks like python lists backed
-      pqueues & bisect give you pretty good performance, and you probably won't benefit
-      from heap based pqueues unless you're dealing with > 10k items. And dicts don't
-      actually seem to help
+    o Queued items are indexed, so membership tests are O(1), and dequeueItems is O(log n)
+      per item: dequeued items are left on the heap as dead entries, skipped when they're
+      popped. The heap is rebuilt without them once they make up most of it
     """
+    # Rebuild the heap when it holds more dead entries than this ratio of live ones (and
+    # at least COMPACT_MIN of them)
+    COMPACT_RATIO = 1
+    COMPACT_MIN = 1024
+    
     def __init__(self):
         """ Python 2.4 replaces the list backed queue with a collections.deque, so we'll just
         emulate 2.3 behavior everywhere for now """
         Queue.__init__(self)
         self.queue = []
+        # map of the queued items to the number of times they're queued
+        self.index = {}
+        # map of the dequeued items still on the heap to the number of their dead entries
+        self.dead = {}
+        self.deadCount = 0
 
     def __len__(self):
-        return len(self.queue)
+        return len(self.queue) - self.deadCount
+
+    def __contains__(self, item):
+        return item in self.index
+
+    def _qsize(self, len = len):
+        return len(self.queue) - self.deadCount
 
     def clear(self):
         """ empty the queue """
@@ -226,6 +236,9 @@ class PriorityQueue(Queue):
             self.mutex.acquire()
             del self.queue
             self.queue = []
+            self.index.clear()
+            self.dead.clear()
+            self.deadCount = 0
             if not hasattr(self, 'not_empty'):
                 # python 2.3
                 self.esema.acquire()
@@ -235,31 +248,98 @@ class PriorityQueue(Queue):
         """ Assume Queue is backed by a list. Add the new item to the list, taking into account
             priority via heapq """
         heappush(self.queue, item)
+        self.index[item] = self.index.get(item, 0) + 1
 
     def _get(self):
         """ Assume Queue is backed by a list. Pop off the first item, taking into account priority
             via heapq """
-        return heappop(self.queue)
+        while True:
+            item = heappop(self.queue)
+            if item in self.dead:
+                # Previously dequeued
+                self._forget(self.dead, item)
+                self.deadCount -= 1
+                continue
+
+            self._forget(self.index, item)
+            return item
+
+    def putItems(self, items):
+        """ Put all of the specified items at once, under a single lock. The queue is heapified
+        once rather than pushing each item """
+        if not len(items):
+            return
+        self.mutex.acquire()
+        try:
+            wasEmpty = not self._qsize()
+            self._putItems(items)
+            if hasattr(self, 'not_empty'):
+                if hasattr(self, 'unfinished_tasks'):
+                    self.unfinished_tasks += len(items)
+                self.not_empty.notifyAll()
+            elif wasEmpty:
+                # python 2.3
+                self.esema.release()
+        finally:
+            self.mutex.release()
+
+    def _putItems(self, items):
+        """ Add the items to the list. Pushing a handful of items onto a large heap is
+        cheaper than heapifying it """
+        if len(items) * 4 < len(self.queue):
+            for item in items:
+                heappush(self.queue, item)
+        else:
+            self.queue.extend(items)
+            heapify(self.queue)
+
+        for item in items:
+            self.index[item] = self.index.get(item, 0) + 1
+
+    def _forget(self, counts, item):
+        """ Decrement the item's count in the specified map """
+        count = counts[item] - 1
+        if count:
+            counts[item] = count
+        else:
+            del counts[item]
 
     def dequeueItems(self, items):
         """ Explicitly dequeue the specified items. Yes, this queue supports random access """
-        succeded = items[:]
+        succeded = []
         self.mutex.acquire()
         for item in items:
-            try:
-                self.queue.remove(item)
-            except ValueError:
-                succeded.remove(item)
-
-        heapify(self.queue)
+            if item not in self.index:
+                continue
+            self._forget(self.index, item)
+            self.dead[item] = self.dead.get(item, 0) + 1
+            self.deadCount += 1
+            succeded.append(item)
+
+        if self.deadCount > self.COMPACT_MIN and \
+                self.deadCount > self.COMPACT_RATIO * (len(self.queue) - self.deadCount):
+            self._compact()
         
         # python 2.3
-        if not hasattr(self, 'not_empty') and not len(self.queue):
+        if not hasattr(self, 'not_empty') and not self._qsize():
             self.esema.acquire()
         self.mutex.release()
         
         return succeded
 
+    def _compact(self):
+        """ Rebuild the heap without its dead entries """
+        live = []
+        for item in self.queue:
+            if item in self.dead:
+                self._forget(self.dead, item)
+            else:
+                live.append(item)
+        heapify(live)
+        self.queue = live
+        self.dead.clear()
+        self.deadCount = 0
+
 class UnicodeList(list):
     """ Ensure all contained objects are casted to unicode. Allows Nones """
     def remove(self, value):
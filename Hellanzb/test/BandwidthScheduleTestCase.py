@@ -0,0 +1,197 @@
+"""
+BandwidthScheduleTestCase - Tests for the BandwidthSchedule
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import time, Hellanzb, Hellanzb.Daemon
+from Hellanzb.test import TempDirTestCase
+from Hellanzb.BandwidthSchedule import PAUSED, BandwidthScheduler, BandwidthWindow, \
+    parseDays, parseRate, parseTime
+
+__id__ = '$Id$'
+
+def localTime(day, hourMinute):
+    """ Return the time of the HH:MM on the specified day of the week of Monday January 1st,
+    2024 (0 == Monday) """
+    hour, minute = [int(part) for part in hourMinute.split(':')]
+    return time.mktime((2024, 1, 1 + day, hour, minute, 0, 0, 0, -1))
+
+class DummyThrottler:
+    def __init__(self):
+        self.readLimits = []
+
+    def setReadLimit(self, readLimit):
+        self.readLimits.append(readLimit)
+
+class BandwidthScheduleTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.setConfig('MAX_RATE', 0)
+        self.setConfig('downloadPaused', False)
+        self.setConfig('ht', DummyThrottler())
+
+        self.pauses = []
+        self.continues = []
+        self.savedDaemon = Hellanzb.Daemon.pauseCurrent, Hellanzb.Daemon.continueCurrent
+        Hellanzb.Daemon.pauseCurrent = self.pauseCurrent
+        Hellanzb.Daemon.continueCurrent = self.continueCurrent
+
+    def tearDown(self):
+        Hellanzb.Daemon.pauseCurrent, Hellanzb.Daemon.continueCurrent = self.savedDaemon
+        TempDirTestCase.tearDown(self)
+
+    def pauseCurrent(self):
+        self.pauses.append(True)
+        Hellanzb.downloadPaused = True
+
+    def continueCurrent(self):
+        self.continues.append(True)
+        Hellanzb.downloadPaused = False
+
+    def testParseDays(self):
+        """ Test parsing day names, ranges (wrapping around the week) and aliases """
+        self.assertEquals([0, 1, 2, 3, 4], parseDays('mon-fri'))
+        self.assertEquals([0, 4, 5, 6], parseDays('fri-mon'))
+        self.assertEquals([0, 6], parseDays('sun-mon'))
+        self.assertEquals([3], parseDays('thu-thu'))
+        self.assertEquals([0, 2, 5, 6], parseDays(' Wednesday, sat,SUN,mon,sat '))
+        self.assertEquals([5, 6], parseDays(['weekends']))
+        self.assertEquals(range(7), parseDays('daily'))
+        self.assertEquals(range(7), parseDays('weekdays,sat-sun'))
+        for days in ('', 'mon,', 'someday', 'mon-someday', []):
+            self.assertRaises(ValueError, parseDays, days)
+
+    def testParseTime(self):
+        """ Test parsing times of day, and their error paths """
+        self.assertEquals(0, parseTime('00:00'))
+        self.assertEquals(9 * 60 + 5, parseTime('9:05'))
+        self.assertEquals(24 * 60, parseTime('24:00'))
+        for hourMinute in ('24:01', '12:60', '-1:00', '12:-1', '12', '12:00:00', 'noon',
+                           ''):
+            self.assertRaises(ValueError, parseTime, hourMinute)
+
+    def testParseRate(self):
+        """ Test parsing window rates, and their error paths """
+        self.assertEquals(0, parseRate(None))
+        self.assertEquals(0, parseRate('Unlimited'))
+        self.assertEquals(PAUSED, parseRate('PAUSED'))
+        self.assertEquals(PAUSED, parseRate(0))
+        self.assertEquals(100, parseRate(100))
+        self.assertEquals(100, parseRate('100'))
+        for rate in (-1, '-5', 'fast', '1.5'):
+            self.assertRaises(ValueError, parseRate, rate)
+
+    def testContains(self):
+        """ Test windows contain their range of minutes, past midnight and around the end of
+        the week """
+        window = BandwidthWindow('mon-fri', '09:00', '17:00', 100)
+        self.assert_(window.contains(0, 9 * 60))
+        self.assert_(window.contains(4, 17 * 60 - 1))
+        self.failIf(window.contains(4, 17 * 60))
+        self.failIf(window.contains(5, 12 * 60))
+
+        window = BandwidthWindow('fri', '22:00', '02:00', 100)
+        self.assert_(window.contains(4, 23 * 60))
+        self.assert_(window.contains(5, 60))
+        self.failIf(window.contains(5, 2 * 60))
+        self.failIf(window.contains(4, 60))
+        self.failIf(window.contains(5, 23 * 60))
+
+        # Sunday night into Monday morning
+        window = BandwidthWindow('sun', '23:00', '01:00', 100)
+        self.assert_(window.contains(6, 23 * 60 + 30))
+        self.assert_(window.contains(0, 30))
+        self.failIf(window.contains(0, 23 * 60 + 30))
+        self.failIf(window.contains(6, 30))
+        self.failIf(window.contains(1, 30))
+
+        # The whole day
+        window = BandwidthWindow('sat', '00:00', '24:00', 100)
+        self.assert_(window.contains(5, 0))
+        self.assert_(window.contains(5, 24 * 60 - 1))
+        self.failIf(window.contains(6, 0))
+
+    def testNextChange(self):
+        """ Test the next change of overlapping windows (the first defined wins) """
+        work = BandwidthWindow('mon-fri', '09:00', '17:00', 100)
+        lunch = BandwidthWindow('mon-fri', '12:00', '13:00', 50)
+        evening = BandwidthWindow('mon-fri', '16:00', '18:00', 'paused')
+        weekend = BandwidthWindow('sun', '22:00', '06:00', 'unlimited')
+        scheduler = BandwidthScheduler([work, lunch, evening, weekend])
+
+        self.assertEquals((localTime(0, '17:00'), evening),
+                          scheduler.nextChange(localTime(0, '10:00')))
+        self.assertEquals((localTime(0, '18:00'), None),
+                          scheduler.nextChange(localTime(0, '17:00')))
+        self.assertEquals((localTime(1, '09:00'), work),
+                          scheduler.nextChange(localTime(0, '18:00')))
+        self.assertEquals((localTime(6, '22:00'), weekend),
+                          scheduler.nextChange(localTime(4, '20:00')))
+        # Around the end of the week
+        self.assertEquals((localTime(7, '06:00'), None),
+                          scheduler.nextChange(localTime(6, '23:00')))
+
+        # A window that's always in effect never changes
+        scheduler = BandwidthScheduler([BandwidthWindow('daily', '00:00', '24:00', 10)])
+        self.assertEquals(None, scheduler.nextChange(localTime(2, '12:00')))
+        self.assertEquals(None, BandwidthScheduler([]).nextChange(localTime(2, '12:00')))
+
+    def testApply(self):
+        """ Test applying window rates only continues downloads the scheduler paused """
+        scheduler = BandwidthScheduler([])
+        window = BandwidthWindow('daily', '09:00', '17:00', 100)
+        paused = BandwidthWindow('daily', '17:00', '18:00', PAUSED)
+
+        scheduler.apply(window)
+        self.assertEquals([100 * 1024], Hellanzb.ht.readLimits)
+
+        scheduler.apply(paused)
+        self.assertEquals(1, len(self.pauses))
+        self.assertEquals(True, Hellanzb.downloadPaused)
+        self.assertEquals([100 * 1024], Hellanzb.ht.readLimits)
+
+        scheduler.apply(None)
+        self.assertEquals(1, len(self.continues))
+        self.assertEquals(False, Hellanzb.downloadPaused)
+        self.assertEquals([100 * 1024, 0], Hellanzb.ht.readLimits)
+
+        # Paused by the user
+        Hellanzb.downloadPaused = True
+        scheduler.apply(paused)
+        scheduler.apply(window)
+        self.assertEquals(1, len(self.pauses))
+        self.assertEquals(1, len(self.continues))
+        self.assertEquals(True, Hellanzb.downloadPaused)
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
@@ -0,0 +1,129 @@
+"""
+DecodeBacklogTestCase - Tests NZBLeechers waiting on the DecodeBacklog are resumed
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import sys, Hellanzb
+from Queue import Empty
+from Hellanzb.test import TempDirTestCase
+from Hellanzb.NZBLeecher.ArticleCache import DecodeBacklog
+from Hellanzb.NZBLeecher.Protocol import NZBLeecher
+
+__id__ = '$Id$'
+
+# (Hellanzb.NZBLeecher.ArticleCache is shadowed by the ArticleCache class)
+articleCacheModule = sys.modules['Hellanzb.NZBLeecher.ArticleCache']
+
+class ImmediateReactor:
+    """ Runs callLater'd functions immediately """
+    def callLater(self, delay, func, *args):
+        func(*args)
+
+class DummySegment:
+    def __init__(self, messageId):
+        self.messageId = messageId
+        self.hedgeLost = False
+
+class DummyQueue:
+    def __init__(self, segments):
+        self.segments = segments
+
+    def getSmart(self, serverFactory):
+        if not len(self.segments):
+            raise Empty()
+        segment = self.segments.pop(0)
+        return 0, segment
+
+    def currentNZBs(self):
+        return []
+
+class DummyFactory:
+    skipGroupCmd = True
+
+class DecodeBacklogTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.backlog = DecodeBacklog(limit = 1)
+        self.setConfig('decodeBacklog', self.backlog)
+        self.setConfig('downloadPaused', False)
+        self.setConfig('queue', DummyQueue([DummySegment('1@test')]))
+
+        self.savedReactor = articleCacheModule.reactor
+        articleCacheModule.reactor = ImmediateReactor()
+
+    def tearDown(self):
+        articleCacheModule.reactor = self.savedReactor
+        TempDirTestCase.tearDown(self)
+
+    def newClient(self):
+        """ Return a freshly logged in (not activated) NZBLeecher, recording the BODYs it
+        fetches """
+        client = NZBLeecher(None, None)
+        client.factory = DummyFactory()
+        client.isLoggedIn = True
+        client.fetched = []
+        client.prepareSegment = lambda segment: None
+        client.getSegmentWriter = lambda segment: None
+        client.activate = lambda: None
+        client.fillPipeline = lambda: None
+        client.fetchBody = client.fetched.append
+        return client
+
+    def testFreshClientResumes(self):
+        """ Ensure a client that was never activated resumes once the backlog drains """
+        self.backlog.backedUp = True
+        client = self.newClient()
+        client.fetchNextNZBSegment()
+        self.assertEquals([], client.fetched)
+        self.assertEquals(False, client.activated)
+
+        self.backlog.drained()
+        self.assertEquals(False, self.backlog.backedUp)
+        self.assertEquals(['1@test'], client.fetched)
+
+    def testPausedClientWaits(self):
+        """ Ensure a client isn't resumed while the download is paused """
+        self.backlog.backedUp = True
+        client = self.newClient()
+        client.fetchNextNZBSegment()
+
+        Hellanzb.downloadPaused = True
+        client.resumeFetching()
+        self.assertEquals([], client.fetched)
+
+        Hellanzb.downloadPaused = False
+        self.backlog.drained()
+        self.assertEquals(['1@test'], client.fetched)
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
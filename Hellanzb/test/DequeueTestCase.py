@@ -0,0 +1,162 @@
+"""
+DequeueTestCase - Tests for dequeueing items from the PriorityQueue
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+from heapq import heapify
+from Queue import Empty
+from Hellanzb.test import HellanzbTestCase
+from Hellanzb.Util import PriorityQueue
+
+__id__ = '$Id$'
+
+class DummySegment:
+    def __init__(self, number):
+        self.number = number
+
+def listDequeue(queue, items):
+    """ Dequeue the items the way PriorityQueue used to: list.remove each, then heapify """
+    succeded = items[:]
+    for item in items:
+        try:
+            queue.remove(item)
+        except ValueError:
+            succeded.remove(item)
+    heapify(queue)
+    return succeded
+
+class DequeueTestCase(HellanzbTestCase):
+
+    def loadQueue(self, count):
+        pq = PriorityQueue()
+        items = [(i % 100, DummySegment(i)) for i in xrange(count)]
+        for item in items:
+            pq.put(item)
+        return pq, items
+
+    def getAll(self, pq):
+        gotten = []
+        try:
+            while True:
+                gotten.append(pq.get_nowait())
+        except Empty:
+            pass
+        return gotten
+
+    def testDequeue(self):
+        """ Test dequeued items are never gotten """
+        pq, items = self.loadQueue(1000)
+        dequeue = items[::3]
+        self.assertEqual(dequeue, pq.dequeueItems(dequeue))
+        self.assertEqual([], pq.dequeueItems(dequeue))
+        self.assertEqual(len(items) - len(dequeue), len(pq))
+        self.assertEqual(len(items) - len(dequeue), pq.qsize())
+        self.assert_(items[0] not in pq)
+        self.assert_(items[1] in pq)
+
+        gotten = self.getAll(pq)
+        self.assertEqual(len(items) - len(dequeue), len(gotten))
+        for item in dequeue:
+            self.assert_(item not in gotten)
+        self.assertEqual(sorted(gotten), gotten)
+        self.assertEqual(0, len(pq))
+
+    def testRequeue(self):
+        """ Test putting back dequeued (and duplicate) items """
+        pq, items = self.loadQueue(10)
+        pq.dequeueItems(items[:5])
+        pq.put(items[0])
+        pq.put(items[9])
+        self.assertEqual(7, len(pq))
+        self.assertEqual([items[9]], pq.dequeueItems([items[9]]))
+        self.assert_(items[9] in pq)
+
+        gotten = self.getAll(pq)
+        self.assertEqual(sorted([items[0]] + items[5:]), gotten)
+
+    def testCompact(self):
+        """ Test the heap is rebuilt once it's mostly dead entries """
+        count = PriorityQueue.COMPACT_MIN * 4
+        pq, items = self.loadQueue(count)
+        pq.dequeueItems(items[:count / 4])
+        self.assertEqual(count, len(pq.queue))
+        pq.dequeueItems(items[count / 4:count - 10])
+        self.assertEqual(10, len(pq.queue))
+        self.assertEqual(sorted(items[-10:]), self.getAll(pq))
+
+    def testPutItems(self):
+        """ Test bulk loading items """
+        pq, items = self.loadQueue(100)
+        pq.dequeueItems(items[:50])
+        more = [(i % 7, DummySegment(i)) for i in xrange(1000)]
+        pq.putItems(more)
+        pq.putItems(items[:5])
+        self.assertEqual(1055, len(pq))
+        self.assert_(more[0] in pq)
+        self.assertEqual(sorted(items[:5] + items[50:] + more), self.getAll(pq))
+
+    def testMatchesListDequeue(self):
+        """ Test dequeueItems agrees with the list based dequeue it replaced (see
+        benchmark.py for their timings) """
+        pq, items = self.loadQueue(5000)
+        queue = items[:]
+        heapify(queue)
+        for dequeue in (items[2500:3000], items[2900:3100] + items[:2500:7]):
+            self.assertEqual(listDequeue(queue, dequeue), pq.dequeueItems(dequeue))
+            self.assertEqual(len(queue), len(pq))
+
+        gotten = self.getAll(pq)
+        self.assertEqual(sorted(queue), gotten)
+
+    def testPutItemsOrder(self):
+        """ Test bulk loading items gets them in the same order as repeatedly putting them
+        (see benchmark.py for their timings) """
+        items = [(i % 100, DummySegment(i)) for i in xrange(5000)]
+        pq = PriorityQueue()
+        for item in items:
+            pq.put(item)
+        bulk = PriorityQueue()
+        bulk.putItems(items)
+        self.assertEqual(len(pq), len(bulk))
+        self.assertEqual(self.getAll(pq), self.getAll(bulk))
+
+        # Into a queue that already has items, some dequeued
+        pq, more = self.loadQueue(500)
+        bulk = PriorityQueue()
+        bulk.putItems(more)
+        for queue in (pq, bulk):
+            queue.dequeueItems(more[::2])
+            queue.putItems(items[:1000])
+        self.assertEqual(self.getAll(pq), self.getAll(bulk))
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
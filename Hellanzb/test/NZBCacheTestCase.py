@@ -0,0 +1,128 @@
+"""
+NZBCacheTestCase - Tests for the NZBCache
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import os, Hellanzb
+from xml.sax.handler import ContentHandler
+from Hellanzb.test import TempDirTestCase
+from Hellanzb.NZBLeecher.NZBCache import cachedTotalBytes, nzbDigest, parseNZBFile
+
+__id__ = '$Id$'
+
+NZB = """<?xml version="1.0" encoding="iso-8859-1" ?>
+<nzb xmlns="http://www.newzbin.com/DTD/2003/nzb">
+ <file poster="poster@example.com" date="1130000000" subject="test - &quot;file.rar&quot; (1/2)">
+  <groups>
+   <group>alt.binaries.test</group>
+   <group>alt.binaries.test2</group>
+  </groups>
+  <segments>
+   <segment bytes="102400" number="1">part1of2.abc@example.com</segment>
+   <segment bytes="51200" number="2">part2of2.abc@example.com</segment>
+  </segments>
+ </file>
+ <file poster="poster@example.com" date="1130000001" subject="test - &#233;vil.par2 (1/1)">
+  <groups>
+   <group>alt.binaries.test</group>
+  </groups>
+  <segments>
+   <segment bytes="bogus" number="1">part1of1.def@example.com</segment>
+  </segments>
+ </file>
+</nzb>
+"""
+
+class EventRecorder(ContentHandler):
+    """ Record the SAX events the NZBParser cares about """
+    def __init__(self):
+        self.events = []
+        self.chars = None
+
+    def startElement(self, name, attrs):
+        self.events.append(('start', name, attrs.get('subject'), attrs.get('poster'),
+                            attrs.get('bytes'), attrs.get('number')))
+        if name in ('group', 'segment'):
+            self.chars = []
+
+    def characters(self, content):
+        if self.chars is not None:
+            self.chars.append(content)
+
+    def endElement(self, name):
+        if self.chars is not None:
+            self.events.append(('chars', ''.join(self.chars).strip()))
+            self.chars = None
+        if name in ('file', 'group', 'segment'):
+            self.events.append(('end', name))
+
+class NZBCacheTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.nzbFileName = self.writeFile('test.nzb', NZB)
+
+        self.setConfig('NZB_CACHE', True)
+        self.setConfig('NZB_CACHE_DIR', os.path.join(self.tempDir, 'nzb-cache'))
+        os.mkdir(Hellanzb.NZB_CACHE_DIR)
+
+    def filteredEvents(self, events):
+        """ The events of the elements the cache records """
+        return [event for event in events if event[0] != 'start' or \
+                    event[1] in ('file', 'group', 'segment')]
+
+    def testReplay(self):
+        """ Test the cached NZB replays the same events as parsing it """
+        self.assertEqual(None, cachedTotalBytes(self.nzbFileName))
+        parsed = EventRecorder()
+        parseNZBFile(self.nzbFileName, parsed)
+        self.assert_(os.path.exists(os.path.join(Hellanzb.NZB_CACHE_DIR,
+                                                 nzbDigest(self.nzbFileName) + '.nzbc')))
+
+        replayed = EventRecorder()
+        parseNZBFile(self.nzbFileName, replayed)
+        self.assertEqual(self.filteredEvents(parsed.events), replayed.events)
+        self.assertEqual(153600, cachedTotalBytes(self.nzbFileName))
+
+    def testChanged(self):
+        """ Test changed NZB files aren't replayed from the cache """
+        parseNZBFile(self.nzbFileName, EventRecorder())
+        self.writeFile('test.nzb', NZB.replace('51200', '51201'))
+        self.assertEqual(None, cachedTotalBytes(self.nzbFileName))
+
+        parsed = EventRecorder()
+        parseNZBFile(self.nzbFileName, parsed)
+        self.assert_(('start', 'segment', None, None, '51201', '2') in parsed.events)
+        self.assertEqual(153601, cachedTotalBytes(self.nzbFileName))
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
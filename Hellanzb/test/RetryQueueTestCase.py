@@ -0,0 +1,154 @@
+"""
+RetryQueueTestCase - Tests for the RetryQueue
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+from Queue import Empty
+from Hellanzb.test import HellanzbTestCase
+from Hellanzb.Util import PoolsExhausted
+from Hellanzb.NZBLeecher.NZBSegmentQueue import NZBSegmentQueue, RetryQueue
+
+__id__ = '$Id$'
+
+class DummySegment:
+    def __init__(self, priority, failedServerPools):
+        self.priority = priority
+        self.failedServerPools = failedServerPools
+        self.nzbFile = None
+
+class DummyFactory:
+    def __init__(self, serverPoolName):
+        self.serverPoolName = serverPoolName
+        self.cost = 0
+
+class RetryQueueTestCase(HellanzbTestCase):
+
+    def setUp(self):
+        HellanzbTestCase.setUp(self)
+        self.rQueue = RetryQueue()
+        for poolName in ('a', 'b', 'c', 'd', 'e', 'f', 'g'):
+            self.rQueue.addServerPool(poolName)
+        self.rQueue.createQueues()
+
+    def testPriority(self):
+        """ Test serverPools get the highest priority segments they haven't tried """
+        first = DummySegment(1, ['a'])
+        second = DummySegment(2, ['b'])
+        third = DummySegment(3, ['a', 'c'])
+        for segment in (third, second, first):
+            self.rQueue.requeue(segment.failedServerPools[-1], segment)
+        self.assertEqual(3, len(self.rQueue))
+
+        self.assertEqual((2, second), self.rQueue.get('a'))
+        self.assertEqual((1, first), self.rQueue.get('c'))
+        self.assertEqual((3, third), self.rQueue.get('b'))
+        self.assertEqual(0, len(self.rQueue))
+        for poolName in self.rQueue.serverPoolNames:
+            self.assertRaises(Empty, self.rQueue.get, poolName)
+
+    def testPassed(self):
+        """ Test segments passed on are excluded from the passing serverPool """
+        segment = DummySegment(1, [])
+        self.rQueue.requeue('a', segment, passed = True)
+        self.assertRaises(Empty, self.rQueue.get, 'a')
+        self.assertEqual((1, segment), self.rQueue.get('b'))
+
+    def testExhausted(self):
+        """ Test PoolsExhausted is raised once all serverPools failed """
+        segment = DummySegment(1, list(self.rQueue.serverPoolNames))
+        self.assertRaises(PoolsExhausted, self.rQueue.requeue, 'g', segment)
+
+    def testDequeue(self):
+        """ Test dequeueing segments """
+        segments = [DummySegment(i, ['a']) for i in range(10)]
+        for segment in segments:
+            self.rQueue.requeue('a', segment)
+        self.assertEqual(segments[:5], self.rQueue.dequeueSegments(segments[:5]))
+        self.assertEqual((5, segments[5]), self.rQueue.get('b'))
+        self.assertEqual(4, len(self.rQueue))
+
+    def testAddRemoveServerPool(self):
+        """ Test adding and removing serverPools at runtime """
+        segment = DummySegment(1, ['a', 'b', 'c', 'd', 'e'])
+        other = DummySegment(2, ['a'])
+        self.rQueue.requeue('e', segment)
+        self.rQueue.requeue('a', other)
+
+        self.rQueue.addServerPool('h')
+        self.assertEqual((1, segment), self.rQueue.get('h'))
+        segment.failedServerPools.append('h')
+        self.rQueue.requeue('h', segment)
+
+        self.assertEqual([], self.rQueue.removeServerPool('f'))
+        self.assertEqual([segment], self.rQueue.removeServerPool('g'))
+        self.assertEqual((2, other), self.rQueue.get('b'))
+        self.assertEqual(0, len(self.rQueue))
+
+    def testRemovePassedServerPool(self):
+        """ Test segments only passed on by the remaining serverPools aren't exhausted when
+        removing a serverPool """
+        rQueue = RetryQueue()
+        for poolName in ('a', 'b', 'c'):
+            rQueue.addServerPool(poolName)
+        rQueue.createQueues()
+
+        segment = DummySegment(1, ['c'])
+        rQueue.requeue('a', segment, passed = True)
+
+        self.assertEqual([], rQueue.removeServerPool('b'))
+        self.assertEqual((1, segment), rQueue.get('a'))
+        self.assertEqual(0, len(rQueue))
+
+    def testSegmentQueueServerRemove(self):
+        """ Test the NZBSegmentQueue toggles the RetryQueue as serverPools are added and
+        removed at runtime """
+        queue = NZBSegmentQueue()
+        queue.serverAdd(DummyFactory('a'))
+        queue.initRetryQueue()
+        self.assertEqual(False, queue.retryQueueEnabled)
+
+        queue.serverAdd(DummyFactory('b'))
+        self.assertEqual(True, queue.retryQueueEnabled)
+
+        failed = DummySegment(1, ['a'])
+        exhausted = DummySegment(2, ['b'])
+        queue.rQueue.requeue('a', failed)
+        queue.rQueue.requeue('b', exhausted)
+
+        # The remaining serverPool retries from the main queue
+        self.assertEqual([exhausted], queue.serverRemove(DummyFactory('a')))
+        self.assertEqual(False, queue.retryQueueEnabled)
+        self.assertEqual(0, len(queue.rQueue))
+        self.assertEqual((1, failed), queue.getSmart(DummyFactory('b')))
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
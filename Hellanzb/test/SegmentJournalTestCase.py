@@ -0,0 +1,200 @@
+"""
+SegmentJournalTestCase - Tests for the SegmentJournal
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import os, Hellanzb
+from Hellanzb.test import TempDirTestCase
+from Hellanzb.NZBLeecher.SegmentJournal import openJournal, ASSEMBLED, FILENAME, PLACING, \
+    SEGMENT_DONE, SEGMENT_CRC_FAILED, SEGMENT_EMPTY, SEGMENT_OK
+from Hellanzb.NZBLeecher.WorkingDirIndex import WorkingDirIndex
+
+__id__ = '$Id$'
+
+class FakeNZB:
+    def __init__(self, nzbFileName):
+        self.nzbFileName = nzbFileName
+        self.journal = None
+        self.firstSegmentsDownloaded = 0
+
+class FakeNZBFile:
+    def __init__(self, number):
+        self.number = number
+        self.filename = None
+        self.segmentMap = None
+
+    def getDestination(self):
+        return os.path.join(Hellanzb.WORKING_DIR, self.filename)
+
+class FakeSegment:
+    def __init__(self, nzbFile, number):
+        self.nzbFile = nzbFile
+        self.number = number
+
+    def getDestination(self):
+        return '%s.segment%04d' % (self.nzbFile.getDestination(), self.number)
+
+class FakeQueue:
+    def __init__(self):
+        self.done = []
+
+    def segmentDone(self, segment):
+        self.done.append(segment)
+
+class SegmentJournalTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.setConfig('CURRENT_DIR', os.path.join(self.tempDir, 'current'))
+        self.setConfig('WORKING_DIR', os.path.join(self.tempDir, 'working'))
+        os.mkdir(Hellanzb.CURRENT_DIR)
+        os.mkdir(Hellanzb.WORKING_DIR)
+
+        self.nzb = FakeNZB(os.path.join(Hellanzb.CURRENT_DIR, 'test.nzb'))
+        self.writeNZB('<nzb></nzb>')
+
+    def tearDown(self):
+        if self.nzb.journal is not None:
+            self.nzb.journal.close()
+        TempDirTestCase.tearDown(self)
+
+    def writeNZB(self, data):
+        self.writeFile(self.nzb.nzbFileName, data)
+
+    def writeJournal(self):
+        journal = openJournal(self.nzb)
+        self.assert_(not journal.replaying)
+        journal.record(FILENAME, 0, data = 'file.rar')
+        journal.record(SEGMENT_DONE, 0, 1 << 2 | SEGMENT_OK)
+        journal.record(SEGMENT_DONE, 0, 2 << 2 | SEGMENT_CRC_FAILED)
+        journal.record(PLACING, 1)
+        journal.record(ASSEMBLED, 2)
+        journal.commit()
+        journal.close()
+        return journal.fileName
+
+    def testReplay(self):
+        """ Test replaying the journal """
+        self.writeJournal()
+        journal = openJournal(self.nzb)
+        self.assert_(journal.replaying)
+        self.assertEqual({(0, 1): SEGMENT_OK, (0, 2): SEGMENT_CRC_FAILED}, journal.segments)
+        self.assertEqual({0: 'file.rar'}, journal.filenames)
+        self.assertEqual(set([1]), journal.placingFiles)
+        self.assertEqual(set([2]), journal.assembledFiles)
+
+        # Appended records are replayed next time
+        journal.record(ASSEMBLED, 0)
+        journal.close()
+        self.assertEqual(set([0, 2]), openJournal(self.nzb).assembledFiles)
+
+    def testUncommitted(self):
+        """ Test a journal that was never committed isn't replayed """
+        journal = openJournal(self.nzb)
+        journal.record(ASSEMBLED, 0)
+        journal.close()
+        self.assert_(not openJournal(self.nzb).replaying)
+
+    def testTornRecord(self):
+        """ Test a partially written last record is ignored """
+        fileName = self.writeJournal()
+        length = os.path.getsize(fileName)
+        f = open(fileName, 'r+b')
+        f.truncate(length - 2)
+        f.close()
+
+        journal = openJournal(self.nzb)
+        self.assert_(journal.replaying)
+        self.assertEqual(set(), journal.assembledFiles)
+        self.assertEqual(set([1]), journal.placingFiles)
+
+    def testCorruptRecord(self):
+        """ Test a journal with a corrupt record (other than the last) isn't replayed """
+        fileName = self.writeJournal()
+        f = open(fileName, 'r+b')
+        data = f.read()
+        offset = data.index('file.rar')
+        f.seek(offset)
+        f.write('F')
+        f.close()
+
+        journal = openJournal(self.nzb)
+        self.assert_(not journal.replaying)
+        self.assertEqual({}, journal.segments)
+
+    def testReplayMissingFiles(self):
+        """ Test replayed segment files and assembled files since deleted are downloaded
+        again """
+        self.setConfig('SMART_PAR', False)
+        self.setConfig('queue', FakeQueue())
+        journal = openJournal(self.nzb)
+        journal.record(FILENAME, 0, data = 'file.rar')
+        journal.record(FILENAME, 1, data = 'file.r00')
+        journal.record(FILENAME, 2, data = 'file.r01')
+        for status in (SEGMENT_OK, SEGMENT_CRC_FAILED, SEGMENT_EMPTY):
+            journal.record(SEGMENT_DONE, 0, (status + 1) << 2 | status)
+        journal.record(ASSEMBLED, 1)
+        journal.record(ASSEMBLED, 2)
+        journal.commit()
+        journal.close()
+
+        self.writeFile(os.path.join('working', 'file.rar.segment0001'), 'ok')
+        self.writeFile(os.path.join('working', 'file.rar.segment0003'))
+        self.writeFile(os.path.join('working', 'file.r00'), 'assembled')
+        self.setConfig('workingDirIndex', WorkingDirIndex(Hellanzb.WORKING_DIR))
+
+        self.nzb.journal = journal = openJournal(self.nzb)
+        self.assert_(journal.replaying)
+        nzbFiles = [FakeNZBFile(number) for number in range(3)]
+        self.assertEqual([True, False, True],
+                         [journal.fileNeedsDownload(nzbFile) for nzbFile in nzbFiles])
+
+        segments = [FakeSegment(nzbFiles[0], number) for number in (1, 2, 3, 4)]
+        needDlFiles, needDlSegments, onDiskSegments = \
+            journal.segmentsNeedDownload(segments)
+        self.assertEqual([segments[0], segments[2]], onDiskSegments)
+        self.assertEqual([segments[1], segments[3]], needDlSegments)
+        self.assertEqual(set([nzbFiles[0]]), needDlFiles)
+
+    def testStale(self):
+        """ Test a journal of a different NZB or WORKING_DIR isn't replayed """
+        self.writeJournal()
+        self.writeNZB('<nzb> </nzb>')
+        self.assert_(not openJournal(self.nzb).replaying)
+
+        self.writeJournal()
+        os.rename(Hellanzb.WORKING_DIR, Hellanzb.WORKING_DIR + '.old')
+        os.mkdir(Hellanzb.WORKING_DIR)
+        self.assert_(not openJournal(self.nzb).replaying)
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
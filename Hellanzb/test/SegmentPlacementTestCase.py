@@ -0,0 +1,124 @@
+"""
+SegmentPlacementTestCase - Tests for the segment map files of SegmentPlacement
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import os
+from Hellanzb.test import TempDirTestCase
+from Hellanzb.NZBLeecher.SegmentPlacement import getPartialFileName, getSegmentMapFileName, \
+    isPlaced, loadSegmentMaps, placeSegment, readSegmentMap, startPlacement
+from Hellanzb.NZBLeecher.WorkingDirIndex import WorkingDirIndex
+
+__id__ = '$Id$'
+
+class DummyNZB:
+    journal = None
+
+class DummyNZBFile:
+    def __init__(self, dirName, filename, subject, ySize, segments):
+        self.dirName = dirName
+        self.filename = filename
+        self.subject = subject
+        self.ySize = ySize
+        self.nzb = DummyNZB()
+        self.segmentMap = None
+        self.segmentOffsets = {}
+        self.nzbSegments = [DummySegment(self, number) for number in range(1, segments + 1)]
+
+    def getDestination(self):
+        return os.path.join(self.dirName, self.filename)
+
+class DummySegment:
+    def __init__(self, nzbFile, number):
+        self.nzbFile = nzbFile
+        self.number = number
+        self.yBegin = self.yEnd = None
+
+    def getDestination(self):
+        return '%s.segment%04d' % (self.nzbFile.getDestination(), self.number)
+
+class SegmentPlacementTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.setConfig('workingDirIndex', WorkingDirIndex(self.tempDir))
+
+    def newNZBFile(self, subject = 'test "file.rar" yEnc', segments = 20):
+        return DummyNZBFile(self.tempDir, 'file.rar', subject, 100, segments)
+
+    def testPlaceSegments(self):
+        """ Ensure placed segments are recorded to the map file """
+        nzbFile = self.newNZBFile()
+        self.assertEquals(True, startPlacement(nzbFile))
+        for segment in (nzbFile.nzbSegments[0], nzbFile.nzbSegments[9]):
+            placeSegment(segment, segment.number - 1, lambda f: f.write('x'))
+
+        subject, segmentMap = readSegmentMap(getSegmentMapFileName(nzbFile),
+                                             getPartialFileName(nzbFile))
+        self.assertEquals(nzbFile.subject, subject)
+        self.assertEquals(100, segmentMap.ySize)
+        self.assertEquals(nzbFile.segmentMap, segmentMap.bitmap)
+
+        # The map is only ever replaced: no temp files are left behind
+        self.assertEquals(['file.rar.hellamap', 'file.rar.hellapartial'],
+                          sorted(os.listdir(self.tempDir)))
+        fileName, segmentMap = loadSegmentMaps(self.tempDir)[nzbFile.subject]
+        self.assertEquals('file.rar', fileName)
+
+    def testOrphanedPartialFile(self):
+        """ Ensure a partial file whose map was lost is started over """
+        nzbFile = self.newNZBFile()
+        self.writeFile('file.rar.hellapartial', 'stale')
+        self.writeFile('file.rar.hellamap', 'truncated')
+
+        self.assertEquals(True, startPlacement(nzbFile))
+        self.assertEquals(100, os.path.getsize(getPartialFileName(nzbFile)))
+        self.assertEquals(False, isPlaced(nzbFile.nzbSegments[0]))
+
+    def testAdoptPartialFile(self):
+        """ Ensure a partial file (with a map) of the same NZBFile is adopted, and one of a
+        dupe is left alone """
+        nzbFile = self.newNZBFile()
+        startPlacement(nzbFile)
+        placeSegment(nzbFile.nzbSegments[2], 2, lambda f: f.write('x'))
+
+        adopted = self.newNZBFile()
+        self.assertEquals(True, startPlacement(adopted))
+        self.assert_(isPlaced(adopted.nzbSegments[2]))
+        self.assertEquals(False, isPlaced(adopted.nzbSegments[3]))
+
+        dupe = self.newNZBFile(subject = 'another "file.rar" yEnc')
+        self.assertEquals(False, startPlacement(dupe))
+        self.assert_(isPlaced(nzbFile.nzbSegments[2]))
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
@@ -0,0 +1,207 @@
+"""
+SegmentRouterTestCase - Tests for the SegmentRouter
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import time, Hellanzb
+from Hellanzb.test import TempDirTestCase
+from Hellanzb.NZBLeecher.NZBSegmentQueue import NZBSegmentQueue
+from Hellanzb.NZBLeecher.SegmentRouter import AGE_BUCKETS, PoolStats, SegmentRouter, \
+    ageBucket, routeKey
+
+__id__ = '$Id$'
+
+DAY = 86400
+
+class DummyNZBFile:
+    def __init__(self, date, groups = ('alt.binaries.test',)):
+        self.date = date
+        self.groups = list(groups)
+
+class DummySegment:
+    def __init__(self, nzbFile, priority = 0):
+        self.nzbFile = nzbFile
+        self.priority = priority
+        self.failedServerPools = []
+
+class DummyClient:
+    def __init__(self, isLoggedIn, activated = False):
+        self.isLoggedIn = isLoggedIn
+        self.activated = activated
+
+class DummyFactory:
+    def __init__(self, serverPoolName, cost = 0, clients = ()):
+        self.serverPoolName = serverPoolName
+        self.cost = cost
+        self.clients = list(clients)
+
+class SegmentRouterTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.setConfig('DEBUG_MODE_ENABLED', False)
+        self.setConfig('nsfs', [])
+        self.now = time.time()
+        self.nzbFile = DummyNZBFile(self.now - DAY / 2)
+        self.key = routeKey(self.nzbFile, self.now)
+
+    def addPool(self, router, serverPoolName, cost = 0, loggedIn = True):
+        router.addServerPool(serverPoolName, cost)
+        Hellanzb.nsfs.append(DummyFactory(serverPoolName, cost,
+                                          [DummyClient(loggedIn)]))
+
+    def testAgeBucket(self):
+        """ Test articles are bucketed by their age """
+        self.assertEquals(None, ageBucket(DummyNZBFile(None), self.now))
+        self.assertEquals(None, ageBucket(DummyNZBFile('bogus'), self.now))
+        self.assertEquals(0, ageBucket(DummyNZBFile(self.now), self.now))
+        self.assertEquals(1, ageBucket(DummyNZBFile(self.now - 3 * DAY), self.now))
+        self.assertEquals(4, ageBucket(DummyNZBFile(self.now - 100 * DAY), self.now))
+        self.assertEquals(len(AGE_BUCKETS),
+                          ageBucket(DummyNZBFile(str(int(self.now - 400 * DAY))),
+                                    self.now))
+
+    def testRouteKey(self):
+        """ Test route keys are made of the first newsgroup (sorted) and the age bucket """
+        nzbFile = DummyNZBFile(self.now - 10 * DAY, ('alt.binaries.z', 'alt.binaries.a'))
+        self.assertEquals(('alt.binaries.a', 2), routeKey(nzbFile, self.now))
+        self.assertEquals((None, None), routeKey(DummyNZBFile(None, ()), self.now))
+
+    def testMissRatePriors(self):
+        """ Test unknown keys assume the pool has the article """
+        pool = PoolStats('a')
+        expected = PoolStats.PRIOR_MISSES / (PoolStats.PRIOR_HITS + PoolStats.PRIOR_MISSES)
+        self.assertAlmostEquals(expected, pool.missRate(self.key))
+        self.assert_(pool.missRate(self.key) < SegmentRouter.LIKELY_MISS_RATE)
+
+    def testMissRateFallback(self):
+        """ Test keys with too few observations fall back to their age bucket's miss rate
+        """
+        pool = PoolStats('a')
+        otherKey = ('alt.binaries.other', self.key[1])
+        for i in range(PoolStats.MIN_OBSERVATIONS):
+            pool.observe(otherKey, False)
+
+        # Tallied across all newsgroups of the age bucket
+        self.assertEquals(pool.missRate((None, self.key[1])), pool.missRate(self.key))
+        self.assert_(pool.missRate(self.key) > SegmentRouter.UNLIKELY_MISS_RATE)
+
+        # (Observations decay, so a few more than MIN_OBSERVATIONS)
+        for i in range(PoolStats.MIN_OBSERVATIONS + 2):
+            pool.observe(self.key, True)
+        self.assert_(pool.missRate(self.key) < pool.missRate((None, self.key[1])))
+
+    def testMissRateDecay(self):
+        """ Test old observations decay, following changes in a server's retention """
+        pool = PoolStats('a')
+        for i in range(50):
+            pool.observe(self.key, False)
+        missing = pool.missRate(self.key)
+
+        for i in range(200):
+            pool.observe(self.key, True)
+        self.assert_(pool.missRate(self.key) < missing)
+        self.assert_(pool.missRate(self.key) < SegmentRouter.LIKELY_MISS_RATE)
+
+        hits, misses = pool.observations[self.key]
+        self.assert_(misses < 50 * PoolStats.DECAY ** 200 + 0.001)
+
+    def testPassToCheaperPool(self):
+        """ Test an expensive pool passes on articles a cheaper pool likely has """
+        router = SegmentRouter()
+        self.addPool(router, 'block', cost = 10)
+        self.addPool(router, 'unlimited', cost = 0)
+        segment = DummySegment(self.nzbFile)
+
+        self.assertEquals(True, router.shouldPass('block', segment))
+        self.assertEquals(False, router.shouldPass('unlimited', segment))
+
+        # Not when the cheaper pool is likely to miss it
+        for i in range(20):
+            router.segmentMissing('unlimited', segment)
+        self.assertEquals(False, router.shouldPass('block', segment))
+
+    def testNoPassToUnavailablePool(self):
+        """ Test segments aren't passed to pools that can't take them on """
+        router = SegmentRouter()
+        self.addPool(router, 'block', cost = 10)
+        self.addPool(router, 'unlimited', cost = 0, loggedIn = False)
+        segment = DummySegment(self.nzbFile)
+
+        self.assertEquals(set(['block']), router.availablePools())
+        self.assertEquals(False, router.shouldPass('block', segment))
+        self.assertEquals(True, router.shouldPass('block', segment,
+                                                  set(['block', 'unlimited'])))
+
+    def testPassOnUnlikelyArticle(self):
+        """ Test a pool passes on articles it's unlikely to have to a pool of the same cost
+        far less likely to miss them """
+        router = SegmentRouter()
+        self.addPool(router, 'a')
+        self.addPool(router, 'b')
+        segment = DummySegment(self.nzbFile)
+        self.assertEquals(False, router.shouldPass('a', segment))
+
+        for i in range(20):
+            router.segmentMissing('a', segment)
+        self.assertEquals(True, router.shouldPass('a', segment))
+        self.assertEquals(False, router.shouldPass('b', segment))
+
+        # Retries are left to the RetryQueue
+        segment.failedServerPools.append('b')
+        self.assertEquals(False, router.shouldPass('a', segment))
+
+    def testGetSmartPassLimit(self):
+        """ Test getSmart passes on at most MAX_PASSES segments per call, nudging the other
+        pools once """
+        queue = NZBSegmentQueue()
+        block = DummyFactory('block', 10, [DummyClient(True)])
+        unlimited = DummyFactory('unlimited', 0, [DummyClient(True)])
+        for factory in (block, unlimited):
+            queue.serverAdd(factory)
+            Hellanzb.nsfs.append(factory)
+        queue.initRetryQueue()
+
+        nudged = []
+        queue.nudgeIdleNZBLeechers = nudged.append
+        segments = [DummySegment(self.nzbFile, i)
+                    for i in range(NZBSegmentQueue.MAX_PASSES * 2)]
+        for segment in segments:
+            queue.put((segment.priority, segment))
+
+        priority, segment = queue.getSmart(block)
+        self.assertEquals(segments[NZBSegmentQueue.MAX_PASSES], segment)
+        self.assertEquals(NZBSegmentQueue.MAX_PASSES, len(queue.rQueue))
+        self.assertEquals(1, len(nudged))
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
@@ -0,0 +1,196 @@
+"""
+StateXMLWriterTestCase - Tests the StateXMLWriter coalesces STATE_XML_FILE writes
+
+(c) Copyright 2006 Philip Jenvey
+[See end of file]
+"""
+import os, Hellanzb, Hellanzb.NZBQueue
+from Hellanzb.test import TempDirTestCase
+from Hellanzb.NZBQueue import StateXMLWriter
+
+__id__ = '$Id$'
+
+class FakeDelayedCall:
+    def __init__(self, delay, func):
+        self.delay = delay
+        self.func = func
+        self.called = self.cancelled = False
+
+    def active(self):
+        return not self.called and not self.cancelled
+
+    def reset(self, delay):
+        self.delay = delay
+
+    def cancel(self):
+        self.cancelled = True
+
+    def call(self):
+        self.called = True
+        self.func()
+
+class FakeReactor:
+    """ Collects the scheduled calls instead of running them """
+    def __init__(self):
+        self.calls = []
+        
+    def callLater(self, delay, func):
+        call = FakeDelayedCall(delay, func)
+        self.calls.append(call)
+        return call
+
+    def pending(self):
+        return [call for call in self.calls if call.active()]
+
+class FakeDeferred:
+    """ Holds the writing thread's work until finish() is called """
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.callbacks = []
+
+    def addBoth(self, callback):
+        self.callbacks.append(callback)
+
+    def finish(self):
+        result = self.func(*self.args)
+        for callback in self.callbacks:
+            callback(result)
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class StateXMLWriterTestCase(TempDirTestCase):
+    """ Tests the StateXMLWriter coalesces STATE_XML_FILE writes, with a fake reactor, writing
+    thread and clock """
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.reactor = FakeReactor()
+        self.time = FakeTime()
+        self.deferreds = []
+        self.states = 0
+
+        module = Hellanzb.NZBQueue
+        self.saved = (module.reactor, module.deferToThread, module.time,
+                      module._writeStateXML)
+        module.reactor = self.reactor
+        module.deferToThread = self.deferToThread
+        module.time = self.time
+        module._writeStateXML = self.writeStateXML
+
+        self.fileName = os.path.join(self.tempDir, 'state.xml')
+        self.writer = StateXMLWriter(self.fileName, delay = 1)
+
+    def tearDown(self):
+        module = Hellanzb.NZBQueue
+        module.reactor, module.deferToThread, module.time, module._writeStateXML = \
+            self.saved
+        TempDirTestCase.tearDown(self)
+
+    def deferToThread(self, func, *args):
+        d = FakeDeferred(func, args)
+        self.deferreds.append(d)
+        return d
+
+    def writeStateXML(self, outFile):
+        self.states += 1
+        outFile.write('state %i' % self.states)
+
+    def readState(self):
+        stateFile = open(self.fileName)
+        try:
+            return stateFile.read()
+        finally:
+            stateFile.close()
+
+    def runPending(self):
+        for call in self.reactor.pending():
+            call.call()
+        for d in self.deferreds:
+            d.finish()
+        self.deferreds = []
+
+    def testCoalesce(self):
+        """ Ensure a burst of changes is written once """
+        for i in range(100):
+            self.writer.changed()
+        self.assertEquals(1, len(self.reactor.pending()))
+        self.assertEquals(0, self.states)
+
+        self.runPending()
+        self.assertEquals(1, self.states)
+        self.assertEquals('state 1', self.readState())
+        self.assertEquals([], self.reactor.pending())
+
+    def testMaxDelay(self):
+        """ Ensure constant changes are written at least every MAX_DELAY seconds """
+        self.writer.changed()
+        for i in range(StateXMLWriter.MAX_DELAY):
+            self.time.now += 1
+            self.writer.changed()
+        self.assertEquals(0, self.reactor.pending()[0].delay)
+
+    def testChangedWhileWriting(self):
+        """ Ensure changes made while the state is being written are written afterwards """
+        self.writer.changed()
+        self.reactor.pending()[0].call()
+        self.writer.changed()
+        self.assertEquals([], self.reactor.pending())
+
+        self.runPending()
+        self.assertEquals(1, len(self.reactor.pending()))
+        self.runPending()
+        self.assertEquals(2, self.states)
+        self.assertEquals('state 2', self.readState())
+
+    def testNewerVersionWins(self):
+        """ Ensure an older state never replaces a newer one """
+        self.writer.changed()
+        self.reactor.pending()[0].call()
+
+        # Flushed (as when shutting down) before the writing thread got to its older state
+        self.writer.changed()
+        self.writer.flush()
+        self.assertEquals('state 2', self.readState())
+        self.assertEquals([], self.reactor.pending())
+
+        self.runPending()
+        self.assertEquals('state 2', self.readState())
+        self.writer.writeFile('state 1', 1)
+        self.assertEquals('state 2', self.readState())
+
+"""
+Copyright (c) 2006 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
@@ -0,0 +1,137 @@
+"""
+TokenBucketTestCase - Tests for the TokenBuckets of the HellaThrottler
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+from Hellanzb.test import TempDirTestCase
+from Hellanzb.NZBLeecher.NZBLeecherUtil import HellaThrottler, TokenBucket
+
+__id__ = '$Id$'
+
+class DummyNZB:
+    def __init__(self, maxRate):
+        self.maxRate = maxRate
+
+class TokenBucketTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.setConfig('downloadPaused', False)
+
+    def newBucket(self, rate):
+        """ Return a new TokenBucket of the specified rate, and the time it was filled at """
+        bucket = TokenBucket(rate)
+        bucket.lastTime = 0.0
+        return bucket, bucket.lastTime
+
+    def testBurst(self):
+        """ Test a full bucket allows a burst of reads without waiting """
+        bucket, now = self.newBucket(100 * 1024)
+        self.assertEquals(int(100 * 1024 * TokenBucket.BURST_SECONDS), bucket.burst)
+        for i in range(bucket.burst / 1024):
+            self.assertEquals(0, bucket.spend(1024, now))
+        self.assert_(bucket.spend(1, now) > 0)
+
+        # Slow rates still allow reads of MIN_BURST
+        bucket, now = self.newBucket(1024)
+        self.assertEquals(TokenBucket.MIN_BURST, bucket.burst)
+        self.assertEquals(0, bucket.spend(TokenBucket.MIN_BURST, now))
+
+    def testRefill(self):
+        """ Test tokens accumulate at the rate, up to the burst size """
+        bucket, now = self.newBucket(100 * 1024)
+        bucket.spend(bucket.burst, now)
+        self.assertEquals(0, bucket.tokens)
+
+        self.assertEquals(0, bucket.spend(12.5 * 1024, now + 0.125))
+        self.assertEquals(0, bucket.tokens)
+
+        bucket.spend(0, now + 60)
+        self.assertEquals(bucket.burst, bucket.tokens)
+
+    def testDebt(self):
+        """ Test reads going into debt wait for the debt to be repaid """
+        bucket, now = self.newBucket(100 * 1024)
+        wait = bucket.spend(bucket.burst + 50 * 1024, now)
+        self.assertEquals(0.5, wait)
+        self.assertEquals(-50 * 1024, bucket.tokens)
+
+        # Reads during the wait add to the debt
+        self.assertEquals(0.875, bucket.spend(50 * 1024, now + 0.125))
+
+        # Repaid after waiting
+        self.assertEquals(0, bucket.spend(0, now + 1))
+        self.assertEquals(0, bucket.tokens)
+
+    def testSetRate(self):
+        """ Test changing the rate refills the bucket to the new burst size """
+        bucket, now = self.newBucket(100 * 1024)
+        bucket.spend(bucket.burst * 2, now)
+        bucket.setRate(200 * 1024)
+        self.assertEquals(200 * 1024, bucket.rate)
+        self.assertEquals(int(200 * 1024 * TokenBucket.BURST_SECONDS), bucket.tokens)
+
+    def testNZBBuckets(self):
+        """ Test NZB TokenBuckets follow their maxRate, and are forgotten once the NZB is
+        done """
+        throttler = HellaThrottler()
+        unlimited = DummyNZB(0)
+        self.assertEquals(None, throttler.getNZBBucket(unlimited))
+        self.assertEquals({}, throttler.nzbBuckets)
+
+        nzb = DummyNZB(50 * 1024)
+        bucket = throttler.getNZBBucket(nzb)
+        self.assertEquals(50 * 1024, bucket.rate)
+        self.assert_(bucket is throttler.getNZBBucket(nzb))
+
+        nzb.maxRate = 20 * 1024
+        self.assert_(bucket is throttler.getNZBBucket(nzb))
+        self.assertEquals(20 * 1024, bucket.rate)
+
+        nzb.maxRate = 0
+        self.assertEquals(None, throttler.getNZBBucket(nzb))
+        self.assertEquals({}, throttler.nzbBuckets)
+
+        nzb.maxRate = 20 * 1024
+        throttler.getNZBBucket(nzb)
+        throttler.nzbDone(nzb)
+        throttler.nzbDone(unlimited)
+        self.assertEquals({}, throttler.nzbBuckets)
+
+        for nzb in (DummyNZB(1024), DummyNZB(2048)):
+            throttler.getNZBBucket(nzb)
+        self.assertEquals(2, len(throttler.nzbBuckets))
+        throttler.endDownload()
+        self.assertEquals({}, throttler.nzbBuckets)
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
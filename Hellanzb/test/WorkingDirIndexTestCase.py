@@ -0,0 +1,99 @@
+"""
+WorkingDirIndexTestCase - Tests for the WorkingDirIndex and SubjectMatcher
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import os, random
+from Hellanzb.test import TempDirTestCase
+from Hellanzb.NZBLeecher.WorkingDirIndex import SubjectMatcher, WorkingDirIndex
+
+__id__ = '$Id$'
+
+class WorkingDirIndexTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.dirName = os.path.join(self.tempDir, 'working')
+        os.mkdir(self.dirName)
+
+    def write(self, file, data = ''):
+        return self.writeFile(os.path.join('working', file), data)
+
+    def testMatcher(self):
+        """ Test the SubjectMatcher finds the same filenames as subject.find() """
+        random.seed(0)
+        for i in range(2000):
+            names = [''.join([random.choice('ab.r') for j in range(random.randint(1, 5))]) \
+                         for k in range(random.randint(0, 8))]
+            matcher = SubjectMatcher(names)
+            removed = [name for name in names if random.random() < 0.2]
+            for name in removed:
+                matcher.remove(name)
+
+            subject = ''.join([random.choice('ab.r') for j in range(random.randint(0, 20))])
+            expected = []
+            for name in names:
+                if name not in removed and name not in expected and subject.find(name) > -1:
+                    expected.append(name)
+            self.assertEqual(expected, matcher.matches(subject))
+
+        matcher = SubjectMatcher(['file.rar', 'file.r00'])
+        self.assertEqual('file.rar', matcher.match('post - "file.rar" yEnc (1/10)'))
+        self.assertEqual(None, matcher.match('post - "file.par2" yEnc (1/10)'))
+
+    def testIndex(self):
+        """ Test the WorkingDirIndex tracks changes to the directory """
+        self.write('file.rar', 'data')
+        self.write('file.r00')
+        os.mkdir(os.path.join(self.dirName, 'dir'))
+
+        index = WorkingDirIndex(self.dirName)
+        self.assertEqual(['file.r00', 'file.rar'], index.listing())
+        self.assert_(index.isValid('file.r00'))
+        self.assert_(not index.isValid('file.r00', overwriteZeroByteFiles = True))
+        self.assert_(index.isFile(os.path.join(self.dirName, 'file.rar')))
+
+        # Changes are seen once refreshed
+        segment = self.write('file.r01.segment0001', 'data')
+        os.remove(os.path.join(self.dirName, 'file.rar'))
+        self.assertEqual(['file.r00', 'file.rar'], index.listing())
+        index.refresh(segment, os.path.join(self.dirName, 'file.rar'),
+                      os.path.join(self.tempDir, 'elsewhere'))
+        self.assertEqual(['file.r00', 'file.r01.segment0001'], index.listing())
+
+        # Replacing the directory triggers a rescan
+        os.rename(self.dirName, self.dirName + '.old')
+        os.mkdir(self.dirName)
+        self.assertEqual([], index.listing())
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
@@ -0,0 +1,267 @@
+"""
+YDecodeTestCase - Tests for the pure python yDecoder and the YDecoder
+
+(c) Copyright 2005 Philip Jenvey
+[See end of file]
+"""
+import random, Hellanzb
+from zlib import crc32
+from Hellanzb.test import HellanzbTestCase
+from Hellanzb.NZBLeecher.ArticleDecoder import YDecoder, yDecodeString, yEndCRC
+
+__id__ = '$Id$'
+
+# Encoded values the yencode standard requires (or some yencoders choose) to be escaped
+CRITICAL = (0, 9, 10, 13, 27, 32, 46, 61)
+
+def yEncodeString(data, escapeAll = False):
+    """ yEncode the string of data (without line breaks), escaping the CRITICAL characters
+    (or every character) """
+    encoded = []
+    for char in data:
+        value = (ord(char) + 42) % 256
+        if escapeAll or value in CRITICAL:
+            encoded.append('=' + chr((value + 64) % 256))
+        else:
+            encoded.append(chr(value))
+    return ''.join(encoded)
+
+def syntheticArticle(size, seed = 0):
+    """ Return a tuple of random data of the specified size, and its yEncoded version """
+    rand = random.Random(seed)
+    data = ''.join([chr(rand.randrange(256)) for i in xrange(size)])
+    return data, yEncodeString(data)
+
+def yEncodeLines(data, lineLength = 128):
+    """ yEncode the string of data into a list of lines, as they'd be sent in an article's
+    BODY: only the characters the yencode standard requires are escaped (leaving dots
+    unescaped), and lines beginning with a dot are double-dotted """
+    lines = []
+    line = []
+    lineLen = 0
+    for char in data:
+        value = (ord(char) + 42) % 256
+        if value in (0, 10, 13, 61):
+            line.append('=' + chr((value + 64) % 256))
+            lineLen += 2
+        else:
+            line.append(chr(value))
+            lineLen += 1
+        if lineLen >= lineLength:
+            lines.append(''.join(line))
+            line = []
+            lineLen = 0
+    if len(line):
+        lines.append(''.join(line))
+
+    for i in range(len(lines)):
+        if lines[i][:1] == '.':
+            lines[i] = '.' + lines[i]
+    return lines
+
+def yEncodeArticle(data, part = None, total = 2, begin = 1, size = None):
+    """ Return a yEncoded article BODY (CRLF line endings, terminated with a dot line) of
+    the string of data, as a single part (or as the specified part of a multi-part) post """
+    crc = '%08x' % (crc32(data) & 2**32L - 1)
+    if part is None:
+        lines = ['=ybegin line=128 size=%d name=test.bin' % len(data)]
+        lines.extend(yEncodeLines(data))
+        lines.append('=yend size=%d crc32=%s' % (len(data), crc))
+    else:
+        lines = ['=ybegin part=%d total=%d line=128 size=%d name=test.bin' % \
+                     (part, total, size or len(data) * total),
+                 '=ypart begin=%d end=%d' % (begin, begin + len(data) - 1)]
+        lines.extend(yEncodeLines(data))
+        lines.append('=yend size=%d part=%d pcrc32=%s' % (len(data), part, crc))
+    lines.append('.')
+    return '\r\n'.join(lines) + '\r\n'
+
+def feedChunks(article, splits):
+    """ Feed the article to a new YDecoder, split into chunks at the specified offsets.
+    Returns the YDecoder and all the data it passed to its sink """
+    sunk = []
+    decoder = YDecoder(sunk.append)
+    last = 0
+    for split in list(splits) + [len(article)]:
+        decoder.feed(article[last:split])
+        last = split
+    return decoder, ''.join(sunk)
+
+def everyChunk(article, chunkSize):
+    """ Return the offsets splitting the article into chunks of the specified size """
+    return range(chunkSize, len(article), chunkSize)
+
+class YDecodeTestCase(HellanzbTestCase):
+
+    def testYDecodeString(self):
+        """ Test yDecodeString decodes data and its CRC """
+        data, encoded = syntheticArticle(64 * 1024)
+        decoded, crc, escape = yDecodeString(encoded)
+        self.assertEqual(data, decoded)
+        self.assertEqual(crc32(data), crc)
+        self.assertEqual(0, escape)
+
+    def testAnyEscape(self):
+        """ Test yDecodeString handles ANY character being escaped """
+        data = ''.join([chr(i) for i in range(256)])
+        self.assertEqual(data, yDecodeString(yEncodeString(data, escapeAll = True))[0])
+        # '==' is an escaped escape character
+        self.assertEqual(chr(211) + 'a', yDecodeString('==\x8b')[0])
+        self.assertEqual(chr(211) + chr(211), yDecodeString('====')[0])
+
+    def testChunks(self):
+        """ Test yDecodeString carries the CRC and escape state between chunks (split
+        between escape characters and their escaped characters) """
+        data, encoded = syntheticArticle(16 * 1024, 1)
+        for chunkSize in (1, 7, 1000):
+            decoded = []
+            crc, escape = 0, 0
+            for i in range(0, len(encoded), chunkSize):
+                chunk, crc, escape = yDecodeString(encoded[i:i + chunkSize], crc, escape)
+                decoded.append(chunk)
+            self.assertEqual(data, ''.join(decoded))
+            self.assertEqual(crc32(data), crc)
+
+    def assertDecoded(self, data, decoder, decoded):
+        """ Ensure the YDecoder yDecoded the data, and its CRC matches the =yend line's """
+        self.assertEqual(True, decoder.isYEncoded())
+        self.assertEqual(YDecoder.DONE, decoder.state)
+        self.assertEqual(data, decoded)
+        self.assertEqual(len(data), decoder.decodedBytes)
+        self.assertEqual(yEndCRC(decoder.yend), decoder.getCRC())
+
+    def testYDecoderChunks(self):
+        """ Test the YDecoder decodes articles fed in any chunk sizes (splitting the =ybegin,
+        =ypart and =yend lines, and their CRLFs) """
+        data = syntheticArticle(4 * 1024, 3)[0]
+        article = yEncodeArticle(data, part = 2, begin = 4097)
+        rand = random.Random(3)
+        splitsList = [everyChunk(article, chunkSize) for chunkSize in (1, 2, 3, 7, 128, 4096)]
+        splitsList.append(sorted(rand.sample(xrange(1, len(article)), 50)))
+        # Within the keywords and CRLFs of the header and trailer lines
+        ypart = article.index('=ypart')
+        yend = article.index('=yend')
+        splitsList.append([3, ypart - 1, ypart + 3, ypart + 20, yend + 2, yend + 10,
+                           len(article) - 4, len(article) - 1])
+
+        for splits in splitsList:
+            decoder, decoded = feedChunks(article, splits)
+            self.assertDecoded(data, decoder, decoded)
+            self.assertEqual('test.bin', decoder.ybegin['name'])
+            self.assertEqual({'begin': '4097', 'end': '8192'}, decoder.ypart)
+            self.assertEqual('2', decoder.yend['part'])
+
+    def testYDecoderDoubleDots(self):
+        """ Test the YDecoder un-double-dots lines """
+        # chr(4) yEncodes to a dot
+        data = (chr(4) + 'x' * 127) * 4 + syntheticArticle(1024, 4)[0]
+        article = yEncodeArticle(data)
+        self.assertEqual(4, article.count('\r\n..'))
+        for chunkSize in (1, 3, len(article)):
+            self.assertDecoded(data, *feedChunks(article, everyChunk(article, chunkSize)))
+
+    def testYDecoderCRC(self):
+        """ Test the YDecoder's running CRC catches corrupt data """
+        data = syntheticArticle(2048, 5)[0]
+        article = yEncodeArticle(data, part = 1)
+        decoder, decoded = feedChunks(article, everyChunk(article, 100))
+        self.assertEqual('%08X' % (crc32(data) & 2**32L - 1), decoder.getCRC())
+
+        # The same article with one byte of its data changed
+        corrupt = yEncodeArticle(data[:1000] + chr((ord(data[1000]) + 1) % 256) +
+                                 data[1001:], part = 1)
+        corrupt = corrupt[:corrupt.index('=yend')] + article[article.index('=yend'):]
+        decoder, decoded = feedChunks(corrupt, everyChunk(corrupt, 100))
+        self.assertEqual(YDecoder.DONE, decoder.state)
+        self.assertNotEqual(yEndCRC(decoder.yend), decoder.getCRC())
+
+    def testYDecoderSinglePart(self):
+        """ Test the YDecoder handles single part articles (no =ypart line, the =yend
+        line's crc32), and multi-part articles """
+        data = syntheticArticle(1000, 6)[0]
+        article = yEncodeArticle(data)
+        decoder, decoded = feedChunks(article, everyChunk(article, 10))
+        self.assertDecoded(data, decoder, decoded)
+        self.assertEqual(None, decoder.ypart)
+        self.assert_('part' not in decoder.ybegin)
+        self.assert_('crc32' in decoder.yend and 'pcrc32' not in decoder.yend)
+
+        article = yEncodeArticle(data, part = 3, total = 5, begin = 2001)
+        decoder, decoded = feedChunks(article, everyChunk(article, 10))
+        self.assertDecoded(data, decoder, decoded)
+        self.assertEqual('3', decoder.ybegin['part'])
+        self.assertEqual('5', decoder.ybegin['total'])
+        self.assertEqual('2001', decoder.ypart['begin'])
+        self.assert_('pcrc32' in decoder.yend)
+
+    def testYDecoderMIMEHeaders(self):
+        """ Test the YDecoder skips leading whitespace and MIME headers, and stops at the
+        end of the article without a =yend """
+        data = syntheticArticle(1000, 7)[0]
+        article = yEncodeArticle(data)
+        article = 'Content-Type: text/plain\r\n\r\n\r\n' + \
+            article[:article.index('=yend')] + '.\r\n'
+        decoder, decoded = feedChunks(article, everyChunk(article, 5))
+        self.assertEqual(True, decoder.isYEncoded())
+        self.assertEqual(YDecoder.DONE, decoder.state)
+        self.assertEqual(None, decoder.yend)
+        self.assertEqual(data, decoded)
+
+        # Data after the end of the article is ignored
+        decoder.feed('garbage\r\n')
+        self.assertEqual(len(data), decoder.decodedBytes)
+
+    def testYDecoderRaw(self):
+        """ Test the YDecoder passes articles that aren't yEncoded (or with an invalid
+        =ybegin line) to the sink untouched """
+        uuArticle = 'begin 644 test.bin\r\nM' + 'a' * 60 + '\r\n`\r\nend\r\n.\r\n'
+        badYBegin = '=ybegin line=128 size=100\r\n' + yEncodeString('x' * 100) + \
+            '\r\n=yend size=100\r\n.\r\n'
+        for article in ('\r\nSome text\r\n' + uuArticle, uuArticle, badYBegin):
+            for chunkSize in (1, 4, 30, len(article)):
+                decoder, sunk = feedChunks(article, everyChunk(article, chunkSize))
+                self.assertEqual(YDecoder.RAW, decoder.state)
+                self.assertEqual(False, decoder.isYEncoded())
+                self.assertEqual(article, sunk)
+
+    def testMatchesCYEnc(self):
+        """ Test yDecodeString agrees with _yenc's decoder (when available. See benchmark.py
+        for their timings) """
+        if not Hellanzb.HAVE_C_YENC:
+            return
+        import _yenc
+        data, encoded = syntheticArticle(64 * 1024, 2)
+        decoded, crc, escape = _yenc.decode_string(encoded)
+        self.assertEqual(yDecodeString(encoded)[0], decoded)
+        self.assertEqual(crc32(data) & 2**32L - 1, (crc ^ -1) & 2**32L - 1)
+
+"""
+Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+3. The name of the author or contributors may not be used to endorse or
+   promote products derived from this software without specific prior
+   written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+SUCH DAMAGE.
+
+$Id$
+"""
@@ -6,8 +6,8 @@ HellanzbTestCase - All hellanzb tests should derive from this class
 (c) Copyright 2005 Philip Jenvey
 [See end of file]
 """
-import unittest
-import Hellanzb.Core
+import os, shutil, tempfile, unittest
+import Hellanzb, Hellanzb.Core
 
 __id__ = '$Id$'
 
@@ -29,6 +29,42 @@ class HellanzbTestCase(unittest.TestCase):
         """ Take it down """
         #Hellanzb.Core.shutdown()
 
+# Marks Hellanzb config values that weren't set before a test
+UNSET = object()
+
+class TempDirTestCase(HellanzbTestCase):
+    """ Tests working with files in a temporary directory (self.tempDir), removed after each
+    test. Also restores the Hellanzb config values set via setConfig """
+
+    def setUp(self):
+        HellanzbTestCase.setUp(self)
+        self.tempDir = tempfile.mkdtemp()
+        self.savedConfig = []
+
+    def tearDown(self):
+        self.savedConfig.reverse()
+        for name, value in self.savedConfig:
+            if value is UNSET:
+                if hasattr(Hellanzb, name):
+                    delattr(Hellanzb, name)
+            else:
+                setattr(Hellanzb, name, value)
+        shutil.rmtree(self.tempDir)
+        HellanzbTestCase.tearDown(self)
+
+    def setConfig(self, name, value):
+        """ Set Hellanzb.<name> to the value for the duration of the test """
+        self.savedConfig.append((name, getattr(Hellanzb, name, UNSET)))
+        setattr(Hellanzb, name, value)
+
+    def writeFile(self, fileName, data = ''):
+        """ Write the data to the file (relative to the tempDir). Returns its full path """
+        fileName = os.path.join(self.tempDir, fileName)
+        f = open(fileName, 'wb')
+        f.write(data)
+        f.close()
+        return fileName
+
 """
 Copyright (c) 2005 Philip Jenvey <pjenvey@groovie.org>
 All rights reserved.
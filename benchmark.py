@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+
+benchmark - Run all or a specific microbenchmark
+
+"""
+import sys, time, Hellanzb
+from heapq import heapify
+from Hellanzb.Core import init
+from Hellanzb.Log import *
+from Hellanzb.Util import PriorityQueue
+from Hellanzb.test.DequeueTestCase import DummySegment, listDequeue
+
+def benchmarkDequeue():
+    """ Benchmark dequeueing a par file's worth of segments from a large queue """
+    count = 60000
+    dequeueCount = 500
+
+    items = [(i % 100, DummySegment(i)) for i in xrange(count)]
+    pq = PriorityQueue()
+    for item in items:
+        pq.put(item)
+    dequeue = items[count / 2:count / 2 + dequeueCount]
+    start = time.time()
+    pq.dequeueItems(dequeue)
+    indexedElapsed = time.time() - start
+
+    queue = items[:]
+    heapify(queue)
+    start = time.time()
+    listDequeue(queue, dequeue)
+    listElapsed = time.time() - start
+
+    info('Dequeued %i of %i items: indexed: %.4fs list: %.4fs' % \
+         (dequeueCount, count, indexedElapsed, listElapsed))
+
+def benchmarkPut():
+    """ Benchmark loading a large NZB's worth of segments via put() and putItems() """
+    count = 150000
+    items = [(i % 100, DummySegment(i)) for i in xrange(count)]
+
+    pq = PriorityQueue()
+    start = time.time()
+    for item in items:
+        pq.put(item)
+    putElapsed = time.time() - start
+
+    pq = PriorityQueue()
+    start = time.time()
+    pq.putItems(items)
+    putItemsElapsed = time.time() - start
+
+    info('Loaded %i items: put: %.4fs putItems: %.4fs' % (count, putElapsed,
+                                                        putItemsElapsed))
+
+def benchmarkYDecode():
+    """ Benchmark the pure python yDecoder against _yenc's (when available) """
+    # (Only importable once Hellanzb.Core is initialized)
+    from Hellanzb.NZBLeecher.ArticleDecoder import yDecodeString
+    from Hellanzb.test.YDecodeTestCase import syntheticArticle
+    data, encoded = syntheticArticle(384 * 1024, 2)
+    iterations = 20
+
+    decoders = [('python', yDecodeString)]
+    if Hellanzb.HAVE_C_YENC:
+        import _yenc
+        decoders.append(('_yenc', _yenc.decode_string))
+    else:
+        info('_yenc unavailable, only benchmarking the python yDecoder')
+
+    for name, decoder in decoders:
+        start = time.time()
+        for i in xrange(iterations):
+            decoder(encoded)
+        elapsed = time.time() - start
+        info('%s: %.2fMB/s' % (name, iterations * len(encoded) / 1024.0 / 1024 /
+                               max(elapsed, 0.001)))
+
+BENCHMARKS = [benchmarkDequeue, benchmarkPut, benchmarkYDecode]
+
+def run(benchmarkName = None):
+    for benchmark in BENCHMARKS:
+        name = benchmark.__name__[len('benchmark'):]
+        if not benchmarkName or name.startswith(benchmarkName):
+            info('Running benchmark: %s' % name)
+            benchmark()
+
+if __name__ == '__main__':
+    Hellanzb.Core.init()
+    try:
+        if len(sys.argv) > 1:
+            run(sys.argv[1])
+        else:
+            run()
+    finally:
+        Hellanzb.Core.shutdown()